@@ -0,0 +1,439 @@
+import collections
+
+import gap
+import commands
+
+# Advertising several payloads at once, e.g. an iBeacon, an Eddystone
+# frame and a connectable service advert, from one device.Device.
+#
+# A controller with extended advertising (BT 5.0) has several
+# advertising sets, each with its own parameters and data, all on air
+# together; we give each AdvertisingSet one of its own, so after setup
+# there's no HCI traffic except for data updates. A legacy controller
+# has one, so the AdvertisingSets take turns on it, each for its share
+# of every period. Where there are more AdvertisingSets than the
+# controller has sets, the last controller set is shared the same way.
+#
+# Switching turns sends only what differs from what the controller
+# already has. Advertising data may be changed while advertising; only
+# a change of parameters (interval, connectable or not) needs it
+# disabled and enabled again. So sets with the same parameters switch
+# with one or two commands rather than five.
+#
+# Legacy advertising PDUs are used throughout (on extended controllers
+# too, so that any scanner sees them), so data is at most 31 bytes.
+
+def _intervalUnits(seconds):
+    # 0.625ms units, Vol 2, 7.8.5
+    return max(0x0020, min(0x4000, int(round(seconds / 0.000625))))
+
+def _bytes(data):
+    # gap.AdvertisingData or bytes
+    return bytes(data.data) if isinstance(data, gap.AdvertisingData) else bytes(data)
+
+
+class AdvertisingSet:
+    # One payload to advertise. duty is its share of air time where it
+    # takes turns with others (None for an equal share of what's left);
+    # where it has a controller set to itself, its interval is stretched
+    # instead, to give the same number of advertising events.
+
+    def __init__(self, advData, scanData=None, connectable=False, interval=0.1, duty=None, name=None):
+        if duty is not None and not (0.0 < duty <= 1.0):
+            raise ValueError("duty must be over 0, and at most 1")
+        self.advData = _bytes(advData)
+        self.scanData = None if scanData is None else _bytes(scanData)
+        self.connectable = connectable
+        self.interval = interval # Seconds
+        self.duty = duty
+        self.name = name
+        self.updater = None
+        self.updateInterval = None
+        self.updateTimer = None
+        self.updates = 0
+
+    def withUpdates(self, updater, interval):
+        '''updater(advSet) is called every interval seconds, and returns
+           new advertising data, or None to leave it as it is'''
+        self.updater = updater
+        self.updateInterval = interval
+        return self
+
+    def scannable(self):
+        return self.connectable or self.scanData is not None
+
+    def legacyType(self):
+        # adv_type for LESetAdvertisingParameters, Vol 2, 7.8.5
+        if self.connectable:
+            return 0x00 # ADV_IND
+        return 0x02 if self.scanData is not None else 0x03 # ADV_SCAN_IND, ADV_NONCONN_IND
+
+    def extendedProperties(self):
+        p = commands.LESetExtendedAdvertisingParameters
+        if self.connectable:
+            return p.LEGACY_ADV_IND
+        return p.LEGACY_ADV_SCAN_IND if self.scanData is not None else p.LEGACY_ADV_NONCONN_IND
+
+    def __str__(self):
+        return self.name if self.name is not None else "AdvertisingSet(%d bytes)" % len(self.advData)
+
+
+class ControllerSet:
+    # One advertising set in the controller (on a legacy controller, the
+    # only one), and the AdvertisingSets which take turns on it. Keeps
+    # what the controller was last sent, so only changes go out.
+
+    def __init__(self, handle):
+        self.handle = handle # None on a legacy controller
+        self.sets = []
+        self.current = None # AdvertisingSet on air
+        self.timer = None
+        self.params = None
+        self.advData = None
+        self.scanData = None
+        self.enabled = False
+
+    def forget(self):
+        # Don't know what the controller has: send everything next time
+        self.params = self.advData = self.scanData = None
+        self.enabled = True
+
+
+class AdvertisingManager:
+    def __init__(self, device, period=1.0, useExtended=None):
+        self.device = device.withAdvertisingManager(self)
+        self.period = period # Seconds in which each shared set gets its turn
+        self.useExtended = useExtended # None to use it if the controller has it
+        self.sets = []
+        self.controllerSets = []
+        self.extended = False
+        self.stackReady = False
+        self.connected = 0
+        self.stats = collections.Counter()
+
+    def add(self, advSet):
+        self.sets.append(advSet)
+        self._restart()
+        return self
+
+    def remove(self, advSet):
+        self.sets.remove(advSet)
+        if advSet.updateTimer is not None:
+            advSet.updateTimer.cancel()
+            advSet.updateTimer = None
+        self._restart()
+        return self
+
+    def update(self, advSet, advData=None, scanData=None):
+        '''New data for advSet; sent now if it's on air, otherwise when
+           it next is'''
+        if advData is not None:
+            advSet.advData = _bytes(advData)
+        if scanData is not None:
+            advSet.scanData = _bytes(scanData)
+        for cs in self.controllerSets:
+            if cs.current is advSet:
+                self._send(self._show(cs, advSet))
+
+    def stop(self):
+        for advSet in self.sets:
+            if advSet.updateTimer is not None:
+                advSet.updateTimer.cancel()
+                advSet.updateTimer = None
+        for cs in self.controllerSets:
+            self._cancelTurn(cs)
+        self.controllerSets = []
+        if self.extended:
+            self._send([ commands.LESetExtendedAdvertisingEnable(commands.LESetExtendedAdvertisingEnable.DISABLE, []) ])
+        else:
+            self._send([ commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.DISABLE) ])
+
+    # From device.Device ---------------
+
+    def onStackReady(self):
+        self.stackReady = True
+        info = self.device.bringup.info
+        available = bool(info.features is not None and info.advertisingSets and
+                         (info.features & commands.LEReadLocalSupportedFeatures.EXTENDED_ADVERTISING))
+        self.extended = available if self.useExtended is None else (self.useExtended and available)
+        self._restart()
+
+    def onConnected(self, handle):
+        # The controller has stopped advertising the set connected to (on
+        # a legacy controller, everything). Only one connection at a time,
+        # so connectable sets stay off air until it's gone.
+        self.connected += 1
+        for cs in self.controllerSets:
+            if cs.current is not None and cs.current.connectable:
+                cs.enabled = False
+        self._resume()
+
+    def onDisconnected(self, handle):
+        self.connected = max(0, self.connected - 1)
+        self._resume()
+
+    # Setup ---------------
+
+    def _restart(self):
+        if not self.stackReady:
+            return
+        for cs in self.controllerSets:
+            self._cancelTurn(cs)
+        for advSet in self.sets:
+            if advSet.updater is not None and advSet.updateTimer is None:
+                advSet.updateTimer = self.device.hciSocket.callLater(advSet.updateInterval, self._onUpdate, advSet)
+        if self.extended:
+            n = min(self.device.bringup.info.advertisingSets, len(self.sets))
+            self.controllerSets = [ ControllerSet(handle) for handle in range(n) ]
+            for (i, advSet) in enumerate(self.sets):
+                self.controllerSets[min(i, n - 1)].sets.append(advSet)
+            # Whatever was there before (e.g. on a warm restart) goes
+            cmds = [ commands.LESetExtendedAdvertisingEnable(commands.LESetExtendedAdvertisingEnable.DISABLE, []) ]
+        else:
+            cs = ControllerSet(None)
+            cs.sets = list(self.sets)
+            self.controllerSets = [ cs ] if len(self.sets) > 0 else []
+            cmds = [ commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.DISABLE) ]
+        toEnable = []
+        for cs in self.controllerSets:
+            advSet = self._nextSet(cs)
+            if advSet is not None:
+                cmds += self._show(cs, advSet, enable=False)
+                toEnable.append(cs)
+                self._scheduleTurn(cs)
+        self._send(cmds + self._enable(toEnable))
+        print ("Advertising %d sets on %d %s controller sets" % (len(self.sets), len(self.controllerSets),
+            "extended" if self.extended else "legacy"))
+
+    def _resume(self):
+        # After the connectable sets have gone off or come back on
+        toEnable = []
+        cmds = []
+        for cs in self.controllerSets:
+            advSet = cs.current if (cs.current is not None and self._eligible(cs.current)) else self._nextSet(cs)
+            if advSet is None:
+                cmds += self._disable(cs)
+                continue
+            if cs.timer is None:
+                self._scheduleTurn(cs)
+            cmds += self._show(cs, advSet, enable=False)
+            if not cs.enabled:
+                toEnable.append(cs)
+        self._send(cmds + self._enable(toEnable))
+
+    def _send(self, cmds):
+        # Queued together: the controller executes them in order
+        for cmd in cmds:
+            self.stats['commands'] += 1
+            self.device.queueCommand(cmd.withCompletion(self._onCommandDone))
+
+    def _onCommandDone(self, cmd):
+        if cmd.error() is None:
+            return
+        # Disabling when not advertising may be refused; that's fine
+        if isinstance(cmd, commands.LESetAdvertiseEnable) and cmd.params[0] == commands.LESetAdvertiseEnable.DISABLE:
+            return
+        if isinstance(cmd, commands.LESetExtendedAdvertisingEnable) and \
+               cmd.params[0] == commands.LESetExtendedAdvertisingEnable.DISABLE:
+            return
+        print ("Advertising setup failed (opc=0x%04X): %s" % (cmd.opcode, cmd.error()))
+        self.stats['errors'] += 1
+        for cs in self.controllerSets:
+            cs.forget()
+
+    # Commands for one controller set ---------------
+
+    def _interval(self, cs, advSet):
+        if len(cs.sets) == 1 and advSet.duty is not None:
+            return advSet.interval / advSet.duty
+        return advSet.interval
+
+    def _show(self, cs, advSet, enable=True):
+        '''Commands to put advSet on air on cs, sending only what's changed.
+           Unless enable, leaves cs to be enabled by the caller.'''
+        units = _intervalUnits(self._interval(cs, advSet))
+        if cs.handle is None:
+            params = commands.LESetAdvertisingParameters(interval_min=units, interval_max=units,
+                                                         adv_type=advSet.legacyType())
+        else:
+            params = commands.LESetExtendedAdvertisingParameters(cs.handle, advSet.extendedProperties(),
+                                                                 interval_min=units, interval_max=units,
+                                                                 sid=cs.handle)
+        cmds = []
+        if params.params != cs.params:
+            # Parameters can't change while advertising
+            cmds += self._disable(cs)
+            cmds.append(params)
+            cs.params = params.params
+        if advSet.advData != cs.advData:
+            cmds.append(commands.LESetAdvertisingData(advSet.advData) if cs.handle is None else
+                        commands.LESetExtendedAdvertisingData(cs.handle, advSet.advData))
+            cs.advData = advSet.advData
+        scanData = advSet.scanData if advSet.scanData is not None else b''
+        if advSet.scannable() and scanData != cs.scanData:
+            cmds.append(commands.LESetScanResponseData(scanData) if cs.handle is None else
+                        commands.LESetExtendedScanResponseData(cs.handle, scanData))
+            cs.scanData = scanData
+        if cs.current is not advSet:
+            self.stats['switches'] += 1
+        cs.current = advSet
+        if enable:
+            cmds += self._enable([ cs ])
+        return cmds
+
+    def _enable(self, controllerSets):
+        # Several extended sets are enabled with one command
+        sets = [ cs for cs in controllerSets if not cs.enabled ]
+        if len(sets) == 0:
+            return []
+        for cs in sets:
+            cs.enabled = True
+        if self.extended:
+            return [ commands.LESetExtendedAdvertisingEnable(commands.LESetExtendedAdvertisingEnable.ENABLE,
+                                                             [ (cs.handle, 0, 0) for cs in sets ]) ]
+        return [ commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.ENABLE) ]
+
+    def _disable(self, cs):
+        if not cs.enabled:
+            return []
+        cs.enabled = False
+        if cs.handle is None:
+            return [ commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.DISABLE) ]
+        return [ commands.LESetExtendedAdvertisingEnable(commands.LESetExtendedAdvertisingEnable.DISABLE,
+                                                         [ (cs.handle, 0, 0) ]) ]
+
+    # Taking turns ---------------
+
+    def _eligible(self, advSet):
+        return not (advSet.connectable and self.connected > 0)
+
+    def _shares(self, cs):
+        # Maps each eligible set to its fraction of the period
+        sets = [ s for s in cs.sets if self._eligible(s) ]
+        fixed = sum(s.duty for s in sets if s.duty is not None)
+        others = [ s for s in sets if s.duty is None ]
+        each = max(0.0, 1.0 - fixed) / len(others) if len(others) > 0 else 0.0
+        shares = { s: (s.duty if s.duty is not None else each) for s in sets }
+        total = sum(shares.values())
+        return { s: share / total for (s, share) in shares.items() if share > 0 }
+
+    def _nextSet(self, cs):
+        # The next eligible set after the current one, in order
+        sets = cs.sets
+        start = sets.index(cs.current) + 1 if cs.current in sets else 0
+        for i in range(len(sets)):
+            advSet = sets[(start + i) % len(sets)]
+            if self._eligible(advSet):
+                return advSet
+        return None
+
+    def _scheduleTurn(self, cs):
+        self._cancelTurn(cs)
+        shares = self._shares(cs)
+        if len(shares) > 1 and cs.current in shares:
+            cs.timer = self.device.hciSocket.callLater(self.period * shares[cs.current], self._onTurnOver, cs)
+
+    def _cancelTurn(self, cs):
+        if cs.timer is not None:
+            cs.timer.cancel()
+            cs.timer = None
+
+    def _onTurnOver(self, cs):
+        cs.timer = None
+        advSet = self._nextSet(cs)
+        if advSet is None:
+            return self._send(self._disable(cs))
+        self._send(self._show(cs, advSet))
+        self._scheduleTurn(cs)
+
+    def _onUpdate(self, advSet):
+        advSet.updateTimer = self.device.hciSocket.callLater(advSet.updateInterval, self._onUpdate, advSet)
+        data = advSet.updater(advSet)
+        if data is not None:
+            advSet.updates += 1
+            self.stats['updates'] += 1
+            self.update(advSet, data)
+
+
+if __name__ == '__main__':
+    # An iBeacon, an Eddystone-TLM style frame updated every 200ms, and a
+    # connectable service advert, for 2s each: on a legacy controller,
+    # and on extended ones with enough sets, and with too few. Shows each
+    # payload's share of air time and advertising events, and the HCI
+    # commands it took after bring-up.
+    import io
+    import sys
+    import time
+    import struct
+    import device
+    import bringup
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualCentral
+
+    def beacon():
+        return gap.AdvertisingData().addItem(gap.GAP_FLAGS, b'\x04').addItem(gap.GAP_MANUFACTURER_DATA,
+            b'\x4C\x00\x02\x15' + bytes(range(16)) + struct.pack(">HHb", 1, 2, -59))
+
+    def tlm(count):
+        return gap.AdvertisingData().addItem(gap.GAP_FLAGS, b'\x04').addItem(
+            gap.GAP_UUID_16BIT_COMPLETE, b'\xAA\xFE').addItem(gap.GAP_SERVICE_DATA_16BIT,
+            b'\xAA\xFE\x20\x00' + struct.pack(">HhII", 3000, 0x1800, count, count * 10))
+
+    def service():
+        return gap.AdvertisingData().addItem(gap.GAP_FLAGS, b'\x06').addItem(
+            gap.GAP_UUID_128BIT_COMPLETE, bytes(range(0xF0, 0x100)))
+
+    def kind(data):
+        tags = gap.AdvertisingData(data).tags
+        if gap.GAP_MANUFACTURER_DATA in tags:
+            return "iBeacon"
+        return "Eddystone" if gap.GAP_SERVICE_DATA_16BIT in tags else "service"
+
+    def run(label, ctlr, connectAt=None, **duties):
+        dev = device.Device().withSocket( VirtualHCISocket(ctlr) ).withCache(bringup.ControllerCache())
+        mgr = AdvertisingManager(dev, period=0.3)
+        counter = [0]
+        def nextTlm(advSet):
+            counter[0] += 1
+            return tlm(counter[0])
+        mgr.add(AdvertisingSet(beacon(), interval=0.1, duty=duties.get("iBeacon"), name="iBeacon"))
+        mgr.add(AdvertisingSet(tlm(0), interval=0.1, duty=duties.get("Eddystone"), name="Eddystone")
+                .withUpdates(nextTlm, 0.2))
+        mgr.add(AdvertisingSet(service(), scanData=gap.AdvertisingData().addItem(gap.GAP_NAME_COMPLETE, b'Sensor'),
+                               connectable=True, interval=0.05, name="service"))
+        peer = VirtualCentral(ctlr)
+        def connect():
+            # When the connectable set next has its turn
+            if peer.connect() is None:
+                dev.hciSocket.callLater(0.02, connect)
+            else:
+                dev.hciSocket.callLater(0.5, peer.disconnect)
+        if connectAt is not None:
+            dev.hciSocket.callLater(connectAt, connect)
+        dev.hciSocket.callLater(2.0, dev.stop)
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            dev.start()
+            ctlr.accountAir()
+        finally:
+            sys.stdout = saved
+        assert mgr.stats['errors'] == 0
+        air = collections.Counter()
+        events = collections.Counter()
+        for (data, t) in ctlr.airTime.items():
+            air[kind(data)] += t
+        for (data, n) in ctlr.airEvents.items():
+            events[kind(data)] += n
+        total = sum(air.values()) if not mgr.extended else 2.0
+        print ("%-34s %3d commands, %3d switches, %2d updates: %s" % (label, mgr.stats['commands'],
+            mgr.stats['switches'], mgr.stats['updates'], ", ".join("%s %3.0f%% %3.0f/s" % (
+            k, air[k] * 100 / total, events[k] / 2.0) for k in ["iBeacon", "Eddystone", "service"])))
+        return mgr
+
+    EXT = commands.LEReadLocalSupportedFeatures.EXTENDED_ADVERTISING
+    run("legacy, equal shares", VirtualController())
+    run("legacy, iBeacon duty 0.5", VirtualController(), iBeacon=0.5)
+    run("legacy, connected for 0.5s", VirtualController(), connectAt=1.0)
+    run("extended, 4 sets", VirtualController(features=0x01 | EXT))
+    run("extended, 4 sets, iBeacon duty 0.5", VirtualController(features=0x01 | EXT), iBeacon=0.5)
+    run("extended, 2 sets", VirtualController(features=0x01 | EXT, advertisingSets=2))
@@ -0,0 +1,416 @@
+import gc
+import sys
+import json
+import time
+import struct
+import argparse
+import platform
+import tracemalloc
+import collections
+
+import uuid
+import gap
+import gatt
+import events
+import hcipacket
+
+# Micro-benchmarks for the protocol stack, layer by layer: UUIDs,
+# advertising data, HCI event decoding, ACL fragmentation and
+# reassembly, and each ATT command against GATT databases of 10, 100
+# and 1000 characteristics. Run as
+#
+#   python3 benchmark.py [--output results.json] [--baseline old.json]
+#
+# Each benchmark is a callable doing one operation. It's run in batches
+# of enough operations to take --min-time seconds (0.1 by default, long
+# enough that a scheduler hiccup is a small part of a batch), with the
+# garbage collector off, taking turns with the others; the fastest of
+# --repeat batches gives ops/sec. How much slower the slowest batch was
+# is shown, so a noisy run is easy to spot; noise only ever slows a
+# batch down, so "slowest +40%" doesn't mean the fastest could be 40%
+# out either way. Against a baseline (an earlier --output), any
+# benchmark more than --tolerance slower fails, and the exit status is
+# 1. Memory is measured outside the timed runs, with tracemalloc: the
+# peak bytes allocated during one operation, and blocks still allocated
+# after a batch, per operation, which should be 0 for anything that
+# doesn't keep state. The stack prints as it goes; that output goes
+# nowhere, but it's formatted, and counts.
+
+GATT_SIZES = [10, 100, 1000]
+
+class NullOutput:
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Benchmark:
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn # fn() does one operation
+
+    def batch(self, loops):
+        fn = self.fn
+        t0 = time.perf_counter()
+        for i in range(loops):
+            fn()
+        return time.perf_counter() - t0
+
+    def calibrate(self, minTime):
+        loops = 1
+        while True:
+            if self.batch(loops) >= minTime:
+                return loops
+            loops *= 2
+
+    def result(self, times, loops):
+        '''Returns a dict of results, from seconds per operation in times'''
+        best = min(times)
+        median = sorted(times)[len(times) // 2]
+        (peak, retained) = self.memory(min(max(loops, 20), 1000))
+        return collections.OrderedDict([
+            ('ops_per_sec', 1.0 / best),
+            ('best_ns', best * 1e9),
+            ('median_ns', median * 1e9),
+            ('slowest', (max(times) - best) / best),
+            ('loops', loops),
+            ('repeat', len(times)),
+            ('peak_bytes', peak),
+            ('retained_blocks', retained),
+        ])
+
+    def memory(self, loops):
+        # (peak bytes for one operation, blocks kept per operation)
+        self.fn() # Anything allocated once is allocated now
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            self.fn()
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+        gc.collect()
+        before = sys.getallocatedblocks()
+        self.batch(loops)
+        gc.collect()
+        retained = (sys.getallocatedblocks() - before) / float(loops)
+        return (peak, retained)
+
+
+# UUIDs and advertising data ---------------
+
+def uuidBenchmarks():
+    short = uuid.UUID(0x2A00)
+    same = uuid.UUID("00002a00-0000-1000-8000-00805f9b34fb")
+    other = uuid.UUID("fffffffffffffffffffffffffffffff0")
+    return [
+        Benchmark("uuid.from_int", lambda: uuid.UUID(0x2A00)),
+        Benchmark("uuid.from_hex", lambda: uuid.UUID("fffffffffffffffffffffffffffffff0")),
+        Benchmark("uuid.from_dashed", lambda: uuid.UUID("0000180a-0000-1000-8000-00805f9b34fb")),
+        Benchmark("uuid.eq", lambda: short == same),
+        Benchmark("uuid.ne", lambda: short == other),
+        Benchmark("uuid.hash", lambda: hash(short)),
+        Benchmark("uuid.str", lambda: str(other)),
+    ]
+
+ADV_DATA = ( gap.AdvertisingData()
+               .addItem(gap.GAP_FLAGS, b'\x06')
+               .addItem(gap.GAP_UUID_16BIT_COMPLETE, b'\x0D\x18\x0F\x18')
+               .addItem(gap.GAP_NAME_COMPLETE, b'Thermometer')
+               .addItem(gap.GAP_MANUFACTURER_DATA, b'\x59\x00\x01\x02\x03').data )
+
+def gapBenchmarks():
+    def build():
+        return ( gap.AdvertisingData()
+                   .addItem(gap.GAP_FLAGS, b'\x06')
+                   .addItem(gap.GAP_UUID_16BIT_COMPLETE, b'\x0D\x18\x0F\x18')
+                   .addItem(gap.GAP_NAME_COMPLETE, b'Thermometer') )
+    return [
+        Benchmark("gap.parse", lambda: gap.AdvertisingData(ADV_DATA)),
+        Benchmark("gap.build", build),
+    ]
+
+
+# HCI event decoding ---------------
+
+def hciEvent(code, params):
+    return struct.pack("<BB", code, len(params)) + params
+
+def advReport(n):
+    # n reports of ADV_DATA, Vol 2, 7.7.65.2
+    params = struct.pack("<BB", events.E_LE_ADVERTISING_REPORT, n)
+    for i in range(n):
+        params += struct.pack("<BB6sB", events.ADV_IND, 0x01, bytes([i, 1, 2, 3, 4, 0xC0]), len(ADV_DATA))
+        params += ADV_DATA + struct.pack("<b", -60)
+    return hciEvent(events.E_LE_META_EVENT, params)
+
+def eventBenchmarks():
+    handler = events.EventHandler()
+    dropping = events.EventHandler().withReportFilter(lambda addrType, addr, data: False)
+    one = advReport(1)
+    four = advReport(4)
+    cmdComplete = hciEvent(events.E_CMD_RESPONSE, struct.pack("<BHB", 1, 0x200C, 0x00))
+    cmdStatus = hciEvent(events.E_CMD_STATUS, struct.pack("<BBH", 0x00, 1, 0x200D))
+    completed = hciEvent(events.E_NUM_COMPLETED_PACKETS,
+                         struct.pack("<B", 4) + b''.join(struct.pack("<HH", 0x40 + i, 1) for i in range(4)))
+    connected = hciEvent(events.E_LE_META_EVENT,
+                         struct.pack("<BBHBB6sHHHB", events.E_LE_CONN_COMPLETE, 0x00, 0x0040, 0x00,
+                                     0x01, b'\x01\x02\x03\x04\x05\xC0', 24, 0, 400, 0))
+    disconnected = hciEvent(events.E_DISCONN_COMPLETE, struct.pack("<BHB", 0x00, 0x0040, 0x13))
+    return [
+        Benchmark("events.adv_report", lambda: handler.onEventReceived(one)),
+        Benchmark("events.adv_report_x4", lambda: handler.onEventReceived(four)),
+        Benchmark("events.adv_report_filtered", lambda: dropping.onEventReceived(four)),
+        Benchmark("events.command_complete", lambda: handler.onEventReceived(cmdComplete)),
+        Benchmark("events.command_status", lambda: handler.onEventReceived(cmdStatus)),
+        Benchmark("events.num_completed_x4", lambda: handler.onEventReceived(completed)),
+        Benchmark("events.conn_complete", lambda: handler.onEventReceived(connected)),
+        Benchmark("events.disconnect", lambda: handler.onEventReceived(disconnected)),
+    ]
+
+
+# ACL fragmentation and reassembly ---------------
+
+class CountingSocket:
+    # Stands in for an HCI socket; keeps only the last packet
+    def __init__(self):
+        self.count = 0
+        self.last = None
+
+    def queuePacket(self, pkt):
+        self.count += 1
+        self.last = pkt
+
+class CollectingSocket:
+    def __init__(self):
+        self.packets = []
+
+    def queuePacket(self, pkt):
+        self.packets.append(pkt)
+
+def aclFragments(pdu, txMtu):
+    # The ACL payloads ACLConnection.send makes of pdu
+    sock = CollectingSocket()
+    conn = hcipacket.ACLConnection(sock, 0x0040)
+    conn.txMtu = txMtu
+    conn.send(gatt.CID_GATT, pdu)
+    return [ p.payload for p in sock.packets ]
+
+def aclBenchmarks():
+    sender = hcipacket.ACLConnection(CountingSocket(), 0x0040)
+    fragmenter = hcipacket.ACLConnection(CountingSocket(), 0x0040)
+    fragmenter.txMtu = 27 + 4 # A 4.0 controller's LE buffers
+    small = bytes(20)
+    large = bytes(247)
+    received = []
+    receiver = hcipacket.ACLConnection(CountingSocket(), 0x0040).withChannel(
+        gatt.CID_GATT, lambda conn, cid, data: received.append(len(data)) or received.clear())
+    whole = aclFragments(small, 9999)
+    frags = aclFragments(large, 27 + 4)
+    assert len(whole) == 1 and len(frags) == 10
+
+    def reassemble():
+        for f in frags:
+            receiver.onReceivedData(f)
+    return [
+        Benchmark("acl.send_20", lambda: sender.send(gatt.CID_GATT, small)),
+        Benchmark("acl.send_247_fragmented", lambda: fragmenter.send(gatt.CID_GATT, large)),
+        Benchmark("acl.receive_20", lambda: receiver.onReceivedData(whole[0])),
+        Benchmark("acl.receive_247_reassembled", reassemble),
+    ]
+
+
+# GATT server ---------------
+
+class ResponseSink:
+    # Stands in for the ACLConnection a GattServer answers on
+    def __init__(self):
+        self.last = None
+
+    def send(self, cid, resp):
+        self.last = resp
+
+def makeServices(nChars):
+    # nChars characteristics, ten to a service. Each service's first
+    # characteristic is writable, its second notifies, with a CCCD;
+    # the last has a 128 bit UUID found nowhere else
+    services = []
+    for s in range(nChars // 10):
+        chars = []
+        for c in range(10):
+            if c == 0:
+                ch = ( gatt.CharacteristicBase()
+                         .withValueAttrib(gatt.DummyWriteAttribute(0xB000, bytes(20)))
+                         .withProperties(gatt.PROPS_READ | gatt.PROPS_WRITE | gatt.PROPS_WRITE_NOACK) )
+            elif c == 1:
+                ch = ( gatt.ReadOnlyCharacteristic(0xB001, bytes(20))
+                         .withProperties(gatt.PROPS_READ | gatt.PROPS_NOTIFY)
+                         .withDescriptor(gatt.DummyWriteAttribute(gatt.UUID_CHAR_CLIENT_CONFIG, b'\x00\x00')) )
+            else:
+                ch = gatt.ReadOnlyCharacteristic(0xB000 + c, bytes(20))
+            chars.append(ch)
+        if s == nChars // 10 - 1:
+            chars[-1] = gatt.ReadOnlyCharacteristic("fffffffffffffffffffffffffffffff9", bytes(20))
+        services.append(gatt.Service().withPrimaryUUID(0xA000 + s).withCharacteristics(*chars))
+    return services
+
+def gattBenchmarks(nChars):
+    # Requests aimed at the end of the database, where the searches
+    # through it take longest
+    server = gatt.GattServer().withServices(makeServices(nChars))
+    sink = ResponseSink()
+    last = server.services[-1]
+    (first, end) = last.getHandleRange()
+    writable = last.characteristics[0].value.handle
+    value = last.characteristics[-1].value.handle
+    requests = collections.OrderedDict([
+        ("exchange_mtu", struct.pack("<BH", 0x02, gatt.ATT_DEFAULT_MTU)),
+        ("find_information", struct.pack("<BHH", 0x04, end - 4, 0xFFFF)),
+        ("find_by_type_value", struct.pack("<BHHH", 0x06, 0x0001, 0xFFFF, 0x2800) + struct.pack("<H", 0xA000 + nChars // 10 - 1)),
+        ("read_by_type", struct.pack("<BHH", 0x08, first, 0xFFFF) + struct.pack("<H", 0x2803)),
+        ("read_by_type_scan", struct.pack("<BHH", 0x08, 0x0001, 0xFFFF) + gatt.getShortForm(last.characteristics[-1].value.typeUUID)),
+        ("read", struct.pack("<BH", 0x0A, value)),
+        ("read_blob", struct.pack("<BHH", 0x0C, value, 10)),
+        ("read_multiple", struct.pack("<BHHH", 0x0E, value, value - 2, value - 4)),
+        ("read_by_group_type", struct.pack("<BHHH", 0x10, first, 0xFFFF, 0x2800)),
+        ("write_request", struct.pack("<BH", 0x12, writable) + bytes(4)),
+        ("write_command", struct.pack("<BH", 0x52, writable) + bytes(4)),
+    ])
+    prepare = struct.pack("<BHH", 0x16, writable, 0) + bytes(18)
+    execute = struct.pack("<BB", 0x18, 0x01)
+
+    def request(pdu):
+        return lambda: server.onMessageReceived(sink, gatt.CID_GATT, pdu)
+
+    def prepareAndExecute():
+        server.onMessageReceived(sink, gatt.CID_GATT, prepare)
+        server.onMessageReceived(sink, gatt.CID_GATT, execute)
+
+    benchmarks = [ Benchmark("gatt.%s.%d" % (name, nChars), request(pdu))
+                   for (name, pdu) in requests.items() ]
+    benchmarks.append(Benchmark("gatt.prepare_execute_write.%d" % nChars, prepareAndExecute))
+
+    # Each must get a proper answer, not an error response
+    saved = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        for (name, pdu) in requests.items():
+            sink.last = None
+            server.onMessageReceived(sink, gatt.CID_GATT, pdu)
+            assert sink.last is None or sink.last[0] != 0x01, (name, nChars, sink.last)
+        prepareAndExecute()
+        assert sink.last == b'\x19'
+    finally:
+        sys.stdout = saved
+    return benchmarks
+
+
+def allBenchmarks():
+    benchmarks = uuidBenchmarks() + gapBenchmarks() + eventBenchmarks() + aclBenchmarks()
+    for n in GATT_SIZES:
+        benchmarks += gattBenchmarks(n)
+    return benchmarks
+
+
+# Running and comparing ---------------
+
+def runAll(benchmarks, repeat, minTime, report=None):
+    '''Returns results as a dict, ready for JSON'''
+    results = collections.OrderedDict()
+    saved = sys.stdout
+    sys.stdout = NullOutput()
+    enabled = gc.isenabled()
+    try:
+        gc.disable()
+        loops = [ b.calibrate(minTime) for b in benchmarks ]
+        # Round robin, so a spell of the machine running slowly hits one
+        # batch of each benchmark rather than all of one's
+        times = [ [] for b in benchmarks ]
+        for r in range(repeat):
+            for (i, b) in enumerate(benchmarks):
+                times[i].append(b.batch(loops[i]) / loops[i])
+        for (i, b) in enumerate(benchmarks):
+            results[b.name] = res = b.result(times[i], loops[i])
+            if report is not None:
+                report(b.name, res)
+    finally:
+        sys.stdout = saved
+        if enabled:
+            gc.enable()
+    return collections.OrderedDict([
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('machine', platform.machine()),
+        ('time', time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ('results', results),
+    ])
+
+def compare(baseline, current, tolerance):
+    '''Returns a list of (name, description) for regressions'''
+    regressions = []
+    old = baseline['results']
+    for (name, r) in current['results'].items():
+        if name not in old:
+            continue
+        b = old[name]
+        change = r['best_ns'] / b['best_ns'] - 1.0
+        if change > tolerance:
+            regressions.append( (name, "%.0f%% slower (%.2fus -> %.2fus)" % (
+                change * 100, b['best_ns'] / 1000.0, r['best_ns'] / 1000.0)) )
+        # Small differences in peak memory come and go with the
+        # interpreter; a leak doesn't
+        if r['peak_bytes'] > b['peak_bytes'] * (1.0 + tolerance) + 256:
+            regressions.append( (name, "peak memory %d -> %d bytes" % (b['peak_bytes'], r['peak_bytes'])) )
+        if r['retained_blocks'] > b['retained_blocks'] + 0.5:
+            regressions.append( (name, "keeps %.1f blocks per op, was %.1f" % (
+                r['retained_blocks'], b['retained_blocks'])) )
+    return regressions
+
+def printResult(name, r):
+    sys.__stdout__.write("%-36s %12.0f ops/s %9.2fus  slowest +%3.0f%% %8d B peak %6.2f blocks kept\n" % (
+        name, r['ops_per_sec'], r['best_ns'] / 1000.0, r['slowest'] * 100,
+        r['peak_bytes'], r['retained_blocks']))
+    sys.__stdout__.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Protocol stack micro-benchmarks")
+    parser.add_argument("--output", "-o", help="write results as JSON")
+    parser.add_argument("--baseline", "-b", help="compare with results from an earlier --output")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown counted as a regression (default 0.25)")
+    parser.add_argument("--repeat", type=int, default=7, help="timed batches per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per batch (default 0.1)")
+    parser.add_argument("--quick", action="store_true", help="fewer, shorter batches")
+    parser.add_argument("--filter", "-k", default="", help="only benchmarks whose name contains this")
+    parser.add_argument("--list", action="store_true", help="list benchmarks and exit")
+    args = parser.parse_args()
+    if args.quick:
+        (args.repeat, args.min_time) = (3, 0.005)
+
+    benchmarks = [ b for b in allBenchmarks() if args.filter in b.name ]
+    if args.list:
+        for b in benchmarks:
+            print (b.name)
+        sys.exit(0)
+
+    current = runAll(benchmarks, args.repeat, args.min_time, printResult)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(current, fp, indent=2)
+        print ("Results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(baseline, current, args.tolerance)
+        missing = [ name for name in current['results'] if name not in baseline['results'] ]
+        if missing:
+            print ("Not in baseline: %s" % ", ".join(missing))
+        for (name, what) in regressions:
+            print ("REGRESSION %s: %s" % (name, what))
+        if regressions:
+            sys.exit(1)
+        print ("No regressions against %s (tolerance %.0f%%)" % (args.baseline, args.tolerance * 100))
@@ -0,0 +1,453 @@
+import os
+import json
+import time
+import binascii
+
+import commands
+import events
+
+# Declarative controller bring-up, shared by device.Device and
+# central.Central. Each Step names the steps it must wait for; every
+# step whose dependencies are done is queued at once, so independent
+# commands are pipelined by the command engine as far as the
+# controller's command credits allow.
+#
+# Nothing but reset, the event mask and the address and version reads
+# goes out until the version is known, so a pre-4.0 controller never
+# sees an LE command.
+#
+# Controller capabilities (version, LE features, ACL buffers) are
+# cached by adapter address, so they're read only once. On a warm
+# restart (the controller was brought up by us before, and hasn't been
+# reset since) Reset is skipped, as are remembered settings whose
+# parameters haven't changed since they were last applied.
+
+ADDRESS_STEP = "readAddress"
+VERSION_STEP = "readVersion"
+# Steps which may go out before the version is known
+PRE_VERSION_STEPS = frozenset([ "reset", ADDRESS_STEP, "eventMask", VERSION_STEP ])
+
+class Step:
+    def __init__(self, name, factory, after=(), remember=False, coldOnly=False, warmOnly=False,
+                 onDone=None):
+        self.name = name
+        self.factory = factory   # factory(bringup) returns an HCICommand, or None to skip
+        self.after = list(after) # Names of steps which must finish first
+        self.remember = remember # Record params; skip on warm restart if unchanged
+        self.coldOnly = coldOnly # Skip on warm restart
+        self.warmOnly = warmOnly # Skip on cold start
+        self.onDone = onDone     # onDone(bringup, cmd) may return an error string
+
+
+class ControllerInfo:
+    FIELDS = [ 'version', 'revision', 'manuf', 'features', 'aclBufferLength', 'aclBufferCount',
+               'whiteListSize', 'advertisingSets', 'maxTxOctets', 'maxTxTime' ]
+
+    def __init__(self):
+        self.address = None
+        self.suggestedTxOctets = None # Controller state, so not cached
+        for f in self.FIELDS:
+            setattr(self, f, None)
+
+    def has(self, *fields):
+        return all(getattr(self, f) is not None for f in fields)
+
+    def toDict(self):
+        return { f: getattr(self, f) for f in self.FIELDS if getattr(self, f) is not None }
+
+    def update(self, d):
+        for f in self.FIELDS:
+            if f in d:
+                setattr(self, f, d[f])
+
+    def __str__(self):
+        return "addr=%s %s" % (
+            "?" if self.address is None else ":".join("%02X" % b for b in reversed(self.address)),
+            " ".join("%s=%r" % (f, getattr(self, f)) for f in self.FIELDS))
+
+
+class ControllerCache:
+    # Maps adapter address to what we know about it: capabilities, and
+    # the parameters of remembered steps last applied. Kept in memory,
+    # and in a JSON file if a path is given.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as fp:
+                self.entries = json.load(fp)
+
+    @staticmethod
+    def key(address):
+        return binascii.b2a_hex(address).decode('ascii')
+
+    def lookup(self, address):
+        return self.entries.get(self.key(address))
+
+    def store(self, address, info, applied, replace):
+        entry = self.entries.setdefault(self.key(address), { 'info': {}, 'applied': {} })
+        entry['info'].update(info.toDict())
+        if replace:
+            entry['applied'] = {}
+        entry['applied'].update(applied)
+        if self.path is not None:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(self.entries, fp, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+# Shared by all stacks in this process, unless they pass their own
+defaultCache = ControllerCache()
+
+
+# Step states
+RUNNING = 1
+DONE = 2
+
+class BringUp:
+    def __init__(self, stack, steps, cache=None, warm=False):
+        self.stack = stack
+        self.steps = steps
+        self.byName = { s.name: s for s in steps }
+        self.cache = cache if (cache is not None) else defaultCache
+        self.warm = warm
+        self.info = ControllerInfo()
+        self.applied = {}   # Maps step name to hex params, this time round
+        self.cached = {}    # Same, from the cache
+        self.state = {}     # Maps step name to RUNNING or DONE
+        self.completion = None
+        self.error = None
+        self.finished = False
+        self.sent = 0
+        self.skipped = 0
+        self.startTime = None
+        self.elapsed = None
+        for s in steps:
+            for d in s.after:
+                if d not in self.byName:
+                    raise ValueError("Step %s waits for unknown step %s" % (s.name, d))
+
+    def withCompletion(self, callback):
+        # callback(bringup); check bringup.error
+        self.completion = callback
+        return self
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self._advance()
+        return self
+
+    def _deps(self, step):
+        deps = step.after
+        if step.name not in PRE_VERSION_STEPS:
+            deps = deps + [VERSION_STEP]
+        if self.warm and (step.remember or step.warmOnly or step.name == VERSION_STEP) and \
+               step.name != ADDRESS_STEP:
+            # Can't compare against the cache (or, for the version, skip
+            # it as cached) until we know which controller this is
+            deps = deps + [ADDRESS_STEP]
+        return deps
+
+    def _command(self, step):
+        if (self.warm and step.coldOnly) or (step.warmOnly and not self.warm):
+            return None
+        cmd = step.factory(self)
+        if (cmd is not None) and self.warm and step.remember:
+            if self.cached.get(step.name) == self._hex(cmd.params):
+                return None
+        return cmd
+
+    def willChange(self, name):
+        '''True if remembered step name will send its command'''
+        return self._command(self.byName[name]) is not None
+
+    @staticmethod
+    def _hex(params):
+        return binascii.b2a_hex(params).decode('ascii')
+
+    def _advance(self):
+        progress = True
+        while progress and self.error is None:
+            progress = False
+            for step in self.steps:
+                if step.name in self.state:
+                    continue
+                if not all(self.state.get(d) == DONE for d in self._deps(step)):
+                    continue
+                cmd = self._command(step)
+                if cmd is None:
+                    self.state[step.name] = DONE
+                    self.skipped += 1
+                    progress = True # Others may have been waiting for it
+                    continue
+                self.state[step.name] = RUNNING
+                self.sent += 1
+                self.stack.queueCommand(cmd.withCompletion(
+                    lambda c, s=step: self._onStepDone(s, c)))
+        if self.error is None and len(self.state) == len(self.steps) and \
+               all(st == DONE for st in self.state.values()):
+            self._finish()
+
+    def _onStepDone(self, step, cmd):
+        if self.error is not None:
+            return
+        err = cmd.error()
+        if err is None and step.onDone is not None:
+            err = step.onDone(self, cmd)
+        if err is not None:
+            return self._fail("%s (opc=0x%04X): %s" % (step.name, cmd.opcode, err))
+        if step.remember:
+            self.applied[step.name] = self._hex(cmd.params)
+        self.state[step.name] = DONE
+        self._advance()
+
+    def onAddress(self, address):
+        self.info.address = address
+        entry = self.cache.lookup(address)
+        if entry is not None:
+            self.info.update(entry['info'])
+            self.cached = entry['applied']
+            self.onInfo()
+
+    def onInfo(self):
+        # Called as capabilities become known, from the controller or the
+        # cache; lets the stack use the buffer sizes as early as possible
+        if self.info.has('aclBufferLength', 'aclBufferCount'):
+            self.stack.setAclBuffers(self.info.aclBufferLength, self.info.aclBufferCount)
+
+    def _fail(self, err):
+        self.error = err
+        self._complete()
+
+    def _finish(self):
+        if self.finished:
+            return
+        if self.info.address is not None:
+            self.cache.store(self.info.address, self.info, self.applied, replace=not self.warm)
+        self._complete()
+
+    def _complete(self):
+        self.finished = True
+        self.elapsed = time.monotonic() - self.startTime
+        print ("Bring-up %s in %.3fs: %d commands, %d skipped" % (
+            "failed" if self.error else "done", self.elapsed, self.sent, self.skipped))
+        if self.completion:
+            self.completion(self)
+
+
+# Step factories, and steps common to all roles ---------------
+
+def _onAddress(b, cmd):
+    b.onAddress(cmd.address)
+
+def _readVersion(b):
+    return None if b.info.has('version') else commands.ReadLocalVersion()
+
+def _onVersion(b, cmd):
+    if cmd.version < commands.ReadLocalVersion.BLUETOOTH_V4_0:
+        return "Bluetooth 4.0 unsupported"
+    b.info.version = cmd.version
+    b.info.revision = cmd.revision
+    b.info.manuf = cmd.manuf
+
+def _readFeatures(b):
+    return None if b.info.has('features') else commands.LEReadLocalSupportedFeatures()
+
+def _onFeatures(b, cmd):
+    b.info.features = cmd.features
+
+def _readBufferSize(b):
+    return None if b.info.has('aclBufferLength') else commands.LEReadBufferSize()
+
+def _onBufferSize(b, cmd):
+    if cmd.packetlength == 0:
+        # Vol 2, 7.8.2: LE shares the BR/EDR buffers; leave ACL data
+        # without flow control
+        print ("Controller has no dedicated LE buffers")
+        return
+    b.info.aclBufferLength = cmd.packetlength
+    b.info.aclBufferCount = cmd.maxpackets
+    b.onInfo()
+
+def _readWhiteListSize(b):
+    return None if b.info.has('whiteListSize') else commands.LEReadWhiteListSize()
+
+def _onWhiteListSize(b, cmd):
+    b.info.whiteListSize = cmd.size
+
+def _readAdvertisingSets(b):
+    # Only asked of controllers with extended advertising
+    if b.info.has('advertisingSets') or \
+           not (b.info.features & commands.LEReadLocalSupportedFeatures.EXTENDED_ADVERTISING):
+        return None
+    return commands.LEReadNumberOfSupportedAdvertisingSets()
+
+def _onAdvertisingSets(b, cmd):
+    b.info.advertisingSets = cmd.num_sets
+
+def _dataLength(b):
+    return b.info.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION
+
+def _readMaxDataLength(b):
+    if b.info.has('maxTxOctets') or not _dataLength(b):
+        return None
+    return commands.LEReadMaximumDataLength()
+
+def _onMaxDataLength(b, cmd):
+    b.info.maxTxOctets = cmd.max_tx_octets
+    b.info.maxTxTime = cmd.max_tx_time
+
+def _readSuggestedDataLength(b):
+    return commands.LEReadSuggestedDefaultDataLength() if _dataLength(b) else None
+
+def _onSuggestedDataLength(b, cmd):
+    b.info.suggestedTxOctets = cmd.tx_octets
+
+def _writeSuggestedDataLength(b):
+    # So new links, including ones the peer sets up, start at the
+    # maximum; skipped if the controller is already there
+    if not _dataLength(b) or b.info.suggestedTxOctets == b.info.maxTxOctets:
+        return None
+    return commands.LEWriteSuggestedDefaultDataLength(b.info.maxTxOctets, b.info.maxTxTime)
+
+def _defaultPhy(b):
+    if not (b.info.features & commands.LEReadLocalSupportedFeatures.LE_2M_PHY):
+        return None
+    phys = commands.LESetDefaultPhy.PREFER_1M | commands.LESetDefaultPhy.PREFER_2M
+    return commands.LESetDefaultPhy(0, phys, phys)
+
+def commonSteps(leEventMask=events.DEFAULT_LE_EVENT_MASK):
+    '''Steps every role needs: reset, event masks, LE host support,
+       and reading the controller's capabilities'''
+    return [
+        Step("reset", lambda b: commands.Reset(), coldOnly=True),
+        Step(ADDRESS_STEP, lambda b: commands.ReadBDADDR(), after=["reset"], onDone=_onAddress),
+        Step("eventMask", lambda b: commands.SetEventMask(events.DEFAULT_EVENT_MASK),
+             after=["reset"], remember=True),
+        Step("leEventMask", lambda b: commands.LESetEventMask(leEventMask),
+             after=["reset"], remember=True),
+        Step("leHostSupported", lambda b: commands.WriteLEHostSupported(
+                commands.WriteLEHostSupported.LE_ENABLE, commands.WriteLEHostSupported.LE_SIMUL_DISABLE),
+             after=["reset"], remember=True),
+        Step(VERSION_STEP, _readVersion, after=["reset"], onDone=_onVersion),
+        Step("readFeatures", _readFeatures, after=[ADDRESS_STEP], onDone=_onFeatures),
+        Step("readBufferSize", _readBufferSize, after=[ADDRESS_STEP], onDone=_onBufferSize),
+        Step("readWhiteListSize", _readWhiteListSize, after=[ADDRESS_STEP], onDone=_onWhiteListSize),
+        Step("readAdvertisingSets", _readAdvertisingSets, after=["readFeatures"], onDone=_onAdvertisingSets),
+        Step("readMaxDataLength", _readMaxDataLength, after=["readFeatures"], onDone=_onMaxDataLength),
+        Step("readSuggestedDataLength", _readSuggestedDataLength, after=["readFeatures"],
+             onDone=_onSuggestedDataLength),
+        Step("writeSuggestedDataLength", _writeSuggestedDataLength,
+             after=["readMaxDataLength", "readSuggestedDataLength"]),
+        Step("defaultPhy", _defaultPhy, after=["readFeatures"], remember=True),
+    ]
+
+# Names of common steps which must be done before the controller can
+# usefully advertise, scan or connect
+CONFIG_STEPS = [ "eventMask", "leEventMask", "leHostSupported" ]
+
+
+class Stack:
+    # Mixin for device.Device and central.Central: bringing up their
+    # controller. Expects self.hciSocket, self.cache, self.warm,
+    # self.bringup and self.aclMtu; calls self.onStackReady() when done.
+
+    def withCache(self, cache, warm=False):
+        # With warm, assume the controller is still set up from last time
+        self.cache = cache
+        self.warm = warm
+        return self
+
+    def startBringUp(self, steps):
+        self.bringup = BringUp(self, steps, cache=self.cache, warm=self.warm)
+        self.bringup.withCompletion(self.onBringUpDone).start()
+
+    def setAclBuffers(self, length, count):
+        # Called during bring-up
+        self.aclMtu = length + 4 # ACLConnection.txMtu includes the ACL header
+        self.hciSocket.packetQueue.setAclBuffers(count)
+
+    def onBringUpDone(self, b):
+        if b.error:
+            print ("Bring-up failed: %s" % b.error)
+            self.stop()
+        else:
+            print ("All done: %s" % b.info)
+            self.onStackReady()
+
+    def onStackReady(self):
+        pass
+
+
+if __name__ == '__main__':
+    # Time to advertising for a Device on a virtual controller which
+    # takes 10ms to answer each command: with one command credit (so
+    # one at a time, as the old callback chain was), then pipelined cold
+    # start, then warm restart from the cache
+    import io
+    import sys
+    import device
+    import hcisocket_virtual
+    from hcisocket_virtual import VirtualController, VirtualHCISocket
+
+    class AdvertisingTimer:
+        # Tap noting when advertising was enabled
+        def __init__(self):
+            self.when = None
+            self.opcode = hcisocket_virtual.opcodeOf(commands.LESetAdvertiseEnable)
+        def onPacketSent(self, sock, data):
+            pass
+        def onPacketReceived(self, sock, data):
+            if data[1] == events.E_CMD_RESPONSE and (data[4] | (data[5] << 8)) == self.opcode:
+                self.when = time.monotonic()
+
+    def timeToAdvertising(ctlr, warm, cache):
+        tap = AdvertisingTimer()
+        dev = device.Device().withSocket( VirtualHCISocket(ctlr).withTap(tap) ).withCache(cache, warm)
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            t0 = time.monotonic()
+            dev.start()
+        finally:
+            sys.stdout = saved
+        assert ctlr.advertising and dev.bringup.error is None
+        return (tap.when - t0, dev.bringup)
+
+    latency = 0.010
+    print ("Per-command latency %.0fms" % (latency * 1000))
+    for (label, credits, warm) in [ ("serial (1 credit), cold", 1, False),
+                                    ("pipelined (4 credits), cold", 4, False),
+                                    ("pipelined (4 credits), warm", 4, True) ]:
+        cache = ControllerCache()
+        ctlr = VirtualController(numCmdPackets=credits, commandLatency=latency)
+        if warm:
+            timeToAdvertising(ctlr, False, cache)
+            ctlr.advertising = False
+        (t, b) = timeToAdvertising(ctlr, warm, cache)
+        print ("%-30s %6.1fms  %2d commands, %d skipped" % (label, t * 1000, b.sent, b.skipped))
+
+    # A 3.0 controller: bring-up fails at the version, before any LE
+    # command goes out
+    class CommandTap:
+        def __init__(self):
+            self.opcodes = []
+        def onPacketSent(self, sock, data):
+            if data[0] == 0x01: # Command packet
+                self.opcodes.append(data[1] | (data[2] << 8))
+        def onPacketReceived(self, sock, data):
+            pass
+    tap = CommandTap()
+    ctlr = VirtualController(version=commands.ReadLocalVersion.BLUETOOTH_V4_0 - 2)
+    dev = device.Device().withSocket( VirtualHCISocket(ctlr).withTap(tap) ).withCache(ControllerCache())
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        dev.start()
+    finally:
+        sys.stdout = saved
+    leCommands = [ opc for opc in tap.opcodes if (opc >> 10) == 0x08 ]
+    assert dev.bringup.error is not None and "4.0" in dev.bringup.error
+    assert not ctlr.advertising and len(leCommands) == 0, leCommands
+    print ("Bluetooth 3.0 controller: %s after %d commands, none LE" % (dev.bringup.error, len(tap.opcodes)))
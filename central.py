@@ -1,19 +1,623 @@
+import bisect
 import struct
 import binascii
+import collections
 
 import hcipacket
+import bringup
+import cmdengine
 import commands
 import events
+import gatt
+import gattcmds
 
-class Central(events.EventHandler):
+# GATT client --------------------------------------------
+
+ATT_NOTIFICATION = 0x1B
+ATT_INDICATION = 0x1D
+ATT_CONFIRMATION = 0x1E
+
+class RemoteService:
+    def __init__(self, uid, startHandle, endHandle):
+        self.uuid = uid
+        self.startHandle = startHandle
+        self.endHandle = endHandle
+        self.characteristics = []
+
+    def __str__(self):
+        return "Service %s 0x%04X-0x%04X" % (self.uuid.getCommonName(), self.startHandle, self.endHandle)
+
+class RemoteCharacteristic:
+    def __init__(self, declHandle, properties, valueHandle, uid):
+        self.declHandle = declHandle
+        self.properties = properties
+        self.valueHandle = valueHandle
+        self.uuid = uid
+        self.endHandle = valueHandle
+        self.descriptors = [] # List of (handle, UUID)
+
+    def __str__(self):
+        return "Char %s value=0x%04X props=0x%02X descs=%s" % (self.uuid.getCommonName(),
+            self.valueHandle, self.properties,
+            ",".join("0x%04X:%s" % (h, u.getCommonName()) for (h, u) in self.descriptors))
+
+
+class GattClient:
+    # ATT client for one connection. Only one request may be outstanding
+    # (Vol 3 / F / 3.3.2), so requests queue here; the next goes out as
+    # soon as the previous one's response has been handled.
+
+    ATT_TIMEOUT = 30.0 # Vol 3 / F / 3.3.3
+
+    def __init__(self, conn, mtu=gatt.ATT_DEFAULT_MTU):
+        self.conn = conn
+        self.mtu = gatt.ATT_DEFAULT_MTU
+        self.preferredMtu = mtu
+        self.pending = collections.deque()
+        self.current = None
+        self.timer = None
+        self.failed = False
+        self.requests = 0
+        self.notifyCallback = None
+        self.sinks = {} # Maps value handle to notifyring.RingSink
+        self.activityCallback = None
+        self.services = []
+        self.servicesStale = False # Peer's database changed; services not yet found again
+        self.valueLengths = {} # Maps handle to length last read, for Read Multiple
+
+    def withNotifyCallback(self, callback):
+        # callback(client, handle, value, isIndication)
+        self.notifyCallback = callback
+        return self
+
+    def withActivityCallback(self, callback):
+        # callback(client) as each request goes out
+        self.activityCallback = callback
+        return self
+
+    def withNotifySink(self, handle, sink):
+        # Notifications and indications from handle go into sink (e.g. a
+        # notifyring.RingSink) instead of to the callback; None removes it
+        if sink is None:
+            self.sinks.pop(handle, None)
+        else:
+            self.sinks[handle] = sink
+        return self
+
+    def takeNotification(self, payload):
+        '''Fast path for a whole notification in one ACL packet, for a
+           handle with a sink: payload is the ACL header onwards. Returns
+           False, having done nothing, if it's anything else.'''
+        if len(payload) < 11 or payload[8] != ATT_NOTIFICATION:
+            return False
+        # ACL header, L2CAP header, then the ATT opcode and handle
+        (hndFlags, aclLen, l2Len, cid) = struct.unpack_from("<HHHH", payload)
+        if cid != gatt.CID_GATT or (hndFlags & hcipacket.FRAG_FLAGS) == hcipacket.FRAG_NEXT or \
+               aclLen != len(payload) - 4 or l2Len != aclLen - 4:
+            return False
+        sink = self.sinks.get(payload[9] | (payload[10] << 8))
+        if sink is None:
+            return False
+        sink.append(payload, 11)
+        return True
+
+    def exchangeMtu(self, completion):
+        '''Asks for preferredMtu (Vol 3 / F / 3.4.2) if it's more than we
+           have; completion(cmd) once answered, with self.mtu updated.
+           Returns False, having sent nothing, if there's no need.'''
+        if self.preferredMtu <= self.mtu:
+            return False
+        def onMtu(cmd):
+            if cmd.error() is None:
+                self.mtu = max(gatt.ATT_DEFAULT_MTU, min(self.preferredMtu, cmd.mtu))
+            completion(cmd)
+        self.sendRequest(gattcmds.ExchangeMTU(self.preferredMtu).withCompletion(onMtu))
+        return True
+
+    def sendRequest(self, cmd):
+        if cmd.responseOpcode is None:
+            # Commands have no response, so may go at any time
+            self.conn.send(gatt.CID_GATT, cmd.data)
+            return
+        if self.failed:
+            cmd.onTimeout()
+            return
+        self.pending.append(cmd)
+        self._sendNext()
+
+    def _sendNext(self):
+        if self.current is not None or len(self.pending) == 0:
+            return
+        self.current = self.pending.popleft()
+        self.requests += 1
+        self.timer = self.conn.sock.callLater(self.ATT_TIMEOUT, self._onTimeout)
+        self.conn.send(gatt.CID_GATT, self.current.data)
+        if self.activityCallback is not None:
+            self.activityCallback(self)
+
+    def _onTimeout(self):
+        # No more ATT on this bearer after a timeout (Vol 3 / F / 3.3.3)
+        print ("ATT request 0x%02X timed out" % self.current.opcode)
+        self.failed = True
+        self.onDisconnect()
+
+    def onDisconnect(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        waiting = ([ self.current ] if self.current else []) + list(self.pending)
+        self.current = None
+        self.pending.clear()
+        self.failed = True
+        for cmd in waiting:
+            cmd.onTimeout()
+
+    def onMessageReceived(self, aclconn, cid, data):
+        # Use as channel callback for hcipacket.ACLConnection
+        opcode = data[0]
+        if opcode in (ATT_NOTIFICATION, ATT_INDICATION):
+            (handle,) = struct.unpack("<H", data[1:3])
+            if opcode == ATT_INDICATION:
+                self.conn.send(gatt.CID_GATT, bytes([ATT_CONFIRMATION]))
+            sink = self.sinks.get(handle)
+            if sink is not None:
+                sink.append(data, 3)
+            elif self.notifyCallback:
+                self.notifyCallback(self, handle, data[3:], opcode == ATT_INDICATION)
+            return
+        cmd = self.current
+        if cmd is None or not (opcode == cmd.responseOpcode or
+                (opcode == gattcmds.ATT_ERROR_RSP and len(data) > 1 and data[1] == cmd.opcode)):
+            print ("Unexpected ATT PDU opcode 0x%02X" % opcode)
+            return
+        self.current = None
+        self.timer.cancel()
+        self.timer = None
+        # Its completion may queue the next request, which then goes
+        # out straight away
+        cmd.onResponse(data)
+        self._sendNext()
+
+    def discover(self, completion):
+        '''Finds all primary services, characteristics and descriptors,
+           into self.services; then calls completion(discovery)'''
+        return Discovery(self, completion).start()
+
+    def readMany(self, handles, completion):
+        '''Reads the values of handles, in as few requests as it can;
+           then calls completion(bulkread)'''
+        return BulkRead(self, handles, completion).start()
+
+    def writeLong(self, handle, value, completion):
+        '''Writes a value of any length; then calls completion(longwrite)'''
+        return LongWrite(self, [ (handle, value) ], completion).start()
+
+    def writeReliable(self, items, completion, reliable=True):
+        '''Writes (handle, value) pairs all together, or (if any part
+           fails) not at all; then calls completion(longwrite)'''
+        return LongWrite(self, items, completion, reliable).start()
+
+
+class Discovery:
+    # Each phase asks for the largest possible range (the whole handle
+    # space left), and moves on from the last handle in each response.
+    # Characteristics are found for all services in one sweep, and
+    # descriptors by one sweep over just the handles which can hold them.
+
+    def __init__(self, client, completion):
+        self.client = client
+        self.completion = completion
+        self.services = []
+        self.characteristics = []
+        self.ranges = [] # (first, last) handles which may be descriptors
+        self.rangeIndex = 0
+        self.error = None
+
+    def start(self):
+        if not self.client.exchangeMtu(self._onMtu):
+            self._findServices(0x0001)
+        return self
+
+    def _fail(self, cmd):
+        self.error = cmd.error()
+        print ("Discovery failed: %s" % self.error)
+        self.completion(self)
+
+    def _onMtu(self, cmd):
+        if cmd.status == gattcmds.E_CLIENT_TIMEOUT:
+            return self._fail(cmd)
+        self._findServices(0x0001)
+
+    # Primary services, Vol 3 / G / 4.4.1
+    def _findServices(self, start):
+        self.client.sendRequest(gattcmds.ReadByGroupType(start, 0xFFFF, gatt.UUID_PRIMARY_SERVICE)
+                                  .withCompletion(self._onServices))
+
+    def _onServices(self, cmd):
+        if cmd.status == gatt.E_ATTR_NOT_FOUND:
+            return self._findCharacteristics(0x0001)
+        if cmd.error():
+            return self._fail(cmd)
+        for (first, last, value) in cmd.records:
+            self.services.append(RemoteService(gatt.uuidFromShortForm(value), first, last))
+        last = cmd.records[-1][1]
+        if last >= 0xFFFF or last < cmd.records[-1][0]:
+            return self._findCharacteristics(0x0001)
+        self._findServices(last + 1)
+
+    # Characteristics, Vol 3 / G / 4.6.1
+    def _findCharacteristics(self, start):
+        if len(self.services) == 0:
+            return self._done()
+        self.serviceStarts = [ s.startHandle for s in self.services ]
+        end = self.services[-1].endHandle
+        if start > end:
+            return self._findDescriptors()
+        self.client.sendRequest(gattcmds.ReadByType(max(start, self.services[0].startHandle), end,
+                                                    gatt.UUID_CHARACTERISTIC_DECL)
+                                  .withCompletion(self._onCharacteristics))
+
+    def _onCharacteristics(self, cmd):
+        if cmd.status == gatt.E_ATTR_NOT_FOUND:
+            return self._findDescriptors()
+        if cmd.error():
+            return self._fail(cmd)
+        for (handle, value) in cmd.records:
+            (props, valueHandle) = struct.unpack("<BH", value[0:3])
+            ch = RemoteCharacteristic(handle, props, valueHandle, gatt.uuidFromShortForm(value[3:]))
+            svc = self.services[bisect.bisect_right(self.serviceStarts, handle) - 1]
+            if svc.startHandle <= handle <= svc.endHandle:
+                svc.characteristics.append(ch)
+                self.characteristics.append(ch)
+        self._findCharacteristics(cmd.records[-1][0] + 1)
+
+    # Descriptors, Vol 3 / G / 4.7.1
+    def _findDescriptors(self):
+        for svc in self.services:
+            chars = svc.characteristics
+            for (i, ch) in enumerate(chars):
+                ch.endHandle = chars[i+1].declHandle - 1 if (i+1 < len(chars)) else svc.endHandle
+                if ch.endHandle > ch.valueHandle:
+                    self.ranges.append( (ch.valueHandle + 1, ch.endHandle, ch) )
+        self.rangeStarts = [ r[0] for r in self.ranges ]
+        self.wideHandles = [ ch.valueHandle for ch in self.characteristics
+                               if len(gatt.getShortForm(ch.uuid)) == 16 ]
+        self._nextDescriptors(0x0001)
+
+    def _nextDescriptors(self, start):
+        # Skip ranges we've got past; start from the next that's left
+        while self.rangeIndex < len(self.ranges) and self.ranges[self.rangeIndex][1] < start:
+            self.rangeIndex += 1
+        if self.rangeIndex >= len(self.ranges):
+            return self._done()
+        start = max(start, self.ranges[self.rangeIndex][0])
+        # A response stops where UUID size changes (Vol 3 / F / 3.4.3.2),
+        # so don't ask past a value handle we know has a 128-bit type
+        i = bisect.bisect_right(self.wideHandles, start)
+        limit = self.wideHandles[i] if (i < len(self.wideHandles)) else 0x10000
+        end = self.ranges[self.rangeIndex][1]
+        for r in self.ranges[self.rangeIndex+1:]:
+            if r[1] >= limit:
+                break
+            end = r[1]
+        self.client.sendRequest(gattcmds.FindInformation(start, end)
+                                  .withCompletion(self._onDescriptors))
+
+    def _onDescriptors(self, cmd):
+        if cmd.status == gatt.E_ATTR_NOT_FOUND:
+            (first, last) = struct.unpack("<HH", cmd.data[1:5])
+            return self._nextDescriptors(last + 1)
+        if cmd.error():
+            return self._fail(cmd)
+        for (handle, uid) in cmd.records:
+            i = bisect.bisect_right(self.rangeStarts, handle) - 1
+            if i >= 0 and handle <= self.ranges[i][1]:
+                self.ranges[i][2].descriptors.append( (handle, uid) )
+        self._nextDescriptors(cmd.records[-1][0] + 1)
+
+    def _done(self):
+        self.client.services = self.services
+        self.completion(self)
+
+
+class BulkRead:
+    # Reads many attribute values in as few requests as possible:
+    #  - Values whose length we know (from reading them before) are
+    #    batched into Read Multiple requests (Vol 3 / F / 3.4.4.7),
+    #    as many as fit in a response.
+    #  - Others sharing an attribute type with more of the set are read
+    #    with Read By Type over their handle range; it gives each
+    #    handle with its value, so lengths needn't be known.
+    #  - The rest are read one by one.
+    # Any value which fills its response may be longer, so continues with
+    # Read Blob. Read Multiple responses give no lengths, so if the total
+    # isn't what we expect, some length has changed; we split the batch
+    # until we find which, and read that one on its own.
+    #
+    # When done, .values maps handle to value, .errors handle to ATT
+    # error code, and .saved is how many round trips fewer than one Read
+    # (and any Read Blobs) per handle it took.
+
+    def __init__(self, client, handles, completion):
+        self.client = client
+        self.handles = sorted(set(handles))
+        self.completion = completion
+        self.values = {}
+        self.errors = {}
+        self.requests = 0
+        self.outstanding = 1 # Until start() has sent everything
+        self.saved = None
+        self.error = None
+
+    def start(self):
+        mtu = self.client.mtu
+        lengths = self.client.valueLengths
+        known = [ h for h in self.handles if lengths.get(h, mtu) < mtu - 1 ]
+        unknown = [ h for h in self.handles if lengths.get(h, mtu) >= mtu - 1 ]
+        self._planReadMultiple(known)
+        byType = collections.defaultdict(list)
+        types = self._attributeTypes()
+        for h in unknown:
+            byType[types.get(h)].append(h)
+        for (uid, hs) in sorted(byType.items(), key=lambda item: item[1][0]):
+            if uid is not None and len(hs) > 1:
+                self._readByType(uid, hs[0], hs[-1], set(hs))
+            else:
+                for h in hs:
+                    self._read(h)
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self._done()
+        return self
+
+    def _attributeTypes(self):
+        # Maps handle to UUID, for what discovery found
+        types = {}
+        for svc in self.client.services:
+            for ch in svc.characteristics:
+                types[ch.valueHandle] = ch.uuid
+                for (hnd, uid) in ch.descriptors:
+                    types[hnd] = uid
+        return types
+
+    def _send(self, cmd, completion):
+        self.outstanding += 1
+        self.requests += 1
+        self.client.sendRequest(cmd.withCompletion(lambda c: self._onResponse(c, completion)))
+
+    def _onResponse(self, cmd, completion):
+        self.outstanding -= 1
+        if cmd.status == gattcmds.E_CLIENT_TIMEOUT:
+            self.error = cmd.error()
+        else:
+            completion(cmd)
+        if self.outstanding == 0:
+            self._done()
+
+    def _setValue(self, handle, value):
+        self.values[handle] = value
+        if len(value) < self.client.mtu - 1:
+            self.client.valueLengths[handle] = len(value)
+
+    # Read Multiple, for values of known length
+    def _planReadMultiple(self, handles):
+        lengths = self.client.valueLengths
+        batch = []
+        total = 0
+        for h in handles:
+            if total + lengths[h] > self.client.mtu - 1:
+                self._readMultiple(batch)
+                batch = []
+                total = 0
+            batch.append(h)
+            total += lengths[h]
+        self._readMultiple(batch)
+
+    def _readMultiple(self, handles):
+        if len(handles) == 1:
+            self._read(handles[0]) # Read Multiple needs at least two
+        elif len(handles) > 1:
+            self._send(gattcmds.ReadMultiple(handles), lambda cmd: self._onReadMultiple(cmd, handles))
+
+    def _onReadMultiple(self, cmd, handles):
+        lengths = [ self.client.valueLengths[h] for h in handles ]
+        if cmd.error() is not None or len(cmd.value) != sum(lengths):
+            # Don't know which handle failed, or which changed length;
+            # halve the batch until we find it
+            if len(handles) > 2:
+                half = len(handles) // 2
+                self._readMultiple(handles[:half])
+                self._readMultiple(handles[half:])
+            else:
+                for h in handles:
+                    self.client.valueLengths.pop(h, None)
+                    self._read(h)
+            return
+        pos = 0
+        for (h, n) in zip(handles, lengths):
+            self._setValue(h, cmd.value[pos:pos+n])
+            pos += n
+
+    # Read By Type, for several values of the same type
+    def _readByType(self, uid, start, end, wanted):
+        self._send(gattcmds.ReadByType(start, end, uid),
+                   lambda cmd: self._onReadByType(cmd, uid, end, wanted))
+
+    def _onReadByType(self, cmd, uid, end, wanted):
+        if cmd.error() is not None or len(cmd.records) == 0:
+            for h in sorted(wanted):
+                self._read(h)
+            return
+        maxValue = min(self.client.mtu - 4, 253) # Vol 3 / F / 3.4.4.2
+        for (h, value) in cmd.records:
+            if h not in wanted:
+                continue
+            wanted.discard(h)
+            if len(value) == maxValue:
+                self._readBlob(h, value)
+            else:
+                self._setValue(h, value)
+        last = cmd.records[-1][0]
+        # Any we asked for below the last one returned aren't of this type
+        for h in sorted(x for x in wanted if x < last):
+            wanted.discard(h)
+            self._read(h)
+        if len(wanted) > 0:
+            self._readByType(uid, last + 1, end, wanted)
+
+    # Read, and Read Blob for long values
+    def _read(self, handle):
+        self._send(gattcmds.Read(handle), lambda cmd: self._onRead(cmd, handle, b''))
+
+    def _readBlob(self, handle, sofar):
+        self._send(gattcmds.ReadBlob(handle, len(sofar)), lambda cmd: self._onRead(cmd, handle, sofar))
+
+    def _onRead(self, cmd, handle, sofar):
+        if cmd.error() is not None:
+            if len(sofar) > 0 and cmd.status in (gatt.E_ATTR_NOT_LONG, gatt.E_INVALID_OFFSET):
+                return self._setValue(handle, sofar) # It was exactly that long
+            self.errors[handle] = cmd.status
+            return
+        value = sofar + cmd.value
+        if len(cmd.value) == self.client.mtu - 1:
+            self._readBlob(handle, value)
+        else:
+            self._setValue(handle, value)
+
+    def _done(self):
+        # One Read per handle, then a Read Blob per further MTU-1 bytes
+        chunk = self.client.mtu - 1
+        naive = sum(1 + len(v) // chunk for v in self.values.values()) + len(self.errors)
+        self.saved = naive - self.requests
+        self.completion(self)
+
+
+class LongWrite:
+    # Queued writes, Vol 3 / G / 4.9.4-5: each value is sent in Prepare
+    # Write chunks of up to MTU-5 bytes, and all are written together by
+    # Execute Write. Chunks are sliced from a memoryview of each value,
+    # and with reliable set, each echo is checked against its chunk
+    # (Vol 3 / F / 3.4.6.2) without copying either; on any mismatch or
+    # error the server's queue is cancelled (Execute Write, flags 0x00).
+    #
+    # ATT allows one request at a time, so each Prepare Write goes out
+    # straight from the previous one's response. A single value which
+    # fits in one Write Request is just written.
+    #
+    # When done, .error is None, or what went wrong; nothing will have
+    # been written if there's an error.
+
+    def __init__(self, client, items, completion, reliable=True):
+        self.client = client
+        self.items = [ (handle, memoryview(value).cast('B')) for (handle, value) in items ]
+        self.completion = completion
+        self.reliable = reliable
+        self.itemIndex = 0
+        self.offset = 0
+        self.requests = 0
+        self.bytesSent = 0
+        self.error = None
+        self.aborted = False
+        self.finished = False
+
+    def start(self):
+        if len(self.items) == 1 and len(self.items[0][1]) <= self.client.mtu - 3:
+            (handle, value) = self.items[0]
+            self._send(gattcmds.WriteRequest(handle, value), self._onWritten)
+        else:
+            self._prepareNext()
+        return self
+
+    def abort(self):
+        '''Stops after the request in flight, cancelling what's queued'''
+        self.aborted = True
+
+    def _send(self, cmd, completion):
+        self.requests += 1
+        self.client.sendRequest(cmd.withCompletion(completion))
+
+    def _prepareNext(self):
+        if self.aborted:
+            return self._cancel("Aborted")
+        if self.itemIndex >= len(self.items):
+            return self._send(gattcmds.ExecuteWriteRequest(gattcmds.ExecuteWriteRequest.WRITE),
+                              self._onWritten)
+        (handle, value) = self.items[self.itemIndex]
+        chunk = value[self.offset:self.offset + self.client.mtu - 5]
+        self._send(gattcmds.PrepareWriteRequest(handle, self.offset, chunk),
+                   lambda cmd: self._onPrepared(cmd, handle, chunk))
+
+    def _onPrepared(self, cmd, handle, chunk):
+        if cmd.error() is not None:
+            if cmd.status == gattcmds.E_CLIENT_TIMEOUT:
+                return self._finish(cmd.error()) # Bearer's gone; nothing to cancel
+            return self._cancel(cmd.error())
+        if self.reliable and (cmd.handle != handle or cmd.offset != self.offset or cmd.value != chunk):
+            return self._cancel("Prepare Write echo differs, handle 0x%04X offset %d" % (handle, self.offset))
+        self.bytesSent += len(chunk)
+        self.offset += len(chunk)
+        if self.offset >= len(self.items[self.itemIndex][1]):
+            self.itemIndex += 1
+            self.offset = 0
+        self._prepareNext()
+
+    def _cancel(self, err):
+        self._send(gattcmds.ExecuteWriteRequest(gattcmds.ExecuteWriteRequest.CANCEL),
+                   lambda cmd: self._finish(err))
+
+    def _onWritten(self, cmd):
+        if cmd.error() is None:
+            self.bytesSent = sum(len(v) for (h, v) in self.items)
+        self._finish(cmd.error())
+
+    def _finish(self, err):
+        self.error = err
+        self.finished = True
+        if err is not None:
+            print ("Long write failed: %s" % err)
+        self.completion(self)
+
+
+class Central(bringup.Stack, events.EventHandler):
     def __init__(self):
-        # TODO: refactor commandMap 
-        self.commandMap = {}  # Maps opcode to command objects
+        self.commands = None # cmdengine.CommandEngine
         self.hciSocket = None
-        self.connection = None
+        self.connections = {} # Maps handle to hcipacket.ACLConnection
+        self.gattClients = {} # Maps handle to GattClient
+        self.connectionManager = None # connmgr.ConnectionManager, if any
+        self.scanner = None # scanner.Scanner, if any
+        self.parameterManager = None # connparams.ParameterManager, if any
+        self.linkSpeedManager = None # linkspeed.LinkSpeedManager, if any
+        self.metrics = None # metrics.StackMetrics, if any
+        self.tracer = None # tracing.Tracer, if any
+        self.cache = None # bringup.ControllerCache, or None for the default
+        self.warm = False
+        self.bringup = None
+        self.aclMtu = None # From controller's LE buffer size
+        self.gattCache = None
+        self.attMtu = 247 # Asked for when discovering, or on a cached reconnect
 
     def withSocket(self, sock):
         self.hciSocket = sock.withDelegate(self)
+        self.commands = cmdengine.CommandEngine(self.hciSocket)
+        return self
+
+    def withMetrics(self, metrics):
+        # metrics.StackMetrics; call after withSocket
+        self.metrics = metrics
+        self.commands.metrics = metrics
+        metrics.watchQueue(self.hciSocket)
+        return self
+
+    def withTracer(self, tracer):
+        # tracing.Tracer; call after withSocket
+        self.tracer = tracer
+        self.hciSocket.tracer = tracer
+        return self
+
+    def withGattCache(self, cache):
+        # gattcache.GattCache, so known peers needn't be discovered again
+        self.gattCache = cache
         return self
 
     def run(self):
@@ -25,94 +629,354 @@ class Central(events.EventHandler):
         print ("Stopping")
 
     def queueCommand(self, cmd):
-        if cmd.opcode in self.commandMap:
-            print("Cmd 0x%04X already in progress", cmd.opcode)
-            return
-        self.commandMap[cmd.opcode] = cmd
-        self.hciSocket.queuePacket(cmd.getPacket())        
+        self.commands.queueCommand(cmd)
 
     def onPacketReceived(self, sock, pkt):
-        print ("Delegate called: " + str(pkt))
-        if pkt.packetType == hcipacket.HCI_EVENT_PACKET:
-            self.onEventReceived(pkt.payload) # Handled by events.EventHandler mixin
-        elif pkt.packetType == hcipacket.HCI_ACL_DATA_PACKET and self.connection is not None:
-            chan = pkt.getAclChannel()
-            # FIXME - look up by channel
-            self.connection.onReceivedData(pkt.payload)
-        else:
-            print ("Unhandled packet")
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        try:
+            if pkt.packetType == hcipacket.HCI_ACL_DATA_PACKET:
+                # Notifications into sinks skip the logging and reassembly
+                client = self.gattClients.get(pkt.getAclChannel())
+                if client is not None and client.sinks and client.takeNotification(pkt.payload):
+                    if self.metrics is not None:
+                        self.metrics.aclReceived(client.conn.handle, len(pkt.payload) - 4)
+                    return
+            print ("Delegate called: " + str(pkt))
+            if pkt.packetType == hcipacket.HCI_EVENT_PACKET:
+                self.onEventReceived(pkt.payload) # Handled by events.EventHandler mixin
+            elif pkt.packetType == hcipacket.HCI_ACL_DATA_PACKET:
+                conn = self.connections.get(pkt.getAclChannel())
+                if conn is None:
+                    print ("ACL data for unknown handle 0x%04X" % pkt.getAclChannel())
+                else:
+                    conn.onReceivedData(pkt.payload)
+            else:
+                print ("Unhandled packet")
+        finally:
+            if tracer is not None:
+                tracer.span("dispatch", tracer.current, start, tracer.now())
 
     # Event handling
     def onCommandResponse(self, n_cmds, opcode, params):
-        # TODO: do sth with n_cmds
-        if opcode in self.commandMap:
-            self.commandMap.pop(opcode).onResponse(params)
+        self.commands.onCommandComplete(n_cmds, opcode, params)
+
+    def onCommandStatus(self, status, n_cmds, opcode):
+        self.commands.onCommandStatus(status, n_cmds, opcode)
+
+    def onNumCompletedPackets(self, handle, count):
+        self.hciSocket.packetQueue.onPacketsCompleted(count, handle)
+
+    def withConnectionManager(self, mgr):
+        self.connectionManager = mgr
+        return self
+
+    def withParameterManager(self, mgr):
+        self.parameterManager = mgr
+        return self
+
+    def withLinkSpeedManager(self, mgr):
+        self.linkSpeedManager = mgr
+        return self
+
+    def withScanner(self, scanner):
+        # scanner.Scanner sets up and enables scanning itself, and gets
+        # the advertising reports
+        self.scanner = scanner
+        return self
+
+    def addConnection(self, handle):
+        conn = hcipacket.ACLConnection(self.hciSocket, handle)
+        conn.metrics = self.metrics
+        conn.tracer = self.tracer
+        if self.aclMtu is not None:
+            conn.txMtu = self.aclMtu
+        self.connections[handle] = conn
+        return conn
+
+    def onMasterConnected(self, handle, peerAddrType, peerAddr):
+        print ("Connected to peripheral, handle=0x%04X" % handle)
+        conn = self.addConnection(handle)
+        client = self.gattClients[handle] = GattClient(conn, self.attMtu)
+        conn.withChannel(gatt.CID_GATT, client.onMessageReceived)
+        if self.parameterManager is not None:
+            self.parameterManager.onConnected(handle, conn, True)
+            client.withActivityCallback(lambda c: self.parameterManager.onActivity(handle))
+        if self.linkSpeedManager is not None:
+            self.linkSpeedManager.onConnected(handle, conn)
+        if self.connectionManager is not None:
+            self.connectionManager.onConnected(handle, peerAddrType, peerAddr, client)
+        if self.gattCache is not None:
+            self.gattCache.discover(client, peerAddrType, peerAddr, self.onDiscoveryDone)
         else:
-            print ("Unhandled opcode 0x%04X" % opcode)
+            client.discover(self.onDiscoveryDone)
+
+    def onConnectionParameters(self, handle, interval, latency, timeout):
+        if self.parameterManager is not None:
+            self.parameterManager.onConnectionParameters(handle, interval, latency, timeout)
 
-    def onSlaveConnected(self, handle, peerAddrType, peerAddr):
-        print ("Slave connected, handle=0x%04X" % handle)
-        self.connection = (hcipacket.ACLConnection(self.hciSocket, handle)
-                              .withChannel(gatt.CID_GATT, self.gatt.onMessageReceived)
-                           ) # FIXME. put in dict
+    def onConnectionUpdated(self, status, handle, interval, latency, timeout):
+        if self.parameterManager is not None:
+            self.parameterManager.onConnectionUpdated(status, handle, interval, latency, timeout)
+
+    def onDataLengthChanged(self, handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime):
+        if self.linkSpeedManager is not None:
+            self.linkSpeedManager.onDataLengthChanged(handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime)
+
+    def onPhyUpdated(self, status, handle, txPhy, rxPhy):
+        if self.linkSpeedManager is not None:
+            self.linkSpeedManager.onPhyUpdated(status, handle, txPhy, rxPhy)
+
+    def onConnectionFailed(self, status, peerAddrType, peerAddr):
+        print ("Connection failed, status 0x%02X" % status)
+        if self.connectionManager is not None:
+            self.connectionManager.onConnectionFailed(status, peerAddrType, peerAddr)
+
+    def onDiscoveryDone(self, discovery):
+        if self.connectionManager is not None:
+            self.connectionManager.onDiscoveryDone(discovery)
+        if discovery.error:
+            return
+        for svc in discovery.services:
+            print (svc)
+            for ch in svc.characteristics:
+                print ("  %s" % ch)
 
     def onDisconnect(self, status, handle, reason):
         if status != 0x00:
             print ("Disconnect failed (err=0x%02X)" % status)
-        elif self.connection is None or handle != self.connection.handle:
+        elif handle not in self.connections:
             print ("Disconnect when apparently not connected? handle=0x%04X" % handle)
         else:
-            self.connection.onDisconnect(reason)
+            self.connections.pop(handle).onDisconnect(reason)
+            self.hciSocket.packetQueue.onDisconnected(handle)
+            client = self.gattClients.pop(handle, None)
+            if client is not None:
+                client.onDisconnect()
+            if self.parameterManager is not None:
+                self.parameterManager.onDisconnected(handle)
+            if self.linkSpeedManager is not None:
+                self.linkSpeedManager.onDisconnected(handle)
+            if self.metrics is not None:
+                self.metrics.forgetConnection(handle)
+            if self.connectionManager is not None:
+                self.connectionManager.onDisconnected(handle, reason)
         
     def onAdvertisingReport(self, report):
-        print ("Reports received:" + str(report))
+        if self.scanner is not None:
+            self.scanner.onAdvertisingReport(report)
+        else:
+            print ("Reports received:" + str(report))
 
     # Various bits of state machine
 
     def start(self):
         assert (self.hciSocket is not None)
 
-        self.startup_state = 0
-        self.startup_next_state(None)
+        lemask = events.DEFAULT_LE_EVENT_MASK
+        lemask |= events.eventMask([events.E_LE_ADVERTISING_REPORT])
+        self.startBringUp(bringup.commonSteps(lemask) + self.scanningSteps())
         return self.run()
 
-    def startup_next_state(self, cmd):
-        print ("startup_next_state", self.startup_state)
-        nextCmd = None
-        if (cmd is not None) and cmd.error():
-            print ("Error from command (opc=0x%04X) : %s" % (cmd.opcode, cmd.error()))
-            self.stop()
-        elif (self.startup_state == 0):
-            nextCmd = commands.Reset()
-        elif (self.startup_state == 1):
-            nextCmd = commands.SetEventMask(events.DEFAULT_EVENT_MASK)
-        elif (self.startup_state == 2):
-            nextCmd = commands.ReadLocalVersion()
-        elif (self.startup_state == 3):
-            if cmd.version < commands.ReadLocalVersion.BLUETOOTH_V4_0:
-                print ("Bluetooth 4.0 unsupported")
-                self.stop()
-            else:
-                lemask = events.DEFAULT_LE_EVENT_MASK
-                lemask |= events.eventMask([events.E_LE_ADVERTISING_REPORT])
-                nextCmd = commands.LESetEventMask(lemask)
-        elif (self.startup_state == 4):
-            nextCmd = commands.WriteLEHostSupported(commands.WriteLEHostSupported.LE_ENABLE, commands.WriteLEHostSupported.LE_SIMUL_DISABLE)
-
-        # Scan-specific stuff starts here...
-        elif (self.startup_state == 5):
-            nextCmd = commands.LESetScanParameters(scan_type=commands.LESetScanParameters.ACTIVE)
-        elif (self.startup_state == 6):
-            nextCmd = commands.LESetScanEnable(commands.LESetScanEnable.ENABLE)
-
-        if nextCmd:
-            self.startup_state += 1
-            self.queueCommand(nextCmd.withCompletion(self.startup_next_state))
-        else:
-            print ("All done")
+    def scanningSteps(self):
+        # Scan parameters can't change while scanning, which it may still
+        # be on a warm restart
+        return [
+            bringup.Step("scanPause", self._pauseScanning, warmOnly=True),
+            bringup.Step("scanParams",
+                         lambda b: commands.LESetScanParameters(scan_type=commands.LESetScanParameters.ACTIVE),
+                         after=["reset", "scanPause"], remember=True),
+            bringup.Step("scanEnable",
+                         lambda b: None if (self.scanner is not None) else
+                                       commands.LESetScanEnable(commands.LESetScanEnable.ENABLE),
+                         after=bringup.CONFIG_STEPS + ["scanParams"]),
+        ]
+
+    def _pauseScanning(self, b):
+        if b.willChange("scanParams"):
+            return commands.LESetScanEnable(commands.LESetScanEnable.DISABLE)
+        return None
+
+    def onStackReady(self):
+        if self.scanner is not None:
+            self.scanner.onStackReady()
+        if self.connectionManager is not None:
+            self.connectionManager.onStackReady()
+
+def makeBigServices(nServices=9, nChars=8):
+    # Test peripheral database: with the gatt.py test services, and the
+    # defaults, just over 200 attributes
+    services = gatt.makeTestServices()
+    for s in range(nServices):
+        # Alternately standard-looking services, and vendor ones with
+        # 128-bit UUIDs throughout
+        vendor = (s % 2 == 1)
+        chars = []
+        for c in range(nChars):
+            uid = "f00d%04x00001000800000000000%04x" % (s, c) if vendor else "%04X" % (0xA000 + s*16 + c)
+            ch = gatt.ReadOnlyCharacteristic(uid, bytes([s, c]) * 4)
+            if c % 2:
+                ch.withProperties(gatt.PROPS_READ | gatt.PROPS_NOTIFY).withDescriptor(
+                    gatt.DummyWriteAttribute(gatt.UUID_CHAR_CLIENT_CONFIG, b'\x00\x00'))
+            chars.append(ch)
+        svcUUID = "f00d%04x000010008000000000000000" % s if vendor else "%04X" % (0xB000 + s)
+        services.append(gatt.Service().withPrimaryUUID(svcUUID).withCharacteristics(*chars))
+    return services
+
+def discoveryBenchmark():
+    # Discovers a ~200 attribute virtual peripheral, and checks we found
+    # everything, for a few ATT MTUs
+    import io
+    import sys
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral
+
+    for mtu in [23, 64, 247]:
+        server = gatt.GattServer().withServices(makeBigServices())
+        periph = VirtualPeripheral(b'\x02\x00\x00\xDD\xDD\xDD', server)
+        ctlr = VirtualController()
+        cen = Central().withSocket( VirtualHCISocket(ctlr) )
+        cen.attMtu = mtu
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            ctlr.connectToPeer(periph)
+            cen.run()
+        finally:
+            sys.stdout = saved
+        client = list(cen.gattClients.values())[0]
+        found = [ (svc.startHandle, svc.endHandle, svc.uuid) for svc in client.services ]
+        expected = [ svc.getHandleRange() + (svc.UUID,) for svc in server.services ]
+        assert found == expected, "Services differ"
+        nChars = sum(len(svc.characteristics) for svc in client.services)
+        nDescs = sum(len(ch.descriptors) for svc in client.services for ch in svc.characteristics)
+        assert nChars == sum(len(svc.characteristics) for svc in server.services)
+        assert nDescs == sum(len(ch.descriptors) for svc in server.services for ch in svc.characteristics)
+        print ("MTU %3d: %d attributes, %d services, %d chars, %d descriptors in %d ATT round trips" % (
+            mtu, len(server.handleTable)-1, len(found), nChars, nDescs, client.requests))
+
+def bulkReadBenchmark():
+    # Reads every characteristic value and descriptor of the same
+    # peripheral: first with lengths unknown, then again once they're
+    # known, then after one value has changed length
+    import io
+    import sys
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral
+
+    for mtu in [23, 247]:
+        services = makeBigServices()
+        services[0].characteristics[0].value.value = b'A rather long device name, more than fits in one PDU' * 2
+        server = gatt.GattServer().withServices(services)
+        handles = [ a.handle for a in server.handleTable[1:]
+                      if a.getValue() is not None and a.typeUUID not in
+                         [gatt.UUID_PRIMARY_SERVICE, gatt.UUID_CHARACTERISTIC_DECL] ]
+        expected = { h: server.handleTable[h].getValue() for h in handles }
+        periph = VirtualPeripheral(b'\x02\x00\x00\xDD\xDD\xDD', server)
+        ctlr = VirtualController()
+        cen = Central().withSocket( VirtualHCISocket(ctlr) )
+        cen.attMtu = mtu
+        results = []
+        client = []
+        def nextRead(bulk=None):
+            if bulk is not None:
+                assert bulk.error is None and bulk.values == expected, "Values differ"
+                results.append(bulk)
+                if len(results) == 2:
+                    # Change one value's length
+                    hnd = services[1].characteristics[0].value.handle
+                    server.handleTable[hnd].value = b'\x01\x02\x03'
+                    expected[hnd] = b'\x01\x02\x03'
+            if len(results) < 3:
+                client[0].readMany(handles, nextRead)
+        def onDiscovered(disc):
+            client.append(disc.client)
+            nextRead()
+        cen.onDiscoveryDone = onDiscovered
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            ctlr.connectToPeer(periph)
+            cen.run()
+        finally:
+            sys.stdout = saved
+        for (label, bulk) in zip(["lengths unknown", "lengths known", "one length changed"], results):
+            print ("MTU %3d, %-18s: %d values in %3d ATT round trips, %3d saved" % (
+                mtu, label, len(bulk.values), bulk.requests, bulk.saved))
+
+def longWriteBenchmark():
+    # Writes a 1kB configuration blob to the gatt.py server, answering
+    # each request 20ms later, at a few MTUs; then a reliable write to
+    # three handles, and one which is aborted part way
+    import os
+    import sys
+    import time
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral
+
+    def run(mtu, work):
+        services = makeBigServices(nServices=2)
+        server = gatt.GattServer().withServices(services)
+        periph = VirtualPeripheral(b'\x02\x00\x00\xDD\xDD\xDD', server, responseDelay=0.02)
+        ctlr = VirtualController()
+        cen = Central().withSocket( VirtualHCISocket(ctlr) )
+        cen.attMtu = mtu
+        results = []
+        def onDiscovered(disc):
+            results.append(time.monotonic())
+            work(server, services, disc.client, lambda w: results.extend([time.monotonic(), w]))
+        cen.onDiscoveryDone = onDiscovered
+        saved = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            cen.start()
+            ctlr.connectToPeer(periph)
+            cen.run()
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved
+        (t0, t1, w) = results
+        return (t1 - t0, w, server)
+
+    blob = bytes(range(256)) * 4
+    def writeBlob(server, services, client, done):
+        client.writeLong(services[2].characteristics[1].value.handle, blob, done)
+    for mtu in [23, 64, 247]:
+        (t, w, server) = run(mtu, writeBlob)
+        assert w.error is None and server.handleTable[w.items[0][0]].value == blob
+        print ("MTU %3d: %d bytes in %2d ATT round trips, %4.0fms, %5.0f bytes/s" % (
+            mtu, len(blob), w.requests, t * 1000, len(blob) / t))
+
+    def cccds(services):
+        return [ d.handle for svc in services for ch in svc.characteristics for d in ch.descriptors ][0:3]
+    def writeConfig(server, services, client, done):
+        client.writeReliable([ (h, b'\x01\x00' + bytes(60)) for h in cccds(services) ], done)
+    (t, w, server) = run(64, writeConfig)
+    # CCCDs are per connection, and take the first two bytes
+    assert w.error is None and all(server.getAttribute(h).getValue() == b'\x01\x00'
+                                   for h in cccds(server.services))
+    print ("Reliable write to 3 handles at MTU 64: %d ATT round trips, %.0fms" % (w.requests, t * 1000))
+
+    def abortBlob(server, services, client, done):
+        handle = services[2].characteristics[1].value.handle
+        w = client.writeLong(handle, blob, done)
+        client.conn.sock.callLater(0.1, w.abort)
+    (t, w, server) = run(64, abortBlob)
+    assert w.error == "Aborted" and len(server.writeQueue) == 0 and server.handleTable[w.items[0][0]].value != blob
+    print ("Aborted after %d of %d bytes: server queue empty, value unchanged" % (w.bytesSent, len(blob)))
 
 if __name__ == '__main__':
+    # Usage: central.py [devId]; see multiadapter.py to run several adapters
+    #        central.py virtual; runs GATT discovery, bulk reads and long
+    #        writes on a virtual peripheral
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "virtual":
+        discoveryBenchmark()
+        bulkReadBenchmark()
+        longWriteBenchmark()
+        sys.exit(0)
     from hcisocket_linux import HCISocket
-    dev = Central().withSocket( HCISocket(devId=0) )
+    devId = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    dev = Central().withSocket( HCISocket(devId=devId) )
     dev.start()
 
@@ -0,0 +1,124 @@
+import time
+import collections
+
+# Issues HCI commands for a Device or Central, honouring the controller's
+# Num_HCI_Command_Packets credits (Vol 2 Part E, 4.4). Independent
+# commands are sent back to back while credits allow; Command Complete
+# and Command Status events are matched to a FIFO per opcode, so the same
+# opcode may be outstanding several times.
+#
+# Commands which get no answer within cmd.TIMEOUT are retried, with the
+# delay doubling each time, up to cmd.MAX_RETRIES; after that they
+# complete with status commands.E_HOST_TIMEOUT. Commands which start a
+# procedure (e.g. LE Create Connection) have no retries: if the
+# controller did get the first, a second is Command Disallowed while the
+# first goes on. Timers come from the socket's timer wheel.
+
+class CommandEngine:
+    def __init__(self, sock):
+        self.sock = sock
+        self.credits = 1 # Until the controller tells us otherwise
+        self.pending = collections.deque() # Queued, not yet sent
+        self.inFlight = {} # Maps opcode to deque of sent commands
+        self.outstanding = 0
+        self.exclusive = None # Command which must run on its own, e.g. Reset
+        self.timers = {} # Maps command to its timeout Timer
+        self.retryBackoff = 0.1 # Seconds before first retry
+        self.timeouts = 0
+        self.metrics = None # metrics.StackMetrics, if any
+
+    def queueCommand(self, cmd):
+        self.pending.append(cmd)
+        self._issue()
+
+    def isIdle(self):
+        return len(self.pending) == 0 and self.outstanding == 0
+
+    def _issue(self):
+        while self.credits > 0 and len(self.pending) > 0 and self.exclusive is None:
+            cmd = self.pending[0]
+            if cmd.EXCLUSIVE:
+                if self.outstanding > 0:
+                    return
+                self.exclusive = cmd
+            self.pending.popleft()
+            self.credits -= 1
+            self.outstanding += 1
+            self.inFlight.setdefault(cmd.opcode, collections.deque()).append(cmd)
+            self.timers[cmd] = self.sock.callLater(cmd.TIMEOUT, self._onTimeout, cmd)
+            if self.metrics is not None:
+                cmd.sentTime = time.monotonic()
+            self.sock.queuePacket(cmd.getPacket())
+
+    def _takeCommand(self, opcode):
+        q = self.inFlight.get(opcode)
+        if not q:
+            return None
+        cmd = q.popleft()
+        if len(q) == 0:
+            del self.inFlight[opcode]
+        self.outstanding -= 1
+        if cmd is self.exclusive:
+            self.exclusive = None
+        timer = self.timers.pop(cmd, None)
+        if timer is not None:
+            timer.cancel()
+        return cmd
+
+    def _onTimeout(self, cmd):
+        q = self.inFlight.get(cmd.opcode)
+        if (q is None) or (cmd not in q):
+            return
+        q.remove(cmd)
+        if len(q) == 0:
+            del self.inFlight[cmd.opcode]
+        del self.timers[cmd]
+        self.outstanding -= 1
+        self.timeouts += 1
+        if self.metrics is not None:
+            self.metrics.commandTimedOut(cmd)
+        if cmd is self.exclusive:
+            self.exclusive = None
+        # The controller has lost it, so don't count it against credits
+        self.credits = max(self.credits, 1)
+        if cmd.retries < cmd.MAX_RETRIES:
+            delay = self.retryBackoff * (1 << cmd.retries)
+            cmd.retries += 1
+            print ("Cmd 0x%04X timed out, retry %d in %.1fs" % (cmd.opcode, cmd.retries, delay))
+            self.sock.callLater(delay, self._retry, cmd)
+        else:
+            print ("Cmd 0x%04X timed out" % cmd.opcode)
+            cmd.onTimeout()
+            self._issue()
+
+    def _retry(self, cmd):
+        self.pending.appendleft(cmd)
+        self._issue()
+
+    def _measure(self, cmd):
+        # Round trip of the last send, if it was timed
+        if self.metrics is not None and getattr(cmd, 'sentTime', None) is not None:
+            self.metrics.commandDone(cmd, time.monotonic() - cmd.sentTime)
+
+    # From events.EventHandler
+    def onCommandComplete(self, n_cmds, opcode, params):
+        self.credits = n_cmds
+        if opcode != 0x0000: # 0 just updates credits
+            cmd = self._takeCommand(opcode)
+            if cmd is None:
+                print ("Unhandled opcode 0x%04X" % opcode)
+            else:
+                self._measure(cmd)
+                cmd.onResponse(params)
+        self._issue()
+
+    def onCommandStatus(self, status, n_cmds, opcode):
+        self.credits = n_cmds
+        if opcode != 0x0000:
+            cmd = self._takeCommand(opcode)
+            if cmd is None:
+                print ("Unhandled status for opcode 0x%04X" % opcode)
+            else:
+                self._measure(cmd)
+                cmd.onStatus(status)
+        self._issue()
@@ -4,11 +4,20 @@ import binascii
 
 from hcipacket import HCIPacket, HCI_COMMAND_PACKET
 
+# Status given to commands the controller never answered. Outside the
+# range of HCI error codes, so it can't be confused with one.
+E_HOST_TIMEOUT = 0x100
+
 class HCICommand:
+    EXCLUSIVE = False # True if nothing else may be outstanding alongside
+    TIMEOUT = 2.0     # Seconds to wait for Command Complete / Status
+    MAX_RETRIES = 2   # Resends after a timeout; 0 unless sending twice is harmless
+
     def __init__(self, params=b''):
         self.opcode = (self.OGF<<10)|self.OCF
         self.params = params
         self.completion = None
+        self.retries = 0
 
     def withCompletion(self, callback):
         self.completion = callback
@@ -25,6 +34,17 @@ class HCICommand:
             print("Calling completer for opcode 0x%04X (%s)" % (self.opcode, self.__class__))
             self.completion(self)
 
+    def onStatus(self, status):
+        # For commands answered by Command Status rather than Complete
+        self.status = status
+        if self.completion:
+            self.completion(self)
+
+    def onTimeout(self):
+        self.status = E_HOST_TIMEOUT
+        if self.completion:
+            self.completion(self)
+
     def parseResponse(self, payload):
         if len(payload) > 1:
             print ("Cmd (opcode 0x%04X) ignored payload %s" % binascii.b2a_hex(payload))
@@ -32,6 +52,8 @@ class HCICommand:
     def error(self):
         if self.status==0:
             return None
+        if self.status == E_HOST_TIMEOUT:
+            return "Command timed out"
         return "HCI Error code %d" % self.status
 
 # Informational commands ---------------------
@@ -48,6 +70,32 @@ class ReadLocalVersion(HCICommand):
     def __str__(self):
         return ("Ver %d rev 0x%04X manuf=0x%04X" % (self.version, self.revision, self.manuf))
 
+class ReadBDADDR(HCICommand):
+    OGF = 0x04
+    OCF = 0x0009
+
+    def parseResponse(self, payload):
+        (self.status, self.address) = struct.unpack("<B6s", payload)
+
+    def __str__(self):
+        return ":".join("%02X" % b for b in reversed(self.address))
+
+# Link control commands -------------------
+
+class LinkControlCommand(HCICommand):
+    OGF = 0x01
+
+class Disconnect(LinkControlCommand):
+    OCF = 0x0006
+    MAX_RETRIES = 0
+
+    # Answered by Command Status, then Disconnection Complete event
+    REMOTE_USER_TERMINATED = 0x13
+    POWER_OFF = 0x15
+
+    def __init__(self, handle, reason=REMOTE_USER_TERMINATED):
+        LinkControlCommand.__init__(self, struct.pack("<HB", handle, reason))
+
 # HCI controller commands ----------
 
 class HCIControllerCommand(HCICommand):
@@ -61,6 +109,7 @@ class SetEventMask(HCIControllerCommand):
 
 class Reset(HCIControllerCommand):
     OCF = 0x0003
+    EXCLUSIVE = True
 
 class WriteLEHostSupported(HCIControllerCommand):
     OCF = 0x006D
@@ -98,6 +147,11 @@ class LEReadBufferSize(LEControllerCommand):
 class LEReadLocalSupportedFeatures(LEControllerCommand):
     OCF = 0x0003
 
+    # Feature bits, Vol 6 / B / 4.6
+    DATA_LENGTH_EXTENSION = 1 << 5
+    LE_2M_PHY = 1 << 8
+    EXTENDED_ADVERTISING = 1 << 12
+
     def parseResponse(self, payload):
          (self.status, self.features) = struct.unpack("<BQ", payload)
 
@@ -155,6 +209,10 @@ class LESetScanParameters(LEControllerCommand):
     PASSIVE = 0x00
     ACTIVE = 0x01
 
+    # scan_filter_policy
+    FILTER_ACCEPT_ALL = 0x00
+    FILTER_WHITE_LIST = 0x01 # Only advertisers on the white (accept) list
+
     def __init__(self,
          scan_type = PASSIVE,
          scan_interval = 0x0010,
@@ -176,3 +234,251 @@ class LESetScanEnable(LEControllerCommand):
 
         
 
+
+class LECreateConnection(LEControllerCommand):
+    OCF = 0x000D
+    MAX_RETRIES = 0
+
+    # BT 4.0 spec, 7.8.12. Answered by Command Status, then LE Connection
+    # Complete event
+    FILTER_PEER_ADDRESS = 0x00
+    FILTER_WHITE_LIST = 0x01
+
+    def __init__(self, peer_addr,
+         peer_addr_type = 0,
+         scan_interval = 0x0060,
+         scan_window = 0x0030,
+         filter_policy = FILTER_PEER_ADDRESS,
+         own_addr_type = 0,
+         interval_min = 0x0018,
+         interval_max = 0x0028,
+         latency = 0,
+         supervision_timeout = 0x0048,
+         min_ce_length = 0,
+         max_ce_length = 0):
+        if len(peer_addr) != 6:
+            raise ValueError("peer_addr must be 6 bytes")
+        LEControllerCommand.__init__(self, struct.pack("<HHBB6sBHHHHHH",
+            scan_interval, scan_window, filter_policy, peer_addr_type, bytes(peer_addr),
+            own_addr_type, interval_min, interval_max, latency, supervision_timeout,
+            min_ce_length, max_ce_length))
+
+class LECreateConnectionCancel(LEControllerCommand):
+    OCF = 0x000E
+    MAX_RETRIES = 0
+
+# White list (the accept list, in later specs). Vol 2, 7.8.14-17. Can't
+# be changed while scanning, advertising or initiating is using it.
+
+class LEReadWhiteListSize(LEControllerCommand):
+    OCF = 0x000F
+
+    def parseResponse(self, payload):
+        (self.status, self.size) = struct.unpack("<BB", payload)
+
+class LEClearWhiteList(LEControllerCommand):
+    OCF = 0x0010
+
+class LEAddDeviceToWhiteList(LEControllerCommand):
+    OCF = 0x0011
+
+    def __init__(self, addr_type, address):
+        if len(address) != 6:
+            raise ValueError("address must be 6 bytes")
+        LEControllerCommand.__init__(self, struct.pack("<B6s", addr_type, bytes(address)))
+
+class LERemoveDeviceFromWhiteList(LEControllerCommand):
+    OCF = 0x0012
+
+    def __init__(self, addr_type, address):
+        if len(address) != 6:
+            raise ValueError("address must be 6 bytes")
+        LEControllerCommand.__init__(self, struct.pack("<B6s", addr_type, bytes(address)))
+
+class LEConnectionUpdate(LEControllerCommand):
+    OCF = 0x0013
+    MAX_RETRIES = 0
+
+    # BT 4.0 spec, 7.8.18. Master only. Answered by Command Status, then
+    # LE Connection Update Complete once the new parameters are in use.
+    # Intervals in 1.25ms units, supervision_timeout in 10ms units.
+    def __init__(self, handle,
+         interval_min = 0x0018,
+         interval_max = 0x0028,
+         latency = 0,
+         supervision_timeout = 0x0048,
+         min_ce_length = 0,
+         max_ce_length = 0):
+        LEControllerCommand.__init__(self, struct.pack("<HHHHHHH", handle, interval_min, interval_max,
+            latency, supervision_timeout, min_ce_length, max_ce_length))
+
+def validParameters(intervalMin, intervalMax, latency, timeout):
+    # Vol 6 / B / 4.5.1-2, in on-air units: interval 7.5ms to 4s,
+    # timeout 100ms to 32s and long enough to survive the latency
+    return ( 0x0006 <= intervalMin <= intervalMax <= 0x0C80 and latency <= 499 and
+             0x000A <= timeout <= 0x0C80 and
+             timeout * 10 > (1 + latency) * intervalMax * 1.25 * 2 )
+
+# Data Length Extension (BT 4.2), Vol 2, 7.8.33-34 and 7.8.46. Octets
+# are LL payload sizes, 27 to 251; times in microseconds, 328 to 17040.
+
+DEFAULT_DATA_OCTETS = 27
+DEFAULT_DATA_TIME = 328
+
+class LESetDataLength(LEControllerCommand):
+    OCF = 0x0022
+
+    # Answered by Command Complete; LE Data Length Change follows if the
+    # peer agrees to anything new
+    def __init__(self, handle, tx_octets, tx_time):
+        LEControllerCommand.__init__(self, struct.pack("<HHH", handle, tx_octets, tx_time))
+
+    def parseResponse(self, payload):
+        (self.status, self.handle) = struct.unpack("<BH", payload)
+
+class LEReadSuggestedDefaultDataLength(LEControllerCommand):
+    OCF = 0x0023
+
+    def parseResponse(self, payload):
+        (self.status, self.tx_octets, self.tx_time) = struct.unpack("<BHH", payload)
+
+class LEWriteSuggestedDefaultDataLength(LEControllerCommand):
+    OCF = 0x0024
+
+    # What the controller uses for new connections
+    def __init__(self, tx_octets, tx_time):
+        LEControllerCommand.__init__(self, struct.pack("<HH", tx_octets, tx_time))
+
+class LEReadMaximumDataLength(LEControllerCommand):
+    OCF = 0x002F
+
+    def parseResponse(self, payload):
+        (self.status, self.max_tx_octets, self.max_tx_time, self.max_rx_octets, self.max_rx_time) = (
+            struct.unpack("<BHHHH", payload) )
+
+# PHYs (BT 5.0), Vol 2, 7.8.47-49
+
+class LEReadPhy(LEControllerCommand):
+    OCF = 0x0030
+
+    def __init__(self, handle):
+        LEControllerCommand.__init__(self, struct.pack("<H", handle))
+
+    def parseResponse(self, payload):
+        (self.status, self.handle, self.tx_phy, self.rx_phy) = struct.unpack("<BHBB", payload)
+
+class LESetDefaultPhy(LEControllerCommand):
+    OCF = 0x0031
+
+    # PHY numbers, as in events
+    PHY_1M = 0x01
+    PHY_2M = 0x02
+    PHY_CODED = 0x03
+
+    # tx_phys / rx_phys bits
+    PREFER_1M = 0x01
+    PREFER_2M = 0x02
+    PREFER_CODED = 0x04
+
+    # all_phys bits
+    NO_TX_PREFERENCE = 0x01
+    NO_RX_PREFERENCE = 0x02
+
+    def __init__(self, all_phys=0, tx_phys=PREFER_1M, rx_phys=PREFER_1M):
+        LEControllerCommand.__init__(self, struct.pack("<BBB", all_phys, tx_phys, rx_phys))
+
+class LESetPhy(LEControllerCommand):
+    OCF = 0x0032
+    MAX_RETRIES = 0
+
+    # Answered by Command Status, then LE PHY Update Complete
+    def __init__(self, handle, all_phys=0, tx_phys=LESetDefaultPhy.PREFER_1M,
+                 rx_phys=LESetDefaultPhy.PREFER_1M, phy_options=0):
+        LEControllerCommand.__init__(self, struct.pack("<HBBBH", handle, all_phys, tx_phys, rx_phys,
+            phy_options))
+
+# Extended advertising (BT 5.0), Vol 2, 7.8.53-61. Each advertising set
+# has its own handle, parameters and data, and they advertise at once.
+
+class LESetExtendedAdvertisingParameters(LEControllerCommand):
+    OCF = 0x0036
+
+    # adv_event_properties bits
+    CONNECTABLE = 0x0001
+    SCANNABLE = 0x0002
+    DIRECTED = 0x0004
+    HIGH_DUTY_CYCLE = 0x0008
+    LEGACY = 0x0010 # Legacy PDUs, so data is limited to 31 bytes
+
+    # Legacy equivalents of LESetAdvertisingParameters adv_type
+    LEGACY_ADV_IND = LEGACY | SCANNABLE | CONNECTABLE
+    LEGACY_ADV_SCAN_IND = LEGACY | SCANNABLE
+    LEGACY_ADV_NONCONN_IND = LEGACY
+
+    PHY_1M = 0x01
+    NO_TX_POWER_PREFERENCE = 0x7F
+
+    def __init__(self, handle,
+         adv_event_properties = LEGACY_ADV_NONCONN_IND,
+         interval_min = 0x00A0,
+         interval_max = 0x00A0,
+         adv_channel_map = 7,
+         own_addr_type = 0,
+         peer_addr_type = 0,
+         peer_addr = b'\x00' * 6,
+         adv_filter_policy = 0,
+         tx_power = NO_TX_POWER_PREFERENCE,
+         primary_phy = PHY_1M,
+         secondary_max_skip = 0,
+         secondary_phy = PHY_1M,
+         sid = 0,
+         scan_req_notify = 0):
+        if len(peer_addr) != 6:
+            raise ValueError("peer_addr must be 6 bytes")
+        # Intervals are 3 bytes
+        LEControllerCommand.__init__(self, struct.pack("<BH", handle, adv_event_properties) +
+            struct.pack("<I", interval_min)[:3] + struct.pack("<I", interval_max)[:3] +
+            struct.pack("<BBB6sBbBBBBB", adv_channel_map, own_addr_type, peer_addr_type, bytes(peer_addr),
+                adv_filter_policy, tx_power, primary_phy, secondary_max_skip, secondary_phy, sid,
+                scan_req_notify))
+
+    def parseResponse(self, payload):
+        (self.status, self.tx_power) = struct.unpack("<Bb", payload)
+
+class LESetExtendedAdvertisingData(LEControllerCommand):
+    OCF = 0x0037
+
+    # operation
+    COMPLETE = 0x03 # All the data in one command; allowed while advertising
+    NO_FRAGMENT = 0x01 # fragment_preference: controller shouldn't fragment
+
+    def __init__(self, handle, advData, operation=COMPLETE, fragment_preference=NO_FRAGMENT):
+        if len(advData) > 251:
+            raise ValueError("Advertising data too long for one command (%d > 251 bytes)" % len(advData))
+        LEControllerCommand.__init__(self, struct.pack("<BBBB", handle, operation, fragment_preference,
+            len(advData)) + bytes(advData))
+
+class LESetExtendedScanResponseData(LEControllerCommand):
+    OCF = 0x0038
+
+    def __init__(self, handle, scanData):
+        LESetExtendedAdvertisingData.__init__(self, handle, scanData)
+
+class LESetExtendedAdvertisingEnable(LEControllerCommand):
+    OCF = 0x0039
+
+    DISABLE = 0x00
+    ENABLE = 0x01
+
+    def __init__(self, state, sets):
+        # sets is a list of (handle, duration, max_events); duration in
+        # 10ms units, 0 for each for no limit. Disabling with no sets
+        # disables them all.
+        LEControllerCommand.__init__(self, struct.pack("<BB", state, len(sets)) +
+            b''.join(struct.pack("<BHB", h, duration, maxEvents) for (h, duration, maxEvents) in sets))
+
+class LEReadNumberOfSupportedAdvertisingSets(LEControllerCommand):
+    OCF = 0x003B
+
+    def parseResponse(self, payload):
+        (self.status, self.num_sets) = struct.unpack("<BB", payload)
@@ -0,0 +1,529 @@
+import time
+import collections
+
+import events
+import commands
+import gattcmds
+import advfilter
+
+# Opens and tracks many LE connections for a central.Central, keyed by
+# connection handle. Connection requests wait in a bounded queue; only
+# maxConnecting LE Create Connections are outstanding at once (most
+# controllers allow just one), each with a timeout after which it's
+# cancelled and retried later.
+#
+# The OperationScheduler runs GATT operations on the links. ATT allows
+# one request outstanding per link, so to get more done, we keep every
+# link busy at once: each link's next operation is sent as soon as its
+# last one completes, and links take turns when maxInFlight limits the
+# total outstanding.
+
+class Link:
+    # One connection, and the operations waiting for it
+    def __init__(self, handle, addrType, address, client):
+        self.handle = handle
+        self.addrType = addrType
+        self.address = address
+        self.client = client
+        self.ready = False # Discovery done
+        self.ops = collections.deque() # (cmd, callback)
+        self.busy = False
+        self.completed = 0
+
+    def findCharacteristic(self, uid):
+        for svc in self.client.services:
+            for ch in svc.characteristics:
+                if ch.uuid == uid:
+                    return ch
+        return None
+
+    def __str__(self):
+        return "Link 0x%04X to %s" % (self.handle, ":".join("%02X" % b for b in reversed(self.address)))
+
+
+class ConnectRequest:
+    def __init__(self, addrType, address, params):
+        self.addrType = addrType
+        self.address = bytes(address)
+        self.params = params # Keyword arguments for commands.LECreateConnection
+        self.timer = None
+        self.attempts = 0
+
+    def key(self):
+        return (self.addrType, self.address)
+
+
+class ConnectionManager:
+    def __init__(self, central, maxConnections=50, maxConnecting=1, maxQueued=256,
+                 connectTimeout=5.0, maxAttempts=3, reconnect=False):
+        self.central = central.withConnectionManager(self)
+        self.maxConnections = maxConnections
+        self.maxConnecting = maxConnecting
+        self.maxQueued = maxQueued
+        self.connectTimeout = connectTimeout
+        self.maxAttempts = maxAttempts
+        self.reconnect = reconnect # Connect again when a link drops
+        self.links = {}     # Maps handle to Link
+        self.byAddress = {} # Maps (addrType, address) to Link
+        self.waiting = collections.deque() # ConnectRequests not yet started
+        self.connecting = {} # Maps (addrType, address) to ConnectRequest
+        self.stackReady = False # Connections wait for the controller's bring-up
+        self.readyCallback = None
+        self.connectCallback = None
+        self.connParams = {} # Defaults for LE Create Connection
+        self.scheduler = OperationScheduler(self)
+        self.stats = collections.Counter()
+
+    def withReadyCallback(self, callback):
+        # callback(link), once a link's discovery is done
+        self.readyCallback = callback
+        return self
+
+    def withConnectCallback(self, callback):
+        # callback(addrType, address, handle) when a connection attempt
+        # ends; handle is None if it failed for good
+        self.connectCallback = callback
+        return self
+
+    def withConnectionParameters(self, **params):
+        # Default commands.LECreateConnection arguments, e.g. interval_min
+        self.connParams = params
+        return self
+
+    def connect(self, addrType, address, **params):
+        '''Queues a connection; returns False if the queue is full.
+           params override the default LE Create Connection arguments.'''
+        merged = dict(self.connParams)
+        merged.update(params)
+        req = ConnectRequest(addrType, address, merged)
+        if req.key() in self.byAddress or req.key() in self.connecting or \
+               any(r.key() == req.key() for r in self.waiting):
+            return True
+        if len(self.waiting) >= self.maxQueued:
+            self.stats['queue_full'] += 1
+            return False
+        self.waiting.append(req)
+        self._pump()
+        return True
+
+    def disconnect(self, handle):
+        if handle in self.links:
+            self.central.queueCommand(commands.Disconnect(handle))
+
+    def connectionCount(self):
+        return len(self.links) + len(self.connecting)
+
+    def _pump(self):
+        while ( self.stackReady and len(self.waiting) > 0 and len(self.connecting) < self.maxConnecting
+                  and self.connectionCount() < self.maxConnections ):
+            req = self.waiting.popleft()
+            req.attempts += 1
+            self.connecting[req.key()] = req
+            self.stats['attempts'] += 1
+            self.central.queueCommand(commands.LECreateConnection(req.address, peer_addr_type=req.addrType,
+                                                                  **req.params)
+                                        .withCompletion(lambda cmd, r=req: self._onCreateStatus(r, cmd)))
+
+    def _onCreateStatus(self, req, cmd):
+        if cmd.status == commands.E_HOST_TIMEOUT:
+            # The controller may have it, and be initiating: cancel after
+            # the usual wait, as if it had said so
+            print ("Create connection unanswered; cancelling in %.1fs" % self.connectTimeout)
+        elif cmd.error():
+            print ("Create connection failed: %s" % cmd.error())
+            self._retry(req)
+            return
+        req.timer = self.central.hciSocket.callLater(self.connectTimeout, self._onConnectTimeout, req)
+
+    def _onConnectTimeout(self, req):
+        # Connection Complete follows the cancel, with status 0x02
+        req.timer = None
+        self.stats['timeouts'] += 1
+        self.central.queueCommand(commands.LECreateConnectionCancel()
+                                    .withCompletion(lambda cmd: self._onCancelStatus(req, cmd)))
+
+    def _onCancelStatus(self, req, cmd):
+        # Refused if nothing was being initiated, after all; then there's
+        # no Connection Complete to retry it
+        if cmd.error() and self.connecting.get(req.key()) is req:
+            self._retry(req)
+
+    def _retry(self, req):
+        self.connecting.pop(req.key(), None)
+        if req.timer is not None:
+            req.timer.cancel()
+            req.timer = None
+        if req.attempts < self.maxAttempts:
+            self.waiting.append(req)
+        else:
+            self.stats['gave_up'] += 1
+            print ("Giving up connecting to %r" % (req.key(),))
+            if self.connectCallback:
+                self.connectCallback(req.addrType, req.address, None)
+        self._pump()
+
+    # From central.Central -------------------
+
+    def onStackReady(self):
+        self.stackReady = True
+        self._pump()
+
+    def onConnected(self, handle, addrType, address, client):
+        req = self.connecting.pop((addrType, bytes(address)), None)
+        if req is not None and req.timer is not None:
+            req.timer.cancel()
+        link = Link(handle, addrType, bytes(address), client)
+        self.links[handle] = link
+        self.byAddress[(addrType, link.address)] = link
+        self.stats['connected'] += 1
+        if self.connectCallback:
+            self.connectCallback(addrType, link.address, handle)
+        self._pump()
+
+    def onConnectionFailed(self, status, addrType, address):
+        req = self.connecting.get((addrType, bytes(address)))
+        if req is None:
+            return
+        self.stats['failed'] += 1
+        self._retry(req)
+
+    def onDiscoveryDone(self, discovery):
+        link = self.links.get(discovery.client.conn.handle)
+        if link is None:
+            return
+        if discovery.error:
+            self.disconnect(link.handle)
+            return
+        link.ready = True
+        if self.readyCallback:
+            self.readyCallback(link)
+        self.scheduler.onLinkReady(link)
+
+    def onDisconnected(self, handle, reason):
+        link = self.links.pop(handle, None)
+        if link is None:
+            return
+        self.byAddress.pop((link.addrType, link.address), None)
+        self.scheduler.onLinkDown(link)
+        self.stats['disconnected'] += 1
+        if self.reconnect:
+            self.connect(link.addrType, link.address)
+        self._pump()
+
+
+class OperationScheduler:
+    def __init__(self, mgr, maxInFlight=None):
+        self.mgr = mgr
+        self.maxInFlight = maxInFlight # None for no limit beyond one per link
+        self.ready = collections.deque() # Links with ops waiting, and none in flight
+        self.inFlight = 0
+        self.completed = 0
+
+    def submit(self, handle, cmd, callback=None):
+        '''Queues gattcmds request cmd on a link; callback(link, cmd) when done'''
+        link = self.mgr.links.get(handle)
+        if link is None:
+            raise KeyError("No link with handle 0x%04X" % handle)
+        link.ops.append( (cmd, callback) )
+        if link.ready and not link.busy and len(link.ops) == 1:
+            self.ready.append(link)
+        self._dispatch()
+
+    def read(self, handle, valueHandle, callback=None):
+        self.submit(handle, gattcmds.Read(valueHandle), callback)
+
+    def readCharacteristic(self, handle, uid, callback=None):
+        '''Reads a characteristic by UUID; returns False if the link has none'''
+        ch = self.mgr.links[handle].findCharacteristic(uid)
+        if ch is None:
+            return False
+        self.read(handle, ch.valueHandle, callback)
+        return True
+
+    def pollAll(self, uid, callback=None):
+        '''Reads characteristic uid on every ready link; returns how many'''
+        n = 0
+        for link in list(self.mgr.links.values()):
+            if link.ready and self.readCharacteristic(link.handle, uid, callback):
+                n += 1
+        return n
+
+    def onLinkReady(self, link):
+        if len(link.ops) > 0 and not link.busy:
+            self.ready.append(link)
+            self._dispatch()
+
+    def onLinkDown(self, link):
+        # The client fails what it had in flight; fail the rest here
+        ops = list(link.ops)
+        link.ops.clear()
+        for (cmd, callback) in ops:
+            cmd.onTimeout()
+            if callback:
+                callback(link, cmd)
+
+    def _dispatch(self):
+        while len(self.ready) > 0 and (self.maxInFlight is None or self.inFlight < self.maxInFlight):
+            link = self.ready.popleft()
+            if link.busy or len(link.ops) == 0 or link.handle not in self.mgr.links:
+                continue
+            (cmd, callback) = link.ops.popleft()
+            link.busy = True
+            self.inFlight += 1
+            link.client.sendRequest(cmd.withCompletion(
+                lambda c, l=link, cb=callback: self._onDone(l, c, cb)))
+
+    def _onDone(self, link, cmd, callback):
+        link.busy = False
+        link.completed += 1
+        self.inFlight -= 1
+        self.completed += 1
+        if callback:
+            callback(link, cmd)
+        if link.client.failed:
+            # The link has gone (onDisconnected may not have been called
+            # yet): fail the rest now rather than sending each to the
+            # dead client, which would fail it, and recurse, in turn
+            return self.onLinkDown(link)
+        if len(link.ops) > 0 and link.handle in self.mgr.links:
+            self.ready.append(link) # Back of the line, behind other links
+        self._dispatch()
+
+
+# LE Create Connection arguments for FastConnect: the peer was advertising
+# a moment ago, so scan for it continuously
+FAST_CONNECT_PARAMS = { 'scan_interval': 0x0010, 'scan_window': 0x0010 }
+
+class FastConnect:
+    # Connects to targets as soon as a scanner.Scanner sees them. Targets
+    # are found by address or by advertised service UUID, in hash
+    # tables. On a match the scan disable and LE Create Connection are
+    # queued together, so both can be in flight at once, instead of
+    # waiting for scanning to stop before starting to connect.
+
+    def __init__(self, mgr, scanner, pipelined=True):
+        self.mgr = mgr.withConnectCallback(self._onConnectDone)
+        self.scanner = scanner
+        self.pipelined = pipelined
+        self.byAddress = {} # Maps (addrType, address) to connection params
+        self.byUUID = {}    # Maps UUID to (matcher, connection params)
+        self.current = None # (key, when seen) for the connection under way
+        self.latencies = [] # Seconds from report to Connection Complete
+        self.callback = None
+
+    def withCallback(self, callback):
+        # callback(addrType, address, handle); handle None on failure
+        self.callback = callback
+        return self
+
+    def addAddress(self, addrType, address, **params):
+        '''Connects to this device once, when seen'''
+        self.byAddress[(addrType, bytes(address))] = self._params(params)
+        return self
+
+    def addUUID(self, uid, **params):
+        '''Connects to every device seen advertising this service'''
+        self.byUUID[uid] = (advfilter.compileFilter(advfilter.ServiceUUID(uid)), self._params(params))
+        return self
+
+    @staticmethod
+    def _params(params):
+        merged = dict(FAST_CONNECT_PARAMS)
+        merged.update(params)
+        return merged
+
+    def start(self):
+        # Just addresses go on the controller's white list
+        self.scanner.scanFor(addresses=list(self.byAddress), uuids=list(self.byUUID), callback=self._onReport)
+        return self
+
+    def _lookup(self, report):
+        key = (report.address_type, report.address)
+        params = self.byAddress.get(key)
+        if params is not None:
+            return params
+        for (match, params) in self.byUUID.values():
+            if match(report.address_type, report.address, report.gap_data):
+                return params
+        return None
+
+    def _onReport(self, report):
+        if self.current is not None or report.event_type not in [events.ADV_IND, events.ADV_DIRECT_IND]:
+            return
+        key = (report.address_type, report.address)
+        if key in self.mgr.byAddress:
+            return
+        params = self._lookup(report)
+        if params is None:
+            return
+        self.current = (key, time.monotonic())
+        if self.pipelined:
+            self.scanner.pause()
+            self.mgr.connect(key[0], key[1], **params)
+        else:
+            self.scanner.pause(lambda cmd: self.mgr.connect(key[0], key[1], **params))
+
+    def _onConnectDone(self, addrType, address, handle):
+        if self.current is None or self.current[0] != (addrType, bytes(address)):
+            return
+        (key, seen) = self.current
+        self.current = None
+        if handle is not None:
+            self.latencies.append(time.monotonic() - seen)
+            self.byAddress.pop(key, None)
+        if self.callback:
+            self.callback(addrType, address, handle)
+        if len(self.byAddress) > 0 or len(self.byUUID) > 0:
+            self.start()
+
+
+if __name__ == '__main__':
+    # Polling throughput against number of links: a gateway connects to
+    # N virtual sensors, each answering 20ms after a request (about a
+    # connection interval or two), then reads each one's device name
+    # repeatedly
+    import os
+    import sys
+    import time
+    import gatt
+    import uuid
+    import central
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral
+
+    READS_PER_LINK = 20
+
+    def pollingRate(nLinks):
+        ctlr = VirtualController()
+        for i in range(nLinks):
+            server = gatt.GattServer().withServices(gatt.makeTestServices())
+            ctlr.withAdvertiser(VirtualPeripheral(bytes([i, 0, 0, 0xEE, 0xEE, 0xEE]), server,
+                                                  responseDelay=0.02))
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+        mgr = ConnectionManager(cen, maxConnections=nLinks)
+        times = {}
+
+        def onRead(link, cmd):
+            assert cmd.error() is None and cmd.value == b'chrubuntu'
+            if link.completed == READS_PER_LINK:
+                times['last'] = time.monotonic()
+                if all(l.completed >= READS_PER_LINK for l in mgr.links.values()):
+                    cen.stop()
+            elif link.completed < READS_PER_LINK:
+                mgr.scheduler.readCharacteristic(link.handle, uuid.AssignedNumbers.deviceName, onRead)
+
+        def onReady(link):
+            if len([ l for l in mgr.links.values() if l.ready ]) == nLinks:
+                times['first'] = time.monotonic()
+                mgr.scheduler.pollAll(uuid.AssignedNumbers.deviceName, onRead)
+        mgr.withReadyCallback(onReady)
+
+        saved = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            t0 = time.monotonic()
+            for adv in ctlr.advertisers:
+                mgr.connect(adv.addrType, adv.address)
+            cen.start()
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved
+        elapsed = times['last'] - times['first']
+        reads = sum(l.completed for l in mgr.links.values())
+        return (times['first'] - t0, reads, reads / elapsed)
+
+    for n in [int(a) for a in sys.argv[1:]] or [1, 5, 10, 25, 50]:
+        (connectTime, reads, rate) = pollingRate(n)
+        print ("%2d links: connected+discovered in %5.2fs, %4d reads at %6.0f reads/s" % (
+            n, connectTime, reads, rate))
+
+    # Advertising report to Connection Complete, for 5 sensors found by
+    # service UUID among 50 other advertisers, with a controller (or a
+    # transport) taking 20ms over each command. Pipelining needs the
+    # controller to take two commands at once; with one credit it's no
+    # quicker than waiting.
+    import gap
+    import scanner
+    from hcisocket_virtual import VirtualAdvertiser
+
+    def fastConnect(pipelined, credits):
+        ctlr = VirtualController(numCmdPackets=credits, commandLatency=0.020)
+        for i in range(50):
+            ctlr.withAdvertiser(VirtualAdvertiser(bytes([i, 1, 0, 0xDD, 0xDD, 0xDD]),
+                gap.AdvertisingData().addItem(gap.GAP_NAME_COMPLETE, b'Other').data))
+        for i in range(5):
+            server = gatt.GattServer().withServices(gatt.makeTestServices())
+            ctlr.withAdvertiser(VirtualPeripheral(bytes([i, 0, 0, 0xEE, 0xEE, 0xEE]), server,
+                gap.AdvertisingData().addItem(gap.GAP_UUID_16BIT_COMPLETE, b'\xAA\xFE').data))
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+        mgr = ConnectionManager(cen)
+        fast = FastConnect(mgr, scanner.Scanner(cen), pipelined).addUUID("FEAA")
+        fast.withCallback(lambda addrType, address, handle: (len(fast.latencies) == 5) and cen.stop())
+        saved = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            fast.start()
+            cen.start()
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved
+        assert len(mgr.links) == 5
+        return fast.latencies
+
+    for (label, pipelined, credits) in [ ("stop scan, then connect", False, 2),
+                                         ("pipelined, 1 credit", True, 1),
+                                         ("pipelined, 2 credits", True, 2) ]:
+        lat = fastConnect(pipelined, credits)
+        print ("%-24s report to connected: mean %5.1fms, max %5.1fms" % (
+            label, 1000 * sum(lat) / len(lat), 1000 * max(lat)))
+
+    # A link dropping with a long queue: every op fails, in turn, and
+    # none is left in flight
+    ctlr = VirtualController()
+    periph = VirtualPeripheral(b'\x09\x00\x00\xEE\xEE\xEE', gatt.GattServer().withServices(gatt.makeTestServices()),
+                               responseDelay=0.02)
+    ctlr.withAdvertiser(periph)
+    cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+    mgr = ConnectionManager(cen, maxConnections=1)
+    failed = []
+    def onQueued(link, cmd):
+        if cmd.error() is not None:
+            failed.append(cmd)
+    def onLinkReady(link):
+        for i in range(2000):
+            mgr.scheduler.read(link.handle, 0x0003, onQueued)
+        ctlr.disconnect(periph.link, 0x13)
+        cen.hciSocket.callLater(0.1, cen.stop)
+    mgr.withReadyCallback(onLinkReady)
+    mgr.connect(periph.addrType, periph.address)
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        cen.start()
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+    assert len(failed) == 2000 and mgr.scheduler.inFlight == 0
+    print ("Link dropped with 2000 ops queued: all failed, none in flight")
+
+    # The controller loses the first LE Create Connection. It isn't
+    # resent (which could cross a live attempt); the cancel is refused,
+    # so it's retried
+    from hcisocket_virtual import opcodeOf
+    ctlr = VirtualController()
+    ctlr.withAdvertiser(periph)
+    ctlr.ignoredOpcodes.add(opcodeOf(commands.LECreateConnection))
+    cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+    mgr = ConnectionManager(cen, connectTimeout=0.5)
+    mgr.withReadyCallback(lambda link: cen.stop())
+    mgr.connect(periph.addrType, periph.address)
+    cen.hciSocket.callLater(0.5, ctlr.ignoredOpcodes.clear)
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        t0 = time.monotonic()
+        cen.start()
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+    assert len(mgr.links) == 1 and mgr.stats['attempts'] == 2 and ctlr.stats['commands_ignored'] == 1
+    print ("Create connection lost: connected on attempt 2 after %.1fs" % (time.monotonic() - t0))
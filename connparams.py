@@ -0,0 +1,475 @@
+import time
+import struct
+import collections
+
+import commands
+from hcipacket import (CID_LE_SIGNALING, SIG_COMMAND_REJECT, SIG_CONN_PARAM_UPDATE_REQ, SIG_CONN_PARAM_UPDATE_RSP,
+                       PARAMS_ACCEPTED, PARAMS_REJECTED, parameterRequest, parameterResponse)
+from commands import validParameters
+
+# Connection parameter management. A connection's interval sets both
+# its latency (a request waits for the next connection event) and its
+# power draw (the radio wakes every interval), so no one setting suits
+# every phase: a short interval while transferring, a long one, with
+# slave latency, while idle. Parameters come in named
+# ConnectionProfiles; a ParameterManager tracks each link's current
+# parameters and asks for changes:
+#
+#  - as master (central.Central), with the LE Connection Update command
+#    (Vol 2, 7.8.18);
+#  - as slave (device.Device), with an L2CAP Connection Parameter Update
+#    Request to the master (Vol 3 / A / 4.20), which may refuse.
+#
+# With autoSwitch, a link switches to the busy profile once it's making
+# requests quickly, and back to the idle profile once it's been quiet
+# for idleTimeout.
+
+
+class ConnectionProfile:
+    # Intervals and timeout in milliseconds
+    def __init__(self, name, intervalMin, intervalMax, latency=0, timeout=4000):
+        self.name = name
+        self.intervalMin = int(round(intervalMin / 1.25))
+        self.intervalMax = int(round(intervalMax / 1.25))
+        self.latency = latency
+        self.timeout = int(round(timeout / 10.0))
+        if not validParameters(self.intervalMin, self.intervalMax, self.latency, self.timeout):
+            raise ValueError("Invalid connection parameters for profile %s" % name)
+
+    @staticmethod
+    def fromUnits(name, intervalMin, intervalMax, latency, timeout):
+        # From on-air units, e.g. as a peer asks for them
+        return ConnectionProfile(name, intervalMin * 1.25, intervalMax * 1.25, latency, timeout * 10)
+
+    def accepts(self, params):
+        return (self.intervalMin <= params.interval <= self.intervalMax and
+                params.latency == self.latency and params.timeout == self.timeout)
+
+    def __str__(self):
+        return "%s (%.2f-%.2fms, latency %d, timeout %dms)" % (self.name, self.intervalMin * 1.25,
+            self.intervalMax * 1.25, self.latency, self.timeout * 10)
+
+# Short intervals to answer quickly; a little longer for bulk transfer,
+# to leave room for several packets per connection event; long intervals
+# and slave latency to save power
+LOW_LATENCY = ConnectionProfile("low-latency", 7.5, 15, latency=0, timeout=2000)
+HIGH_THROUGHPUT = ConnectionProfile("high-throughput", 15, 30, latency=0, timeout=4000)
+LOW_POWER = ConnectionProfile("low-power", 200, 250, latency=4, timeout=6000)
+
+PROFILES = { p.name: p for p in [LOW_LATENCY, HIGH_THROUGHPUT, LOW_POWER] }
+
+
+class ConnectionParameters:
+    # In on-air units: interval 1.25ms, timeout 10ms
+    def __init__(self, interval, latency, timeout):
+        self.interval = interval
+        self.latency = latency
+        self.timeout = timeout
+
+    def __str__(self):
+        return "interval %.2fms, latency %d, timeout %dms" % (self.interval * 1.25, self.latency, self.timeout * 10)
+
+
+class LinkParameters:
+    # What we know about one link's parameters
+    def __init__(self, handle, params):
+        self.handle = handle
+        self.conn = None # hcipacket.ACLConnection
+        self.master = False # Our role
+        self.current = params # ConnectionParameters
+        self.profile = None # Last asked for
+        self.wanted = None # To ask for once the current request is done
+        self.pending = None # Profile asked for, not yet answered
+        self.identifier = None # Of the slave's pending request
+        self.timer = None # L2CAP response timeout
+        self.activity = collections.deque() # Times of recent requests
+        self.idleTimer = None
+        self.updates = 0
+        self.rejected = 0
+
+
+class ParameterManager:
+    # Attach to a central.Central (master) or device.Device (slave)
+    RTX_TIMEOUT = 30.0 # Vol 3 / A / 6.2.1, for the slave's request
+
+    def __init__(self, stack, defaultProfile=None, autoSwitch=False, busyProfile=HIGH_THROUGHPUT,
+                 idleProfile=LOW_POWER, busyRequests=3, busyWindow=1.0, idleTimeout=1.0):
+        self.stack = stack.withParameterManager(self)
+        self.defaultProfile = defaultProfile # Asked for on connection, if any
+        self.autoSwitch = autoSwitch
+        self.busyProfile = busyProfile
+        self.idleProfile = idleProfile
+        self.busyRequests = busyRequests # This many requests within busyWindow
+        self.busyWindow = busyWindow     #   seconds is busy
+        self.idleTimeout = idleTimeout
+        self.links = {} # Maps handle to LinkParameters
+        self.nextIdentifier = 1
+        self.acceptCallback = None
+        self.updateCallback = None
+        self.stats = collections.Counter()
+
+    def withAcceptCallback(self, callback):
+        # As master: callback(handle, ConnectionParameters) says whether to
+        # accept a slave's request. Default accepts any valid one.
+        self.acceptCallback = callback
+        return self
+
+    def withUpdateCallback(self, callback):
+        # callback(handle, ConnectionParameters) when a link's parameters
+        # change
+        self.updateCallback = callback
+        return self
+
+    def parameters(self, handle):
+        '''ConnectionParameters now in use on handle, or None'''
+        link = self.links.get(handle)
+        return None if link is None else link.current
+
+    def setProfile(self, handle, profile):
+        '''Asks for handle to use profile (a ConnectionProfile, or the name
+           of one). If a request is already out, this one follows when
+           it's answered.'''
+        if not isinstance(profile, ConnectionProfile):
+            profile = PROFILES[profile]
+        link = self.links.get(handle)
+        if link is None or link.conn is None:
+            return
+        link.wanted = profile
+        self._request(link)
+
+    def onActivity(self, handle):
+        '''A request went out on handle (or, as a GATT server, came in or
+           was notified); with autoSwitch, picks the profile'''
+        link = self.links.get(handle)
+        if not self.autoSwitch or link is None:
+            return
+        now = time.monotonic()
+        link.activity.append(now)
+        while link.activity[0] < now - self.busyWindow:
+            link.activity.popleft()
+        if link.idleTimer is not None:
+            link.idleTimer.cancel()
+        link.idleTimer = self.stack.hciSocket.callLater(self.idleTimeout, self._onIdle, link)
+        if len(link.activity) >= self.busyRequests and self._target(link) is not self.busyProfile:
+            self.stats['busy'] += 1
+            self.setProfile(handle, self.busyProfile)
+
+    # From the stack ---------------
+
+    def onConnectionParameters(self, handle, interval, latency, timeout):
+        self.links[handle] = LinkParameters(handle, ConnectionParameters(interval, latency, timeout))
+
+    def onConnected(self, handle, conn, master):
+        link = self.links.get(handle)
+        if link is None:
+            return
+        link.master = master
+        link.conn = conn.withChannel(CID_LE_SIGNALING, self.onSignalingReceived)
+        profile = self.defaultProfile if not self.autoSwitch else self.idleProfile
+        if profile is not None:
+            self.setProfile(handle, profile)
+
+    def onConnectionUpdated(self, status, handle, interval, latency, timeout):
+        link = self.links.get(handle)
+        if link is None:
+            return
+        if status == 0:
+            link.current = ConnectionParameters(interval, latency, timeout)
+            link.updates += 1
+            self.stats['updates'] += 1
+            print ("Connection 0x%04X now %s" % (handle, link.current))
+        elif link.pending is not None:
+            print ("Connection update on 0x%04X failed, status 0x%02X" % (handle, status))
+        if link.master:
+            self._requestDone(link)
+        elif link.pending is not None and link.identifier is None:
+            # The update our accepted request asked for
+            if link.timer is not None:
+                link.timer.cancel()
+                link.timer = None
+            self._requestDone(link)
+        if status == 0 and self.updateCallback:
+            self.updateCallback(handle, link.current)
+
+    def onDisconnected(self, handle):
+        link = self.links.pop(handle, None)
+        if link is None:
+            return
+        for t in (link.timer, link.idleTimer):
+            if t is not None:
+                t.cancel()
+
+    def onSignalingReceived(self, aclconn, cid, data):
+        # Use as channel callback for hcipacket.ACLConnection
+        link = self.links.get(aclconn.handle)
+        if link is None or len(data) < 4:
+            return
+        (code, identifier, length) = struct.unpack("<BBH", data[0:4])
+        if len(data) < 4 + length:
+            # Truncated; never answer a reject with a reject
+            self.stats['malformed'] += 1
+            if code != SIG_COMMAND_REJECT:
+                self._reject(aclconn, identifier)
+            return
+        if code == SIG_CONN_PARAM_UPDATE_REQ and link.master and length == 8:
+            return self._onParameterRequest(link, identifier, *struct.unpack("<HHHH", data[4:12]))
+        if code == SIG_CONN_PARAM_UPDATE_RSP and not link.master and length == 2:
+            return self._onParameterResponse(link, struct.unpack("<H", data[4:6])[0])
+        if code == SIG_COMMAND_REJECT and identifier == link.identifier and link.pending is not None:
+            # A master which doesn't understand the request (Vol 3 / A / 4.1)
+            # has refused it, so don't wait out RTX_TIMEOUT
+            return self._onParameterResponse(link, PARAMS_REJECTED)
+        if code in (SIG_COMMAND_REJECT, SIG_CONN_PARAM_UPDATE_RSP):
+            return
+        self._reject(aclconn, identifier)
+
+    def _reject(self, aclconn, identifier):
+        # Vol 3 / A / 4.1: reason 0 is Command not understood
+        aclconn.send(CID_LE_SIGNALING, struct.pack("<BBHH", SIG_COMMAND_REJECT, identifier, 2, 0))
+
+    # Requests ---------------
+
+    def _target(self, link):
+        # The profile link has, or will have once requests are done
+        if link.wanted is not None:
+            return link.wanted
+        return link.pending if link.pending is not None else link.profile
+
+    def _onIdle(self, link):
+        link.idleTimer = None
+        link.activity.clear()
+        if self._target(link) is not self.idleProfile:
+            self.stats['idle'] += 1
+            self.setProfile(link.handle, self.idleProfile)
+
+    def _request(self, link):
+        if link.pending is not None or link.wanted is None:
+            return
+        profile = link.wanted
+        link.wanted = None
+        if profile.accepts(link.current):
+            link.profile = profile
+            return
+        link.pending = profile
+        self.stats['requests'] += 1
+        print ("Asking for %s on 0x%04X" % (profile, link.handle))
+        if link.master:
+            self.stack.queueCommand(commands.LEConnectionUpdate(link.handle, profile.intervalMin,
+                profile.intervalMax, profile.latency, profile.timeout)
+                .withCompletion(lambda cmd: self._onUpdateStatus(link, cmd)))
+        else:
+            identifier = self.nextIdentifier
+            self.nextIdentifier = (identifier % 255) + 1 # Never 0
+            link.identifier = identifier
+            link.timer = self.stack.hciSocket.callLater(self.RTX_TIMEOUT, self._onResponseTimeout, link)
+            link.conn.send(CID_LE_SIGNALING, parameterRequest(identifier, profile.intervalMin,
+                profile.intervalMax, profile.latency, profile.timeout))
+
+    def _onUpdateStatus(self, link, cmd):
+        if cmd.error():
+            print ("Connection update on 0x%04X refused: %s" % (link.handle, cmd.error()))
+            self._requestDone(link)
+        # Otherwise done when LE Connection Update Complete comes
+
+    def _requestDone(self, link):
+        if link.pending is not None and link.pending.accepts(link.current):
+            link.profile = link.pending
+        link.pending = None
+        if self.links.get(link.handle) is link:
+            self._request(link)
+
+    def _onParameterResponse(self, link, result):
+        # As slave; if accepted, the master goes on to update the
+        # connection, and the request is done when we get LE Connection
+        # Update Complete. Until then link.current is the old parameters,
+        # which a following request mustn't be compared with; the timer
+        # keeps running in case the master never does update.
+        link.identifier = None
+        if result == PARAMS_ACCEPTED:
+            return
+        if link.timer is not None:
+            link.timer.cancel()
+            link.timer = None
+        print ("Master rejected %s on 0x%04X" % (link.pending, link.handle))
+        link.rejected += 1
+        self.stats['rejected'] += 1
+        link.pending = None
+        self._request(link)
+
+    def _onResponseTimeout(self, link):
+        link.timer = None
+        link.identifier = None
+        print ("Parameter request on 0x%04X timed out" % link.handle)
+        link.pending = None
+        self._request(link)
+
+    def _onParameterRequest(self, link, identifier, intervalMin, intervalMax, latency, timeout):
+        # As master: the slave asks, and we decide
+        params = ConnectionParameters(intervalMax, latency, timeout)
+        ok = validParameters(intervalMin, intervalMax, latency, timeout) and \
+             (self.acceptCallback is None or self.acceptCallback(link.handle, params))
+        link.conn.send(CID_LE_SIGNALING, parameterResponse(identifier, PARAMS_ACCEPTED if ok else PARAMS_REJECTED))
+        if not ok:
+            self.stats['refused'] += 1
+            return
+        self.stats['accepted'] += 1
+        # Wanted rather than issued at once, so it doesn't cross one of ours
+        link.wanted = ConnectionProfile.fromUnits("peer request", intervalMin, intervalMax, latency, timeout)
+        self._request(link)
+
+
+if __name__ == '__main__':
+    # A central reading a virtual peripheral which answers each request
+    # one connection interval later: per-read time, and how often an idle
+    # slave has to wake, with fixed profiles and with automatic switching
+    # (idle at low power, busy at high throughput). Then a slave asking
+    # its master for parameters, and a master answering a slave.
+    import io
+    import sys
+    import gatt
+    import gattcmds
+    import central
+    import device
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral, VirtualCentral
+
+    def wakeups(params):
+        # Connection events per second the slave must listen to
+        return 1000.0 / (params.interval * 1.25 * (1 + params.latency))
+
+    def readTest(label, nReads, fixed=None, **kwargs):
+        server = gatt.GattServer().withServices(gatt.makeTestServices())
+        periph = VirtualPeripheral(b'\x02\x00\x00\xDD\xDD\xDD', server, responseIntervals=1)
+        ctlr = VirtualController()
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+        mgr = ParameterManager(cen, **kwargs)
+        state = { 'client': None, 'started': None, 'done': None }
+
+        def settled(profile):
+            link = list(mgr.links.values())[0]
+            return link.pending is None and link.wanted is None and profile.accepts(link.current)
+
+        def startBurst():
+            state['started'] = time.monotonic()
+            readNext(nReads)
+
+        def readNext(n):
+            if n == 0:
+                state['done'] = time.monotonic()
+                if fixed is not None:
+                    cen.stop()
+                return
+            state['client'].sendRequest(gattcmds.Read(0x0003).withCompletion(lambda cmd: readNext(n - 1)))
+
+        def onUpdate(handle, params):
+            if state['started'] is None and state['client'] is not None and \
+                   settled(fixed if fixed is not None else mgr.idleProfile):
+                startBurst()
+            elif state['done'] is not None and settled(mgr.idleProfile):
+                cen.stop() # Relaxed again
+
+        def onDiscovered(disc):
+            assert disc.error is None
+            state['client'] = disc.client
+            if fixed is not None:
+                mgr.setProfile(list(mgr.links)[0], fixed)
+            onUpdate(None, None)
+        mgr.withUpdateCallback(onUpdate)
+        cen.onDiscoveryDone = onDiscovered
+        cen.hciSocket.callLater(20.0, cen.stop)
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            ctlr.connectToPeer(periph)
+            cen.run()
+        finally:
+            sys.stdout = saved
+        assert state['done'] is not None, "Reads didn't finish"
+        t = state['done'] - state['started']
+        params = list(mgr.links.values())[0].current
+        print ("%-26s %2d reads in %5.0fms, %5.1fms each; then %s, %4.1f wakeups/s; %d updates" % (
+            label, nReads, t * 1000, t * 1000 / nReads, params, wakeups(params), mgr.stats['updates']))
+
+    readTest("fixed low-power", 6, fixed=LOW_POWER)
+    readTest("fixed high-throughput", 30, fixed=HIGH_THROUGHPUT)
+    readTest("automatic", 30, autoSwitch=True, idleTimeout=0.3)
+
+    # Slave side: the peripheral asks for low latency, which the master
+    # grants, then for something the master refuses
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        ctlr = VirtualController()
+        dev = device.Device().withSocket( VirtualHCISocket(ctlr) )
+        mgr = ParameterManager(dev, defaultProfile=LOW_LATENCY)
+        dev.start()
+        peer = VirtualCentral(ctlr)
+        link = peer.connect(interval=0x0028)
+        dev.run()
+        granted = mgr.parameters(link.handle)
+        peer.acceptParameters = False
+        mgr.setProfile(link.handle, LOW_POWER)
+        dev.run()
+        refused = mgr.parameters(link.handle)
+        # A master which doesn't know the request rejects the command
+        peer.onSignalingReceived = lambda lnk, pdu: lnk.sendToHost(CID_LE_SIGNALING,
+            struct.pack("<BBHH", SIG_COMMAND_REJECT, pdu[1], 2, 0))
+        mgr.setProfile(link.handle, HIGH_THROUGHPUT)
+        started = time.monotonic()
+        dev.run()
+        waited = time.monotonic() - started
+    finally:
+        sys.stdout = saved
+    assert LOW_LATENCY.accepts(granted) and refused is granted
+    assert mgr.links[link.handle].pending is None and mgr.stats['rejected'] == 2 and waited < 1.0
+    print ("Slave: asked for %s, got %s; low-power refused, high-throughput rejected in %.0fms" % (
+        LOW_LATENCY.name, granted, waited * 1000))
+
+    # Slave side with autoSwitch: a burst of reads from the master makes
+    # the peripheral ask for the busy profile, then the idle one again
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        ctlr = VirtualController()
+        dev = device.Device().withSocket( VirtualHCISocket(ctlr) )
+        mgr = ParameterManager(dev, autoSwitch=True, idleTimeout=0.3)
+        seen = []
+        mgr.withUpdateCallback(lambda handle, params: seen.append(params))
+        dev.start()
+        peer = VirtualCentral(ctlr)
+        link = peer.connect(interval=0x0028)
+        dev.run()
+        for i in range(10):
+            peer.sendAtt(struct.pack("<BH", 0x0A, 0x0003)) # Read Request
+        dev.run()
+    finally:
+        sys.stdout = saved
+    assert mgr.stats['busy'] == 1 and any(HIGH_THROUGHPUT.accepts(p) for p in seen)
+    assert LOW_POWER.accepts(mgr.parameters(link.handle)) and len(peer.received) == 10
+    print ("Slave autoSwitch: %s" % ", then ".join(str(p.interval * 1.25) + "ms" for p in seen))
+
+    # Master side: the peripheral asks, the central accepts
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        server = gatt.GattServer().withServices(gatt.makeTestServices())
+        periph = VirtualPeripheral(b'\x02\x00\x00\xDD\xDD\xDD', server)
+        ctlr = VirtualController()
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+        mgr = ParameterManager(cen)
+        cen.start()
+        link = ctlr.connectToPeer(periph)
+        cen.run()
+        periph.requestConnectionParameters(LOW_POWER.intervalMin, LOW_POWER.intervalMax,
+                                           LOW_POWER.latency, LOW_POWER.timeout)
+        cen.run()
+        # A request cut short is rejected, not unpacked
+        link.sendToHost(CID_LE_SIGNALING, struct.pack("<BBH", SIG_CONN_PARAM_UPDATE_REQ, 2, 8) + b'\x06\x00')
+        cen.run()
+    finally:
+        sys.stdout = saved
+    params = mgr.parameters(link.handle)
+    assert LOW_POWER.accepts(params) and mgr.stats['accepted'] == 1 and mgr.stats['malformed'] == 1
+    assert periph.signaling == [ parameterResponse(1, PARAMS_ACCEPTED),
+                                 struct.pack("<BBHH", SIG_COMMAND_REJECT, 2, 2, 0) ]
+    print ("Master: slave asked for %s, now %s; truncated request rejected" % (LOW_POWER.name, params))
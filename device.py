@@ -2,19 +2,69 @@ import struct
 import binascii
 
 import hcipacket
+import bringup
+import cmdengine
 import commands
 import events
 import gap
 import gatt
 
-class Device(events.EventHandler):
+class Device(bringup.Stack, events.EventHandler):
     def __init__(self):
-        self.commandMap = {}  # Maps opcode to command objects
+        self.commands = None # cmdengine.CommandEngine
         self.hciSocket = None
-        self.connection = None
+        self.connections = {} # Maps handle to hcipacket.ACLConnection
+        self.gattSessions = {} # Maps handle to the connection's gatt.GattServer
+        self.maxConnections = 1
+        self.services = None # List of gatt.Service; None for the test services
+        self.cache = None # bringup.ControllerCache, or None for the default
+        self.warm = False
+        self.bringup = None
+        self.aclMtu = None # From controller's LE buffer size
+        self.advertisingManager = None # advmanager.AdvertisingManager, if any
+        self.parameterManager = None # connparams.ParameterManager, if any
+        self.linkSpeedManager = None # linkspeed.LinkSpeedManager, if any
+        self.metrics = None # metrics.StackMetrics, if any
+        self.tracer = None # tracing.Tracer, if any
 
     def withSocket(self, sock):
         self.hciSocket = sock.withDelegate(self)
+        self.commands = cmdengine.CommandEngine(self.hciSocket)
+        return self
+
+    def withMetrics(self, metrics):
+        # metrics.StackMetrics; call after withSocket
+        self.metrics = metrics
+        self.commands.metrics = metrics
+        metrics.watchQueue(self.hciSocket)
+        return self
+
+    def withTracer(self, tracer):
+        # tracing.Tracer; call after withSocket
+        self.tracer = tracer
+        self.hciSocket.tracer = tracer
+        return self
+
+    def withServices(self, services):
+        self.services = services
+        return self
+
+    def withMaxConnections(self, n):
+        # Advertising resumes after each connection until there are n
+        self.maxConnections = n
+        return self
+
+    def withAdvertisingManager(self, mgr):
+        # The manager then sets up advertising, instead of bring-up
+        self.advertisingManager = mgr
+        return self
+
+    def withParameterManager(self, mgr):
+        self.parameterManager = mgr
+        return self
+
+    def withLinkSpeedManager(self, mgr):
+        self.linkSpeedManager = mgr
         return self
 
     def run(self):
@@ -26,45 +76,121 @@ class Device(events.EventHandler):
         print ("Stopping")
 
     def queueCommand(self, cmd):
-        if cmd.opcode in self.commandMap:
-            print("Cmd 0x%04X already in progress", cmd.opcode)
-            return
-        self.commandMap[cmd.opcode] = cmd
-        self.hciSocket.queuePacket(cmd.getPacket())        
+        self.commands.queueCommand(cmd)
 
     def onPacketReceived(self, sock, pkt):
-        print ("Delegate called: " + str(pkt))
-        if pkt.packetType == hcipacket.HCI_EVENT_PACKET:
-            self.onEventReceived(pkt.payload) # Handled by events.EventHandler mixin
-        elif pkt.packetType == hcipacket.HCI_ACL_DATA_PACKET and self.connection is not None:
-            chan = pkt.getAclChannel()
-            # FIXME - look up by channel
-            self.connection.onReceivedData(pkt.payload)
-        else:
-            print ("Unhandled packet")
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        try:
+            print ("Delegate called: " + str(pkt))
+            if pkt.packetType == hcipacket.HCI_EVENT_PACKET:
+                self.onEventReceived(pkt.payload) # Handled by events.EventHandler mixin
+            elif pkt.packetType == hcipacket.HCI_ACL_DATA_PACKET:
+                conn = self.connections.get(pkt.getAclChannel())
+                if conn is not None:
+                    conn.onReceivedData(pkt.payload)
+                else:
+                    print ("ACL data for unknown handle 0x%04X" % pkt.getAclChannel())
+            else:
+                print ("Unhandled packet")
+        finally:
+            if tracer is not None:
+                tracer.span("dispatch", tracer.current, start, tracer.now())
 
     # Event handling
     def onCommandResponse(self, n_cmds, opcode, params):
-        # TODO: do sth with n_cmds
-        if opcode in self.commandMap:
-            self.commandMap.pop(opcode).onResponse(params)
-        else:
-            print ("Unhandled opcode 0x%04X" % opcode)
+        self.commands.onCommandComplete(n_cmds, opcode, params)
+
+    def onCommandStatus(self, status, n_cmds, opcode):
+        self.commands.onCommandStatus(status, n_cmds, opcode)
+
+    def onNumCompletedPackets(self, handle, count):
+        self.hciSocket.packetQueue.onPacketsCompleted(count, handle)
 
     def onSlaveConnected(self, handle, peerAddrType, peerAddr):
         print ("Slave connected, handle=0x%04X" % handle)
-        self.connection = (hcipacket.ACLConnection(self.hciSocket, handle)
-                              .withChannel(gatt.CID_GATT, self.gatt.onMessageReceived)
-                           ) # FIXME. put in dict
+        conn = self.connections[handle] = (hcipacket.ACLConnection(self.hciSocket, handle)
+                                             .withChannel(gatt.CID_GATT, self.openGattSession(handle)))
+        conn.metrics = self.metrics
+        conn.tracer = self.tracer
+        if self.aclMtu is not None:
+            conn.txMtu = self.aclMtu
+        if self.parameterManager is not None:
+            self.parameterManager.onConnected(handle, conn, False)
+        if self.linkSpeedManager is not None:
+            self.linkSpeedManager.onConnected(handle, conn)
+        if self.advertisingManager is not None:
+            self.advertisingManager.onConnected(handle)
+        elif len(self.connections) < self.maxConnections:
+            # The controller stopped advertising as it connected
+            self._resumeAdvertising()
+
+    def onConnectionParameters(self, handle, interval, latency, timeout):
+        if self.parameterManager is not None:
+            self.parameterManager.onConnectionParameters(handle, interval, latency, timeout)
+
+    def onConnectionUpdated(self, status, handle, interval, latency, timeout):
+        if self.parameterManager is not None:
+            self.parameterManager.onConnectionUpdated(status, handle, interval, latency, timeout)
+
+    def onDataLengthChanged(self, handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime):
+        if self.linkSpeedManager is not None:
+            self.linkSpeedManager.onDataLengthChanged(handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime)
+
+    def onPhyUpdated(self, status, handle, txPhy, rxPhy):
+        if self.linkSpeedManager is not None:
+            self.linkSpeedManager.onPhyUpdated(status, handle, txPhy, rxPhy)
 
     def onDisconnect(self, status, handle, reason):
         if status != 0x00:
             print ("Disconnect failed (err=0x%02X)" % status)
-        elif self.connection is None or handle != self.connection.handle:
+        elif handle not in self.connections:
             print ("Disconnect when apparently not connected? handle=0x%04X" % handle)
         else:
-            self.connection.onDisconnect(reason)
-        
+            self.connections.pop(handle).onDisconnect(reason)
+            self.hciSocket.packetQueue.onDisconnected(handle)
+            self.closeGattSession(handle)
+            if self.parameterManager is not None:
+                self.parameterManager.onDisconnected(handle)
+            if self.linkSpeedManager is not None:
+                self.linkSpeedManager.onDisconnected(handle)
+            if self.metrics is not None:
+                self.metrics.forgetConnection(handle)
+            if self.advertisingManager is not None:
+                self.advertisingManager.onDisconnected(handle)
+            elif len(self.connections) == self.maxConnections - 1:
+                # It stopped at the limit
+                self._resumeAdvertising()
+
+    def openGattSession(self, handle):
+        # Returns the ATT channel callback for a new connection
+        server = self.gattSessions[handle] = self.gatt.forConnection()
+        if self.parameterManager is None:
+            return server.onMessageReceived
+        mgr = self.parameterManager
+        def onMessageReceived(aclconn, cid, data):
+            # Each PDU from the client counts towards autoSwitch's busy profile
+            mgr.onActivity(handle)
+            server.onMessageReceived(aclconn, cid, data)
+        return onMessageReceived
+
+    def closeGattSession(self, handle):
+        self.gattSessions.pop(handle, None)
+
+    def notify(self, handle, value):
+        '''Sends value from handle, as a notification, to each connection
+           which has subscribed to it; returns how many'''
+        sent = 0
+        for (hnd, server) in self.gattSessions.items():
+            if server.notify(self.connections[hnd], handle, value):
+                sent += 1
+                if self.parameterManager is not None:
+                    self.parameterManager.onActivity(hnd)
+        return sent
+
+    def _resumeAdvertising(self):
+        self.queueCommand(commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.ENABLE))
 
     # Various bits of state machine
 
@@ -78,48 +204,47 @@ class Device(events.EventHandler):
         self.scn.addItem(gap.GAP_NAME_INCOMPLETE, 'test'.encode('ascii'))
         print ("adv=", binascii.b2a_hex(self.adv.data))
         print ("scn=", binascii.b2a_hex(self.scn.data))
-        self.gatt = gatt.GattServer().withServices(gatt.makeTestServices()) # ...
+        self.gatt = gatt.GattServer().withServices(self.services or gatt.makeTestServices())
+        if self.metrics is not None:
+            self.gatt.withMetrics(self.metrics)
+        if self.tracer is not None:
+            self.gatt.withTracer(self.tracer)
 
-        self.startup_state = 0
-        self.startup_next_state(None)
+        self.startBringUp(bringup.commonSteps() + self.advertisingSteps())
         return self.run()
 
-    def startup_next_state(self, cmd):
-        nextCmd = None
-        if (cmd is not None) and cmd.error():
-            print ("Error from command (opc=0x%04X) : %s" % (cmd.opcode, cmd.error()))
-            self.stop()
-        elif (self.startup_state == 0):
-            nextCmd = commands.Reset()
-        elif (self.startup_state == 1):
-            nextCmd = commands.SetEventMask(events.DEFAULT_EVENT_MASK)
-        elif (self.startup_state == 2):
-            nextCmd = commands.ReadLocalVersion()
-        elif (self.startup_state == 3):
-            if cmd.version < commands.ReadLocalVersion.BLUETOOTH_V4_0:
-                print ("Bluetooth 4.0 unsupported")
-                self.stop()
-            else:
-                nextCmd = commands.LESetEventMask(events.DEFAULT_LE_EVENT_MASK)
-        elif (self.startup_state == 4):
-            nextCmd = commands.WriteLEHostSupported(commands.WriteLEHostSupported.LE_ENABLE, commands.WriteLEHostSupported.LE_SIMUL_DISABLE)
-        elif (self.startup_state == 5):
-            nextCmd = commands.LESetAdvertisingParameters()
-        elif (self.startup_state == 6):
-            nextCmd = commands.LESetAdvertisingData(self.adv.data)
-        elif (self.startup_state == 7):
-            nextCmd = commands.LESetScanResponseData(self.scn.data)
-        elif (self.startup_state == 8):
-            nextCmd = commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.ENABLE)
-
-        if nextCmd:
-            self.startup_state += 1
-            self.queueCommand(nextCmd.withCompletion(self.startup_next_state))
-        else:
-            print ("All done")
+    def advertisingSteps(self):
+        # Advertising parameters can't change while advertising, which it
+        # may still be on a warm restart
+        if self.advertisingManager is not None:
+            return []
+        return [
+            bringup.Step("advPause", self._pauseAdvertising, warmOnly=True),
+            bringup.Step("advParams", lambda b: commands.LESetAdvertisingParameters(),
+                         after=["reset", "advPause"], remember=True),
+            bringup.Step("advData", lambda b: commands.LESetAdvertisingData(self.adv.data),
+                         after=["reset"], remember=True),
+            bringup.Step("scanResponse", lambda b: commands.LESetScanResponseData(self.scn.data),
+                         after=["reset"], remember=True),
+            bringup.Step("advEnable",
+                         lambda b: commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.ENABLE),
+                         after=bringup.CONFIG_STEPS + ["advParams", "advData", "scanResponse"]),
+        ]
+
+    def _pauseAdvertising(self, b):
+        if b.willChange("advParams"):
+            return commands.LESetAdvertiseEnable(commands.LESetAdvertiseEnable.DISABLE)
+        return None
+
+    def onStackReady(self):
+        if self.advertisingManager is not None:
+            self.advertisingManager.onStackReady()
 
 if __name__ == '__main__':
+    # Usage: device.py [devId]; see multiadapter.py to run several adapters
+    import sys
     from hcisocket_linux import HCISocket
-    dev = Device().withSocket( HCISocket(devId=0) )
+    devId = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    dev = Device().withSocket( HCISocket(devId=devId) )
     dev.start()
 
@@ -9,6 +9,7 @@ E_DISCONN_COMPLETE = 0x05
 E_ENCRYPT_CHANGE = 0x08
 E_CMD_RESPONSE = 0x0E
 E_CMD_STATUS = 0x0F
+E_NUM_COMPLETED_PACKETS = 0x13
 E_LE_META_EVENT = 0x3E
 
 # LE Meta-event subcodes
@@ -17,6 +18,15 @@ E_LE_META_EVENT = 0x3E
 E_LE_CONN_COMPLETE = 0x01
 E_LE_ADVERTISING_REPORT = 0x02
 E_LE_CONN_UPDATE_COMPLETE = 0x03
+E_LE_DATA_LENGTH_CHANGE = 0x07
+E_LE_PHY_UPDATE_COMPLETE = 0x0C
+
+# Advertising report event types, Vol 2, 7.7.65.2
+ADV_IND = 0x00
+ADV_DIRECT_IND = 0x01
+ADV_SCAN_IND = 0x02
+ADV_NONCONN_IND = 0x03
+SCAN_RSP = 0x04
 
 def eventMask(evtList):
     w=0
@@ -27,12 +37,22 @@ def eventMask(evtList):
 
 DEFAULT_EVENT_MASK = eventMask([E_DISCONN_COMPLETE, E_ENCRYPT_CHANGE, E_CMD_RESPONSE, E_CMD_STATUS, E_LE_META_EVENT])
 
-DEFAULT_LE_EVENT_MASK = eventMask([E_LE_CONN_COMPLETE, E_LE_CONN_UPDATE_COMPLETE])
+DEFAULT_LE_EVENT_MASK = eventMask([E_LE_CONN_COMPLETE, E_LE_CONN_UPDATE_COMPLETE,
+                                   E_LE_DATA_LENGTH_CHANGE, E_LE_PHY_UPDATE_COMPLETE])
 
 class EventHandler:
     # This is basically a mixin to do the event-handling portion of 
     # the main Device class. Kept separate to aid reuse.
 
+    reportFilter = None # match(addrType, address, advData), e.g. from advfilter
+    metrics = None # metrics.StackMetrics, if any
+
+    def withReportFilter(self, match):
+        # Advertising reports for which match() is False are dropped
+        # before they're parsed
+        self.reportFilter = match
+        return self
+
     def onEventReceived(self, data):
         eventCode = data[0]
         dlen = data[1]
@@ -43,6 +63,9 @@ class EventHandler:
         if eventCode == E_CMD_RESPONSE:
             (n_cmds, opcode) = struct.unpack("<BH", data[2:5])
             return self.onCommandResponse(n_cmds, opcode, data[5:])
+        elif eventCode == E_CMD_STATUS:
+            (status, n_cmds, opcode) = struct.unpack("<BBH", data[2:6])
+            return self.onCommandStatus(status, n_cmds, opcode)
         elif eventCode == E_LE_META_EVENT:
             subEvent = data[2]
             if subEvent == E_LE_CONN_COMPLETE:
@@ -50,14 +73,36 @@ class EventHandler:
                    latency, timeout, masterClock) = struct.unpack("<BHBB6sHHHB", data[3:])
                 if status != 0:
                     return self.onConnectionFailed(status, peerAddrType, peerAddr)
-                elif role == 0x00:
+                self.onConnectionParameters(handle, interval, latency, timeout)
+                if role == 0x00:
                     return self.onMasterConnected(handle, peerAddrType, peerAddr)
                 elif role == 0x01:
                     return self.onSlaveConnected(handle, peerAddrType, peerAddr)
+            elif subEvent == E_LE_CONN_UPDATE_COMPLETE:
+                # Vol 2, 7.7.65.3
+                (status, handle, interval, latency, timeout) = struct.unpack("<BHHHH", data[3:])
+                return self.onConnectionUpdated(status, handle, interval, latency, timeout)
+            elif subEvent == E_LE_DATA_LENGTH_CHANGE:
+                # Vol 2, 7.7.65.7
+                (handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime) = struct.unpack("<HHHHH", data[3:])
+                return self.onDataLengthChanged(handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime)
+            elif subEvent == E_LE_PHY_UPDATE_COMPLETE:
+                # Vol 2, 7.7.65.12
+                (status, handle, txPhy, rxPhy) = struct.unpack("<BHBB", data[3:])
+                return self.onPhyUpdated(status, handle, txPhy, rxPhy)
             elif subEvent == E_LE_ADVERTISING_REPORT:
                 n_reports = data[3]
                 pos = 4
+                if self.metrics is not None:
+                    self.metrics.advertisingReports(n_reports)
+                match = self.reportFilter
                 for i in range(n_reports):
+                    if match is not None:
+                        # Vol 2, 7.7.65.2: type, address type, address, length, data, RSSI
+                        datalen = data[pos+8]
+                        if not match(data[pos+1], data[pos+2:pos+8], data[pos+9:pos+9+datalen]):
+                            pos += 10 + datalen
+                            continue
                     report = AdvertisingReport()
                     pos = report.parseData(data, pos)
                     self.onAdvertisingReport(report)
@@ -65,6 +110,13 @@ class EventHandler:
         elif eventCode == E_DISCONN_COMPLETE:
             (status, handle, reason) = struct.unpack("<BHB", data[2:])
             return self.onDisconnect(status, handle, reason) 
+        elif eventCode == E_NUM_COMPLETED_PACKETS:
+            # Vol 2, 7.7.19
+            n_handles = data[2]
+            for i in range(n_handles):
+                (handle, count) = struct.unpack("<HH", data[3+4*i:7+4*i])
+                self.onNumCompletedPackets(handle, count)
+            return
             
         print ("Unhandled event %02X" % eventCode)
 
@@ -72,6 +124,9 @@ class EventHandler:
     def onCommandResponse(self, n_cmds, opcode, params):
         pass
 
+    def onCommandStatus(self, status, n_cmds, opcode):
+        pass
+
     def onConnectionFailed(self, status, peerAddrType, peerAddr):
         pass
 
@@ -81,12 +136,29 @@ class EventHandler:
     def onSlaveConnected(self, handle, peerAddrType, peerAddr):
         pass
 
+    def onConnectionParameters(self, handle, interval, latency, timeout):
+        # As a connection is made, before onMaster/SlaveConnected. interval
+        # is in 1.25ms units, timeout in 10ms units (Vol 2, 7.7.65.1)
+        pass
+
+    def onConnectionUpdated(self, status, handle, interval, latency, timeout):
+        pass
+
+    def onDataLengthChanged(self, handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime):
+        pass
+
+    def onPhyUpdated(self, status, handle, txPhy, rxPhy):
+        pass
+
     def onDisconnect(self, status, handle, reason):
         pass
 
     def onAdvertisingReport(self, report):
         pass
 
+    def onNumCompletedPackets(self, handle, count):
+        pass
+
 class AdvertisingReport:
     def __init__(self):
         self.event_type = self.address_type = self.address = self.gap_data = None
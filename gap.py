@@ -12,6 +12,8 @@ GAP_UUID_128BIT_COMPLETE = 0x07
 GAP_NAME_INCOMPLETE = 0x08
 GAP_NAME_COMPLETE = 0x09
 GAP_TX_POWER = 0x0A
+GAP_SERVICE_DATA_16BIT = 0x16
+GAP_MANUFACTURER_DATA = 0xFF
 
 class AdvertisingData:
     def __init__(self, withData=b''):
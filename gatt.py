@@ -1,3 +1,4 @@
+import time
 import struct
 import binascii
 import uuid
@@ -5,6 +6,8 @@ import uuid
 
 CID_GATT = 0x04
 
+ATT_DEFAULT_MTU = 23 # Vol 3 / F / 3.2.8
+
 # Core 4.0 Spec, Vol 3 Part G, 3.4
 
 UUID_PRIMARY_SERVICE     = 0x2800
@@ -33,7 +36,7 @@ def uuidFromShortForm(db):
     if len(db)==2:
         return uuid.UUID( struct.unpack("<H", db)[0] )
     elif len(db)==16:
-        return uuid.UUID( binascii.b2a_hex(db[::-1]).encode("utf-8") )
+        return uuid.UUID( binascii.b2a_hex(db[::-1]).decode("ascii") )
     else:
         return None
 
@@ -214,14 +217,19 @@ class Service():
 # Utility classes -------------------------------------
 
 class RecordPacker:
-    # Packs one or more records of the same length into a byte block
+    # Packs one or more records of the same length into a byte block,
+    # of at most maxlen bytes
     
-    def __init__(self):
+    def __init__(self, maxlen=None):
         self.reclen = None
         self.recdata = None
+        self.maxlen = maxlen
         
     def add(self, data):
         '''Returns true if data can be added'''
+        if (self.maxlen is not None) and (self.recdata is not None) and \
+               len(self.recdata) + len(data) > self.maxlen:
+            return False
         if self.reclen == None:
             self.recdata = data
             self.reclen = len(data)
@@ -273,7 +281,7 @@ class ExchangeMTU(Command):
     def execute(self, params):
         # Vol 3 / F / 3.4.2
         theirMTU = struct.unpack("<BH", params)[1]
-        self.server.mtu = min(theirMTU, self.server.mtu)
+        self.server.mtu = max(ATT_DEFAULT_MTU, min(theirMTU, self.server.maxMtu))
         print ("MTU now %d" % self.server.mtu)
         return struct.pack("<BH", 0x03, self.server.mtu)
 
@@ -287,7 +295,7 @@ class FindInformation(Command):
             return self.error(E_INVALID_HANDLE, startHnd)
 
         print ("Find Information %04X-%04X" % (startHnd, endHnd))
-        rp = RecordPacker()
+        rp = RecordPacker(self.server.mtu - 2)
         hnd = startHnd
         endHnd = min(endHnd, len(self.server.handleTable)-1)
         while hnd <= endHnd:
@@ -309,7 +317,7 @@ class FindByTypeValue(Command):
         uid = uuidFromShortForm(params[5:7])
         attrVal = params[7:]
 
-        rp = RecordPacker()
+        rp = RecordPacker(self.server.mtu - 1)
         for svc in self.server.services:
             # Seems this cmd is only valid for discovering services
             (first, last) = svc.getHandleRange()
@@ -336,13 +344,15 @@ class ReadByType(Command):
             return self.error(E_INVALID_PDU)
 
         print ("Read by type %04X-%04X, uid=%s" % (startHnd, endHnd, uid))
-        rp = RecordPacker()
+        rp = RecordPacker(self.server.mtu - 2)
+        maxValue = min(self.server.mtu - 4, 253) # Vol 3 / F / 3.4.4.2
         hnd = startHnd
         endHnd = min(endHnd, len(self.server.handleTable)-1)
         while hnd <= endHnd:
             attr = self.server.handleTable[hnd]
             if uid == attr.typeUUID:
-                if not rp.add( struct.pack("<H", hnd) + attr.getValue() ):
+                attr = self.server.getAttribute(hnd)
+                if not rp.add( struct.pack("<H", hnd) + attr.getValue()[0:maxValue] ):
                     break
             hnd += 1
 
@@ -356,8 +366,7 @@ class Read(Command):
         # Vol 3 / F / 3.4.4.3
         (_, handle) = struct.unpack("<BH", params)
         attr = self.server.getAttribute(handle)
-        # TODO: MTU
-        return struct.pack("<B", 0x0B) + attr.getValue()
+        return struct.pack("<B", 0x0B) + attr.getValue()[0:self.server.mtu-1]
 
 class ReadBlob(Command):
     opcode = 0x0C
@@ -366,8 +375,7 @@ class ReadBlob(Command):
         # Vol 3 / F / 3.4.4.5
         (_, handle, offset) = struct.unpack("<BHH", params)
         attr = self.server.getAttribute(handle)
-        cdata = attr.getValue() [ offset: ]
-        # TODO: MTU
+        cdata = attr.getValue() [ offset: offset+self.server.mtu-1 ]
         return struct.pack("<B", 0x0D) + cdata
 
 class ReadMultiple(Command):
@@ -379,8 +387,8 @@ class ReadMultiple(Command):
         for ofs in range(1, len(params), 2):
             handle = struct.unpack("<H", params[ofs:ofs+2])[0]
             attr = self.server.getAttribute(handle)
-            cdata += attr.getValue() # Assume lengths work??
-        return struct.pack("<B", 0x0F) + cdata
+            cdata += attr.getValue() # Client must know the lengths
+        return struct.pack("<B", 0x0F) + cdata[0:self.server.mtu-1]
 
 
 class ReadByGroupType(Command):
@@ -398,7 +406,8 @@ class ReadByGroupType(Command):
             
         print ("Read By Group %04X-%04X, uid=%s" % (startHnd, endHnd, uid))
         
-        rp = RecordPacker()
+        rp = RecordPacker(self.server.mtu - 2)
+        maxValue = min(self.server.mtu - 6, 251) # Vol 3 / F / 3.4.4.10
         
         for svc in self.server.services:
             (first, last) = svc.getHandleRange()
@@ -406,7 +415,7 @@ class ReadByGroupType(Command):
                 continue
             elif first > endHnd:
                 break
-            if not rp.add( struct.pack("<HH", first, last) + svc.svcDefn.getValue() ):
+            if not rp.add( struct.pack("<HH", first, last) + svc.svcDefn.getValue()[0:maxValue] ):
                 break
 
         rp.trapIfEmpty(startHnd)
@@ -422,7 +431,7 @@ class WriteRequest(Command):
         value = params[3:]
         
         attr = self.server.getAttribute(handle)
-        self.server.handleTable[handle].setValue(value)
+        attr.setValue(value)
         return struct.pack("<B", 0x13)
 
 class WriteCommand(Command):
@@ -473,27 +482,62 @@ class ExecuteWriteRequest(Command):
         # Vol 3 / F / 3.4.6.3
         (_, flags) = struct.unpack("<BB", params)
         
-        if flags == 0x00:
-            self.server.writeQueue.clear()
-        elif flags == 0x01:
-            for (hnd, val) in self.server.writeQueue.items():
-                attr = self.server.getAttribute(hnd)
-                attr.setValue(val)
-                     
+        queue = self.server.writeQueue
+        try:
+            if flags == 0x01:
+                for (hnd, val) in sorted(queue.items()):
+                    attr = self.server.getAttribute(hnd)
+                    attr.setValue(val)
+        finally:
+            # Done with, written or not
+            queue.clear()
         return struct.pack("<B", 0x19)
 
 # Main GattServer object
 
 # This contains the attribute objects, and provides a command dispatcher
-# to execute GATT requests against them.
+# to execute GATT requests against them. The MTU, prepared writes and
+# Client Characteristic Configuration are per connection, so each
+# connection has its own GattServer, from forConnection(), sharing the
+# attributes. Its CCCDs are ClientConfigAttributes of its own, standing
+# in for the shared ones.
+
+# Client Characteristic Configuration bits, Vol 3 / G / 3.3.3.3
+CCCD_NOTIFY   = 0x0001
+CCCD_INDICATE = 0x0002
+
+class ClientConfigAttribute(Attribute):
+    # One connection's value of a CCCD; Vol 3 / G / 3.3.3.3 has each
+    # client's configuration kept separately
+
+    def __init__(self, server, attr):
+        self.server = server
+        self.handle = attr.handle
+        self.typeUUID = attr.typeUUID
+
+    def getValue(self):
+        valueHandle = self.server.clientConfigs[self.handle]
+        return struct.pack("<H", self.server.subscriptions.get(valueHandle, 0))
+
+    def isWriteable(self):
+        return True
+
+    def setValue(self, value):
+        self.server.onClientConfig(self.handle, value)
 
 class GattServer:
     def __init__(self):
         self.services = []
         self.handleTable = [ None ]
         self.cmdDispatch = {}
-        self.mtu = 9999 # FIXME 
+        self.mtu = ATT_DEFAULT_MTU
+        self.maxMtu = 9999 # FIXME: what can we actually take?
         self.writeQueue = {} # Map handle : value bytes
+        self.clientConfigs = {} # Map CCCD handle : its characteristic's value handle
+        self.subscriptions = {} # Map value handle : CCCD bits, for this connection
+        self.configAttrs = {} # Map CCCD handle : ClientConfigAttribute, for this connection
+        self.metrics = None # metrics.StackMetrics, if any
+        self.tracer = None # tracing.Tracer, if any
         for cmdclass in [
            ExchangeMTU, 
            FindInformation, FindByTypeValue,
@@ -512,27 +556,90 @@ class GattServer:
                 attr.setHandle(hnd)
                 self.handleTable.append(attr)
                 hnd += 1
-                
+            for ch in sv.characteristics:
+                for desc in ch.descriptors:
+                    if desc.typeUUID == UUID_CHAR_CLIENT_CONFIG:
+                        self.clientConfigs[desc.handle] = ch.value.handle
+        self._makeConfigAttrs()
+
+    def _makeConfigAttrs(self):
+        self.configAttrs = dict( (hnd, ClientConfigAttribute(self, self.handleTable[hnd]))
+                                 for hnd in self.clientConfigs )
+
+    def withMetrics(self, metrics):
+        self.metrics = metrics
+        return self
+
+    def withTracer(self, tracer):
+        self.tracer = tracer
+        return self
+
     def withServices(self, serviceList):
         self.services = serviceList
         self._configureServices()
         return self
 
+    def forConnection(self):
+        '''A server for another connection to the same attributes'''
+        s = GattServer()
+        s.services = self.services
+        s.handleTable = self.handleTable
+        s.clientConfigs = self.clientConfigs
+        s._makeConfigAttrs()
+        s.maxMtu = self.maxMtu
+        s.metrics = self.metrics
+        s.tracer = self.tracer
+        return s
+
+    def onClientConfig(self, handle, value):
+        # A CCCD was written
+        flags = struct.unpack("<H", value[0:2])[0] if len(value) >= 2 else 0
+        valueHandle = self.clientConfigs[handle]
+        if flags:
+            self.subscriptions[valueHandle] = flags
+        else:
+            self.subscriptions.pop(valueHandle, None)
+
+    def notify(self, aclconn, handle, value):
+        '''Sends a Handle Value Notification if the client has asked for
+           them; returns True if it did'''
+        if not (self.subscriptions.get(handle, 0) & CCCD_NOTIFY):
+            return False
+        # Vol 3 / F / 3.4.7.1
+        aclconn.send(CID_GATT, struct.pack("<BH", 0x1B, handle) + value[0:self.mtu-3])
+        return True
+
     def onMessageReceived(self, aclconn, cid, data):
         # Use as channel callback for hcipacket.ACLConnection
         opcode = data[0]
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        if self.metrics is not None:
+            t0 = time.perf_counter()
         if opcode in self.cmdDispatch:
             print ("Dispatch opcode %s" % self.cmdDispatch[opcode])
+            if tracer is not None:
+                t1 = tracer.now()
             resp = self.cmdDispatch[opcode].execute_and_trap(data)
+            if tracer is not None:
+                tracer.span("execute", tracer.current, t1, tracer.now(),
+                            { 'command': type(self.cmdDispatch[opcode]).__name__ })
         else:
             print ("Unknown opcode 0x%02X" % opcode)
             resp = Command(self, opcode).error(E_REQ_NOT_SUPPORTED)
+        if self.metrics is not None:
+            self.metrics.attServed(opcode, resp, time.perf_counter() - t0)
         if resp is not None:
             aclconn.send(cid, resp)
+        if tracer is not None:
+            tracer.span("att", tracer.current, start, tracer.now(), { 'opcode': opcode })
 
     def getAttribute(self, handle):
         if (handle == 0x0000) or (handle >= len(self.handleTable)):
             raise CommandError(E_INVALID_HANDLE, "Invalid handle", handle)
+        if handle in self.configAttrs:
+            return self.configAttrs[handle]
         return self.handleTable[handle] 
 
 # Testing code --------------------
@@ -0,0 +1,373 @@
+import os
+import json
+import base64
+import struct
+import binascii
+
+import gatt
+import gattcmds
+import central
+
+# Remembers each peer's GATT database, so a Central needn't discover it
+# again on every connection. Entries are keyed by peer address and
+# type, and hold the peer's Database Hash if it has one (Vol 3 / G /
+# 7.3). On reconnect one Read By Type of the hash characteristic checks
+# the entry is still good; if it's changed, or the peer has no hash, we
+# discover from scratch.
+#
+# We don't do SMP, so can't resolve private addresses; the key is just
+# the address the peer connected with.
+#
+# While connected, we have the peer indicate Service Changed (Vol 3 /
+# G / 7.1); on an indication the entry goes, and the database is
+# discovered again into the client.
+
+UUID_SERVICE_CHANGED = 0x2A05
+UUID_DATABASE_HASH = 0x2B2A
+
+def peerKey(addrType, address):
+    return "%d-%s" % (addrType, binascii.b2a_hex(address).decode('ascii'))
+
+# Compact database encoding: a run of records, each a tag byte, handles,
+# then a length-prefixed UUID in its shortest on-air form
+TAG_SERVICE = 0x01
+TAG_CHARACTERISTIC = 0x02
+TAG_DESCRIPTOR = 0x03
+
+def _packUUID(uid):
+    sf = gatt.getShortForm(uid)
+    return bytes([len(sf)]) + sf
+
+def _unpackUUID(data, pos):
+    n = data[pos]
+    return (gatt.uuidFromShortForm(data[pos+1:pos+1+n]), pos+1+n)
+
+def encodeDatabase(services):
+    out = []
+    for svc in services:
+        out.append(struct.pack("<BHH", TAG_SERVICE, svc.startHandle, svc.endHandle) + _packUUID(svc.uuid))
+        for ch in svc.characteristics:
+            out.append(struct.pack("<BHBH", TAG_CHARACTERISTIC, ch.declHandle, ch.properties,
+                                   ch.valueHandle) + _packUUID(ch.uuid))
+            for (hnd, uid) in ch.descriptors:
+                out.append(struct.pack("<BH", TAG_DESCRIPTOR, hnd) + _packUUID(uid))
+    return b''.join(out)
+
+def decodeDatabase(data):
+    services = []
+    svc = ch = None
+    pos = 0
+    while pos < len(data):
+        tag = data[pos]
+        if tag == TAG_SERVICE:
+            (start, end) = struct.unpack("<HH", data[pos+1:pos+5])
+            (uid, pos) = _unpackUUID(data, pos+5)
+            svc = central.RemoteService(uid, start, end)
+            services.append(svc)
+        elif tag == TAG_CHARACTERISTIC:
+            (decl, props, vhnd) = struct.unpack("<HBH", data[pos+1:pos+6])
+            (uid, pos) = _unpackUUID(data, pos+6)
+            ch = central.RemoteCharacteristic(decl, props, vhnd, uid)
+            svc.characteristics.append(ch)
+        elif tag == TAG_DESCRIPTOR:
+            (hnd,) = struct.unpack("<H", data[pos+1:pos+3])
+            (uid, pos) = _unpackUUID(data, pos+3)
+            ch.descriptors.append( (hnd, uid) )
+        else:
+            raise ValueError("Bad tag 0x%02X in cached database" % tag)
+    # End handles aren't stored; they follow from the layout
+    for svc in services:
+        chars = svc.characteristics
+        for (i, ch) in enumerate(chars):
+            ch.endHandle = chars[i+1].declHandle - 1 if (i+1 < len(chars)) else svc.endHandle
+    return services
+
+
+class GattCache:
+    # Kept in memory, and in a JSON file (one line per peer) if a path is
+    # given
+
+    def __init__(self, path=None, trustUnhashed=False):
+        self.path = path
+        self.trustUnhashed = trustUnhashed # Use entries we can't check
+        self.entries = {} # Maps peer key to (hash or None, encoded database)
+        self.hits = self.misses = 0
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as fp:
+                for line in fp:
+                    if line.strip() == '':
+                        continue
+                    (key, dbHash, db) = json.loads(line)
+                    self.entries[key] = ( None if dbHash is None else binascii.a2b_hex(dbHash),
+                                          base64.b64decode(db) )
+
+    def lookup(self, key):
+        '''Returns (hash, services), or None'''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            return (entry[0], decodeDatabase(entry[1]))
+        except (ValueError, IndexError, struct.error) as e:
+            print ("Dropping bad cache entry for %s: %s" % (key, e))
+            self.invalidate(key)
+            return None
+
+    def store(self, key, dbHash, services):
+        self.entries[key] = (dbHash, encodeDatabase(services))
+        self._save()
+
+    def discover(self, client, addrType, address, completion):
+        '''Like client.discover(completion), but using the cache'''
+        return CachedDiscovery(client, self, peerKey(addrType, address), completion).start()
+
+    def invalidate(self, key):
+        if self.entries.pop(key, None) is not None:
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            for (key, (dbHash, db)) in sorted(self.entries.items()):
+                fp.write(json.dumps([ key, None if dbHash is None else binascii.b2a_hex(dbHash).decode('ascii'),
+                                      base64.b64encode(db).decode('ascii') ]) + "\n")
+        os.replace(tmp, self.path)
+
+
+class CachedDiscovery:
+    # Drop-in for central.Discovery: same completion(discovery), and
+    # .error / .services when done. .fromCache says which way it went.
+
+    def __init__(self, client, cache, key, completion):
+        self.client = client
+        self.cache = cache
+        self.key = key
+        self.completion = completion
+        self.cached = None
+        self.services = []
+        self.error = None
+        self.fromCache = False
+        self.dbHash = None
+        self.watching = False # Service Changed indications enabled
+        self.rediscovering = False
+        self.changedAgain = False # Indicated again while rediscovering
+
+    def start(self):
+        self.cached = self.cache.lookup(self.key)
+        if self.cached is not None and (self.cached[0] is not None or self.cache.trustUnhashed):
+            # Discovery would have exchanged MTUs first; here it's queued
+            # along with the hash check, which goes out as soon as it's done
+            mtuSent = self.client.exchangeMtu(self._onMtu)
+            if self.cached[0] is not None:
+                # One round trip: we needn't know the hash's handle
+                self.client.sendRequest(gattcmds.ReadByType(0x0001, 0xFFFF, UUID_DATABASE_HASH)
+                                          .withCompletion(self._onHashCheck))
+            elif not mtuSent:
+                return self._useCache()
+        else:
+            self._discover()
+        return self
+
+    def _onMtu(self, cmd):
+        if self.cached[0] is not None:
+            return # The hash check follows
+        if cmd.status == gattcmds.E_CLIENT_TIMEOUT:
+            self.error = cmd.error()
+            return self.completion(self)
+        self._useCache()
+
+    def _onHashCheck(self, cmd):
+        if cmd.error() is None and len(cmd.records) > 0 and cmd.records[0][1] == self.cached[0]:
+            return self._useCache()
+        if cmd.status == gattcmds.E_CLIENT_TIMEOUT:
+            self.error = cmd.error()
+            return self.completion(self)
+        print ("Database hash changed for %s" % self.key)
+        self.cache.invalidate(self.key)
+        self._discover()
+
+    def _useCache(self):
+        self.cache.hits += 1
+        self.fromCache = True
+        self.services = self.client.services = self.cached[1]
+        self._done()
+
+    def _discover(self):
+        self.cache.misses += 1
+        central.Discovery(self.client, self._onDiscovered).start()
+
+    def _onDiscovered(self, disc):
+        if disc.error and self.rediscovering:
+            # client.services stays stale
+            self.rediscovering = False
+            return
+        if disc.error:
+            self.error = disc.error
+            return self.completion(self)
+        self.services = disc.services
+        ch = self._findCharacteristic(UUID_DATABASE_HASH)
+        if ch is None:
+            return self._store()
+        self.client.sendRequest(gattcmds.Read(ch.valueHandle).withCompletion(self._onHashRead))
+
+    def _onHashRead(self, cmd):
+        if cmd.error() is None:
+            self.dbHash = cmd.value
+        self._store()
+
+    def _store(self):
+        self.cache.store(self.key, self.dbHash, self.services)
+        self._done()
+
+    def _done(self):
+        if not self.rediscovering:
+            self._watchServiceChanged()
+            return self.completion(self)
+        # Found again after Service Changed; client.services is new
+        self.rediscovering = False
+        if self.changedAgain:
+            self.changedAgain = False
+            return self._onServiceChanged()
+        self.client.servicesStale = False
+
+    def _findCharacteristic(self, uid):
+        for svc in self.services:
+            for ch in svc.characteristics:
+                if ch.uuid == uid:
+                    return ch
+        return None
+
+    def _watchServiceChanged(self):
+        # CCCDs don't last between connections without bonding, so this
+        # is each time. The write goes out ahead of the caller's first
+        # request.
+        ch = self._findCharacteristic(UUID_SERVICE_CHANGED)
+        if ch is None or self.watching:
+            return
+        cccds = [ hnd for (hnd, uid) in ch.descriptors if uid == gatt.UUID_CHAR_CLIENT_CONFIG ]
+        if len(cccds) == 0:
+            return
+        self.watching = True
+        self.client.withNotifySink(ch.valueHandle, ServiceChangedSink(self))
+        self.client.sendRequest(gattcmds.WriteRequest(cccds[0], struct.pack("<H", gatt.CCCD_INDICATE)))
+
+    def _onServiceChanged(self):
+        # Peer says its database has changed: forget what we have, and
+        # find it again. The indication gives the range affected, but
+        # Discovery only does the whole database.
+        print ("Service changed on %s" % self.key)
+        self.cache.invalidate(self.key)
+        self.client.servicesStale = True
+        if self.rediscovering:
+            self.changedAgain = True
+            return
+        self.rediscovering = True
+        self.dbHash = None
+        central.Discovery(self.client, self._onDiscovered).start()
+
+
+class ServiceChangedSink:
+    # Notify sink (see GattClient.withNotifySink) for the Service
+    # Changed characteristic, so it doesn't depend on notifyCallback
+    def __init__(self, discovery):
+        self.discovery = discovery
+
+    def append(self, data, offset=0):
+        self.discovery._onServiceChanged()
+
+if __name__ == '__main__':
+    # Connection to first read, for a ~200 attribute peripheral with a
+    # Database Hash, answering each request 20ms later (a couple of
+    # connection intervals): first connection, then reconnections
+    # with the cache valid, and after the database has changed
+    import io
+    import sys
+    import time
+    import hashlib
+    import tempfile
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral
+
+    def makeServer(extra=0):
+        services = central.makeBigServices(nServices=9 + extra)
+        hashChar = gatt.ReadOnlyCharacteristic("%04X" % UUID_DATABASE_HASH, bytes(16))
+        services[1].withCharacteristics(hashChar) # The Generic Attribute service
+        server = gatt.GattServer().withServices(services)
+        # Stands in for the spec's AES-CMAC over the database
+        h = hashlib.md5()
+        for attr in server.handleTable[1:]:
+            h.update(struct.pack("<H", attr.handle) + attr.typeUUID.binVal)
+        hashChar.value.value = h.digest()
+        return server
+
+    def firstRead(cache, server):
+        periph = VirtualPeripheral(b'\x03\x00\x00\xDD\xDD\xDD', server, responseDelay=0.02)
+        ctlr = VirtualController()
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) ).withGattCache(cache)
+        done = []
+        def onDiscovered(disc):
+            assert disc.error is None
+            name = disc._findCharacteristic(gatt.uuid.AssignedNumbers.deviceName)
+            disc.client.sendRequest(gattcmds.Read(name.valueHandle)
+                .withCompletion(lambda cmd: done.append( (time.monotonic(), cmd.value, disc.fromCache,
+                                                          disc.client.requests, disc.client.mtu) )))
+        cen.onDiscoveryDone = onDiscovered
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            t0 = time.monotonic()
+            ctlr.connectToPeer(periph)
+            cen.run()
+        finally:
+            sys.stdout = saved
+        (t1, value, fromCache, requests, mtu) = done[0]
+        assert value == b'chrubuntu'
+        assert mtu == cen.attMtu, "ATT MTU %d" % mtu
+        return (t1 - t0, requests, fromCache)
+
+    def serviceChanged(cache, extra):
+        # Connected, with the cache good, the peripheral's database
+        # changes and it indicates Service Changed over the lot
+        server = makeServer(extra)
+        periph = VirtualPeripheral(b'\x03\x00\x00\xDD\xDD\xDD', server)
+        ctlr = VirtualController()
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) ).withGattCache(cache)
+        found = []
+        cen.onDiscoveryDone = found.append
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            ctlr.connectToPeer(periph)
+            cen.run()
+            disc = found[0]
+            ch = disc._findCharacteristic(UUID_SERVICE_CHANGED)
+            subscribed = server.subscriptions.get(ch.valueHandle, 0)
+            periph.server = makeServer(extra + 1)
+            periph.link.sendToHost(gatt.CID_GATT, struct.pack("<BHHH", central.ATT_INDICATION,
+                                                              ch.valueHandle, 0x0001, 0xFFFF))
+            cen.run()
+        finally:
+            sys.stdout = saved
+        client = disc.client
+        assert disc.fromCache and subscribed == gatt.CCCD_INDICATE and len(found) == 1
+        assert not client.servicesStale and len(client.services) == len(periph.server.services)
+        assert len(cache.lookup(disc.key)[1]) == len(client.services)
+        return (len(server.services), len(client.services))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "gattcache.json")
+        server = makeServer()
+        cache = GattCache(path)
+        for label in ["first connection", "reconnect", "reconnect, new process"]:
+            if label.endswith("new process"):
+                cache = GattCache(path)
+            (t, rtts, fromCache) = firstRead(cache, server)
+            print ("%-28s %6.0fms to first read, %2d ATT round trips, cached=%s" % (label, t*1000, rtts, fromCache))
+        (t, rtts, fromCache) = firstRead(cache, makeServer(extra=1))
+        print ("%-28s %6.0fms to first read, %2d ATT round trips, cached=%s" % ("database changed", t*1000, rtts, fromCache))
+        (before, after) = serviceChanged(cache, 1)
+        print ("%-28s %d services, rediscovered as %d" % ("service changed indication", before, after))
+        print ("Cache file %d bytes" % os.path.getsize(path))
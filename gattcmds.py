@@ -1,90 +1,218 @@
 # GATT commands - issued by Central
 
-# WORK IN PROGRESS - not suitable for use yet
-
 import struct
 import binascii
 import uuid
 
+from gatt import getShortForm, uuidFromShortForm, E_NO_ERROR
+
+ATT_ERROR_RSP = 0x01
+
+# Status given to requests the server never answered. Outside the range
+# of ATT error codes, so it can't be confused with one.
+E_CLIENT_TIMEOUT = 0x100
+E_INVALID_RESPONSE = 0x101
+
+def _uuidField(uid):
+    if not isinstance(uid, uuid.UUID):
+        uid = uuid.UUID(uid)
+    return getShortForm(uid)
+
+def _records(data, reclen):
+    # Splits a response's attribute data into reclen-sized records
+    if reclen == 0:
+        raise struct.error("zero record length")
+    return [ data[pos:pos+reclen] for pos in range(0, len(data) - reclen + 1, reclen) ]
 
-# Command dispatch. Core 4.0 spec Vol 3 Part F, 3.4.2-7 --- 
+
+# Command dispatch. Core 4.0 spec Vol 3 Part F, 3.4.2-7 ---
 class GATTCommand:
+    opcode = None
+    responseOpcode = None # None for commands with no response
+
     def __init__(self, data_):
         self.data = data_
+        self.completion = None
+        self.status = None
+        self.errorHandle = 0x0000
+
+    def withCompletion(self, callback):
+        # callback(cmd); check cmd.error()
+        self.completion = callback
+        return self
+
+    def onResponse(self, pdu):
+        if pdu[0] == ATT_ERROR_RSP:
+            # Vol 3 / F / 3.4.1.1
+            (_, _, self.errorHandle, self.status) = struct.unpack("<BBHB", pdu)
+        else:
+            self.status = E_NO_ERROR
+            try:
+                self.parseResponse(pdu)
+            except struct.error as e:
+                print ("Bad response to opcode 0x%02X (%s): %s" % (self.opcode, str(e),
+                          binascii.b2a_hex(pdu).decode('ascii')))
+                self.status = E_INVALID_RESPONSE
+        if self.completion:
+            self.completion(self)
+
+    def onTimeout(self):
+        self.status = E_CLIENT_TIMEOUT
+        if self.completion:
+            self.completion(self)
+
+    def parseResponse(self, pdu):
+        pass
+
+    def error(self):
+        if self.status == E_NO_ERROR:
+            return None
+        if self.status == E_CLIENT_TIMEOUT:
+            return "Request timed out"
+        if self.status == E_INVALID_RESPONSE:
+            return "Invalid response"
+        return "ATT Error code 0x%02X, handle=0x%04X" % (self.status, self.errorHandle)
 
 class ExchangeMTU(GATTCommand):
     # Vol 3 / F / 3.4.2
-    def __init__(self, mtu): # Defaults?
+    opcode = 0x02
+    responseOpcode = 0x03
+
+    def __init__(self, mtu):
         GATTCommand.__init__(self, struct.pack("<BH", 0x02, mtu) )
-        # result is struct.pack("<BH", 0x03, self.server.mtu)
+
+    def parseResponse(self, pdu):
+        (_, self.mtu) = struct.unpack("<BH", pdu)
 
 class FindInformation(GATTCommand):
     # Vol 3 / F / 3.4.3.1
+    opcode = 0x04
+    responseOpcode = 0x05
+
     def __init__(self, startHnd, endHnd):
         GATTCommand.__init__(self, struct.pack("<BHH", 0x04, startHnd, endHnd))
-        # result is struct.pack("<BB", 0x05, fmt) + rp.recdata
+
+    def parseResponse(self, pdu):
+        # Vol 3 / F / 3.4.3.2: format 1 is 16-bit UUIDs, 2 is 128-bit
+        fmt = pdu[1]
+        uidlen = 2 if (fmt == 0x01) else 16
+        self.records = [ (struct.unpack("<H", rec[0:2])[0], uuidFromShortForm(rec[2:]))
+                         for rec in _records(pdu[2:], 2+uidlen) ]
 
 class FindByTypeValue(GATTCommand):
     # Vol 3 / F / 3.4.3.3
-    def __init__(self, startHnd, endHnd):
-        GATTCommand.__init__(self, struct.pack("<BHH", 0x06, startHnd, endHnd))
-        # result is struct.pack("<B", 0x07) + rp.recdata
+    opcode = 0x06
+    responseOpcode = 0x07
+
+    def __init__(self, startHnd, endHnd, uid, value):
+        uidfield = _uuidField(uid)
+        if len(uidfield) != 2:
+            raise ValueError("Find By Type Value needs a 16-bit attribute type")
+        GATTCommand.__init__(self, struct.pack("<BHH", 0x06, startHnd, endHnd) +
+            uidfield + bytes(value))
+
+    def parseResponse(self, pdu):
+        # List of (found handle, group end handle)
+        self.records = [ struct.unpack("<HH", rec) for rec in _records(pdu[1:], 4) ]
 
 class ReadByType(GATTCommand):
     # Vol 3 / F / 3.4.4.1
-    def __init__(self, startHnd, endHnd):
-        GATTCommand.__init__(self, struct.pack("<BHH", 0x08, startHnd, endHnd))
-        # result is struct.pack("<BB", 0x09, rp.reclen) + rp.recdata
+    opcode = 0x08
+    responseOpcode = 0x09
+
+    def __init__(self, startHnd, endHnd, uid):
+        GATTCommand.__init__(self, struct.pack("<BHH", 0x08, startHnd, endHnd) + _uuidField(uid))
+
+    def parseResponse(self, pdu):
+        # List of (handle, value)
+        self.records = [ (struct.unpack("<H", rec[0:2])[0], rec[2:])
+                         for rec in _records(pdu[2:], pdu[1]) ]
 
 class Read(GATTCommand):
-     # Vol 3 / F / 3.4.4.3
+    # Vol 3 / F / 3.4.4.3
+    opcode = 0x0A
+    responseOpcode = 0x0B
+
     def __init__(self, handle):
         GATTCommand.__init__(self, struct.pack("<BH", 0x0A, handle))
-        # result is struct.pack("<B", 0x0B) + attr.getValue()
+
+    def parseResponse(self, pdu):
+        self.value = pdu[1:]
 
 class ReadBlob(GATTCommand):
     # Vol 3 / F / 3.4.4.5
+    opcode = 0x0C
+    responseOpcode = 0x0D
+
     def __init__(self, handle, offset):
         GATTCommand.__init__(self, struct.pack("<BHH", 0x0C, handle, offset))
-        # result is struct.pack("<B", 0x0D) + cdata
+
+    def parseResponse(self, pdu):
+        self.value = pdu[1:]
 
 class ReadMultiple(GATTCommand):
     # Vol 3 / F / 3.4.4.7
+    opcode = 0x0E
+    responseOpcode = 0x0F
+
     def __init__(self, handleList):
-        l = len(handleList)
-        strL = "%d" % l
-        GATTCommand.__init__(self, struct.pack("<BH"+strL+"H", 0x0E, l, *handleList) )
-        # result is struct.pack("<B", 0x0F) + cdata
+        GATTCommand.__init__(self, struct.pack("<B%dH" % len(handleList), 0x0E, *handleList) )
+
+    def parseResponse(self, pdu):
+        # Values are just concatenated; caller must know their lengths
+        self.value = pdu[1:]
 
 
 class ReadByGroupType(GATTCommand):
     # Vol 3 / F / 3.4.4.9
-    def __init__(self, startHnd, endHnd):
-        GATTCommand.__init__(self, struct.pack("<BHH", 0x10, startHnd, endHnd))
-    # result is struct.pack("<BB", 0x11, rp.reclen) + rp.recdata
+    opcode = 0x10
+    responseOpcode = 0x11
+
+    def __init__(self, startHnd, endHnd, uid):
+        GATTCommand.__init__(self, struct.pack("<BHH", 0x10, startHnd, endHnd) + _uuidField(uid))
+
+    def parseResponse(self, pdu):
+        # List of (handle, end group handle, value)
+        self.records = [ struct.unpack("<HH", rec[0:4]) + (rec[4:],)
+                         for rec in _records(pdu[2:], pdu[1]) ]
 
 
 class WriteRequest(GATTCommand):
     # Vol 3 / F / 3.4.5.1
+    opcode = 0x12
+    responseOpcode = 0x13
+
     def __init__(self, handle, data):
         GATTCommand.__init__(self, struct.pack("<BH", 0x12, handle) + bytes(data))
-        # result is struct.pack("<B", 0x13)
 
 class WriteCommand(GATTCommand):
+    # Vol 3 / F / 3.4.5.3
+    opcode = 0x52
+
     def __init__(self, handle, value):
-        GATTCommand.__init__(self, struct.pack("<BH", 0x52) + bytes(value))
+        GATTCommand.__init__(self, struct.pack("<BH", 0x52, handle) + bytes(value))
         # No return
 
 class PrepareWriteRequest(GATTCommand):
+    # Vol 3 / F / 3.4.6.1
+    opcode = 0x16
+    responseOpcode = 0x17
+
     def __init__(self, handle, offset, value):
         GATTCommand.__init__(self, struct.pack("<BHH", 0x16, handle, offset) + bytes(value))
-        # result is struct.pack("<BHH", 0x17, handle, offset) + value
+
+    def parseResponse(self, pdu):
+        # The value echoed back; a view, so checking it copies nothing
+        (_, self.handle, self.offset) = struct.unpack_from("<BHH", pdu)
+        self.value = memoryview(pdu)[5:]
 
 class ExecuteWriteRequest(GATTCommand):
-    def __init__(self, flags):
-        GATTCommand.__init__(self, struct.pack("<BB", 0x18, flags))
-        # result is struct.pack("<B", 0x19)
+    # Vol 3 / F / 3.4.6.3
+    opcode = 0x18
+    responseOpcode = 0x19
 
+    CANCEL = 0x00
+    WRITE = 0x01
 
-r = ReadMultiple([1,4,5,6])
-print( r.data )
+    def __init__(self, flags):
+        GATTCommand.__init__(self, struct.pack("<BB", 0x18, flags))
@@ -0,0 +1,631 @@
+import os
+import sys
+import time
+import select
+import struct
+import multiprocessing
+
+import gatt
+import device
+import hcipacket
+
+# Sharded GATT server: one process owns the HCI socket, and hands each
+# connection's ACL data to one of a pool of worker processes, which
+# reassemble it, do the ATT command dispatch, and fragment responses.
+# The router does bring-up, advertising, and L2CAP signalling (which
+# workers pass back to it), as device.Device does, and sends the
+# workers' ACL packets; it only looks at the handle of what it passes on.
+#
+# Connections go to workers by handle, so everything for one connection
+# goes down the same pipe, in order. What a worker is sent in one turn
+# of the router's loop goes as one message of records, and it answers
+# each message with one of its own. Records carry the connection's
+# generation, new each time a handle is used, so a late response for a
+# connection that's gone isn't sent on one which has taken its handle.
+#
+# Each worker has its own copy of the
+# services (for handles, types and grouping), but attribute values live
+# in an AttributeStore in shared memory, so a write made through one
+# worker is seen by reads in all the others without any messages.
+#
+# Each value has a sequence lock: writers (serialised by a lock, striped
+# by handle) make the count odd, copy the value in, then make it even;
+# readers take no lock, and retry if the count was odd or changed while
+# they copied. The counts and lengths are arrays of their own, so each
+# is set by one aligned store (struct.pack_into zeroes its target before
+# filling it in, which a reader could catch). CPython makes the stores
+# in program order, which x86 keeps for the reader; a weakly-ordered CPU
+# would want barriers Python can't express.
+#
+# The router sends notifications itself: each worker publishes its
+# connections' MTU and CCCD bits in a SessionTable, also shared memory.
+# Metrics and tracing cover the router only; the workers record nothing.
+
+MAX_ATTR_LEN = 512 # Vol 3 / F / 3.2.9
+MAX_HANDLES = 0xF00 # Connection handles run 0x000 to 0xEFF
+LOCK_STRIPES = 16
+
+UNSET = 0xFFFF # Length of a value which is None
+
+# Pipe records: kind, handle, generation, payload length; then payload
+RECORD = struct.Struct("<BHHH")
+REC_OPEN = 0x01  # Payload is the ACL MTU, as ACLConnection.txMtu
+REC_MTU = 0x02   # Likewise, when it changes
+REC_ACL = 0x03   # ACL data, without the packet type byte
+REC_L2CAP = 0x04 # To the router: CID, then a PDU for it to handle
+REC_CLOSE = 0x05
+REC_QUIT = 0x06
+HANDLE = struct.Struct("<H")
+
+# ATT opcodes which can change a connection's MTU or CCCD bits
+PUBLISH_OPCODES = frozenset([0x02, 0x12, 0x52, 0x18])
+
+# Attributes whose values are fixed by the database's layout; all
+# others may be set, by a client or by ShardedDevice.setValue()
+DECLARATION_TYPES = [ gatt.UUID_PRIMARY_SERVICE, gatt.UUID_SECONDARY_SERVICE,
+                      gatt.UUID_INCLUDE_DEFINITION, gatt.UUID_CHARACTERISTIC_DECL ]
+
+
+class AttributeStore:
+    # Attribute values, by handle, in memory shared with the workers
+
+    def __init__(self, sizes):
+        # sizes is each handle's capacity in bytes; index 0 is unused
+        self.offsets = []
+        self.capacity = list(sizes)
+        pos = 0
+        for n in sizes:
+            self.offsets.append(pos)
+            pos += (n + 7) & ~7
+        self.mem = multiprocessing.RawArray('B', max(pos, 1))
+        self.seqs = multiprocessing.RawArray('I', len(sizes))
+        self.lengths = multiprocessing.RawArray('H', len(sizes))
+        self.locks = [ multiprocessing.Lock() for i in range(LOCK_STRIPES) ]
+        self.retries = 0 # Reads which had to go round again, in this process
+        self._map()
+
+    @staticmethod
+    def fromServer(server):
+        '''A store holding the current values of server's attributes.
+           All but declarations get room for the longest value allowed.'''
+        table = server.handleTable
+        sizes = [0]
+        for attr in table[1:]:
+            if any(attr.typeUUID == t for t in DECLARATION_TYPES):
+                v = attr.getValue()
+                sizes.append(0 if v is None else len(v))
+            else:
+                sizes.append(MAX_ATTR_LEN)
+        store = AttributeStore(sizes)
+        for hnd in range(1, len(table)):
+            store.write(hnd, table[hnd].getValue())
+        return store
+
+    def _map(self):
+        self.view = memoryview(self.mem).cast('B')
+
+    def __getstate__(self):
+        # The view can't be pickled (e.g. to a spawned worker); the
+        # shared array and locks can
+        state = dict(self.__dict__)
+        del state['view']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    def read(self, handle):
+        off = self.offsets[handle]
+        seqs = self.seqs
+        while True:
+            seq = seqs[handle]
+            if not (seq & 1):
+                n = self.lengths[handle]
+                value = None if (n == UNSET) else bytes(self.view[off : off+n])
+                if seqs[handle] == seq:
+                    return value
+            # A write is under way: try again, letting the writer run
+            self.retries += 1
+            time.sleep(0)
+
+    def write(self, handle, value):
+        n = UNSET if (value is None) else len(value)
+        if value is not None and n > self.capacity[handle]:
+            raise gatt.CommandError(gatt.E_INVALID_ATTRIB_LEN, "Invalid attribute value length", handle)
+        off = self.offsets[handle]
+        seqs = self.seqs
+        with self.locks[handle % LOCK_STRIPES]:
+            seq = seqs[handle]
+            seqs[handle] = (seq + 1) & 0xFFFFFFFF
+            self.lengths[handle] = n
+            if value is not None:
+                self.view[off : off+n] = value
+            seqs[handle] = (seq + 2) & 0xFFFFFFFF
+
+
+class SharedAttribute(gatt.Attribute):
+    # Stands in for attr in a worker's handle table, with its value in
+    # the store
+
+    def __init__(self, store, attr):
+        self.store = store
+        self.attr = attr
+        self.handle = attr.handle
+        self.typeUUID = attr.typeUUID
+
+    def getValue(self):
+        return self.store.read(self.handle)
+
+    def isWriteable(self):
+        return self.attr.isWriteable()
+
+    def setValue(self, value):
+        self.attr.setValue(value) # Raises if not permitted
+        self.store.write(self.handle, value)
+
+
+class SessionTable:
+    # Each connection's ATT MTU and CCCD bits, written by the worker
+    # which has the connection, and read by the router
+
+    def __init__(self, server):
+        valueHandles = sorted(set(server.clientConfigs.values()))
+        self.columns = dict( (hnd, k + 1) for (k, hnd) in enumerate(valueHandles) )
+        self.stride = 1 + len(valueHandles)
+        self.mem = multiprocessing.RawArray('H', MAX_HANDLES * self.stride)
+
+    def publish(self, handle, session):
+        row = handle * self.stride
+        self.mem[row] = session.mtu
+        for (hnd, col) in self.columns.items():
+            self.mem[row + col] = session.subscriptions.get(hnd, 0)
+
+    def clear(self, handle):
+        row = handle * self.stride
+        for i in range(row, row + self.stride):
+            self.mem[i] = 0
+
+    def mtu(self, handle):
+        return self.mem[handle * self.stride] or gatt.ATT_DEFAULT_MTU
+
+    def subscription(self, handle, valueHandle):
+        '''CCCD bits for valueHandle on connection handle'''
+        col = self.columns.get(valueHandle)
+        return 0 if (col is None) else self.mem[handle * self.stride + col]
+
+
+# Worker side ---------------
+
+class ShardLink(hcipacket.ACLConnection):
+    # A connection, as its worker sees it. Its "socket" is itself: the
+    # packets it queues go back to the router.
+
+    def __init__(self, worker, handle, generation, txMtu):
+        hcipacket.ACLConnection.__init__(self, self, handle)
+        self.worker = worker
+        self.generation = generation
+        self.txMtu = txMtu
+        self.session = worker.server.forConnection()
+
+    def queuePacket(self, pkt, txClass=None):
+        self.worker.out.append(RECORD.pack(REC_ACL, self.handle, self.generation, len(pkt.payload)) + pkt.payload)
+
+    def onPacketComplete(self, cid, data):
+        if cid != gatt.CID_GATT:
+            # e.g. L2CAP signalling, which the router deals with
+            self.worker.out.append(RECORD.pack(REC_L2CAP, self.handle, self.generation, len(data) + 2) +
+                                   HANDLE.pack(cid) + data)
+            return
+        self.session.onMessageReceived(self, cid, data)
+        if data[0] in PUBLISH_OPCODES:
+            self.worker.table.publish(self.handle, self.session)
+
+
+class ShardWorker:
+    def __init__(self, services, store, table, pipe):
+        self.server = gatt.GattServer().withServices(services)
+        handles = self.server.handleTable
+        for hnd in range(1, len(handles)):
+            handles[hnd] = SharedAttribute(store, handles[hnd])
+        self.table = table
+        self.pipe = pipe
+        self.links = {} # Maps handle to ShardLink
+        self.out = [] # Records for the router
+
+    def run(self):
+        pipe = self.pipe
+        while True:
+            msg = pipe.recv_bytes()
+            pos = 0
+            while pos < len(msg):
+                (kind, handle, generation, n) = RECORD.unpack_from(msg, pos)
+                pos += RECORD.size
+                if kind == REC_ACL:
+                    link = self.links.get(handle)
+                    if link is not None and link.generation == generation:
+                        link.onReceivedData(msg[pos:pos+n])
+                elif kind == REC_OPEN:
+                    self.links[handle] = ShardLink(self, handle, generation, HANDLE.unpack_from(msg, pos)[0])
+                    self.table.clear(handle)
+                elif kind == REC_MTU:
+                    link = self.links.get(handle)
+                    if link is not None and link.generation == generation:
+                        link.txMtu = HANDLE.unpack_from(msg, pos)[0]
+                elif kind == REC_CLOSE:
+                    self.links.pop(handle, None)
+                    self.table.clear(handle)
+                elif kind == REC_QUIT:
+                    return
+                pos += n
+            # One answer for each message, even if there's nothing in it
+            pipe.send_bytes(b''.join(self.out))
+            self.out = []
+
+def _workerMain(services, store, table, pipe, quiet):
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    try:
+        ShardWorker(services, store, table, pipe).run()
+    except (EOFError, KeyboardInterrupt):
+        pass # Router has gone
+
+
+# Router side ---------------
+
+class Shard:
+    def __init__(self, index, process, pipe):
+        self.index = index
+        self.process = process
+        self.pipe = pipe
+        self.batch = [] # Records to send at the end of this turn
+        self.connections = 0
+
+
+class ShardedDevice(device.Device):
+    def __init__(self):
+        device.Device.__init__(self)
+        self.workerCount = multiprocessing.cpu_count()
+        self.shards = []
+        self.byFd = {} # Maps pipe fd to Shard
+        self.store = None # AttributeStore, once started
+        self.table = None # SessionTable, once started
+        self.generations = {} # Maps handle to its connection's generation
+        self.nextGeneration = 0
+        self.linkMtus = {} # Maps handle to the ACL MTU its worker has
+        self.outstanding = 0 # Messages sent to workers, not yet answered
+        self.stale = 0 # Records from workers for connections since gone
+
+    def withWorkers(self, n):
+        self.workerCount = n
+        return self
+
+    def _startShards(self):
+        # Workers can't write to a redirected sys.stdout; they discard
+        # their output if ours is redirected
+        quiet = sys.stdout is not sys.__stdout__
+        self.store = AttributeStore.fromServer(self.gatt)
+        self.table = SessionTable(self.gatt)
+        for i in range(self.workerCount):
+            (ours, theirs) = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_workerMain, name="gatt%d" % i,
+                    args=(self.gatt.services, self.store, self.table, theirs, quiet))
+            p.daemon = True
+            p.start()
+            theirs.close()
+            shard = Shard(i, p, ours)
+            self.shards.append(shard)
+            self.byFd[ours.fileno()] = shard
+
+    def close(self):
+        '''Stops the workers'''
+        for shard in self.shards:
+            shard.batch.append(RECORD.pack(REC_QUIT, 0, 0, 0))
+        try:
+            self._flush()
+        except (BrokenPipeError, OSError):
+            pass
+        for shard in self.shards:
+            shard.process.join()
+            shard.pipe.close()
+        self.shards = []
+        self.byFd = {}
+
+    def shardFor(self, handle):
+        return self.shards[handle % len(self.shards)]
+
+    def _record(self, kind, handle, payload=b''):
+        self.shardFor(handle).batch.append(
+            RECORD.pack(kind, handle, self.generations[handle], len(payload)) + payload)
+
+    def _flush(self):
+        for shard in self.shards:
+            if len(shard.batch) > 0:
+                shard.pipe.send_bytes(b''.join(shard.batch))
+                shard.batch = []
+                self.outstanding += 1
+
+    def openGattSession(self, handle):
+        self.generations[handle] = self.nextGeneration
+        self.nextGeneration = (self.nextGeneration + 1) & 0xFFFF
+        mtu = self.aclMtu if (self.aclMtu is not None) else 9999
+        self.linkMtus[handle] = mtu
+        self.shardFor(handle).connections += 1
+        self._record(REC_OPEN, handle, HANDLE.pack(mtu))
+        # ATT data goes to the worker before reassembly, so the router's
+        # ACLConnection never calls this
+        return self._notRouted
+
+    def _notRouted(self, aclconn, cid, data):
+        print ("ATT PDU for handle 0x%04X reassembled by the router" % aclconn.handle)
+
+    def closeGattSession(self, handle):
+        self.shardFor(handle).connections -= 1
+        self._record(REC_CLOSE, handle)
+        del self.generations[handle]
+        self.linkMtus.pop(handle, None)
+
+    def onPacketReceived(self, sock, pkt):
+        if pkt.packetType == hcipacket.HCI_ACL_DATA_PACKET:
+            handle = pkt.getAclChannel()
+            if handle in self.generations:
+                txMtu = self.connections[handle].txMtu
+                if txMtu != self.linkMtus[handle]:
+                    # e.g. after data length negotiation
+                    self.linkMtus[handle] = txMtu
+                    self._record(REC_MTU, handle, HANDLE.pack(txMtu))
+                self._record(REC_ACL, handle, pkt.payload)
+                if self.parameterManager is not None:
+                    # Per packet rather than per PDU, which is near enough
+                    self.parameterManager.onActivity(handle)
+                return
+        device.Device.onPacketReceived(self, sock, pkt)
+
+    def _drain(self, shard):
+        pipe = shard.pipe
+        sock = self.hciSocket
+        while pipe.poll():
+            msg = pipe.recv_bytes()
+            self.outstanding -= 1
+            pos = 0
+            while pos < len(msg):
+                (kind, handle, generation, n) = RECORD.unpack_from(msg, pos)
+                pos += RECORD.size
+                if self.generations.get(handle) != generation:
+                    self.stale += 1
+                elif kind == REC_ACL:
+                    sock.queuePacket(hcipacket.HCIPacket(hcipacket.HCI_ACL_DATA_PACKET, msg[pos:pos+n]))
+                elif kind == REC_L2CAP:
+                    self.connections[handle].onPacketComplete(HANDLE.unpack_from(msg, pos)[0], msg[pos+2:pos+n])
+                pos += n
+
+    def setValue(self, handle, value):
+        '''Changes an attribute's value, as seen by all workers'''
+        self.store.write(handle, value)
+
+    def notify(self, handle, value):
+        '''As device.Device.notify, from the workers' published CCCDs'''
+        sent = 0
+        for (hnd, conn) in self.connections.items():
+            if self.table.subscription(hnd, handle) & gatt.CCCD_NOTIFY:
+                # Vol 3 / F / 3.4.7.1
+                mtu = self.table.mtu(hnd)
+                conn.send(gatt.CID_GATT, struct.pack("<BH", 0x1B, handle) + value[0:mtu-3])
+                sent += 1
+                if self.parameterManager is not None:
+                    self.parameterManager.onActivity(hnd)
+        return sent
+
+    def run(self):
+        # As the socket's own run(), also waiting on the workers' pipes.
+        # On a virtual socket, returns when idle with nothing at the
+        # workers.
+        if len(self.shards) == 0:
+            self._startShards() # Now the services are set up
+        sock = self.hciSocket
+        pollable = hasattr(sock, "fileno")
+        poller = select.poll()
+        for fd in self.byFd:
+            poller.register(fd, select.POLLIN)
+        if pollable:
+            poller.register(sock.fileno(), sock.pollMask())
+        sock.running = True
+        while sock.running:
+            busy = False
+            if not pollable:
+                busy = sock.runOnce() or sock.controller.tick()
+            self._flush()
+            timeout = sock.timers.nextTimeout()
+            if busy:
+                timeout = 0
+            elif not pollable and timeout is None and self.outstanding == 0:
+                break
+            if pollable:
+                poller.modify(sock.fileno(), sock.pollMask())
+            evts = poller.poll(1000.0 if (timeout is None) else min(1000.0, timeout*1000.0))
+            for (fd, evtmask) in evts:
+                if fd in self.byFd:
+                    if evtmask & (select.POLLHUP|select.POLLERR):
+                        print ("GATT worker %d failed" % self.byFd[fd].index)
+                        sock.running = False
+                    else:
+                        self._drain(self.byFd[fd])
+                elif not sock.onPollEvent(evtmask):
+                    sock.running = False
+            if pollable:
+                self._flush()
+                sock.timers.advance() # runOnce() does this for virtual ones
+        sock.running = False
+        return self
+
+
+if __name__ == '__main__':
+    # Seqlock under concurrent writers and readers, then a sharded
+    # Device on the virtual controller: cross-worker visibility,
+    # notifications, and read throughput against the single process.
+    import io
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualCentral
+
+    def stressReader(store, handles, until, result):
+        # Each value is one byte repeated; a torn read would mix them
+        torn = reads = 0
+        while time.monotonic() < until:
+            for h in handles:
+                v = store.read(h)
+                if len(v) == 0 or v.count(v[0:1]) != len(v):
+                    torn += 1
+                reads += 1
+        result.put( (reads, torn, store.retries) )
+
+    def stressWriter(store, handles, until, seed):
+        i = seed
+        while time.monotonic() < until:
+            for h in handles:
+                store.write(h, bytes([i & 0xFF]) * (1 + (i * 37) % MAX_ATTR_LEN))
+                i += 1
+
+    store = AttributeStore([0] + [MAX_ATTR_LEN] * 4)
+    for h in range(1, 5):
+        store.write(h, b'\x00')
+    until = time.monotonic() + 1.0
+    result = multiprocessing.Queue()
+    procs = [ multiprocessing.Process(target=stressWriter, args=(store, [1, 2, 3, 4], until, k)) for k in range(2) ]
+    procs += [ multiprocessing.Process(target=stressReader, args=(store, [1, 2, 3, 4], until, result)) for k in range(2) ]
+    for p in procs:
+        p.start()
+    got = [ result.get() for k in range(2) ]
+    for p in procs:
+        p.join()
+    (reads, torn, retries) = [ sum(g[i] for g in got) for i in range(3) ]
+    print ("Seqlock: %d reads against 2 writers, %d torn, %d retried" % (reads, torn, retries))
+    assert torn == 0 and reads > 0
+
+    def makeDevice(workers, services=None):
+        ctlr = VirtualController()
+        dev = ShardedDevice().withWorkers(workers) if workers else device.Device()
+        dev.withSocket(VirtualHCISocket(ctlr)).withMaxConnections(0x0EFF)
+        if services is not None:
+            dev.withServices(services)
+        dev.start()
+        return (dev, ctlr)
+
+    def connect(dev, ctlr, n, callback):
+        peers = []
+        for i in range(n):
+            peer = VirtualCentral(ctlr, address=struct.pack("<I", i + 1) + b'\xCC\xCC').withAttCallback(callback)
+            peer.connect()
+            dev.run() # Advertising resumes after each
+            peers.append(peer)
+        return peers
+
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        # Writes through one worker, read through the others
+        import benchmark
+        services = benchmark.makeServices(10) # Writeable at 0x0003, notifying at 0x0005
+        (dev, ctlr) = makeDevice(4, services)
+        got = {}
+        peers = connect(dev, ctlr, 4, lambda peer, pdu: got.__setitem__(peer, pdu))
+        peers[0].sendAtt(struct.pack("<BH", 0x12, 0x0003) + b'shared')
+        dev.run()
+        writeRsp = got[peers[0]]
+        for p in peers[1:]:
+            p.sendAtt(struct.pack("<BH", 0x0A, 0x0003))
+        dev.run()
+        seen = [ got[p] for p in peers[1:] ]
+        workers = len(set(dev.shardFor(c.link.handle).index for c in peers))
+        # Subscribe on one connection; only it is notified
+        peers[2].sendAtt(struct.pack("<BH", 0x12, 0x0006) + b'\x01\x00')
+        dev.run()
+        got.clear()
+        sent = dev.notify(0x0005, b'tick')
+        dev.run()
+        notified = list(got.values())
+        # A read-only value can grow
+        dev.setValue(0x0008, b'longer than it was: ' + bytes(40))
+        got.clear()
+        peers[1].sendAtt(struct.pack("<BH", 0x0A, 0x0008))
+        dev.run()
+        grown = got[peers[1]]
+
+        # A response still with the worker when its connection goes, and
+        # another takes the handle, isn't sent on the new connection
+        peers[0].sendAtt(struct.pack("<BH", 0x0A, 0x0003))
+        dev.hciSocket.runOnce()
+        dev._flush() # The Read is now with the worker
+        handle = peers[0].link.handle
+        peers[0].disconnect()
+        ctlr.nextHandle = handle
+        newcomer = VirtualCentral(ctlr, address=b'\x99\x00\x00\x00\xCC\xCC')
+        newcomer.connect()
+        dev.run()
+        reused = (newcomer.link.handle == handle)
+        leaked = list(newcomer.received)
+        stale = dev.stale
+        newcomer.sendAtt(struct.pack("<BH", 0x0A, 0x0003))
+        dev.run()
+        own = list(newcomer.received)
+        dev.close()
+    finally:
+        sys.stdout = saved
+    assert writeRsp == b'\x13', writeRsp
+    assert seen == [b'\x0Bshared'] * 3, seen
+    assert sent == 1 and notified == [b'\x1B\x05\x00tick'], notified
+    assert grown == b'\x0B' + b'longer than it was: ' + bytes(2), grown
+    assert reused and leaked == [] and stale == 1 and own == [b'\x0Bshared'], (reused, leaked, stale, own)
+    print ("Write on one worker read back on %d others; notification to the 1 subscriber" % (workers - 1))
+    print ("Read-only value grown by setValue(); late response for a reused handle dropped")
+
+    # Throughput: each central sends one request after another. The
+    # centrals and controller run in the router's process, in both modes.
+    # With a core for each process, the router or the busiest worker
+    # sets the pace, so the bound is 1 / the larger of their CPU time
+    # per request; worker CPU includes their start-up.
+    import resource
+    CENTRALS = 16
+    WORKLOADS = [
+        ("Read", None, struct.pack("<BH", 0x0A, 0x0003), 500),
+        ("Read By Type, 1000 chars", benchmark.makeServices(1000),
+         struct.pack("<BHHH", 0x08, 0x0001, 0xFFFF, gatt.UUID_CHARACTERISTIC_DECL), 20),
+    ]
+
+    def childCpu():
+        r = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return r.ru_utime + r.ru_stime
+
+    def throughput(workers, services, pdu, each):
+        state = { 'left': CENTRALS * each }
+        def onAtt(peer, rsp):
+            state['left'] -= 1
+            if state['left'] >= CENTRALS:
+                peer.sendAtt(pdu)
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        w0 = childCpu()
+        try:
+            (dev, ctlr) = makeDevice(workers, services)
+            peers = connect(dev, ctlr, CENTRALS, onAtt)
+            t0 = time.perf_counter()
+            c0 = time.process_time()
+            for p in peers:
+                p.sendAtt(pdu)
+            dev.run()
+            (t, cpu) = (time.perf_counter() - t0, time.process_time() - c0)
+            if workers:
+                dev.close()
+        finally:
+            sys.stdout = saved
+        assert state['left'] == 0, state
+        n = CENTRALS * each
+        return (n / t, cpu / n, (childCpu() - w0) / n / max(workers, 1))
+
+    print ("%d centrals, %d CPUs here:" % (CENTRALS, multiprocessing.cpu_count()))
+    for (name, services, pdu, each) in WORKLOADS:
+        print ("  %s" % name)
+        for workers in [0, 1, 2, 4]:
+            (rate, cpu, workerCpu) = throughput(workers, services, pdu, each)
+            print ("    %-16s %6.0f requests/s here, CPU each: %5.1fus router, %5.1fus per worker; "
+                   "%6.0f/s with a core each" % (
+                   "single process" if workers == 0 else "%d worker%s" % (workers, "s" if workers > 1 else ""),
+                   rate, cpu * 1e6, workerCpu * 1e6, 1.0 / max(cpu, workerCpu)))
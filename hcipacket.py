@@ -7,6 +7,9 @@ HCI_ACL_DATA_PACKET = 0x02
 HCI_EVENT_PACKET = 0x04
 
 class HCIPacket:
+    traceId = None  # Set by tracing.Tracer.tag()
+    queuedAt = None
+
     @staticmethod
     def fromBytes(buf):
         return HCIPacket(buf[0], buf[1:])
@@ -42,6 +45,9 @@ class ACLConnection:
         self.fragCID = 0
         self.fragPktLen = 0
         self.txMtu = 9999
+        self.metrics = None # metrics.StackMetrics, if any
+        self.tracer = None # tracing.Tracer, if any
+        self.fragTrace = None # (trace ID, start) of the PDU being reassembled
 
     def withChannel(self, cid, callback):
         self.channelFns[cid] = callback
@@ -49,29 +55,57 @@ class ACLConnection:
 
     # Deals with reassembly of fragmented receive packets
     def onReceivedData(self, data):
-        (hnd_flags, fraglen) = struct.unpack("<HH", data[0:4])
-        if fraglen+4 != len(data):
-            print ("Invalid ACL length %d" % fraglen) 
-            return
-        if (hnd_flags & FRAG_FLAGS) == FRAG_FIRST:
-            (pktlen,cid) = struct.unpack("<HH", data[4:8])
-            print ("First frag, cid=%02X pktlen=%04X" % (cid, pktlen))
-            if pktlen+4 == fraglen:
-                return self.onPacketComplete(cid, data[8:])
-            else:
-                self.fragBuf = data[8:]
-                self.fragCID = cid
-                self.fragPktLen = pktlen
-                print ("Have %d/%d, buffering" % (fraglen-4,pktlen)) 
-                return
-        elif (hnd_flags & FRAG_FLAGS) == FRAG_NEXT:
-            self.fragBuf += data[4:]
-            print ("Buffer length now %d/%d" % (len(self.fragBuf), self.fragPktLen))
-            if len(self.fragBuf) < self.fragPktLen:
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        try:
+            (hnd_flags, fraglen) = struct.unpack("<HH", data[0:4])
+            if fraglen+4 != len(data):
+                print ("Invalid ACL length %d" % fraglen) 
                 return
-            return self.onPacketComplete(self.fragCID, self.fragBuf[0:self.fragPktLen])
+            if self.metrics is not None:
+                self.metrics.aclReceived(self.handle, fraglen)
+            if (hnd_flags & FRAG_FLAGS) in (FRAG_FIRST, FRAG_FIRST_HOST):
+                (pktlen,cid) = struct.unpack("<HH", data[4:8])
+                print ("First frag, cid=%02X pktlen=%04X" % (cid, pktlen))
+                if self.fragBuf is not None:
+                    self._stalled()
+                if pktlen+4 == fraglen:
+                    return self.onPacketComplete(cid, data[8:])
+                else:
+                    self.fragBuf = data[8:]
+                    self.fragCID = cid
+                    self.fragPktLen = pktlen
+                    if self.tracer is not None:
+                        self.fragTrace = (self.tracer.current, self.tracer.now())
+                    print ("Have %d/%d, buffering" % (fraglen-4,pktlen)) 
+                    return
+            elif (hnd_flags & FRAG_FLAGS) == FRAG_NEXT:
+                if self.fragBuf is None:
+                    print ("Continuation with no start, dropped")
+                    return self._stalled()
+                self.fragBuf += data[4:]
+                print ("Buffer length now %d/%d" % (len(self.fragBuf), self.fragPktLen))
+                if len(self.fragBuf) < self.fragPktLen:
+                    return
+                (buf, self.fragBuf) = (self.fragBuf, None)
+                if self.tracer is not None and self.fragTrace is not None:
+                    # The PDU, and what's sent in reply, keep the first fragment's ID
+                    (self.tracer.current, start) = self.fragTrace
+                    self.tracer.span("fragments", self.tracer.current, start, self.tracer.now())
+                    self.fragTrace = None
+                return self.onPacketComplete(self.fragCID, buf[0:self.fragPktLen])
             
-        print ("Unhandled ACL receive data hnd_flags=0x%04X" % hnd_flags)
+            print ("Unhandled ACL receive data hnd_flags=0x%04X" % hnd_flags)
+        finally:
+            if tracer is not None:
+                tracer.span("acl", tracer.current, start, tracer.now())
+
+    def _stalled(self):
+        # A PDU was left part way through reassembly
+        self.fragBuf = None
+        if self.metrics is not None:
+            self.metrics.reassemblyStalled(self.handle)
 
     def onPacketComplete(self, cid, data):
         if cid in self.channelFns:
@@ -82,11 +116,21 @@ class ACLConnection:
 
     def send(self, cid, data):
         # FIXME: what is MTU here?
+        tracer = self.tracer
+        if tracer is not None:
+            if tracer.current is None:
+                return self._tracedSend(tracer, cid, data)
+            start = tracer.now()
         dlen = len(data)
+        if self.metrics is not None:
+            self.metrics.aclSent(self.handle, dlen + 4)
         if dlen <= self.txMtu - 8:
             payload = struct.pack("<HHHH", FRAG_FIRST_HOST | self.handle,
                 dlen+4, dlen, cid) + data
-            self.sock.queuePacket(HCIPacket(HCI_ACL_DATA_PACKET, payload))
+            pkt = HCIPacket(HCI_ACL_DATA_PACKET, payload)
+            if tracer is not None:
+                tracer.tag(pkt)
+            self.sock.queuePacket(pkt)
         else:
             pdu = struct.pack("<HH", dlen, cid) + data
             pos = 0
@@ -94,13 +138,39 @@ class ACLConnection:
             flags = FRAG_FIRST_HOST | self.handle
             while remain > 0:
                 n = min(remain, self.txMtu-4)
-                payload = struct.pack("<HH", flags, n) + data[pos : pos+n]
-                self.sock.queuePacket(HCIPacket(HCI_ACL_DATA_PACKET, payload))
+                payload = struct.pack("<HH", flags, n) + pdu[pos : pos+n]
+                pkt = HCIPacket(HCI_ACL_DATA_PACKET, payload)
+                if tracer is not None:
+                    tracer.tag(pkt)
+                self.sock.queuePacket(pkt)
                 flags = FRAG_NEXT | self.handle
                 pos += n
                 remain -= n
+        if tracer is not None:
+            tracer.span("send", tracer.current, start, tracer.now())
+
+    def _tracedSend(self, tracer, cid, data):
+        # Sent unprompted (e.g. a notification), so starts its own trace
+        tracer.begin()
+        try:
+            self.send(cid, data)
+        finally:
+            tracer.end()
 
     def onDisconnect(self, reason):
         print ("Handle 0x%04X disconnecting, reason 0x%02X" % (self.handle, reason))
 
+# LE signaling channel, Vol 3 / A / 4
+CID_LE_SIGNALING = 0x0005
+SIG_COMMAND_REJECT = 0x01
+SIG_CONN_PARAM_UPDATE_REQ = 0x12
+SIG_CONN_PARAM_UPDATE_RSP = 0x13
+PARAMS_ACCEPTED = 0x0000
+PARAMS_REJECTED = 0x0001
+
+def parameterRequest(identifier, intervalMin, intervalMax, latency, timeout):
+    return struct.pack("<BBHHHHH", SIG_CONN_PARAM_UPDATE_REQ, identifier, 8,
+                       intervalMin, intervalMax, latency, timeout)
 
+def parameterResponse(identifier, result):
+    return struct.pack("<BBHH", SIG_CONN_PARAM_UPDATE_RSP, identifier, 2, result)
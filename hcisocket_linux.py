@@ -6,6 +6,8 @@ import select
 import struct
 
 import hcipacket
+import txsched
+import timerwheel
 
 
 class HCISocket:
@@ -18,48 +20,100 @@ class HCISocket:
         self.sock.bind( (devId,) )
         filt = struct.pack("@LLLH", # struct hci_filter
                     0x14, # type_mask
-                    0xC120, 0x40000000, # event_mask[2]
+                    0x8C120, 0x40000000, # event_mask[2]: 05,08,0E,0F,13,3E
                     0 ) # opcode
         self.sock.setsockopt(socket.SOL_HCI, socket.HCI_FILTER, filt)
-        self.packetQueue = []
+        self.packetQueue = txsched.TransmitScheduler()
         self.poller = select.poll()
         self.poller.register(self.sock)
         self.running = False
+        self.taps = []
+        self.host = None
+        self.timers = timerwheel.TimerWheel()
+        self.tracer = None # tracing.Tracer, if any
 
     def withDelegate(self, d):
         self.delegate = d
         return self
 
-    def queuePacket(self, packet):
-        self.packetQueue.append(packet)
+    def withHost(self, host):
+        # Lets e.g. a multiadapter.MultiAdapterHost drive this socket from
+        # its own loop; run() then returns at once
+        self.host = host
+        return self
+
+    def withTap(self, tap):
+        # tap.onPacketSent(sock, data) / tap.onPacketReceived(sock, data)
+        # see every raw packet (including the type byte), e.g. for capture
+        self.taps.append(tap)
+        return self
+
+    def queuePacket(self, packet, txClass=None):
+        # Returns False if dropped (see txsched.DEFAULT_LIMITS)
+        return self.packetQueue.push(packet, txClass)
 
     def stop(self):
         self.running = False
 
+    def callLater(self, delay, callback, *args):
+        # Timers run from the poll loop; returns a timerwheel.Timer
+        return self.timers.callLater(delay, callback, *args)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def pollMask(self):
+        if self.packetQueue.ready():
+            return (select.POLLIN|select.POLLOUT|select.POLLERR)
+        return (select.POLLIN|select.POLLERR)
+
+    def onPollEvent(self, evtmask):
+        # Does one poll's worth of I/O; returns False if socket failed
+        if (evtmask & select.POLLERR):
+            print ("Error on socket, exiting")
+            self.running = False
+            return False
+        pkt = self.packetQueue.pop() if (evtmask & select.POLLOUT) else None
+        if pkt is not None:
+            print ("Sending:" + str(pkt))
+            data = pkt.toBytes()
+            if self.tracer is not None:
+                start = self.tracer.now()
+            self.sock.send(data)
+            if self.tracer is not None:
+                self.tracer.sent(pkt, start)
+            for tap in self.taps:
+                tap.onPacketSent(self, data)
+        if (evtmask & select.POLLIN):
+            tracer = self.tracer
+            if tracer is not None:
+                # From poll wakeup; the kernel's wait isn't seen
+                start = tracer.now()
+            pktbuf = self.sock.recv(self.MAX_PACKET_LEN)
+            for tap in self.taps:
+                tap.onPacketReceived(self, pktbuf)
+            pkt = hcipacket.HCIPacket.fromBytes(pktbuf)
+            print ("Got:" + str(pkt))
+            if tracer is None:
+                self.delegate.onPacketReceived(self, pkt)
+            else:
+                traceId = tracer.begin()
+                tracer.span("socket", traceId, start, tracer.now())
+                self.delegate.onPacketReceived(self, pkt)
+                tracer.end()
+        return True
+
     def run(self):
         self.running = True
+        if self.host is not None:
+            return
         while self.running:
-            if len(self.packetQueue) > 0:
-                self.poller.modify(self.sock, (select.POLLIN|select.POLLOUT|select.POLLERR))
-            else:
-                self.poller.modify(self.sock, (select.POLLIN|select.POLLERR))
+            self.poller.modify(self.sock, self.pollMask())
             print ("Wait...")
-            evts = self.poller.poll(1000.0)
+            timeout = self.timers.nextTimeout()
+            evts = self.poller.poll(1000.0 if (timeout is None) else min(1000.0, timeout*1000.0))
             for (fd, evtmask) in evts:
-                if (evtmask & select.POLLERR):
-                    print ("Error on socket, exiting")
-                    self.running = False
+                if not self.onPollEvent(evtmask):
                     break
-                if (evtmask & select.POLLOUT) and len(self.packetQueue) > 0:
-                    pkt = self.packetQueue.pop(0)
-                    print ("Sending:" + str(pkt))
-                    self.sock.send( pkt.toBytes() )
-                if (evtmask & select.POLLIN):
-                    pktbuf = self.sock.recv(self.MAX_PACKET_LEN)
-                    pkt = hcipacket.HCIPacket.fromBytes(pktbuf)
-                    print ("Got:" + str(pkt))
-                    self.delegate.onPacketReceived(self, pkt)
-
-
-
+            self.timers.advance()
 
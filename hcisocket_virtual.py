@@ -0,0 +1,1109 @@
+import time
+import struct
+import binascii
+import collections
+
+import hcipacket
+import commands
+import events
+import gatt
+import txsched
+import timerwheel
+from hcipacket import HCI_COMMAND_PACKET, HCI_ACL_DATA_PACKET, HCI_EVENT_PACKET
+from events import ADV_IND, ADV_DIRECT_IND, ADV_SCAN_IND, ADV_NONCONN_IND, SCAN_RSP
+
+# In-process stand-in for hcisocket_linux.HCISocket. A VirtualHCISocket
+# has the same withDelegate / queuePacket / run / stop interface, but
+# instead of a kernel socket it talks to a VirtualController, which
+# answers the commands in commands.py and emulates advertising, scanning,
+# connections and ACL buffer flow control. Virtual peers (a central
+# which connects to us, or advertisers which we can scan) sit behind
+# the controller, so the whole stack can be run with no hardware.
+
+def opcodeOf(cmdclass):
+    return (cmdclass.OGF << 10) | cmdclass.OCF
+
+# HCI error codes, Vol 2 Part D
+E_SUCCESS = 0x00
+E_UNKNOWN_COMMAND = 0x01
+E_UNKNOWN_CONNECTION = 0x02
+E_MEMORY_CAPACITY_EXCEEDED = 0x07
+E_COMMAND_DISALLOWED = 0x0C
+E_INVALID_PARAMETERS = 0x12
+E_REMOTE_USER_TERMINATED = 0x13
+E_LOCAL_HOST_TERMINATED = 0x16
+E_UNSUPPORTED_REMOTE_FEATURE = 0x1A
+E_UNKNOWN_ADVERTISING_IDENTIFIER = 0x42
+
+# Defaults after HCI Reset, Vol 2, 7.3.1 and 7.8.1
+RESET_EVENT_MASK = 0x00001FFFFFFFFFFF
+RESET_LE_EVENT_MASK = 0x000000000000001F
+
+# LE features of a peer which supports Data Length Extension and 2M
+FEATURES_DLE_2M = (0x01 | commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION |
+                   commands.LEReadLocalSupportedFeatures.LE_2M_PHY)
+MAX_DATA_OCTETS = 251 # Vol 6 / B / 4.5.10
+IFS = 150e-6
+
+def pduAirTime(octets, phy):
+    # Seconds to send an LL data PDU without MIC: preamble, access
+    # address, header, payload and CRC (Vol 6 / B / 2.1), at 1 or 2Mbit/s
+    if phy == commands.LESetDefaultPhy.PHY_2M:
+        return (11 + octets) * 4e-6
+    return (10 + octets) * 8e-6
+
+
+class VirtualHCISocket:
+    def __init__(self, controller=None):
+        self.controller = controller if (controller is not None) else VirtualController()
+        self.controller.attach(self)
+        self.delegate = None
+        self.packetQueue = txsched.TransmitScheduler()
+        self.rxQueue = collections.deque()
+        self.running = False
+        self.taps = []
+        self.host = None
+        self.timers = timerwheel.TimerWheel()
+        self.tracer = None # tracing.Tracer, if any
+        self.rxTimes = collections.deque() # When each rxQueue packet came, if tracing
+
+    def withDelegate(self, d):
+        self.delegate = d
+        return self
+
+    def withHost(self, host):
+        # Lets e.g. a multiadapter.MultiAdapterHost drive this socket from
+        # its own loop; run() then returns at once
+        self.host = host
+        return self
+
+    def withTap(self, tap):
+        self.taps.append(tap)
+        return self
+
+    def queuePacket(self, packet, txClass=None):
+        return self.packetQueue.push(packet, txClass)
+
+    def stop(self):
+        self.running = False
+
+    def callLater(self, delay, callback, *args):
+        return self.timers.callLater(delay, callback, *args)
+
+    def deliver(self, data):
+        # Called by the controller with a complete packet for the host
+        self.rxQueue.append(data)
+        if self.tracer is not None:
+            self.rxTimes.append(self.tracer.now())
+
+    def runOnce(self):
+        '''Moves all pending packets in both directions.
+           Returns True if anything happened.'''
+        busy = self.timers.advance() > 0
+        while True:
+            pkt = self.packetQueue.pop()
+            if pkt is None:
+                break
+            data = pkt.toBytes()
+            if self.tracer is not None:
+                start = self.tracer.now()
+            self.controller.onHostPacket(data)
+            if self.tracer is not None:
+                self.tracer.sent(pkt, start)
+            for tap in self.taps:
+                tap.onPacketSent(self, data)
+            busy = True
+        self.controller.onTurnComplete()
+        while len(self.rxQueue) > 0 and self.delegate is not None:
+            data = self.rxQueue.popleft()
+            for tap in self.taps:
+                tap.onPacketReceived(self, data)
+            pkt = hcipacket.HCIPacket.fromBytes(data)
+            tracer = self.tracer
+            if tracer is None:
+                self.delegate.onPacketReceived(self, pkt)
+            else:
+                traceId = tracer.begin()
+                tracer.span("socket", traceId, self.rxTimes.popleft() if self.rxTimes else tracer.now(),
+                            tracer.now())
+                self.delegate.onPacketReceived(self, pkt)
+                tracer.end()
+            busy = True
+        return busy
+
+    def run(self):
+        # Unlike the real socket, returns when nothing is left to do
+        # (no queued packets or timers, and the controller has nothing
+        # to emit).
+        self.running = True
+        if self.host is not None:
+            return
+        while self.running:
+            if self.runOnce() or self.controller.tick():
+                continue
+            timeout = self.timers.nextTimeout()
+            if timeout is None:
+                break
+            time.sleep(timeout)
+        self.running = False
+
+
+class VirtualConnection:
+    # One LE link, as seen from the controller
+
+    def __init__(self, controller, handle, peer, role):
+        self.controller = controller
+        self.handle = handle
+        self.peer = peer
+        self.role = role # Host's role: 0x00 master, 0x01 slave
+        self.interval = 0x0018 # 1.25ms units
+        self.latency = 0
+        self.timeout = 0x0048 # 10ms units
+        self.txOctets = self.rxOctets = commands.DEFAULT_DATA_OCTETS # Max LL payloads
+        self.txPhy = self.rxPhy = commands.LESetDefaultPhy.PHY_1M
+        self.airFree = 0.0 # When the last host data queued will have gone
+        self.airQueue = collections.deque() # (time sent, hnd_flags, data), in order
+        self.airTimer = None
+        self.rxBuf = None
+        self.rxPktLen = 0
+
+    def onHostData(self, hnd_flags, data):
+        # Reassemble host->controller ACL, and pass L2CAP PDUs to peer
+        flags = hnd_flags & hcipacket.FRAG_FLAGS
+        if flags == hcipacket.FRAG_NEXT:
+            if self.rxBuf is None:
+                print ("Virtual: continuation with no start, handle 0x%04X" % self.handle)
+                return
+            self.rxBuf += data
+        else:
+            (self.rxPktLen, _) = struct.unpack("<HH", data[0:4])
+            self.rxBuf = bytes(data)
+        if len(self.rxBuf) >= self.rxPktLen + 4:
+            (_, cid) = struct.unpack("<HH", self.rxBuf[0:4])
+            pdu = self.rxBuf[4:4+self.rxPktLen]
+            self.rxBuf = None
+            self.peer.onL2CAPReceived(self, cid, pdu)
+
+    def dataAirTime(self, dlen):
+        # Sending dlen bytes of host data as LL PDUs of up to txOctets,
+        # each acknowledged by an empty PDU from the peer
+        t = 0.0
+        for pos in range(0, dlen, self.txOctets):
+            t += (pduAirTime(min(self.txOctets, dlen - pos), self.txPhy) + IFS +
+                  pduAirTime(0, self.rxPhy) + IFS)
+        return t
+
+    def sendToHost(self, cid, pdu):
+        # Fragment an L2CAP PDU into controller->host ACL packets
+        frame = struct.pack("<HH", len(pdu), cid) + bytes(pdu)
+        fragLen = self.controller.rxFragmentLength
+        flags = hcipacket.FRAG_FIRST
+        for pos in range(0, len(frame), fragLen):
+            frag = frame[pos:pos+fragLen]
+            self.controller.deliverToHost(HCI_ACL_DATA_PACKET,
+                struct.pack("<HH", flags | self.handle, len(frag)) + frag)
+            flags = hcipacket.FRAG_NEXT
+
+
+class VirtualPeer:
+    # Base class for things on the far side of the radio link
+
+    def __init__(self, address, addrType=0):
+        if len(address) != 6:
+            raise ValueError("address must be 6 bytes")
+        self.address = bytes(address)
+        self.addrType = addrType
+        self.link = None
+        self.signaling = [] # LE signaling PDUs from the host
+        self.features = 0x01 # LE features, Vol 6 / B / 4.6
+
+    def withFeatures(self, features):
+        # e.g. FEATURES_DLE_2M, to allow longer packets and 2M PHY
+        self.features = features
+        return self
+
+    def onConnected(self, link):
+        self.link = link
+
+    def onDisconnected(self, reason):
+        self.link = None
+
+    def onL2CAPReceived(self, link, cid, pdu):
+        if cid == hcipacket.CID_LE_SIGNALING:
+            return self.onSignalingReceived(link, pdu)
+        print ("Virtual peer dropping %d bytes on CID %d" % (len(pdu), cid))
+
+    def onSignalingReceived(self, link, pdu):
+        # Keeps what the host answers
+        self.signaling.append(pdu)
+
+    def requestConnectionParameters(self, intervalMin, intervalMax, latency, timeout, identifier=1):
+        # As slave, asks the host (as master) for new parameters
+        self.link.sendToHost(hcipacket.CID_LE_SIGNALING, hcipacket.parameterRequest(
+            identifier, intervalMin, intervalMax, latency, timeout))
+
+    def isConnected(self):
+        return self.link is not None
+
+
+class VirtualCentral(VirtualPeer):
+    # Remote central which connects to an advertising host, then
+    # exchanges ATT PDUs with it
+
+    def __init__(self, controller, address=b'\x01\x00\x00\x00\xCC\xCC', addrType=0):
+        VirtualPeer.__init__(self, address, addrType)
+        self.controller = controller
+        self.attCallback = None
+        self.received = []
+        self.acceptParameters = True # Answer to the host's parameter requests
+
+    def withAttCallback(self, callback):
+        # callback(central, pdu)
+        self.attCallback = callback
+        return self
+
+    def connect(self, interval=0x0018, latency=0, timeout=0x0048):
+        return self.controller.connectFromPeer(self, interval, latency, timeout)
+
+    def disconnect(self, reason=E_REMOTE_USER_TERMINATED):
+        if self.link is not None:
+            self.controller.disconnect(self.link, reason)
+
+    def sendAtt(self, pdu):
+        if self.link is None:
+            raise RuntimeError("Virtual central not connected")
+        self.link.sendToHost(gatt.CID_GATT, pdu)
+
+    def onSignalingReceived(self, link, pdu):
+        # As master, answers the host's Connection Parameter Update
+        # Requests, then (if accepted) updates the connection
+        self.signaling.append(pdu)
+        if pdu[0] != hcipacket.SIG_CONN_PARAM_UPDATE_REQ:
+            return
+        (identifier, intervalMin, intervalMax, latency, timeout) = struct.unpack("<BxxHHHH", pdu[1:12])
+        ok = self.acceptParameters and commands.validParameters(intervalMin, intervalMax, latency, timeout)
+        link.sendToHost(hcipacket.CID_LE_SIGNALING, hcipacket.parameterResponse(
+            identifier, hcipacket.PARAMS_ACCEPTED if ok else hcipacket.PARAMS_REJECTED))
+        if ok:
+            self.controller.updateConnection(link, intervalMax, latency, timeout)
+
+    def onL2CAPReceived(self, link, cid, pdu):
+        if cid != gatt.CID_GATT:
+            return VirtualPeer.onL2CAPReceived(self, link, cid, pdu)
+        if self.attCallback:
+            self.attCallback(self, pdu)
+        else:
+            self.received.append(pdu)
+
+
+class VirtualAdvertiser(VirtualPeer):
+    # Remote device which is seen when the host scans
+
+    def __init__(self, address, advData=b'', scanData=None, addrType=0,
+                 eventType=ADV_IND, rssi=-60):
+        VirtualPeer.__init__(self, address, addrType)
+        self.advData = bytes(advData)
+        self.scanData = None if (scanData is None) else bytes(scanData)
+        self.eventType = eventType
+        self.rssi = rssi
+
+    def getReports(self, active):
+        # Returns list of (event_type, data) seen during one scan pass
+        rv = [ (self.eventType, self.advData) ]
+        if active and (self.scanData is not None) and self.eventType in [ADV_IND, ADV_SCAN_IND]:
+            rv.append( (SCAN_RSP, self.scanData) )
+        return rv
+
+
+class VirtualPeripheral(VirtualAdvertiser):
+    # Connectable advertiser with a gatt.GattServer, for the host (as a
+    # central) to connect to and use
+
+    def __init__(self, address, server, advData=b'', scanData=None, addrType=0, rssi=-60,
+                 responseDelay=0.0, responseIntervals=0):
+        VirtualAdvertiser.__init__(self, address, advData, scanData, addrType, ADV_IND, rssi)
+        self.server = server
+        self.requests = 0
+        self.responseDelay = responseDelay # Seconds, e.g. to model connection interval
+        self.responseIntervals = responseIntervals # If set, responses wait this many connection intervals
+
+    def onL2CAPReceived(self, link, cid, pdu):
+        if cid != gatt.CID_GATT:
+            return VirtualPeer.onL2CAPReceived(self, link, cid, pdu)
+        self.requests += 1
+        self.server.onMessageReceived(self, cid, pdu)
+
+    def send(self, cid, data):
+        # From the GattServer, which takes us for an hcipacket.ACLConnection
+        if self.link is None:
+            return
+        delay = self.responseDelay
+        if self.responseIntervals > 0:
+            delay = self.responseIntervals * self.link.interval * 0.00125
+        if delay > 0:
+            self.link.controller.sock.callLater(delay, self._sendNow, self.link, cid, data)
+        else:
+            self.link.sendToHost(cid, data)
+
+    def _sendNow(self, link, cid, data):
+        if link is self.link:
+            link.sendToHost(cid, data)
+
+
+class VirtualAdvertisingSet:
+    # One extended advertising set, on our side
+
+    def __init__(self, params):
+        self.params = params
+        (self.properties,) = struct.unpack("<H", params[1:3])
+        self.interval = struct.unpack("<I", params[6:9] + b'\x00')[0] # Max interval
+        self.advData = b''
+        self.scanRspData = b''
+        self.enabled = False
+
+
+class VirtualController:
+    def __init__(self, address=b'\x01\x00\x00\xAA\xBB\xCC',
+                 aclBufferLength=27, aclBufferCount=8, numCmdPackets=1,
+                 version=commands.ReadLocalVersion.BLUETOOTH_V4_0, features=0x01,
+                 commandLatency=0.0, whiteListSize=8, advertisingSets=4, dataAirTime=False):
+        if len(address) != 6:
+            raise ValueError("address must be 6 bytes")
+        self.address = bytes(address)
+        self.aclBufferLength = aclBufferLength
+        self.aclBufferCount = aclBufferCount
+        self.numCmdPackets = numCmdPackets
+        self.commandLatency = commandLatency # Seconds before each Command Complete
+        self.commandsBusy = 0
+        self.version = version
+        self.features = features
+        self.whiteListSize = whiteListSize
+        self.advertisingSets = advertisingSets # If features has EXTENDED_ADVERTISING
+        self.rxFragmentLength = 27 # Max ACL fragment sent to host
+        self.dataAirTime = dataAirTime # If set, host ACL data takes its time on air to go
+        self.sock = None
+        self.advertisers = []
+        self.stats = collections.Counter()
+        self.handlers = {}
+        self.ignoredOpcodes = set() # Commands to drop, e.g. to test timeouts
+        for (cmdclass, fn) in [
+            (commands.Reset, self.cmdReset),
+            (commands.SetEventMask, self.cmdSetEventMask),
+            (commands.ReadLocalVersion, self.cmdReadLocalVersion),
+            (commands.ReadBDADDR, self.cmdReadBDADDR),
+            (commands.WriteLEHostSupported, self.cmdWriteLEHostSupported),
+            (commands.LESetEventMask, self.cmdLESetEventMask),
+            (commands.LEReadBufferSize, self.cmdLEReadBufferSize),
+            (commands.LEReadLocalSupportedFeatures, self.cmdLEReadLocalSupportedFeatures),
+            (commands.LESetAdvertisingParameters, self.cmdLESetAdvertisingParameters),
+            (commands.LESetAdvertisingData, self.cmdLESetAdvertisingData),
+            (commands.LESetScanResponseData, self.cmdLESetScanResponseData),
+            (commands.LESetAdvertiseEnable, self.cmdLESetAdvertiseEnable),
+            (commands.LESetScanParameters, self.cmdLESetScanParameters),
+            (commands.LESetScanEnable, self.cmdLESetScanEnable),
+            (commands.LECreateConnection, self.cmdLECreateConnection),
+            (commands.LECreateConnectionCancel, self.cmdLECreateConnectionCancel),
+            (commands.Disconnect, self.cmdDisconnect),
+            (commands.LEConnectionUpdate, self.cmdLEConnectionUpdate),
+            (commands.LEReadWhiteListSize, self.cmdLEReadWhiteListSize),
+            (commands.LEClearWhiteList, self.cmdLEClearWhiteList),
+            (commands.LEAddDeviceToWhiteList, self.cmdLEAddDeviceToWhiteList),
+            (commands.LERemoveDeviceFromWhiteList, self.cmdLERemoveDeviceFromWhiteList),
+            (commands.LESetExtendedAdvertisingParameters, self.cmdLESetExtendedAdvertisingParameters),
+            (commands.LESetExtendedAdvertisingData, self.cmdLESetExtendedAdvertisingData),
+            (commands.LESetExtendedScanResponseData, self.cmdLESetExtendedScanResponseData),
+            (commands.LESetExtendedAdvertisingEnable, self.cmdLESetExtendedAdvertisingEnable),
+            (commands.LEReadNumberOfSupportedAdvertisingSets, self.cmdLEReadNumberOfSupportedAdvertisingSets),
+            (commands.LESetDataLength, self.cmdLESetDataLength),
+            (commands.LEReadSuggestedDefaultDataLength, self.cmdLEReadSuggestedDefaultDataLength),
+            (commands.LEWriteSuggestedDefaultDataLength, self.cmdLEWriteSuggestedDefaultDataLength),
+            (commands.LEReadMaximumDataLength, self.cmdLEReadMaximumDataLength),
+            (commands.LEReadPhy, self.cmdLEReadPhy),
+            (commands.LESetDefaultPhy, self.cmdLESetDefaultPhy),
+            (commands.LESetPhy, self.cmdLESetPhy),
+            ]:
+            self.handlers[opcodeOf(cmdclass)] = fn
+        self.reset()
+
+    def attach(self, sock):
+        self.sock = sock
+
+    def reset(self):
+        self.eventMask = RESET_EVENT_MASK
+        self.leEventMask = RESET_LE_EVENT_MASK
+        self.leHostSupported = False
+        self.advParams = commands.LESetAdvertisingParameters().params
+        self.advData = b''
+        self.scanRspData = b''
+        self.advertising = False
+        self.scanType = commands.LESetScanParameters.PASSIVE
+        self.scanning = False
+        self.scanFilterPolicy = commands.LESetScanParameters.FILTER_ACCEPT_ALL
+        self.scanFilterDuplicates = False
+        self.scanSeen = set()
+        self.connections = {} # Maps handle to VirtualConnection
+        self.nextHandle = 0x0040
+        self.aclInFlight = collections.Counter() # Maps handle to buffers used
+        self.aclFree = self.aclBufferCount
+        self.initiating = None # (policy, addrType, address, interval, latency, timeout)
+        self.initiatingStarted = False
+        self.whiteList = set() # (addrType, address)
+        self.advSets = {} # Maps handle to VirtualAdvertisingSet
+        self.advCommands = None # 'legacy' or 'extended', once either has been used
+        self.airTime = collections.Counter() # Maps advertising data to seconds on air
+        self.airEvents = collections.Counter() # and to advertising events sent
+        self.airChecked = time.monotonic()
+        self.suggestedDataLength = (commands.DEFAULT_DATA_OCTETS, commands.DEFAULT_DATA_TIME)
+        self.defaultPhys = (0, commands.LESetDefaultPhy.PREFER_1M, commands.LESetDefaultPhy.PREFER_1M)
+
+    def withAdvertiser(self, adv):
+        self.advertisers.append(adv)
+        return self
+
+    # Sending to host -----------------------
+
+    def deliverToHost(self, packetType, payload):
+        self.stats['rx_packets'] += 1
+        self.sock.deliver(bytes([packetType]) + payload)
+
+    def sendEvent(self, eventCode, params):
+        if eventCode not in [events.E_CMD_RESPONSE, events.E_CMD_STATUS, events.E_NUM_COMPLETED_PACKETS]:
+            if not (self.eventMask & events.eventMask([eventCode])):
+                return
+        self.deliverToHost(HCI_EVENT_PACKET, struct.pack("<BB", eventCode, len(params)) + params)
+
+    def sendLEMetaEvent(self, subEvent, params):
+        if not (self.eventMask & events.eventMask([events.E_LE_META_EVENT])):
+            return
+        if not (self.leEventMask & events.eventMask([subEvent])):
+            return
+        self.sendEvent(events.E_LE_META_EVENT, bytes([subEvent]) + params)
+
+    def commandComplete(self, opcode, retParams, then=None):
+        self._respond(events.E_CMD_RESPONSE,
+            lambda credits: struct.pack("<BH", credits, opcode) + retParams, then)
+
+    def commandStatus(self, opcode, status, then=None):
+        # then() runs after the status is sent, e.g. to send the event
+        # which completes the command
+        self._respond(events.E_CMD_STATUS,
+            lambda credits: struct.pack("<BBH", status, credits, opcode), then)
+
+    def _respond(self, eventCode, makeParams, then):
+        if self.commandLatency > 0:
+            # Emulates a controller (or transport) which takes a while to
+            # answer; up to numCmdPackets commands are worked on at once
+            self.commandsBusy += 1
+            self.sock.callLater(self.commandLatency, self._sendResponse, eventCode, makeParams, then)
+        else:
+            self._sendResponse(eventCode, makeParams, then)
+
+    def _sendResponse(self, eventCode, makeParams, then):
+        if self.commandLatency > 0:
+            self.commandsBusy -= 1
+        credits = max(0, self.numCmdPackets - self.commandsBusy)
+        self.sendEvent(eventCode, makeParams(credits))
+        if then is not None:
+            then()
+
+    # Receiving from host -------------------
+
+    def onHostPacket(self, data):
+        self.stats['tx_packets'] += 1
+        if data[0] == HCI_COMMAND_PACKET:
+            (opcode, plen) = struct.unpack("<HB", data[1:4])
+            params = data[4:]
+            if plen != len(params):
+                print ("Virtual: bad command length for opcode 0x%04X" % opcode)
+                return
+            self.onCommand(opcode, params)
+        elif data[0] == HCI_ACL_DATA_PACKET:
+            self.onAclData(data[1:])
+        else:
+            print ("Virtual: unexpected packet type %02X from host" % data[0])
+
+    def onCommand(self, opcode, params):
+        self.stats['commands'] += 1
+        if opcode in self.ignoredOpcodes:
+            self.stats['commands_ignored'] += 1
+            return
+        if opcode in self.handlers:
+            try:
+                retParams = self.handlers[opcode](params)
+            except struct.error:
+                retParams = bytes([E_INVALID_PARAMETERS])
+        else:
+            print ("Virtual: unknown command opcode 0x%04X" % opcode)
+            retParams = bytes([E_UNKNOWN_COMMAND])
+        if retParams is not None:
+            self.commandComplete(opcode, retParams)
+
+    def onAclData(self, payload):
+        (hnd_flags, dlen) = struct.unpack("<HH", payload[0:4])
+        handle = hnd_flags & 0xFFF
+        if handle not in self.connections:
+            print ("Virtual: ACL data for unknown handle 0x%04X" % handle)
+            return
+        if dlen > self.aclBufferLength or dlen != len(payload)-4:
+            print ("Virtual: bad ACL length %d on handle 0x%04X" % (dlen, handle))
+            self.stats['acl_bad_length'] += 1
+            return
+        if self.aclFree == 0:
+            # Host ignored its buffer credits
+            self.stats['acl_overruns'] += 1
+        else:
+            self.aclFree -= 1
+        link = self.connections[handle]
+        if self.dataAirTime:
+            # Packets on a link go out one after another; the buffer comes
+            # back once the last PDU is acknowledged
+            now = time.monotonic()
+            link.airFree = max(link.airFree, now) + link.dataAirTime(dlen)
+            link.airQueue.append( (link.airFree, hnd_flags, payload[4:]) )
+            if link.airTimer is None:
+                link.airTimer = self.sock.callLater(link.airFree - now, self._onDataSent, link)
+            return
+        self.aclInFlight[handle] += 1
+        link.onHostData(hnd_flags, payload[4:])
+
+    def _onDataSent(self, link):
+        # One timer per link, as timers due in the same tick may run in
+        # any order
+        link.airTimer = None
+        if self.connections.get(link.handle) is not link:
+            return
+        now = time.monotonic()
+        while len(link.airQueue) > 0 and link.airQueue[0][0] <= now:
+            (_, hnd_flags, data) = link.airQueue.popleft()
+            self.aclInFlight[link.handle] += 1
+            link.onHostData(hnd_flags, data)
+        if len(link.airQueue) > 0:
+            link.airTimer = self.sock.callLater(link.airQueue[0][0] - now, self._onDataSent, link)
+
+    def onTurnComplete(self):
+        # Everything the host sent this turn has now gone out over the
+        # air; hand back the buffer credits
+        if len(self.aclInFlight) == 0:
+            return
+        items = list(self.aclInFlight.items())
+        self.aclInFlight.clear()
+        params = bytes([len(items)])
+        for (handle, count) in items:
+            params += struct.pack("<HH", handle, count)
+            self.aclFree = min(self.aclFree + count, self.aclBufferCount)
+        self.sendEvent(events.E_NUM_COMPLETED_PACKETS, params)
+
+    def tick(self):
+        # Generates spontaneous traffic (e.g. advertising reports).
+        # Returns True if anything was sent to the host.
+        sent = self.tryInitiate()
+        if not self.scanning:
+            return sent
+        active = (self.scanType == commands.LESetScanParameters.ACTIVE)
+        useWhiteList = (self.scanFilterPolicy == commands.LESetScanParameters.FILTER_WHITE_LIST)
+        for adv in self.advertisers:
+            if adv.isConnected():
+                continue
+            if useWhiteList and (adv.addrType, adv.address) not in self.whiteList:
+                continue
+            for (evtType, data) in adv.getReports(active):
+                key = (adv.address, evtType)
+                if self.scanFilterDuplicates:
+                    if key in self.scanSeen:
+                        continue
+                    self.scanSeen.add(key)
+                self.sendAdvertisingReport(adv, evtType, data)
+                sent = True
+        return sent
+
+    def sendAdvertisingReport(self, adv, evtType, data):
+        self.stats['adv_reports'] += 1
+        self.sendLEMetaEvent(events.E_LE_ADVERTISING_REPORT,
+            struct.pack("<BBB6sB", 1, evtType, adv.addrType, adv.address, len(data))
+               + data + struct.pack("<b", adv.rssi))
+
+    # Connections ---------------------------
+
+    def onAir(self):
+        # Returns list of (advData, interval) now being advertised
+        if self.advCommands == 'extended':
+            return [ (a.advData, a.interval) for a in self.advSets.values() if a.enabled ]
+        if self.advertising:
+            (interval,) = struct.unpack("<H", self.advParams[2:4]) # Max interval
+            return [ (self.advData, interval) ]
+        return []
+
+    def accountAir(self):
+        # Credits what's been on air since last time; call before any
+        # change to it
+        now = time.monotonic()
+        for (data, interval) in self.onAir():
+            self.airTime[data] += now - self.airChecked
+            self.airEvents[data] += (now - self.airChecked) / (interval * 0.000625)
+        self.airChecked = now
+
+    def _advCommands(self, kind):
+        # Vol 4 / E / 3.1.1: a host uses legacy or extended advertising
+        # commands, not both, until reset
+        if self.advCommands is None:
+            self.advCommands = kind
+        return self.advCommands == kind
+
+    def allocHandle(self):
+        # Vol 4 / E / 5.4.2: handles run 0x000 to 0xEFF
+        while self.nextHandle in self.connections:
+            self.nextHandle = (self.nextHandle + 1) % 0xF00
+        hnd = self.nextHandle
+        self.nextHandle = (self.nextHandle + 1) % 0xF00
+        return hnd
+
+    def findAdvertiser(self, addrType, address):
+        for adv in self.advertisers:
+            if adv.address == address and adv.addrType == addrType:
+                return adv
+        return None
+
+    def tryInitiate(self):
+        # Connects to the peer we're initiating to, if it's advertising
+        # connectably. Returns True if it did.
+        if self.initiating is None or not self.initiatingStarted:
+            return False
+        (policy, addrType, address, interval, latency, timeout) = self.initiating
+        if policy == commands.LECreateConnection.FILTER_WHITE_LIST:
+            found = [ adv for adv in self.advertisers if (adv.addrType, adv.address) in self.whiteList ]
+        else:
+            found = [ self.findAdvertiser(addrType, address) ]
+        found = [ adv for adv in found if adv is not None and not adv.isConnected()
+                    and adv.eventType in [ADV_IND, ADV_DIRECT_IND] ]
+        if len(found) == 0:
+            return False
+        adv = found[0]
+        self.initiating = None
+        self.connectToPeer(adv, interval, latency, timeout)
+        return True
+
+    def connectToPeer(self, peer, interval=0x0018, latency=0, timeout=0x0048):
+        # Host, as master, connects to a remote peripheral
+        return self.addConnection(peer, 0x00, interval, latency, timeout)
+
+    def connectFromPeer(self, central, interval, latency, timeout):
+        # Remote central connects to us; only allowed if we're doing
+        # connectable advertising
+        self.accountAir()
+        if self.advCommands == 'extended':
+            found = [ a for a in self.advSets.values() if a.enabled and
+                      (a.properties & commands.LESetExtendedAdvertisingParameters.CONNECTABLE) ]
+            if len(found) == 0:
+                print ("Virtual: host not connectable")
+                return None
+            found[0].enabled = False
+            return self.addConnection(central, 0x01, interval, latency, timeout)
+        advType = self.advParams[4]
+        if not self.advertising or advType not in [ADV_IND, ADV_DIRECT_IND]:
+            print ("Virtual: host not connectable")
+            return None
+        self.advertising = False
+        link = self.addConnection(central, 0x01, interval, latency, timeout)
+        return link
+
+    def addConnection(self, peer, role, interval, latency, timeout):
+        link = VirtualConnection(self, self.allocHandle(), peer, role)
+        (link.interval, link.latency, link.timeout) = (interval, latency, timeout)
+        self.connections[link.handle] = link
+        peer.onConnected(link)
+        # Vol 2, 7.7.65.1
+        self.sendLEMetaEvent(events.E_LE_CONN_COMPLETE,
+            struct.pack("<BHBB6sHHHB", E_SUCCESS, link.handle, role, peer.addrType,
+                peer.address, interval, latency, timeout, 0))
+        return link
+
+    def updateConnection(self, link, interval, latency, timeout):
+        # Master has started the Connection Update procedure; the new
+        # parameters apply from an instant at least 6 connection events
+        # on (Vol 6 / B / 5.1.1)
+        def apply():
+            if self.connections.get(link.handle) is not link:
+                return
+            (link.interval, link.latency, link.timeout) = (interval, latency, timeout)
+            self.stats['conn_updates'] += 1
+            # Vol 2, 7.7.65.3
+            self.sendLEMetaEvent(events.E_LE_CONN_UPDATE_COMPLETE,
+                struct.pack("<BHHHH", E_SUCCESS, link.handle, interval, latency, timeout))
+        self.sock.callLater(6 * link.interval * 0.00125, apply)
+
+    def updateDataLength(self, link, txOctets):
+        # Data Length Update procedure (Vol 6 / B / 5.1.9), done in the
+        # next connection event; a peer without the feature answers
+        # LL_UNKNOWN_RSP, and nothing changes
+        def apply():
+            if self.connections.get(link.handle) is not link or \
+                   not (link.peer.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION):
+                return
+            tx = min(txOctets, MAX_DATA_OCTETS)
+            if (link.txOctets, link.rxOctets) == (tx, MAX_DATA_OCTETS):
+                return
+            (link.txOctets, link.rxOctets) = (tx, MAX_DATA_OCTETS)
+            self.stats['data_length_changes'] += 1
+            # Vol 2, 7.7.65.7; times are for 1M, with MIC
+            self.sendLEMetaEvent(events.E_LE_DATA_LENGTH_CHANGE, struct.pack("<HHHHH", link.handle,
+                tx, (tx + 14) * 8, MAX_DATA_OCTETS, (MAX_DATA_OCTETS + 14) * 8))
+        self.sock.callLater(link.interval * 0.00125, apply)
+
+    def updatePhy(self, link, txPhys, rxPhys):
+        # PHY Update procedure (Vol 6 / B / 5.1.10): request and response
+        # in one event, then the instant
+        def apply():
+            if self.connections.get(link.handle) is not link:
+                return
+            status = E_SUCCESS
+            if not (link.peer.features & commands.LEReadLocalSupportedFeatures.LE_2M_PHY):
+                status = E_UNSUPPORTED_REMOTE_FEATURE
+            else:
+                link.txPhy = self._pickPhy(txPhys)
+                link.rxPhy = self._pickPhy(rxPhys)
+                self.stats['phy_updates'] += 1
+            # Vol 2, 7.7.65.12
+            self.sendLEMetaEvent(events.E_LE_PHY_UPDATE_COMPLETE,
+                struct.pack("<BHBB", status, link.handle, link.txPhy, link.rxPhy))
+        self.sock.callLater(3 * link.interval * 0.00125, apply)
+
+    @staticmethod
+    def _pickPhy(phys):
+        # Fastest allowed; coded isn't emulated
+        if phys & commands.LESetDefaultPhy.PREFER_2M:
+            return commands.LESetDefaultPhy.PHY_2M
+        return commands.LESetDefaultPhy.PHY_1M
+
+    def disconnect(self, link, reason):
+        if self.connections.pop(link.handle, None) is None:
+            return
+        link.peer.onDisconnected(reason)
+        flushed = self.aclInFlight.pop(link.handle, 0) + len(link.airQueue)
+        if link.airTimer is not None:
+            link.airTimer.cancel()
+        self.aclFree = min(self.aclFree + flushed, self.aclBufferCount)
+        link.airQueue.clear()
+        self.sendEvent(events.E_DISCONN_COMPLETE,
+            struct.pack("<BHB", E_SUCCESS, link.handle, reason))
+
+    # Command handlers ----------------------
+    # Each takes the command parameters, and returns Command Complete
+    # return parameters (or None if it sends its own response).
+
+    def cmdReset(self, params):
+        self.reset()
+        return bytes([E_SUCCESS])
+
+    def cmdSetEventMask(self, params):
+        (self.eventMask,) = struct.unpack("<Q", params)
+        return bytes([E_SUCCESS])
+
+    def cmdReadLocalVersion(self, params):
+        return struct.pack("<BBHBHH", E_SUCCESS, self.version, 0x0000, self.version, 0xFFFF, 0x0000)
+
+    def cmdReadBDADDR(self, params):
+        return struct.pack("<B6s", E_SUCCESS, self.address)
+
+    def cmdWriteLEHostSupported(self, params):
+        (le, simul) = struct.unpack("<BB", params)
+        self.leHostSupported = (le == commands.WriteLEHostSupported.LE_ENABLE)
+        return bytes([E_SUCCESS])
+
+    def cmdLESetEventMask(self, params):
+        (self.leEventMask,) = struct.unpack("<Q", params)
+        return bytes([E_SUCCESS])
+
+    def cmdLEReadBufferSize(self, params):
+        return struct.pack("<BHB", E_SUCCESS, self.aclBufferLength, self.aclBufferCount)
+
+    def cmdLEReadLocalSupportedFeatures(self, params):
+        return struct.pack("<BQ", E_SUCCESS, self.features)
+
+    def cmdLESetAdvertisingParameters(self, params):
+        if not self._advCommands('legacy'):
+            return bytes([E_COMMAND_DISALLOWED])
+        if self.advertising or len(params) != 15:
+            return bytes([E_COMMAND_DISALLOWED])
+        self.advParams = params
+        return bytes([E_SUCCESS])
+
+    def cmdLESetAdvertisingData(self, params):
+        ld = params[0]
+        if not self._advCommands('legacy'):
+            return bytes([E_COMMAND_DISALLOWED])
+        if ld > 31 or len(params) != 32:
+            return bytes([E_INVALID_PARAMETERS])
+        self.accountAir()
+        self.advData = params[1:1+ld]
+        return bytes([E_SUCCESS])
+
+    def cmdLESetScanResponseData(self, params):
+        ld = params[0]
+        if not self._advCommands('legacy'):
+            return bytes([E_COMMAND_DISALLOWED])
+        if ld > 31 or len(params) != 32:
+            return bytes([E_INVALID_PARAMETERS])
+        self.scanRspData = params[1:1+ld]
+        return bytes([E_SUCCESS])
+
+    def cmdLESetAdvertiseEnable(self, params):
+        if not self._advCommands('legacy'):
+            return bytes([E_COMMAND_DISALLOWED])
+        self.accountAir()
+        self.advertising = (params[0] == commands.LESetAdvertiseEnable.ENABLE)
+        return bytes([E_SUCCESS])
+
+    def cmdLESetScanParameters(self, params):
+        if self.scanning:
+            return bytes([E_COMMAND_DISALLOWED])
+        (self.scanType, _, _, _, self.scanFilterPolicy) = struct.unpack("<BHHBB", params)
+        return bytes([E_SUCCESS])
+
+    def cmdLESetScanEnable(self, params):
+        (enable, filt) = struct.unpack("<BB", params)
+        def apply():
+            self.scanning = (enable == commands.LESetScanEnable.ENABLE)
+            self.scanFilterDuplicates = (filt != 0)
+            self.scanSeen.clear()
+        # Takes effect as it's answered, so with commandLatency reports
+        # start (or stop) after the host hears the command is done
+        self.commandComplete(opcodeOf(commands.LESetScanEnable), bytes([E_SUCCESS]), then=apply)
+        return None
+
+    def cmdLECreateConnection(self, params):
+        (_, _, policy, addrType, address, _, intervalMin, intervalMax, latency, timeout, _, _) = (
+            struct.unpack("<HHBB6sBHHHHHH", params) )
+        opcode = opcodeOf(commands.LECreateConnection)
+        if self.initiating is not None:
+            self.commandStatus(opcode, E_COMMAND_DISALLOWED)
+            return None
+        self.initiating = (policy, addrType, address, intervalMax, latency, timeout)
+        self.initiatingStarted = False
+        # Connects on a later tick, if the peer is there to be found
+        self.commandStatus(opcode, E_SUCCESS, then=self._startInitiating)
+        return None
+
+    def _startInitiating(self):
+        self.initiatingStarted = True
+
+    def cmdLECreateConnectionCancel(self, params):
+        if self.initiating is None:
+            return bytes([E_COMMAND_DISALLOWED])
+        (_, addrType, address, _, _, _) = self.initiating
+        self.initiating = None
+        # Vol 2, 7.8.13: then a Connection Complete with this status
+        self.commandComplete(opcodeOf(commands.LECreateConnectionCancel), bytes([E_SUCCESS]),
+            then=lambda: self.sendLEMetaEvent(events.E_LE_CONN_COMPLETE,
+                struct.pack("<BHBB6sHHHB", E_UNKNOWN_CONNECTION, 0, 0x00, addrType, address, 0, 0, 0, 0)))
+        return None
+
+    def cmdDisconnect(self, params):
+        (handle, reason) = struct.unpack("<HB", params)
+        link = self.connections.get(handle)
+        opcode = opcodeOf(commands.Disconnect)
+        if link is None:
+            self.commandStatus(opcode, E_UNKNOWN_CONNECTION)
+            return None
+        self.commandStatus(opcode, E_SUCCESS, then=lambda: self.disconnect(link, E_LOCAL_HOST_TERMINATED))
+        return None
+
+    def cmdLEConnectionUpdate(self, params):
+        (handle, intervalMin, intervalMax, latency, timeout, _, _) = struct.unpack("<HHHHHHH", params)
+        link = self.connections.get(handle)
+        opcode = opcodeOf(commands.LEConnectionUpdate)
+        if link is None:
+            self.commandStatus(opcode, E_UNKNOWN_CONNECTION)
+        elif link.role != 0x00 or not commands.validParameters(intervalMin, intervalMax, latency, timeout):
+            # 4.0 slaves can't; they ask over L2CAP
+            self.commandStatus(opcode, E_COMMAND_DISALLOWED if link.role != 0x00 else E_INVALID_PARAMETERS)
+        else:
+            self.commandStatus(opcode, E_SUCCESS,
+                then=lambda: self.updateConnection(link, intervalMax, latency, timeout))
+        return None
+
+    def whiteListInUse(self):
+        # Vol 2, 7.8.15: the list can't change while anything uses it
+        return ( (self.scanning and self.scanFilterPolicy == commands.LESetScanParameters.FILTER_WHITE_LIST)
+                 or (self.initiating is not None and
+                     self.initiating[0] == commands.LECreateConnection.FILTER_WHITE_LIST) )
+
+    def cmdLEReadWhiteListSize(self, params):
+        return struct.pack("<BB", E_SUCCESS, self.whiteListSize)
+
+    def cmdLEClearWhiteList(self, params):
+        if self.whiteListInUse():
+            return bytes([E_COMMAND_DISALLOWED])
+        self.whiteList.clear()
+        return bytes([E_SUCCESS])
+
+    def cmdLEAddDeviceToWhiteList(self, params):
+        entry = struct.unpack("<B6s", params)
+        if self.whiteListInUse():
+            return bytes([E_COMMAND_DISALLOWED])
+        if entry not in self.whiteList and len(self.whiteList) >= self.whiteListSize:
+            return bytes([E_MEMORY_CAPACITY_EXCEEDED])
+        self.whiteList.add(entry)
+        return bytes([E_SUCCESS])
+
+    def cmdLERemoveDeviceFromWhiteList(self, params):
+        if self.whiteListInUse():
+            return bytes([E_COMMAND_DISALLOWED])
+        self.whiteList.discard(struct.unpack("<B6s", params))
+        return bytes([E_SUCCESS])
+
+    def cmdLESetExtendedAdvertisingParameters(self, params):
+        if not self._advCommands('extended') or not (self.features &
+                commands.LEReadLocalSupportedFeatures.EXTENDED_ADVERTISING):
+            return bytes([E_COMMAND_DISALLOWED])
+        if len(params) != 25:
+            return bytes([E_INVALID_PARAMETERS])
+        handle = params[0]
+        current = self.advSets.get(handle)
+        if current is not None and current.enabled:
+            return bytes([E_COMMAND_DISALLOWED])
+        if current is None and len(self.advSets) >= self.advertisingSets:
+            return bytes([E_MEMORY_CAPACITY_EXCEEDED])
+        newSet = VirtualAdvertisingSet(params)
+        if current is not None:
+            (newSet.advData, newSet.scanRspData) = (current.advData, current.scanRspData)
+        self.advSets[handle] = newSet
+        return struct.pack("<Bb", E_SUCCESS, 0)
+
+    def _setExtendedData(self, params, attr):
+        (handle, operation, _, ld) = struct.unpack("<BBBB", params[0:4])
+        advSet = self.advSets.get(handle)
+        if not self._advCommands('extended') or advSet is None:
+            return bytes([E_UNKNOWN_ADVERTISING_IDENTIFIER])
+        if len(params) != 4 + ld:
+            return bytes([E_INVALID_PARAMETERS])
+        if operation != commands.LESetExtendedAdvertisingData.COMPLETE:
+            return bytes([E_UNKNOWN_COMMAND]) # Fragmented data not emulated
+        legacy = advSet.properties & commands.LESetExtendedAdvertisingParameters.LEGACY
+        if legacy and ld > 31:
+            return bytes([E_INVALID_PARAMETERS])
+        self.accountAir()
+        setattr(advSet, attr, params[4:])
+        return bytes([E_SUCCESS])
+
+    def cmdLESetExtendedAdvertisingData(self, params):
+        return self._setExtendedData(params, 'advData')
+
+    def cmdLESetExtendedScanResponseData(self, params):
+        return self._setExtendedData(params, 'scanRspData')
+
+    def cmdLESetExtendedAdvertisingEnable(self, params):
+        (enable, n) = struct.unpack("<BB", params[0:2])
+        if not self._advCommands('extended') or len(params) != 2 + 4 * n:
+            return bytes([E_INVALID_PARAMETERS])
+        handles = [ params[2+4*i] for i in range(n) ]
+        if any(h not in self.advSets for h in handles):
+            return bytes([E_UNKNOWN_ADVERTISING_IDENTIFIER])
+        if n == 0:
+            if enable == commands.LESetExtendedAdvertisingEnable.ENABLE:
+                return bytes([E_INVALID_PARAMETERS])
+            handles = list(self.advSets.keys()) # Vol 2, 7.8.56: all sets
+        self.accountAir()
+        for h in handles:
+            self.advSets[h].enabled = (enable == commands.LESetExtendedAdvertisingEnable.ENABLE)
+        return bytes([E_SUCCESS])
+
+    def cmdLEReadNumberOfSupportedAdvertisingSets(self, params):
+        if not (self.features & commands.LEReadLocalSupportedFeatures.EXTENDED_ADVERTISING):
+            return bytes([E_UNKNOWN_COMMAND])
+        return struct.pack("<BB", E_SUCCESS, self.advertisingSets)
+
+    def cmdLESetDataLength(self, params):
+        (handle, txOctets, txTime) = struct.unpack("<HHH", params)
+        link = self.connections.get(handle)
+        if not (self.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION):
+            return struct.pack("<BH", E_UNKNOWN_COMMAND, handle)
+        if link is None:
+            return struct.pack("<BH", E_UNKNOWN_CONNECTION, handle)
+        if not (commands.DEFAULT_DATA_OCTETS <= txOctets <= MAX_DATA_OCTETS):
+            return struct.pack("<BH", E_INVALID_PARAMETERS, handle)
+        self.updateDataLength(link, txOctets)
+        return struct.pack("<BH", E_SUCCESS, handle)
+
+    def cmdLEReadSuggestedDefaultDataLength(self, params):
+        if not (self.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION):
+            return bytes([E_UNKNOWN_COMMAND])
+        return struct.pack("<BHH", E_SUCCESS, *self.suggestedDataLength)
+
+    def cmdLEWriteSuggestedDefaultDataLength(self, params):
+        (octets, txTime) = struct.unpack("<HH", params)
+        if not (self.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION):
+            return bytes([E_UNKNOWN_COMMAND])
+        if not (commands.DEFAULT_DATA_OCTETS <= octets <= MAX_DATA_OCTETS):
+            return bytes([E_INVALID_PARAMETERS])
+        self.suggestedDataLength = (octets, txTime)
+        return bytes([E_SUCCESS])
+
+    def cmdLEReadMaximumDataLength(self, params):
+        if not (self.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION):
+            return bytes([E_UNKNOWN_COMMAND])
+        maxTime = (MAX_DATA_OCTETS + 14) * 8 # 1M, with MIC
+        return struct.pack("<BHHHH", E_SUCCESS, MAX_DATA_OCTETS, maxTime, MAX_DATA_OCTETS, maxTime)
+
+    def cmdLEReadPhy(self, params):
+        (handle,) = struct.unpack("<H", params)
+        link = self.connections.get(handle)
+        if link is None:
+            return struct.pack("<BHBB", E_UNKNOWN_CONNECTION, handle, 0, 0)
+        return struct.pack("<BHBB", E_SUCCESS, handle, link.txPhy, link.rxPhy)
+
+    def cmdLESetDefaultPhy(self, params):
+        if not (self.features & commands.LEReadLocalSupportedFeatures.LE_2M_PHY):
+            return bytes([E_UNKNOWN_COMMAND])
+        self.defaultPhys = struct.unpack("<BBB", params)
+        return bytes([E_SUCCESS])
+
+    def cmdLESetPhy(self, params):
+        (handle, allPhys, txPhys, rxPhys, _) = struct.unpack("<HBBBH", params)
+        link = self.connections.get(handle)
+        opcode = opcodeOf(commands.LESetPhy)
+        if not (self.features & commands.LEReadLocalSupportedFeatures.LE_2M_PHY):
+            self.commandStatus(opcode, E_UNKNOWN_COMMAND)
+        elif link is None:
+            self.commandStatus(opcode, E_UNKNOWN_CONNECTION)
+        else:
+            # No preference means any
+            anyPhy = commands.LESetDefaultPhy.PREFER_1M | commands.LESetDefaultPhy.PREFER_2M
+            if allPhys & commands.LESetDefaultPhy.NO_TX_PREFERENCE:
+                txPhys = anyPhy
+            if allPhys & commands.LESetDefaultPhy.NO_RX_PREFERENCE:
+                rxPhys = anyPhy
+            self.commandStatus(opcode, E_SUCCESS, then=lambda: self.updatePhy(link, txPhys, rxPhys))
+        return None
+
+if __name__ == '__main__':
+    # Runs the gatt.py test script, but through the whole HCI / ACL
+    # stack of a Device talking to a virtual controller
+    import device
+
+    ctlr = VirtualController()
+    dev = device.Device().withSocket( VirtualHCISocket(ctlr) )
+    dev.start()
+    assert ctlr.advertising, "Device failed to start advertising"
+
+    central = VirtualCentral(ctlr)
+    assert central.connect() is not None
+    dev.run()
+
+    errors = 0
+    with open("gatt-cmds.hex", "r") as fp:
+        for line in fp:
+            if (':' not in line) or (line.startswith('#')):
+                continue
+            cmd,resp = line.rstrip().split(':')
+            central.sendAtt(binascii.a2b_hex(cmd))
+            dev.run()
+            expected = [] if (resp=='-') else [ binascii.a2b_hex(resp) ]
+            if central.received != expected:
+                print ("ERROR: command %s, got %r expected %r" % (cmd, central.received, expected))
+                errors += 1
+            central.received = []
+
+    central.disconnect()
+    dev.run()
+    print ("Virtual controller stats: %r" % dict(ctlr.stats))
+    print ("%d errors" % errors)
@@ -0,0 +1,192 @@
+import collections
+
+import commands
+
+# Data length and PHY management. A link starts with LL payloads of 27
+# bytes at 1Mbit/s, so a 247 byte ATT PDU takes ten packets, each with
+# its own headers, acknowledgement and two inter-frame spaces; no more
+# than a third or so of the air time carries data. BT 4.2 controllers
+# can send payloads of up to 251 bytes (Data Length Extension), and 5.0
+# ones can switch the link to the 2M PHY. A LinkSpeedManager asks for
+# both on each new connection, if our controller supports them; the
+# link layers then agree what the peer can do too, and report it in LE
+# Data Length Change (Vol 2, 7.7.65.7) and LE PHY Update Complete
+# (7.7.65.12).
+#
+# The connection's ACL fragments are kept to the link's payload size,
+# so each ACL buffer is one LL PDU: buffer credits then come back a
+# packet at a time, and one link's long PDU can't hold the buffers for
+# several connection events.
+
+class LinkSpeed:
+    # What a link's link layers have agreed
+
+    def __init__(self, handle, conn):
+        self.handle = handle
+        self.conn = conn # hcipacket.ACLConnection
+        self.txOctets = self.rxOctets = commands.DEFAULT_DATA_OCTETS
+        self.txTime = self.rxTime = commands.DEFAULT_DATA_TIME
+        self.txPhy = self.rxPhy = commands.LESetDefaultPhy.PHY_1M
+
+    def __str__(self):
+        return "%d/%d octets, %dM/%dM PHY" % (self.txOctets, self.rxOctets, self.txPhy, self.rxPhy)
+
+
+class LinkSpeedManager:
+    # Attach to a central.Central or device.Device
+
+    def __init__(self, stack, dataLength=True, phy2M=True):
+        self.stack = stack.withLinkSpeedManager(self)
+        self.dataLength = dataLength # Ask for the longest packets
+        self.phy2M = phy2M           # Ask for the 2M PHY
+        self.links = {} # Maps handle to LinkSpeed
+        self.updateCallback = None
+        self.stats = collections.Counter()
+
+    def withUpdateCallback(self, callback):
+        # callback(handle, LinkSpeed) when a link's data length or PHY
+        # changes
+        self.updateCallback = callback
+        return self
+
+    def speed(self, handle):
+        '''LinkSpeed for handle, or None'''
+        return self.links.get(handle)
+
+    # From the stack ---------------
+
+    def onConnected(self, handle, conn):
+        link = self.links[handle] = LinkSpeed(handle, conn)
+        self._fitFragments(link)
+        info = self.stack.bringup.info if self.stack.bringup is not None else None
+        if info is None or info.features is None:
+            return
+        if self.dataLength and info.has('maxTxOctets') and \
+               (info.features & commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION):
+            self.stats['data_length_requests'] += 1
+            self.stack.queueCommand(commands.LESetDataLength(handle, info.maxTxOctets, info.maxTxTime)
+                .withCompletion(lambda cmd: self._onCommandDone(link, cmd)))
+        if self.phy2M and (info.features & commands.LEReadLocalSupportedFeatures.LE_2M_PHY):
+            self.stats['phy_requests'] += 1
+            self.stack.queueCommand(commands.LESetPhy(handle, 0,
+                commands.LESetDefaultPhy.PREFER_2M, commands.LESetDefaultPhy.PREFER_2M)
+                .withCompletion(lambda cmd: self._onCommandDone(link, cmd)))
+
+    def onDataLengthChanged(self, handle, maxTxOctets, maxTxTime, maxRxOctets, maxRxTime):
+        link = self.links.get(handle)
+        if link is None:
+            return
+        (link.txOctets, link.txTime, link.rxOctets, link.rxTime) = (maxTxOctets, maxTxTime, maxRxOctets, maxRxTime)
+        self.stats['data_length_changes'] += 1
+        self._fitFragments(link)
+        print ("Connection 0x%04X now %s" % (handle, link))
+        if self.updateCallback:
+            self.updateCallback(handle, link)
+
+    def onPhyUpdated(self, status, handle, txPhy, rxPhy):
+        link = self.links.get(handle)
+        if link is None:
+            return
+        if status != 0:
+            # e.g. the peer hasn't got 2M; the event still has the PHYs
+            print ("PHY update on 0x%04X failed, status 0x%02X" % (handle, status))
+            self.stats['phy_failed'] += 1
+        (link.txPhy, link.rxPhy) = (txPhy, rxPhy)
+        if status == 0:
+            self.stats['phy_updates'] += 1
+            print ("Connection 0x%04X now %s" % (handle, link))
+            if self.updateCallback:
+                self.updateCallback(handle, link)
+
+    def onDisconnected(self, handle):
+        self.links.pop(handle, None)
+
+    # Internals ---------------
+
+    def _onCommandDone(self, link, cmd):
+        if cmd.error():
+            print ("%s on 0x%04X refused: %s" % (type(cmd).__name__, link.handle, cmd.error()))
+            self.stats['refused'] += 1
+
+    def _fitFragments(self, link):
+        # ACLConnection.txMtu includes the 4 byte ACL header
+        if self.stack.aclMtu is not None:
+            link.conn.txMtu = min(self.stack.aclMtu, link.txOctets + 4)
+
+
+if __name__ == '__main__':
+    # Throughput of Write Commands from a central to a virtual peripheral,
+    # with the virtual controller timing each LL PDU on air: a 4.0
+    # controller, then DLE on 1M, DLE on 2M, and a DLE + 2M controller
+    # whose peer has neither
+    import io
+    import sys
+    import time
+    import gatt
+    import gattcmds
+    import bringup
+    import central
+    from hcisocket_virtual import (VirtualController, VirtualHCISocket, VirtualPeripheral,
+                                   FEATURES_DLE_2M)
+
+    DLE = 0x01 | commands.LEReadLocalSupportedFeatures.DATA_LENGTH_EXTENSION
+    TOTAL = 64 * 1024
+
+    class CountingPeripheral(VirtualPeripheral):
+        # Notes when TOTAL bytes of written values have arrived
+        def __init__(self, server, stack):
+            VirtualPeripheral.__init__(self, b'\x02\x00\x00\xDD\xDD\xDD', server)
+            self.stack = stack
+            self.received = 0
+            self.done = None
+
+        def onL2CAPReceived(self, link, cid, pdu):
+            if cid == gatt.CID_GATT and pdu[0] == 0x52:
+                self.received += len(pdu) - 3
+                if self.received >= TOTAL and self.done is None:
+                    self.done = time.monotonic()
+                    self.stack.stop()
+                return
+            VirtualPeripheral.onL2CAPReceived(self, link, cid, pdu)
+
+    def throughput(label, features, bufferLength, peerFeatures):
+        server = gatt.GattServer().withServices(gatt.makeTestServices())
+        ctlr = VirtualController(aclBufferLength=bufferLength, aclBufferCount=32, features=features,
+                                 dataAirTime=True)
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) ).withCache(bringup.ControllerCache())
+        mgr = LinkSpeedManager(cen)
+        periph = CountingPeripheral(server, cen).withFeatures(peerFeatures)
+        state = { 'started': None }
+
+        def startWrites(client):
+            size = client.mtu - 3
+            state['started'] = time.monotonic()
+            for i in range((TOTAL + size - 1) // size):
+                client.sendRequest(gattcmds.WriteCommand(0x0003, bytes(size)))
+
+        def onDiscovered(disc):
+            assert disc.error is None
+            # Leave the link layers time to finish
+            cen.hciSocket.callLater(0.1, startWrites, disc.client)
+        cen.onDiscoveryDone = onDiscovered
+        cen.hciSocket.callLater(20.0, cen.stop)
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            link = ctlr.connectToPeer(periph)
+            cen.run()
+        finally:
+            sys.stdout = saved
+        assert periph.done is not None, "Writes didn't finish"
+        assert ctlr.stats['acl_overruns'] == 0 and ctlr.stats['acl_bad_length'] == 0
+        rate = periph.received / (periph.done - state['started'])
+        print ("%-24s %s: %6.1f kB/s" % (label, mgr.speed(link.handle), rate / 1000))
+        return rate
+
+    base = throughput("4.0 controller", 0x01, 27, FEATURES_DLE_2M)
+    dle = throughput("DLE, 1M", DLE, 251, DLE)
+    fast = throughput("DLE and 2M", FEATURES_DLE_2M, 251, FEATURES_DLE_2M)
+    old = throughput("DLE and 2M, 4.0 peer", FEATURES_DLE_2M, 251, 0x01)
+    assert fast > dle > 1.5 * base and old < 1.2 * base, (base, dle, fast, old)
+    print ("2M with DLE is %.1fx a 4.0 link" % (fast / base))
@@ -0,0 +1,423 @@
+import sys
+import math
+import time
+import struct
+import collections
+
+import gatt
+import gattcmds
+import central
+import device
+import txsched
+from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualCentral
+
+# Load generator for a Device's GATT server: many virtual centrals, each
+# a central.GattClient, connect through the virtual controller and keep
+# it busy, in stages of more and more clients. What each client does is
+# its Mix:
+#
+#   polling      reads a value every readInterval
+#   control      Write Requests, and the odd read
+#   subscriber   subscribes to every notifying characteristic, while
+#                the generator notifies them all every notifyInterval
+#   reconnecting disconnects after a while, then connects and
+#                discovers everything again, as after a server restart;
+#                all at once, it's a discovery storm
+#
+# Latency is from each request going out to its response arriving, and
+# for notifications from the server's notify() call. Reads and writes
+# are offered on a fixed schedule, and done when their response comes;
+# a request isn't sent while the last is still waiting, nor is anything
+# when the loop is too busy to keep to the schedule, so a server falling
+# behind gets fewer done. A stage sustains its load if the 99th
+# percentile of both latencies stays within maxP99 and at least
+# minDelivered of the offered reads and writes get done. Everything,
+# clients included, runs in this process, so the capacity found is a
+# lower bound. Without services of its own, the generator uses
+# loadServices().
+
+class Mix:
+    def __init__(self, name, readInterval=None, writeInterval=None, subscribe=False,
+                 reconnectAfter=None, reconnectDelay=0.1, mtu=gatt.ATT_DEFAULT_MTU):
+        self.name = name
+        self.readInterval = readInterval   # Seconds between reads, or None
+        self.writeInterval = writeInterval # and Write Requests
+        self.subscribe = subscribe
+        self.reconnectAfter = reconnectAfter # Seconds connected, or None to stay
+        self.reconnectDelay = reconnectDelay
+        self.mtu = mtu
+
+MIXES = {
+    'polling': Mix('polling', readInterval=0.05),
+    'control': Mix('control', readInterval=0.5, writeInterval=0.02),
+    'subscriber': Mix('subscriber', readInterval=1.0, subscribe=True, mtu=247),
+    'reconnecting': Mix('reconnecting', readInterval=0.2, reconnectAfter=1.0),
+}
+
+# Clients take these in turn
+DEFAULT_MIX = [ MIXES['polling'], MIXES['control'], MIXES['subscriber'], MIXES['reconnecting'] ]
+
+
+def loadServices():
+    '''gatt.makeTestServices(), with a characteristic which notifies; the
+       test services' only CCCD is on one which just indicates'''
+    ch = ( gatt.ReadOnlyCharacteristic("fffffffffffffffffffffffffffffff7", b'\x00' * 8)
+             .withProperties(gatt.PROPS_READ | gatt.PROPS_NOTIFY)
+             .withDescriptor(gatt.DummyWriteAttribute(gatt.UUID_CHAR_CLIENT_CONFIG, b'\x00\x00')) )
+    sv = ( gatt.Service().withPrimaryUUID("fffffffffffffffffffffffffffffff6")
+             .withCharacteristics(ch) )
+    return gatt.makeTestServices() + [sv]
+
+
+def percentile(values, p):
+    '''Nearest rank; values must be sorted'''
+    if len(values) == 0:
+        return None
+    return values[max(0, min(len(values) - 1, int(math.ceil(p * len(values))) - 1))]
+
+
+class StageStats:
+    def __init__(self, clients):
+        self.clients = clients
+        self.latencies = []    # Seconds, for each ATT response
+        self.notifyLatencies = []
+        self.counts = collections.Counter()
+        self.elapsed = None
+
+    def result(self):
+        '''Returns a dict, ready for JSON'''
+        lat = sorted(self.latencies)
+        nlat = sorted(self.notifyLatencies)
+        return collections.OrderedDict([
+            ('clients', self.clients),
+            ('offered_per_sec', self.counts['offered'] / self.elapsed),
+            ('requests_per_sec', self.counts['done'] / self.elapsed),
+            ('p50_ms', percentile(lat, 0.5) * 1000 if lat else None),
+            ('p99_ms', percentile(lat, 0.99) * 1000 if lat else None),
+            ('notifications_per_sec', len(nlat) / self.elapsed),
+            ('notify_p50_ms', percentile(nlat, 0.5) * 1000 if nlat else None),
+            ('notify_p99_ms', percentile(nlat, 0.99) * 1000 if nlat else None),
+            ('notifications_dropped', self.counts['notify_dropped']),
+            ('att_errors', self.counts['att_errors']),
+            ('discoveries', self.counts['discoveries']),
+            ('skipped', self.counts['skipped']),
+        ])
+
+
+class LoadClient(VirtualCentral):
+    # One virtual central, running its mix; it stands in for the
+    # ACLConnection its GattClient would otherwise use
+
+    def __init__(self, gen, index, mix):
+        VirtualCentral.__init__(self, gen.controller, address=struct.pack("<I", index) + b'\xCC\xCC')
+        self.gen = gen
+        self.mix = mix
+        self.sock = gen.device.hciSocket # For GattClient's timers
+        self.client = None
+        self.ready = False
+        self.sentAt = None
+        self.loadPending = False # A read or write of the mix's is waiting
+        self.timers = {}
+        self.reads = []    # Value handles which can be read
+        self.writes = []   # and written with Write Request
+        self.configs = []  # CCCDs of characteristics which notify
+        self.next = 0
+
+    # Connection ---------------
+
+    def start(self):
+        link = self.connect()
+        if link is None:
+            # Not advertising, e.g. still resuming after the last connection
+            self.timers['connect'] = self.sock.callLater(0.01, self.start)
+            return
+        self.connectedAt = time.perf_counter()
+        self.client = central.GattClient(self, self.mix.mtu).withActivityCallback(self._onRequest)
+        self.client.discover(self._onDiscovered)
+
+    def stop(self):
+        for t in self.timers.values():
+            t.cancel()
+        self.timers.clear()
+        self.ready = False
+        self.loadPending = False
+        if self.client is not None:
+            self.client.onDisconnect()
+            self.client = None
+        self.disconnect()
+
+    def _reconnect(self):
+        self.stop()
+        self.timers['connect'] = self.sock.callLater(self.mix.reconnectDelay, self.start)
+
+    def _onDiscovered(self, disc):
+        if disc.error is not None:
+            return
+        self.gen.stage.counts['discoveries'] += 1
+        self.gen.totals['discoveries'] += 1
+        self.reads = []
+        self.writes = []
+        self.configs = []
+        for ch in disc.characteristics:
+            if ch.properties & gatt.PROPS_READ:
+                self.reads.append(ch.valueHandle)
+            if ch.properties & gatt.PROPS_WRITE:
+                self.writes.append(ch.valueHandle)
+            if ch.properties & gatt.PROPS_NOTIFY:
+                self.configs += [ h for (h, uid) in ch.descriptors if uid == gatt.UUID_CHAR_CLIENT_CONFIG ]
+        if self.mix.subscribe:
+            for h in self.configs:
+                self.client.sendRequest(gattcmds.WriteRequest(h, struct.pack("<H", gatt.CCCD_NOTIFY)))
+        self.ready = True
+        if self.mix.readInterval and self.reads:
+            self._every('read', self.mix.readInterval, self._read)
+        if self.mix.writeInterval and self.writes:
+            self._every('write', self.mix.writeInterval, self._write)
+        if self.mix.reconnectAfter:
+            self.timers['reconnect'] = self.sock.callLater(self.mix.reconnectAfter, self._reconnect)
+
+    # Load ---------------
+
+    def _every(self, name, interval, fn):
+        # Keeps to the schedule; if the loop's too busy to, the times
+        # missed count as offered, but not sent
+        due = [ time.monotonic() + interval ]
+        def fire():
+            now = time.monotonic()
+            missed = int((now - due[0]) / interval)
+            counts = self.gen.stage.counts
+            counts['offered'] += missed + 1
+            counts['skipped'] += missed
+            due[0] += (missed + 1) * interval
+            self.timers[name] = self.sock.callLater(due[0] - now, fire)
+            fn()
+        self.timers[name] = self.sock.callLater(interval, fire)
+
+    def _busy(self):
+        if self.client.current is not None or len(self.client.pending) > 0:
+            # Still waiting for the last
+            self.gen.stage.counts['skipped'] += 1
+            return True
+        return False
+
+    def _read(self):
+        if self._busy():
+            return
+        self.next = (self.next + 1) % len(self.reads)
+        self.loadPending = True
+        self.client.sendRequest(gattcmds.Read(self.reads[self.next]))
+
+    def _write(self):
+        if self._busy():
+            return
+        self.next = (self.next + 1) % len(self.writes)
+        self.loadPending = True
+        self.client.sendRequest(gattcmds.WriteRequest(self.writes[self.next], struct.pack("<I", self.next)))
+
+    # As the client's connection ---------------
+
+    def send(self, cid, data):
+        self.sendAtt(data)
+
+    def _onRequest(self, client):
+        self.sentAt = time.perf_counter()
+
+    def onL2CAPReceived(self, link, cid, pdu):
+        if cid != gatt.CID_GATT:
+            return VirtualCentral.onL2CAPReceived(self, link, cid, pdu)
+        now = time.perf_counter()
+        stage = self.gen.stage
+        if pdu[0] == central.ATT_NOTIFICATION:
+            if len(pdu) >= 11:
+                stage.notifyLatencies.append(now - struct.unpack("<d", pdu[3:11])[0])
+            return
+        if self.sentAt is not None:
+            stage.latencies.append(now - self.sentAt)
+            self.sentAt = None
+        if self.loadPending:
+            # Sent alone, so this is its response
+            self.loadPending = False
+            if pdu[0] != gattcmds.ATT_ERROR_RSP:
+                stage.counts['done'] += 1
+        if pdu[0] == gattcmds.ATT_ERROR_RSP and len(pdu) >= 5 and pdu[4] != gatt.E_ATTR_NOT_FOUND:
+            # Not found just ends each discovery phase
+            stage.counts['att_errors'] += 1
+        if self.client is not None:
+            self.client.onMessageReceived(self, cid, pdu)
+
+
+class LoadGenerator:
+    def __init__(self, services=None, mixes=DEFAULT_MIX, notifyInterval=0.1,
+                 maxP99=0.05, minDelivered=0.9, controller=None):
+        self.controller = controller if (controller is not None) else VirtualController(aclBufferCount=32)
+        self.device = ( device.Device().withSocket( VirtualHCISocket(self.controller) )
+                          .withMaxConnections(0x0EFF)
+                          .withServices(services if (services is not None) else loadServices()) )
+        self.mixes = mixes
+        self.notifyInterval = notifyInterval
+        self.maxP99 = maxP99             # Seconds
+        self.minDelivered = minDelivered # Fraction of offered requests
+        self.clients = []
+        self.stage = StageStats(0)
+        self.totals = collections.Counter() # Over all stages, settling included
+        self.results = []
+        self.notifyTimer = None
+        self.started = False
+        self.stageCallback = None
+
+    def withStageCallback(self, callback):
+        # callback(result) as each stage finishes
+        self.stageCallback = callback
+        return self
+
+    def _start(self):
+        self.device.start()
+        self.notifyHandles = sorted(set(self.device.gatt.clientConfigs.values()))
+        if self.notifyHandles:
+            self.notifyTimer = self.device.hciSocket.callLater(self.notifyInterval, self._notify, 0)
+        self.started = True
+
+    def _notify(self, i):
+        # Each handle in turn, spread over notifyInterval
+        step = self.notifyInterval / len(self.notifyHandles)
+        self.notifyTimer = self.device.hciSocket.callLater(step, self._notify, (i + 1) % len(self.notifyHandles))
+        self.stage.counts['notified'] += self.device.notify(self.notifyHandles[i], struct.pack("<d", time.perf_counter()))
+
+    def _runFor(self, seconds):
+        timer = self.device.hciSocket.callLater(seconds, self.device.stop)
+        self.device.run()
+        timer.cancel()
+
+    def runStage(self, clients, duration=2.0, settle=5.0):
+        '''Adds clients up to the number given, waits (up to settle
+           seconds) for them to connect and discover, then measures
+           for duration seconds. Returns the stage's result.'''
+        if not self.started:
+            self._start()
+        while len(self.clients) < clients:
+            c = LoadClient(self, len(self.clients) + 1, self.mixes[len(self.clients) % len(self.mixes)])
+            self.clients.append(c)
+            c.start()
+        self.stage = StageStats(len(self.clients)) # Not kept
+        waited = 0.0
+        while waited < settle and not all(c.ready for c in self.clients):
+            self._runFor(0.1)
+            waited += 0.1
+        self.stage = StageStats(len(self.clients))
+        drops = self.device.hciSocket.packetQueue.drops
+        d0 = drops[txsched.CLASS_NOTIFICATION]
+        t0 = time.perf_counter()
+        self._runFor(duration)
+        self.stage.elapsed = time.perf_counter() - t0
+        self.stage.counts['notify_dropped'] = drops[txsched.CLASS_NOTIFICATION] - d0
+        result = self.stage.result()
+        result['sustained'] = self._sustained(result)
+        self.results.append(result)
+        if self.stageCallback is not None:
+            self.stageCallback(result)
+        return result
+
+    def _sustained(self, r):
+        if r['p99_ms'] is None or r['p99_ms'] > self.maxP99 * 1000:
+            return False
+        if r['notify_p99_ms'] is not None and r['notify_p99_ms'] > self.maxP99 * 1000:
+            return False
+        if r['notifications_dropped'] > (1.0 - self.minDelivered) * self.stage.counts['notified']:
+            return False
+        return r['requests_per_sec'] >= self.minDelivered * r['offered_per_sec']
+
+    def ramp(self, stages=(1, 2, 4, 8, 16, 32, 64, 128), duration=2.0):
+        '''Runs stages until one doesn't sustain its load; returns the
+           results'''
+        for n in stages:
+            if not self.runStage(n, duration)['sustained']:
+                break
+        self.stop()
+        return self.results
+
+    def stop(self):
+        for c in self.clients:
+            c.stop()
+        if self.notifyTimer is not None:
+            self.notifyTimer.cancel()
+        self._runFor(0.05)
+
+    def capacity(self):
+        '''The last sustained stage's result, or None'''
+        good = [ r for r in self.results if r['sustained'] ]
+        return good[-1] if good else None
+
+    def report(self):
+        '''Capacity report, as text'''
+        def ms(v):
+            return "%8.2f" % v if v is not None else "       -"
+        lines = [ "%7s %10s %10s %8s %8s %9s %8s %7s %6s %6s %7s" % ("clients", "offered/s", "done/s",
+                  "p50 ms", "p99 ms", "notify/s", "ntf p99", "dropped", "errors", "disc", "skipped") ]
+        for r in self.results:
+            lines.append("%7d %10.0f %10.0f %s %s %9.0f %s %7d %6d %6d %7d %s" % (r['clients'],
+                r['offered_per_sec'], r['requests_per_sec'], ms(r['p50_ms']), ms(r['p99_ms']),
+                r['notifications_per_sec'], ms(r['notify_p99_ms']), r['notifications_dropped'],
+                r['att_errors'], r['discoveries'], r['skipped'], "" if r['sustained'] else "<- degraded"))
+        best = self.capacity()
+        db = self.device.gatt
+        notifying = sum(1 for sv in db.services for ch in sv.characteristics
+                        if ch.properties & gatt.PROPS_NOTIFY)
+        lines.append("Database: %d services, %d attributes, %d notifying" % (len(db.services),
+                     len(db.handleTable) - 1, notifying))
+        if best is None:
+            lines.append("Capacity: not even the first stage was sustained")
+        else:
+            lines.append("Capacity: %d clients, %.0f requests/s, p99 %.2fms" % (
+                best['clients'], best['requests_per_sec'], best['p99_ms']))
+        return "\n".join(lines)
+
+
+class NullOutput:
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+
+if __name__ == '__main__':
+    # Usage: loadgen.py [--chars N] [--mix name] [--stages 1,2,4,...]
+    #                   [--time seconds] [--p99 ms] [--json file]
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(description="GATT server load generator")
+    parser.add_argument("--chars", type=int, help="synthetic database of N characteristics "
+                        "(as benchmark.py); default loadServices()")
+    parser.add_argument("--mix", choices=sorted(MIXES), help="every client the same, instead of all mixes")
+    parser.add_argument("--stages", default="1,2,4,8,16,32,64,128", help="clients in each stage")
+    parser.add_argument("--time", type=float, default=2.0, help="seconds measured per stage")
+    parser.add_argument("--p99", type=float, default=50.0, help="highest sustainable p99 latency, ms")
+    parser.add_argument("--json", help="write stage results as JSON")
+    args = parser.parse_args()
+
+    services = None
+    if args.chars:
+        import benchmark
+        services = benchmark.makeServices(args.chars)
+    mixes = [ MIXES[args.mix] ] if args.mix else DEFAULT_MIX
+    gen = LoadGenerator(services, mixes, maxP99=args.p99 / 1000.0)
+
+    def progress(r):
+        sys.__stdout__.write("%d clients: %.0f requests/s, p99 %s ms%s\n" % (r['clients'], r['requests_per_sec'],
+            "%.2f" % r['p99_ms'] if r['p99_ms'] is not None else "-", "" if r['sustained'] else ", degraded"))
+        sys.__stdout__.flush()
+    gen.withStageCallback(progress)
+
+    saved = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        results = gen.ramp([ int(n) for n in args.stages.split(",") ], args.time)
+    finally:
+        sys.stdout = saved
+    print (gen.report())
+    assert gen.totals['discoveries'] > 0 and results[0]['att_errors'] == 0, results
+    if any(c.mix.subscribe for c in gen.clients):
+        assert any(r['notifications_per_sec'] > 0 for r in results), results
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,357 @@
+import time
+import bisect
+import threading
+import collections
+
+try:
+    import http.server as httpserver
+except ImportError:
+    httpserver = None
+
+import gattcmds
+import txsched
+
+# Instrumentation for a running stack. A Registry holds metric families
+# (counters, gauges and histograms, each keyed by a tuple of label
+# values); StackMetrics creates the families the stack feeds, and has
+# the methods the hot paths call. Components take one with withMetrics()
+# and do nothing extra without it.
+#
+# Only the stack's own thread updates the values, so there are no
+# locks. snapshot() may be called from another thread (as the exporter
+# does): it copies each family in one step, so a snapshot may be a
+# fraction of an update behind, but is never corrupt.
+#
+# MetricsServer exports the Prometheus text format over HTTP, on
+# localhost by default.
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Upper bounds, in seconds
+ATT_SERVICE_BOUNDS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 1e-2, 0.1)
+COMMAND_RTT_BOUNDS = (1e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.1, 0.5, 2.0)
+
+# ATT opcode labels, from the client's requests
+ATT_NAMES = { c.opcode: c.__name__ for c in vars(gattcmds).values()
+              if isinstance(c, type) and issubclass(c, gattcmds.GATTCommand) and c.opcode is not None }
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # Last is above all bounds
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        '''(cumulative bucket counts, sum, count)'''
+        counts = list(self.counts)
+        cumulative = []
+        total = 0
+        for n in counts:
+            total += n
+            cumulative.append(total)
+        return (cumulative, self.sum, total)
+
+
+class Family:
+    def __init__(self, name, kind, help, labelNames=(), bounds=None, sample=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.bounds = bounds
+        self.sample = sample # For gauges: sample() returns { labels: value }
+        self.values = collections.Counter() if kind == COUNTER else {}
+
+    def inc(self, labels=(), n=1):
+        self.values[labels] += n
+
+    def set(self, labels, value):
+        self.values[labels] = value
+
+    def observe(self, labels, value):
+        h = self.values.get(labels)
+        if h is None:
+            h = self.values[labels] = Histogram(self.bounds)
+        h.observe(value)
+
+    def remove(self, match):
+        '''Drops the label sets for which match(labels) is True'''
+        for labels in [ l for l in list(self.values) if match(l) ]:
+            self.values.pop(labels, None)
+
+    def snapshot(self):
+        items = self.sample() if self.sample is not None else dict(list(self.values.items()))
+        if self.kind == HISTOGRAM:
+            return { labels: h.snapshot() for (labels, h) in items.items() }
+        return items
+
+
+class Registry:
+    def __init__(self):
+        self.families = collections.OrderedDict()
+
+    def _add(self, family):
+        if family.name in self.families:
+            raise ValueError("Metric %s already registered" % family.name)
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, help, labelNames=()):
+        return self._add(Family(name, COUNTER, help, labelNames))
+
+    def gauge(self, name, help, labelNames=(), sample=None):
+        # Set values with set(), or give sample() to read them at
+        # snapshot time
+        return self._add(Family(name, GAUGE, help, labelNames, sample=sample))
+
+    def histogram(self, name, help, labelNames=(), bounds=ATT_SERVICE_BOUNDS):
+        return self._add(Family(name, HISTOGRAM, help, labelNames, bounds=tuple(bounds)))
+
+    def snapshot(self):
+        '''Maps each family name to { labels: value }; a histogram's
+           value is (cumulative bucket counts, sum, count)'''
+        return { f.name: f.snapshot() for f in list(self.families.values()) }
+
+    def prometheusText(self):
+        '''Snapshot in the Prometheus text exposition format'''
+        lines = []
+        for f in list(self.families.values()):
+            lines.append("# HELP %s %s" % (f.name, f.help))
+            lines.append("# TYPE %s %s" % (f.name, f.kind))
+            for (labels, value) in sorted(f.snapshot().items()):
+                if f.kind != HISTOGRAM:
+                    lines.append("%s%s %s" % (f.name, _labelText(f.labelNames, labels), _number(value)))
+                    continue
+                (cumulative, total, count) = value
+                for (bound, n) in zip(list(f.bounds) + ["+Inf"], cumulative):
+                    le = bound if bound == "+Inf" else repr(float(bound))
+                    lines.append("%s_bucket%s %d" % (f.name,
+                        _labelText(f.labelNames + ('le',), labels + (le,)), n))
+                lines.append("%s_sum%s %s" % (f.name, _labelText(f.labelNames, labels), _number(total)))
+                lines.append("%s_count%s %d" % (f.name, _labelText(f.labelNames, labels), count))
+        return "\n".join(lines) + "\n"
+
+def _labelText(names, values):
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                                       .replace("\n", "\\n")) for (n, v) in zip(names, values)) + "}"
+
+def _number(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class StackMetrics:
+    # What a Device or Central (and a GattServer) reports
+
+    def __init__(self, registry=None):
+        r = self.registry = registry if (registry is not None) else Registry()
+        self.attRequests = r.counter("ble_att_requests_total", "ATT PDUs served, by opcode", ("opcode",))
+        self.attErrors = r.counter("ble_att_errors_total", "ATT Error Responses sent", ("opcode", "error"))
+        self.attServiceTime = r.histogram("ble_att_service_seconds", "Time to serve an ATT PDU",
+                                          ("opcode",), ATT_SERVICE_BOUNDS)
+        self.commandTime = r.histogram("ble_hci_command_seconds",
+                                       "HCI command to Command Complete or Status", ("command",),
+                                       COMMAND_RTT_BOUNDS)
+        self.commandTimeouts = r.counter("ble_hci_command_timeouts_total", "HCI commands timed out",
+                                         ("command",))
+        self.aclBytes = r.counter("ble_acl_bytes_total", "ACL payload bytes, by connection",
+                                  ("handle", "direction"))
+        self.stalls = r.counter("ble_acl_reassembly_stalls_total",
+                                "L2CAP PDUs abandoned part way through reassembly", ("handle",))
+        self.advReports = r.counter("ble_adv_reports_total", "Advertising reports from the controller")
+        self.advRate = r.gauge("ble_adv_reports_per_second",
+                               "Advertising reports per second, since the last snapshot",
+                               sample=self._sampleAdvRate)
+        self.lastAdv = (time.monotonic(), 0)
+        self.queues = []
+
+    def watchQueue(self, sock):
+        '''Adds gauges for sock.packetQueue (a txsched.TransmitScheduler)'''
+        if len(self.queues) == 0:
+            self.registry.gauge("ble_tx_queue_depth", "Packets waiting to go to the controller",
+                                ("queue", "class"), sample=self._sampleDepth)
+            self.registry.gauge("ble_acl_credits", "Controller ACL buffers free", ("queue",),
+                                sample=self._sampleCredits)
+        self.queues.append(sock.packetQueue)
+
+    def _sampleDepth(self):
+        return { (str(i), name): q.depth(c) for (i, q) in enumerate(self.queues)
+                 for (c, name) in enumerate(txsched.CLASS_NAMES) }
+
+    def _sampleCredits(self):
+        return { (str(i),): q.aclCredits for (i, q) in enumerate(self.queues) if q.aclCredits is not None }
+
+    def _sampleAdvRate(self):
+        now = time.monotonic()
+        count = self.advReports.values[()]
+        (then, before) = self.lastAdv
+        self.lastAdv = (now, count)
+        return { (): (count - before) / (now - then) if now > then else 0.0 }
+
+    # Hot path hooks ---------------
+
+    def attServed(self, opcode, resp, seconds):
+        name = ATT_NAMES.get(opcode) or ("0x%02X" % opcode)
+        self.attRequests.values[(name,)] += 1
+        self.attServiceTime.observe((name,), seconds)
+        if resp is not None and len(resp) == 5 and resp[0] == gattcmds.ATT_ERROR_RSP:
+            self.attErrors.values[(name, "0x%02X" % resp[4])] += 1
+
+    def commandDone(self, cmd, seconds):
+        self.commandTime.observe((type(cmd).__name__,), seconds)
+
+    def commandTimedOut(self, cmd):
+        self.commandTimeouts.values[(type(cmd).__name__,)] += 1
+
+    # Connections are labelled with the handle in decimal
+    def aclReceived(self, handle, n):
+        self.aclBytes.values[(handle, "rx")] += n
+
+    def aclSent(self, handle, n):
+        self.aclBytes.values[(handle, "tx")] += n
+
+    def reassemblyStalled(self, handle):
+        self.stalls.values[(handle,)] += 1
+
+    def advertisingReports(self, n):
+        self.advReports.values[()] += n
+
+    def forgetConnection(self, handle):
+        for f in (self.aclBytes, self.stalls):
+            f.remove(lambda labels: labels[0] == handle)
+
+
+class MetricsServer:
+    # Serves registry.prometheusText() at /metrics, from a daemon thread
+
+    def __init__(self, registry, port=9464, host="127.0.0.1"):
+        if httpserver is None:
+            raise ImportError("http.server unavailable")
+        self.registry = registry
+        exporter = self
+
+        class Handler(httpserver.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.registry.prometheusText().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = httpserver.HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1] # If port was 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    # Reads from 4 virtual peripherals, with and without metrics, for
+    # the cost per request; then the counters, over HTTP as Prometheus
+    # would fetch them
+    import io
+    import sys
+    import urllib.request
+    import gatt
+    import central
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualPeripheral
+
+    LINKS = 4
+    READS = 500
+
+    def readLoad(m):
+        ctlr = VirtualController()
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+        if m is not None:
+            cen.withMetrics(m)
+        peers = []
+        for i in range(LINKS):
+            server = gatt.GattServer().withServices(gatt.makeTestServices())
+            if m is not None:
+                server.withMetrics(m)
+            peers.append(VirtualPeripheral(bytes([0x10 + i, 0, 0, 0xDD, 0xDD, 0xDD]), server))
+        state = { 'links': 0, 'done': 0, 'started': None }
+
+        def readNext(client, n):
+            if n == 0:
+                state['done'] += 1
+                if state['done'] == LINKS:
+                    cen.stop()
+                return
+            client.sendRequest(gattcmds.Read(0x0003).withCompletion(lambda cmd: readNext(client, n - 1)))
+
+        def onDiscovered(disc):
+            assert disc.error is None
+            disc.client.sendRequest(gattcmds.Read(0x1234)) # One error each
+            state['links'] += 1
+            if state['links'] == LINKS:
+                state['started'] = time.process_time()
+                for c in cen.gattClients.values():
+                    readNext(c, READS)
+        cen.onDiscoveryDone = onDiscovered
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            cen.start()
+            for p in peers:
+                ctlr.connectToPeer(p)
+            cen.run()
+        finally:
+            sys.stdout = saved
+        assert state['done'] == LINKS
+        return (time.process_time() - state['started']) / (LINKS * READS)
+
+    bare = min(readLoad(None) for i in range(3))
+    timed = None
+    for i in range(3):
+        m = StackMetrics()
+        t = readLoad(m)
+        timed = t if timed is None else min(timed, t)
+    print ("Per read: %.1fus without metrics, %.1fus with (%+.1f%%)" % (
+        bare * 1e6, timed * 1e6, (timed - bare) * 100 / bare))
+
+    snap = m.registry.snapshot()
+    (buckets, total, count) = snap["ble_att_service_seconds"][("Read",)]
+    assert count == LINKS * (READS + 1)
+    assert snap["ble_att_errors_total"][("Read", "0x01")] == LINKS
+    assert snap["ble_hci_command_seconds"][("Reset",)][2] == 1
+    print ("ATT Read: %d served, mean %.1fus; HCI commands timed: %d" % (
+        count, total * 1e6 / count, sum(h[2] for h in snap["ble_hci_command_seconds"].values())))
+
+    server = MetricsServer(m.registry, port=0).start()
+    try:
+        text = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % server.port).read().decode('utf-8')
+    finally:
+        server.stop()
+    assert 'ble_att_requests_total{opcode="Read"} %d' % count in text
+    assert 'ble_att_service_seconds_bucket{opcode="Read",le="+Inf"} %d' % count in text
+    assert 'ble_tx_queue_depth{queue="0",class="bulk"} 0' in text
+    print ("Exported %d lines, e.g.:" % len(text.splitlines()))
+    for line in text.splitlines():
+        if line.startswith("ble_att_requests_total") or line.startswith("ble_acl_bytes_total"):
+            print ("  " + line)
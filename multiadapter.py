@@ -0,0 +1,440 @@
+import sys
+import time
+import queue
+import select
+import struct
+import multiprocessing
+
+import commands
+import timerwheel
+import events
+from hcipacket import HCI_EVENT_PACKET
+
+# Runs several HCI adapters (each with its own Device or Central stack)
+# in one process, from a single poll loop. Alternatively runWorkers()
+# gives each adapter a process of its own, and collects their scan
+# results in the parent.
+#
+# New connections are spread over the adapters by pickAdapter(): the
+# host's connect() initiates from the adapter it picks, and of the
+# adapters which readvertise, only the one it picks advertises (a
+# central connects to whichever adapter it finds advertising).
+
+class ScanResult:
+    def __init__(self, address, addrType):
+        self.address = address
+        self.addrType = addrType
+        self.rssi = None        # Best RSSI of latest sightings
+        self.adapters = {}      # Maps adapter id to last RSSI seen there
+        self.advData = None     # Latest report data, by event type
+        self.scanData = None
+        self.firstSeen = self.lastSeen = time.monotonic()
+        self.reports = 0
+
+    def update(self, adapterId, report, now):
+        self.adapters[adapterId] = report.RSSI
+        self.rssi = max(self.adapters.values())
+        if report.event_type == events.SCAN_RSP:
+            self.scanData = report.adv_data
+        else:
+            self.advData = report.adv_data
+        self.lastSeen = now
+        self.reports += 1
+
+    def bestAdapter(self):
+        return max(self.adapters, key=lambda a: self.adapters[a])
+
+    def __str__(self):
+        return "addr=%s rssi=%d via %r adv=%s" % (
+            ":".join("%02X" % b for b in reversed(self.address)), self.rssi,
+            sorted(self.adapters), self.advData)
+
+
+class ScanAggregator(events.EventHandler):
+    # Merges advertising reports from many adapters, keyed by address
+
+    def __init__(self, maxAge=30.0):
+        self.results = {} # Maps address to ScanResult
+        self.maxAge = maxAge
+        self.callback = None
+        self.adapterId = None
+
+    def withCallback(self, callback):
+        # callback(result, isNew)
+        self.callback = callback
+        return self
+
+    def onReportEvent(self, adapterId, data):
+        # data is an LE Advertising Report event, without packet type byte
+        self.adapterId = adapterId
+        self.onEventReceived(data)
+
+    def onAdvertisingReport(self, report):
+        now = time.monotonic()
+        res = self.results.get(report.address)
+        isNew = res is None
+        if isNew:
+            res = self.results[report.address] = ScanResult(report.address, report.address_type)
+        res.update(self.adapterId, report, now)
+        if self.callback:
+            self.callback(res, isNew)
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        old = [ addr for (addr, res) in self.results.items() if now - res.lastSeen > self.maxAge ]
+        for addr in old:
+            del self.results[addr]
+        return len(old)
+
+
+def isAdvertisingReport(data):
+    # data is a raw HCI packet, including type byte
+    return (len(data) > 3 and data[0] == HCI_EVENT_PACKET and data[1] == events.E_LE_META_EVENT
+              and data[3] == events.E_LE_ADVERTISING_REPORT)
+
+
+class Adapter:
+    def __init__(self, host, adapterId, sock, stack, maxConnections, readvertise):
+        self.host = host
+        self.adapterId = adapterId
+        self.sock = sock
+        self.stack = stack
+        self.maxConnections = maxConnections
+        self.readvertise = readvertise
+        self.advertising = readvertise # As bring-up leaves it
+        self.connections = {} # Maps handle to role
+        self.connecting = 0 # Connections we've asked for, not yet complete
+
+    def isPollable(self):
+        return hasattr(self.sock, "fileno")
+
+    def load(self):
+        return len(self.connections) + self.connecting
+
+    def hasCapacity(self):
+        return (self.maxConnections is None) or self.load() < self.maxConnections
+
+    def onConnectFailed(self, cmd):
+        if cmd.error() is not None:
+            self.connecting = max(0, self.connecting - 1)
+
+    # Tap interface: watches connections come and go, and scan reports
+    def onPacketSent(self, sock, data):
+        pass
+
+    def onPacketReceived(self, sock, data):
+        if data[0] != HCI_EVENT_PACKET:
+            return
+        code = data[1]
+        if code == events.E_LE_META_EVENT:
+            sub = data[3]
+            if sub == events.E_LE_ADVERTISING_REPORT:
+                self.host.scanResults.onReportEvent(self.adapterId, data[1:])
+            elif sub == events.E_LE_CONN_COMPLETE:
+                (status, handle, role) = struct.unpack("<BHB", data[4:8])
+                if role == 0x00 and self.connecting > 0:
+                    self.connecting -= 1
+                if status == 0:
+                    if role == 0x01:
+                        self.advertising = False # The controller stops
+                    self.connections[handle] = role
+                    self.host.onConnectionCountChanged(self)
+        elif code == events.E_DISCONN_COMPLETE:
+            (status, handle) = struct.unpack("<BH", data[3:6])
+            if status == 0 and self.connections.pop(handle, None) is not None:
+                self.host.onConnectionCountChanged(self)
+
+
+class MultiAdapterHost:
+    EXPIRY_INTERVAL = 1.0
+
+    def __init__(self):
+        self.adapters = []
+        self.byFd = {}
+        self.poller = select.poll()
+        self.scanResults = ScanAggregator().withCallback(self._onScanResult)
+        self.scanCallback = None
+        self.running = False
+        self.timers = timerwheel.TimerWheel()
+        self.expiryTimer = None
+
+    def addAdapter(self, sock, stack, adapterId=None, maxConnections=None, readvertise=False):
+        '''Attaches stack (e.g. device.Device()) to sock, to be run from
+           this host's loop. With readvertise, the host keeps one such
+           adapter advertising, the least loaded, until all have
+           maxConnections; leave the stack's own maxConnections at 1.'''
+        if adapterId is None:
+            adapterId = getattr(sock, "devId", len(self.adapters))
+        adapter = Adapter(self, adapterId, sock, stack, maxConnections, readvertise)
+        sock.timers = self.timers # All stacks' timers run from our loop
+        stack.withSocket(sock.withHost(self).withTap(adapter))
+        self.adapters.append(adapter)
+        if adapter.isPollable():
+            self.byFd[sock.fileno()] = adapter
+            self.poller.register(sock.fileno(), sock.pollMask())
+        return adapter
+
+    def withScanCallback(self, callback):
+        self.scanCallback = callback
+        return self
+
+    def _onScanResult(self, res, isNew):
+        if self.expiryTimer is None:
+            self.expiryTimer = self.timers.callLater(self.EXPIRY_INTERVAL, self._expireScanResults)
+        if self.scanCallback:
+            self.scanCallback(res, isNew)
+
+    def _expireScanResults(self):
+        self.scanResults.expire()
+        self.expiryTimer = None
+        if len(self.scanResults.results) > 0:
+            self.expiryTimer = self.timers.callLater(self.EXPIRY_INTERVAL, self._expireScanResults)
+
+    def start(self):
+        # Each stack's start() returns straight away, as its socket is hosted
+        for adapter in self.adapters:
+            adapter.stack.start()
+        return self.run()
+
+    def stop(self):
+        self.running = False
+
+    def pickAdapter(self, accept=None):
+        '''Returns the running adapter which should take a new connection;
+           accept(adapter), if given, limits the choice'''
+        live = [ a for a in self.adapters if a.sock.running and a.hasCapacity()
+                   and (accept is None or accept(a)) ]
+        if len(live) == 0:
+            return None
+        return min(live, key=lambda a: a.load())
+
+    def connect(self, addrType, address):
+        '''Connects to a peripheral from the adapter pickAdapter() chooses,
+           among those which don't readvertise; returns it, or None if
+           all are full. Uses the stack's connection manager, if it has
+           one, so connections to one adapter wait their turn.'''
+        adapter = self.pickAdapter(lambda a: not a.readvertise)
+        if adapter is None:
+            return None
+        adapter.connecting += 1
+        mgr = getattr(adapter.stack, "connectionManager", None)
+        if mgr is not None:
+            if not mgr.connect(addrType, address):
+                adapter.connecting -= 1
+                return None
+        else:
+            adapter.stack.queueCommand(commands.LECreateConnection(address, peer_addr_type=addrType)
+                                         .withCompletion(adapter.onConnectFailed))
+        return adapter
+
+    def connectionCount(self):
+        return sum(len(a.connections) for a in self.adapters)
+
+    def onConnectionCountChanged(self, adapter):
+        if adapter.readvertise:
+            self._placeAdvertising()
+
+    def _placeAdvertising(self):
+        # Controllers stop advertising once connected. Advertise from
+        # just the adapter the next connection should go to.
+        target = self.pickAdapter(lambda a: a.readvertise)
+        for a in self.adapters:
+            if a.readvertise and a.sock.running and a.advertising != (a is target):
+                a.advertising = (a is target)
+                a.stack.queueCommand(commands.LESetAdvertiseEnable(
+                    commands.LESetAdvertiseEnable.ENABLE if a.advertising else commands.LESetAdvertiseEnable.DISABLE))
+
+    def run(self):
+        self.running = True
+        while self.running:
+            live = [ a for a in self.adapters if a.sock.running ]
+            if len(live) == 0:
+                break
+            # In-process (virtual) sockets just get a turn each time round,
+            # and their controllers a tick once the sockets are drained,
+            # whether or not there are real adapters too
+            virtual = [ a for a in live if not a.isPollable() ]
+            busy = False
+            for a in virtual:
+                busy = a.sock.runOnce() or busy
+            if not busy:
+                for a in virtual:
+                    busy = a.sock.controller.tick() or busy
+            polled = [ a for a in live if a.isPollable() ]
+            timeout = self.timers.nextTimeout()
+            if not busy and len(polled) == 0:
+                housekeeping = 1 if (self.expiryTimer is not None) else 0
+                if self.timers.count <= housekeeping:
+                    break # All virtual, and nothing left to do
+                time.sleep(timeout)
+            if busy:
+                timeout = 0
+            if len(polled) > 0:
+                for a in polled:
+                    self.poller.modify(a.sock.fileno(), a.sock.pollMask())
+                evts = self.poller.poll(1000.0 if (timeout is None) else min(1000.0, timeout*1000.0))
+                for (fd, evtmask) in evts:
+                    adapter = self.byFd[fd]
+                    if not adapter.sock.onPollEvent(evtmask):
+                        print ("Adapter %s failed" % adapter.adapterId)
+                        self.poller.unregister(fd)
+                        del self.byFd[fd]
+            self.timers.advance()
+        self.running = False
+        return self
+
+
+# Process-per-adapter mode ---------------
+
+class ScanForwarder:
+    # Tap which passes advertising reports to the parent process
+    def __init__(self, reportQueue, adapterId):
+        self.reportQueue = reportQueue
+        self.adapterId = adapterId
+
+    def onPacketSent(self, sock, data):
+        pass
+
+    def onPacketReceived(self, sock, data):
+        if isAdvertisingReport(data):
+            self.reportQueue.put( (self.adapterId, bytes(data[1:])) )
+
+def _workerMain(devId, stackFactory, reportQueue):
+    from hcisocket_linux import HCISocket
+    sock = HCISocket(devId).withTap(ScanForwarder(reportQueue, devId))
+    stackFactory().withSocket(sock).start()
+
+class WorkerPool:
+    EXPIRY_INTERVAL = MultiAdapterHost.EXPIRY_INTERVAL
+
+    def __init__(self, devIds, stackFactory):
+        self.reportQueue = multiprocessing.Queue()
+        self.scanResults = ScanAggregator()
+        self.workers = [ multiprocessing.Process(target=_workerMain,
+                             args=(devId, stackFactory, self.reportQueue), name="hci%d" % devId)
+                           for devId in devIds ]
+
+    def withScanCallback(self, callback):
+        self.scanResults.withCallback(callback)
+        return self
+
+    def run(self):
+        for w in self.workers:
+            w.start()
+        try:
+            # Expires on a deadline, not when reports stop, which in a
+            # crowded place they never do
+            nextExpiry = time.monotonic() + self.EXPIRY_INTERVAL
+            while any(w.is_alive() for w in self.workers):
+                try:
+                    (adapterId, data) = self.reportQueue.get(timeout=max(0, nextExpiry - time.monotonic()))
+                    self.scanResults.onReportEvent(adapterId, data)
+                except queue.Empty:
+                    pass
+                if time.monotonic() >= nextExpiry:
+                    self.scanResults.expire()
+                    nextExpiry = time.monotonic() + self.EXPIRY_INTERVAL
+        finally:
+            for w in self.workers:
+                w.terminate()
+                w.join()
+        return self
+
+def runWorkers(devIds, stackFactory):
+    return WorkerPool(devIds, stackFactory).run()
+
+
+def virtualCapacity(nAdapters, perAdapter, role, nPeers):
+    # Connections a host of nAdapters virtual controllers, each taking
+    # perAdapter, ends up with when nPeers try to connect; and how many
+    # each adapter has. As peripherals, each remote central connects to
+    # the first adapter it finds advertising; as centrals, the host
+    # connects to each of nPeers peripherals, which all adapters can hear.
+    import io
+    import gatt
+    import central
+    import connmgr
+    import device
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualCentral, VirtualPeripheral
+
+    host = MultiAdapterHost()
+    ctlrs = [ VirtualController(address=bytes([i, 0, 0, 0xAA, 0xBB, 0xCC])) for i in range(nAdapters) ]
+    peers = []
+    if role == "central":
+        server = gatt.GattServer().withServices(gatt.makeTestServices())
+        peers = [ VirtualPeripheral(bytes([i, 0, 0, 0xEE, 0xEE, 0xEE]), server) for i in range(nPeers) ]
+    for ctlr in ctlrs:
+        if role == "central":
+            for p in peers:
+                ctlr.withAdvertiser(p)
+            cen = central.Central()
+            connmgr.ConnectionManager(cen, maxConnections=perAdapter)
+            host.addAdapter(VirtualHCISocket(ctlr), cen, maxConnections=perAdapter)
+        else:
+            host.addAdapter(VirtualHCISocket(ctlr), device.Device(), maxConnections=perAdapter,
+                            readvertise=True)
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        if role == "central":
+            # Adapters can be picked once the host is running them
+            def connectAll():
+                for p in peers:
+                    host.connect(p.addrType, p.address)
+            host.timers.callLater(0.01, connectAll)
+            # Scan reports never run out, so the loop won't end by itself
+            host.timers.callLater(1.0, host.stop)
+            host.start()
+        else:
+            host.start()
+            for i in range(nPeers):
+                found = [ c for c in ctlrs if c.advertising ]
+                if len(found) == 0:
+                    break
+                VirtualCentral(found[0], address=bytes([i & 0xFF, i >> 8, 0, 0, 0xCC, 0xCC])).connect()
+                host.run()
+    finally:
+        sys.stdout = saved
+    return (host.connectionCount(), [ len(a.connections) for a in host.adapters ])
+
+
+if __name__ == '__main__':
+    # Usage: multiadapter.py [--workers] central|device devId ...
+    #    or: multiadapter.py virtual, for capacity as adapters are added
+    if sys.argv[1:] == ["virtual"]:
+        # Capacity with more peers than that, and how fewer are spread
+        PER_ADAPTER = 8
+        for role in ["device", "central"]:
+            for n in [1, 2, 4]:
+                (total, each) = virtualCapacity(n, PER_ADAPTER, role, 40)
+                assert total == min(40, n * PER_ADAPTER), (total, each)
+                (some, spread) = virtualCapacity(n, PER_ADAPTER, role, 2 * n + 1)
+                assert some == 2 * n + 1 and max(spread) - min(spread) <= 1, spread
+                print ("%-7s %d adapter(s) x %d: %2d of 40 connected; %d spread as %s" % (
+                    role, n, PER_ADAPTER, total, some, spread))
+        sys.exit(0)
+
+    import central
+    import device
+    from hcisocket_linux import HCISocket
+
+    args = sys.argv[1:]
+    useWorkers = "--workers" in args
+    args = [ a for a in args if a != "--workers" ]
+    if len(args) < 2 or args[0] not in ["central", "device"]:
+        print ("Usage: %s [--workers] central|device devId ..." % sys.argv[0])
+        sys.exit(1)
+    factory = central.Central if args[0] == "central" else device.Device
+    devIds = [ int(a) for a in args[1:] ]
+    def onScan(res, isNew):
+        if isNew:
+            print ("New device: %s" % res)
+
+    if useWorkers:
+        WorkerPool(devIds, factory).withScanCallback(onScan).run()
+    else:
+        host = MultiAdapterHost().withScanCallback(onScan)
+        for devId in devIds:
+            host.addAdapter(HCISocket(devId), factory(), readvertise=(factory is device.Device))
+        host.start()
@@ -0,0 +1,284 @@
+import collections
+
+import advfilter
+import commands
+
+# Scanning for particular devices, filtering reports as early as
+# possible. In a crowded place most advertising reports are from
+# devices we don't care about, and each one costs an HCI event and a
+# parse on the host. Filtering layers, cheapest first:
+#
+#  - White list (the accept list, in later specs): the controller only
+#    reports listed addresses. Needs every address known in advance, and
+#    no more of them than the controller's list holds.
+#  - Duplicate filtering: the controller reports each advertiser once,
+#    until scanning is enabled again. We re-enable it every
+#    refreshInterval, so devices still around are seen again.
+#  - Host: anything else (service UUIDs, more addresses than fit the
+#    white list, other advfilter predicates) is matched on the raw
+#    report bytes, before the report is parsed.
+#
+# Scanner.scanFor() picks the layers for what it's asked to find.
+
+def _addressKey(entry):
+    # (addrType, address) or just an address, taken to be public
+    if isinstance(entry, tuple):
+        return (entry[0], bytes(entry[1]))
+    return (0, bytes(entry))
+
+class ScanFilter:
+    # Matches reports from any of addresses, advertising any of uuids,
+    # or matching advfilter predicate match; with none of them, matches
+    # everything
+
+    def __init__(self, addresses=(), uuids=(), match=None):
+        self.addresses = set(_addressKey(a) for a in addresses)
+        self.known = set(self.addresses) # Plus those matched otherwise, for their scan responses
+        self.uuids = list(uuids)
+        self.match = match
+        preds = [ advfilter.AddressIn(self.known) ] + [ advfilter.ServiceUUID(u) for u in self.uuids ]
+        if match is not None:
+            preds.append(match)
+        self.matcher = advfilter.compileFilter(advfilter.AnyOf(*preds))
+
+    def isEmpty(self):
+        return len(self.addresses) == 0 and len(self.uuids) == 0 and self.match is None
+
+    def addressesOnly(self):
+        return len(self.uuids) == 0 and self.match is None
+
+    def matches(self, report):
+        return self.isEmpty() or self.matcher(report.address_type, report.address, report.gap_data)
+
+    def remember(self, report):
+        self.known.add( (report.address_type, report.address) )
+
+
+class ScanPlan:
+    # What the controller is asked to do for a ScanFilter
+    def __init__(self, whiteList, filterDuplicates, hostFilter):
+        self.whiteList = whiteList # List of (addrType, address), or None
+        self.filterDuplicates = filterDuplicates
+        self.hostFilter = hostFilter # ScanFilter, or None if controller does it all
+
+    def __str__(self):
+        layers = []
+        if self.whiteList is not None:
+            layers.append("white list (%d)" % len(self.whiteList))
+        if self.filterDuplicates:
+            layers.append("duplicates")
+        if self.hostFilter is not None:
+            layers.append("host")
+        return "+".join(layers) if layers else "none"
+
+
+class Scanner:
+    def __init__(self, central, refreshInterval=10.0, active=True,
+                 scanInterval=0x0010, scanWindow=0x0010):
+        self.central = central.withScanner(self)
+        self.refreshInterval = refreshInterval
+        self.scanType = commands.LESetScanParameters.ACTIVE if active else commands.LESetScanParameters.PASSIVE
+        self.scanInterval = scanInterval
+        self.scanWindow = scanWindow
+        self.filter = ScanFilter()
+        self.everyReport = False
+        self.callback = None
+        self.plan = None
+        self.stackReady = False
+        self.scanning = False
+        self.generation = 0 # Changes when a command sequence is superseded
+        self.refreshTimer = None
+        self.stats = collections.Counter()
+
+    def scanFor(self, addresses=(), uuids=(), callback=None, everyReport=False, match=None):
+        '''Scans for devices with any of addresses, advertising any of
+           uuids, or matching advfilter predicate match; callback(report)
+           for each report from one. With everyReport, duplicates aren't
+           filtered (e.g. to track RSSI).'''
+        self.filter = ScanFilter(addresses, uuids, match)
+        self.everyReport = everyReport
+        if callback is not None:
+            self.callback = callback
+        self._restart()
+        return self
+
+    def scanAll(self, callback=None, everyReport=False):
+        return self.scanFor((), (), callback, everyReport)
+
+    def stop(self):
+        self.pause()
+        self.plan = None
+        self.central.withReportFilter(None)
+
+    def pause(self, completion=None):
+        '''Stops scanning for now (e.g. to connect); resume() restarts it.
+           completion(cmd) when the controller has stopped.'''
+        self._cancelRefresh()
+        self.generation += 1 # Anything under way stops where it is
+        if self.scanning:
+            self.scanning = False
+            self.central.queueCommand(commands.LESetScanEnable(commands.LESetScanEnable.DISABLE)
+                                        .withCompletion(completion))
+        elif completion is not None:
+            completion(None)
+
+    def resume(self):
+        self._restart()
+
+    def makePlan(self):
+        whiteListSize = None
+        if self.central.bringup is not None:
+            whiteListSize = self.central.bringup.info.whiteListSize
+        if self.filter.addressesOnly() and len(self.filter.addresses) > 0 and \
+               whiteListSize is not None and len(self.filter.addresses) <= whiteListSize:
+            return ScanPlan(sorted(self.filter.addresses), not self.everyReport, None)
+        return ScanPlan(None, not self.everyReport, None if self.filter.isEmpty() else self.filter)
+
+    # From central.Central ---------------
+
+    def onStackReady(self):
+        self.stackReady = True
+        self._restart()
+
+    def onAdvertisingReport(self, report):
+        # The central has already dropped those the host filter doesn't match
+        if self.plan is None:
+            return
+        if self.plan.hostFilter is not None:
+            self.plan.hostFilter.remember(report)
+        self.stats['matched'] += 1
+        if self.callback:
+            self.callback(report)
+
+    # Controller setup ---------------
+
+    def _restart(self):
+        if not self.stackReady:
+            return
+        self._cancelRefresh()
+        self.plan = self.makePlan()
+        print ("Scanning with filtering: %s" % self.plan)
+        self.central.withReportFilter(None if (self.plan.hostFilter is None) else self.plan.hostFilter.matcher)
+        # The white list and scan parameters can't change while scanning
+        cmds = [ commands.LESetScanEnable(commands.LESetScanEnable.DISABLE), commands.LEClearWhiteList() ]
+        policy = commands.LESetScanParameters.FILTER_ACCEPT_ALL
+        if self.plan.whiteList is not None:
+            cmds += [ commands.LEAddDeviceToWhiteList(addrType, address)
+                      for (addrType, address) in self.plan.whiteList ]
+            policy = commands.LESetScanParameters.FILTER_WHITE_LIST
+        cmds += [ commands.LESetScanParameters(scan_type=self.scanType, scan_interval=self.scanInterval,
+                      scan_window=self.scanWindow, scan_filter_policy=policy),
+                  commands.LESetScanEnable(commands.LESetScanEnable.ENABLE,
+                      filter_duplicates=self.plan.filterDuplicates) ]
+        self.scanning = True
+        self.generation += 1
+        self._sendSequence(cmds, self._onStarted)
+
+    def _sendSequence(self, cmds, done, generation=None):
+        # One at a time, as each depends on the last having taken effect.
+        # Stops if paused or restarted meanwhile, so it can't re-enable
+        # scanning after a pause's DISABLE.
+        if generation is None:
+            generation = self.generation
+        elif generation != self.generation or not self.scanning:
+            return
+        if len(cmds) == 0:
+            return done()
+        def onComplete(cmd):
+            # Disabling when not scanning may be refused; that's fine
+            if cmd.error() and not (isinstance(cmd, commands.LESetScanEnable) and
+                                    cmd.params[0] == commands.LESetScanEnable.DISABLE):
+                print ("Scan setup failed (opc=0x%04X): %s" % (cmd.opcode, cmd.error()))
+                self.scanning = False
+                return
+            self._sendSequence(cmds[1:], done, generation)
+        self.central.queueCommand(cmds[0].withCompletion(onComplete))
+
+    def _onStarted(self):
+        if self.plan is not None and self.plan.filterDuplicates:
+            self.refreshTimer = self.central.hciSocket.callLater(self.refreshInterval, self._refresh)
+
+    def _refresh(self):
+        # Re-enabling clears the controller's duplicate list
+        self.refreshTimer = None
+        self.stats['refreshes'] += 1
+        self._sendSequence([ commands.LESetScanEnable(commands.LESetScanEnable.DISABLE),
+                             commands.LESetScanEnable(commands.LESetScanEnable.ENABLE, filter_duplicates=True) ],
+                           self._onStarted)
+
+    def _cancelRefresh(self):
+        if self.refreshTimer is not None:
+            self.refreshTimer.cancel()
+            self.refreshTimer = None
+
+
+if __name__ == '__main__':
+    # Reports reaching the host, and host CPU time, scanning for 3 of our
+    # sensors among 200 other advertisers for a second, with each way of
+    # filtering
+    import os
+    import sys
+    import time
+    import gap
+    import central
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualAdvertiser
+
+    OUR_UUID = "FEAA"
+    ours = [ bytes([i, 0, 0, 0xEE, 0xEE, 0xEE]) for i in range(3) ]
+
+    def scanTest(label, **kwargs):
+        ctlr = VirtualController()
+        for i in range(200):
+            advData = gap.AdvertisingData().addItem(gap.GAP_FLAGS, b'\x06').addItem(
+                gap.GAP_NAME_COMPLETE, b'Other %d' % i).data
+            ctlr.withAdvertiser(VirtualAdvertiser(bytes([i, 1, 0, 0xDD, 0xDD, 0xDD]), advData,
+                                                  scanData=b'\x03\xFF\x34\x12'))
+        for addr in ours:
+            advData = gap.AdvertisingData().addItem(gap.GAP_FLAGS, b'\x06').addItem(
+                gap.GAP_UUID_16BIT_COMPLETE, b'\xAA\xFE').addItem(gap.GAP_NAME_COMPLETE, b'Sensor').data
+            ctlr.withAdvertiser(VirtualAdvertiser(addr, advData))
+        cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+        found = set()
+        scanner = Scanner(cen, refreshInterval=0.25).scanFor(callback=lambda r: found.add(r.address), **kwargs)
+        cen.hciSocket.callLater(1.0, cen.stop)
+        saved = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            t0 = time.process_time()
+            cen.start()
+            cpu = time.process_time() - t0
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved
+        assert found == set(ours), "Found %r" % found
+        print ("%-22s %-26s %6d reports to host, %4d matched, %3d refreshes, %5.0fms CPU" % (
+            label, scanner.plan, ctlr.stats['adv_reports'], scanner.stats['matched'],
+            scanner.stats['refreshes'], cpu * 1000))
+
+    scanTest("UUID, every report", uuids=[OUR_UUID], everyReport=True)
+    scanTest("UUID", uuids=[OUR_UUID])
+    scanTest("name prefix", match=advfilter.NamePrefix("Sensor"))
+    scanTest("addresses", addresses=ours)
+
+    # Paused (as FastConnect does, from a report) while a refresh is
+    # under way: scanning stays off
+    ctlr = VirtualController()
+    for addr in ours:
+        ctlr.withAdvertiser(VirtualAdvertiser(addr, b''))
+    cen = central.Central().withSocket( VirtualHCISocket(ctlr) )
+    scanner = Scanner(cen, refreshInterval=0.05).scanAll()
+    refresh = scanner._refresh
+    def refreshThenPause():
+        refresh()
+        scanner.pause()
+    scanner._refresh = refreshThenPause
+    cen.hciSocket.callLater(0.5, cen.stop)
+    saved = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        cen.start()
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved
+    assert not ctlr.scanning and scanner.refreshTimer is None and scanner.stats['refreshes'] == 1
+    print ("Paused during a refresh: scanning stays off")
@@ -0,0 +1,148 @@
+import time
+
+# Hierarchical timing wheel, for timers driven from an HCI socket's poll
+# loop rather than from threads. Starting and cancelling a timer is O(1)
+# however many are pending; each tick touches one slot, plus an
+# occasional cascade of one slot down from a coarser wheel.
+#
+# With the defaults (10ms ticks, 4 wheels of 64 slots) timers can run
+# for up to 64**4 ticks, about 46 hours.
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'args', 'slot', 'wheel')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires # In ticks
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+    def isPending(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    SLOT_BITS = 6
+
+    def __init__(self, tickInterval=0.01, levels=4, clock=time.monotonic):
+        self.tickInterval = tickInterval
+        self.levels = levels
+        self.clock = clock
+        self.nslots = 1 << self.SLOT_BITS
+        self.mask = self.nslots - 1
+        self.wheels = [ [ set() for i in range(self.nslots) ] for l in range(levels) ]
+        self.maxTicks = 1 << (self.SLOT_BITS * levels)
+        self.startTime = clock()
+        self.current = 0 # Ticks processed so far
+        self.count = 0   # Pending timers
+
+    def callLater(self, delay, callback, *args):
+        '''Runs callback(*args) after delay seconds; returns a Timer'''
+        ticks = max(1, int(delay / self.tickInterval + 0.999999))
+        if ticks >= self.maxTicks:
+            raise ValueError("Timer delay %.1fs too long" % delay)
+        t = Timer(self, self._nowTicks() + ticks, callback, args)
+        self._place(t)
+        self.count += 1
+        return t
+
+    def _nowTicks(self):
+        # Timers are relative to real time, not to how far we've ticked
+        return max(self.current, int((self.clock() - self.startTime) / self.tickInterval))
+
+    def _place(self, t):
+        delta = t.expires - self.current
+        if delta < 0:
+            delta = 0
+            t.expires = self.current
+        level = 0
+        while level < self.levels-1 and delta >= (1 << (self.SLOT_BITS * (level+1))):
+            level += 1
+        slot = self.wheels[level][(t.expires >> (self.SLOT_BITS * level)) & self.mask]
+        slot.add(t)
+        t.slot = slot
+
+    def advance(self, now=None):
+        '''Runs all timers due by now; returns the number run'''
+        if now is None:
+            now = self.clock()
+        target = int((now - self.startTime) / self.tickInterval)
+        if self.count == 0:
+            self.current = max(self.current, target)
+            return 0
+        ran = 0
+        while self.current < target and self.count > 0:
+            ran += self._tick()
+        if self.count == 0:
+            self.current = max(self.current, target)
+        return ran
+
+    def _tick(self):
+        self.current += 1
+        cur = self.current
+        for level in range(1, self.levels):
+            if cur & ((1 << (self.SLOT_BITS * level)) - 1):
+                break
+            self._cascade(level, (cur >> (self.SLOT_BITS * level)) & self.mask)
+        idx = cur & self.mask
+        slot = self.wheels[0][idx]
+        if len(slot) == 0:
+            return 0
+        self.wheels[0][idx] = set()
+        ran = 0
+        for t in list(slot):
+            if t.slot is not slot:
+                continue # Cancelled by an earlier callback
+            t.slot = None
+            self.count -= 1
+            t.callback(*t.args)
+            ran += 1
+        return ran
+
+    def _cascade(self, level, idx):
+        slot = self.wheels[level][idx]
+        if len(slot) == 0:
+            return
+        self.wheels[level][idx] = set()
+        for t in slot:
+            self._place(t)
+
+    def nextTimeout(self):
+        '''Seconds until the next timer may be due, or None if none pending.
+           Suitable for a poll() timeout; may be early, never late.'''
+        if self.count == 0:
+            return None
+        ticks = self.nslots - (self.current & self.mask) # Up to the next cascade
+        for i in range(1, ticks):
+            if len(self.wheels[0][(self.current + i) & self.mask]) > 0:
+                ticks = i
+                break
+        due = self.startTime + (self.current + ticks) * self.tickInterval
+        return max(0.0, due - self.clock())
+
+
+if __name__ == '__main__':
+    import random
+
+    wheel = TimerWheel()
+    fired = []
+    timers = []
+    for i in range(20000):
+        delay = random.uniform(0.0, 2.0)
+        timers.append( wheel.callLater(delay, fired.append, delay) )
+    for t in timers[::2]:
+        t.cancel()
+    t0 = time.monotonic()
+    while wheel.count > 0:
+        time.sleep(wheel.nextTimeout())
+        wheel.advance()
+    elapsed = time.monotonic() - t0
+    print ("%d fired in %.2fs, %d pending" % (len(fired), elapsed, wheel.count))
+    assert len(fired) == 10000
@@ -0,0 +1,600 @@
+import os
+import sys
+import time
+import struct
+import collections
+
+import hcipacket
+import events
+import gap
+import gatt
+import btsnoop
+from hcipacket import HCI_COMMAND_PACKET, HCI_ACL_DATA_PACKET, HCI_EVENT_PACKET
+
+# Offline analysis of btsnoop captures. analyzeFile() walks the mapped
+# file itself: every record is counted from its header bytes, and only
+# those a summary needs go further. Command Complete / Status and ATT
+# PDUs are timed from their bytes, advertising reports are taken apart
+# in place for the census (names only when an advertiser's data
+# changes), and only the rare events (connections, disconnections) go
+# through the stack's events.EventHandler. feed() does one record at a
+# time, the slow way, for callers with records of their own.
+
+# ATT PDUs, Core 4.0 spec Vol 3 Part F, 3.4.8
+ATT_OPCODE_NAMES = { 0x01: "ErrorResponse", 0x1B: "HandleValueNotification",
+    0x1D: "HandleValueIndication", 0x1E: "HandleValueConfirmation" }
+for _cls in gatt.Command.__subclasses__():
+    ATT_OPCODE_NAMES[_cls.opcode] = _cls.__name__
+    if _cls.opcode & 0x40 == 0:
+        ATT_OPCODE_NAMES[_cls.opcode+1] = _cls.__name__ + "Response"
+
+# Opcodes which are answered, mapped to the opcode of the answer
+# (an Error Response may also answer any of them)
+ATT_TRANSACTIONS = { 0x02:0x03, 0x04:0x05, 0x06:0x07, 0x08:0x09, 0x0A:0x0B,
+    0x0C:0x0D, 0x0E:0x0F, 0x10:0x11, 0x12:0x13, 0x16:0x17, 0x18:0x19, 0x1D:0x1E }
+ATT_ANSWERS = set(ATT_TRANSACTIONS.values())
+
+DIR_TX = 0 # Host->controller
+DIR_RX = 1 # Controller->host
+DIR_NAMES = ["tx", "rx"]
+
+ACL_HEADER = struct.Struct("<HH") # Also does for the L2CAP header
+RECORD_FIELDS = struct.Struct(">4xII4xq") # Of btsnoop.RECORD_HEADER: incl len, flags, timestamp
+
+def advertisedName(data):
+    '''The Local Name in advertising data, if any; the shortened one if
+       there are both, as gap.AdvertisingData's tags would have it'''
+    name = short = None
+    pos = 0
+    while pos + 1 < len(data):
+        n = data[pos]
+        if n == 0 or pos + 1 + n > len(data):
+            break
+        tag = data[pos+1]
+        if tag == gap.GAP_NAME_COMPLETE:
+            name = data[pos+2:pos+1+n]
+        elif tag == gap.GAP_NAME_INCOMPLETE:
+            short = data[pos+2:pos+1+n]
+        pos += 1 + n
+    if short is not None:
+        name = short
+    return None if name is None else bytes(name).decode('utf-8', 'replace')
+
+
+class Histogram:
+    # Power-of-two buckets; bucket n counts values in [2^(n-1), 2^n)
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.buckets[int(value).bit_length()] += 1
+        self.count += 1
+        self.total += value
+
+    def mean(self):
+        return (self.total / self.count) if self.count else 0
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p'th percentile
+        want = self.count * p / 100.0
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= want:
+                return (1 << b) - 1
+        return 0
+
+
+class AdvertiserInfo:
+    def __init__(self, address, addrType):
+        self.address = address
+        self.addrType = addrType
+        self.reports = 0
+        self.rssiMin = self.rssiMax = None
+        self.rssiTotal = 0
+        self.name = None
+        self.lastData = None # Advertising data last seen
+
+    def add(self, report):
+        self.addReport(report.RSSI, report.gap_data)
+
+    def addReport(self, rssi, data):
+        self.reports += 1
+        self.rssiTotal += rssi
+        if self.rssiMin is None or rssi < self.rssiMin:
+            self.rssiMin = rssi
+        if self.rssiMax is None or rssi > self.rssiMax:
+            self.rssiMax = rssi
+        if data != self.lastData:
+            # Most advertisers send the same data every time
+            self.lastData = bytes(data)
+            name = advertisedName(data)
+            if name is not None:
+                self.name = name
+
+
+class TraceAnalyzer(events.EventHandler):
+    def __init__(self, bucketSeconds=1.0):
+        self.bucketUs = int(bucketSeconds * 1000000)
+        self.records = 0
+        self.bytes = 0
+        self.firstTs = self.lastTs = None
+        self.packetTypes = collections.Counter()     # (dir, packet type)
+        self.hciCommands = collections.Counter()     # opcode
+        self.hciEvents = collections.Counter()       # event code
+        self.leEvents = collections.Counter()        # LE subevent code
+        self.cmdLatency = collections.defaultdict(Histogram) # opcode -> us
+        self.cmdSent = collections.defaultdict(collections.deque) # opcode -> times sent, oldest first
+        self.attOpcodes = collections.Counter()      # (dir, ATT opcode)
+        self.attErrors = collections.Counter()       # (request opcode, error code)
+        self.attLatency = collections.defaultdict(Histogram) # request opcode -> us
+        self.attPending = {}                         # handle << 1 | dir -> (opcode, time)
+        self.l2capCids = collections.Counter()       # (dir, CID)
+        self.throughput = collections.Counter()      # (dir, time bucket) -> ACL bytes
+        self.advertisers = {}                        # address -> AdvertiserInfo
+        self.fragments = {}                          # handle << 1 | dir -> [length, bytearray, CID]
+        self.connectionEvents = collections.Counter()
+        self.now = 0
+
+    # Input -----------------------------
+
+    def feed(self, flags, ts, data):
+        self.records += 1
+        self.bytes += len(data)
+        if self.firstTs is None:
+            self.firstTs = ts
+        self.lastTs = self.now = ts
+        direction = DIR_RX if (flags & btsnoop.FLAG_RECEIVED) else DIR_TX
+        ptype = data[0]
+        self.packetTypes[(direction, ptype)] += 1
+        if ptype == HCI_ACL_DATA_PACKET:
+            self.onAclData(direction, ts, data)
+        elif ptype == HCI_EVENT_PACKET:
+            self.onEventData(data)
+        elif ptype == HCI_COMMAND_PACKET:
+            opcode = data[1] | (data[2] << 8)
+            self.hciCommands[opcode] += 1
+            # The same opcode may be outstanding several times (as
+            # cmdengine allows); answers come in the order sent
+            self.cmdSent[opcode].append(ts)
+
+    def analyzeFile(self, path):
+        with btsnoop.BtSnoopReader(path) as rdr:
+            if self.feedBuffer(rdr.mm, btsnoop.FILE_HEADER.size, rdr.size) < rdr.size:
+                print ("%s: last record truncated" % path)
+        return self
+
+    def feedBuffer(self, buf, pos, end):
+        '''Analyzes the btsnoop records in buf[pos:end], e.g. a mapped
+           file; returns where the first incomplete one starts, or end'''
+        # Counts go into flat lists, indexed by direction and code, and
+        # into the Counters at the end. Everything used per record is a
+        # local.
+        unpack = RECORD_FIELDS.unpack_from
+        unpackAcl = ACL_HEADER.unpack_from
+        hdrlen = RECORD_FIELDS.size
+        epoch = btsnoop.EPOCH_DELTA_US
+        bucketUs = self.bucketUs
+        transactions = ATT_TRANSACTIONS
+        answers = ATT_ANSWERS
+        attPending = self.attPending
+        attLatency = self.attLatency
+        hciCommands = self.hciCommands
+        cmdSent = self.cmdSent
+        types = [0] * 512 # dir << 8 | packet type
+        hciEvents = [0] * 256
+        leEvents = [0] * 256
+        attOpcodes = [0] * 512 # dir << 8 | opcode
+        attCids = [0, 0]
+        cids = collections.Counter() # dir << 16 | CID, other than ATT's
+        tput = [0, 0] # ACL bytes in the current time bucket
+        bucket = None
+        records = nbytes = 0
+        if pos + hdrlen <= end and self.firstTs is None:
+            self.firstTs = unpack(buf, pos)[2] - epoch
+        while pos + hdrlen <= end:
+            (n, d, ts) = unpack(buf, pos)
+            start = pos + hdrlen
+            if start + n > end:
+                break
+            pos = start + n
+            records += 1
+            nbytes += n
+            if n < 2:
+                continue
+            ts -= epoch
+            d &= btsnoop.FLAG_RECEIVED # So DIR_TX or DIR_RX
+            ptype = buf[start]
+            types[d << 8 | ptype] += 1
+            if ptype == HCI_ACL_DATA_PACKET:
+                if n < 5:
+                    continue
+                (hf, fraglen) = unpackAcl(buf, start + 1)
+                b = ts // bucketUs
+                if b != bucket:
+                    if bucket is not None:
+                        self._addThroughput(bucket, tput)
+                    bucket = b
+                    tput = [0, 0]
+                tput[d] += fraglen
+                if fraglen + 5 != n:
+                    continue # As ACLConnection, drop it
+                if (hf & hcipacket.FRAG_FLAGS) != hcipacket.FRAG_NEXT and fraglen >= 4:
+                    (pktlen, cid) = unpackAcl(buf, start + 5)
+                    if pktlen + 4 == fraglen:
+                        # Unfragmented, the usual case: as onL2CAPPacket
+                        if cid != gatt.CID_GATT:
+                            cids[d << 16 | cid] += 1
+                            continue
+                        attCids[d] += 1
+                        if pktlen == 0:
+                            continue
+                        opcode = buf[start + 9]
+                        attOpcodes[d << 8 | opcode] += 1
+                        if opcode in transactions:
+                            attPending[(hf & 0xFFF) << 1 | d] = (opcode, ts)
+                        elif opcode in answers or opcode == 0x01:
+                            req = attPending.pop((hf & 0xFFF) << 1 | (d ^ 1), None)
+                            if req is not None:
+                                attLatency[req[0]].add(ts - req[1])
+                                if opcode == 0x01 and pktlen >= 5:
+                                    self.attErrors[(buf[start + 10], buf[start + 13])] += 1
+                        continue
+                self.now = ts
+                self._reassemble(hf & 0xFFF, d, hf, buf[start+1:pos])
+            elif ptype == HCI_EVENT_PACKET:
+                code = buf[start + 1]
+                hciEvents[code] += 1
+                if code == events.E_NUM_COMPLETED_PACKETS or n < 4:
+                    continue
+                if code == events.E_LE_META_EVENT:
+                    sub = buf[start + 3]
+                    leEvents[sub] += 1
+                    if sub == events.E_LE_ADVERTISING_REPORT:
+                        if buf[start + 2] + 3 == n:
+                            self._onAdvertisingReports(buf, start + 4, pos)
+                        continue
+                elif code == events.E_CMD_RESPONSE:
+                    if n >= 6 and buf[start + 2] + 3 == n:
+                        self.now = ts
+                        self.onCommandResponse(buf[start + 3], buf[start + 4] | (buf[start + 5] << 8), None)
+                    continue
+                elif code == events.E_CMD_STATUS:
+                    if n >= 7 and buf[start + 2] + 3 == n:
+                        self.now = ts
+                        self.onCommandResponse(buf[start + 4], buf[start + 5] | (buf[start + 6] << 8), None)
+                    continue
+                elif code != events.E_DISCONN_COMPLETE:
+                    continue
+                self.now = ts
+                self._decodeEvent(buf[start:pos])
+            elif ptype == HCI_COMMAND_PACKET and n >= 3:
+                opcode = buf[start + 1] | (buf[start + 2] << 8)
+                hciCommands[opcode] += 1
+                cmdSent[opcode].append(ts)
+        if bucket is not None:
+            self._addThroughput(bucket, tput)
+        if records > 0:
+            self.lastTs = self.now = ts
+        self.records += records
+        self.bytes += nbytes
+        for (i, count) in enumerate(types):
+            if count:
+                self.packetTypes[(i >> 8, i & 0xFF)] += count
+        for (i, count) in enumerate(hciEvents):
+            if count:
+                self.hciEvents[i] += count
+        for (i, count) in enumerate(leEvents):
+            if count:
+                self.leEvents[i] += count
+        for (i, count) in enumerate(attOpcodes):
+            if count:
+                self.attOpcodes[(i >> 8, i & 0xFF)] += count
+        for d in (DIR_TX, DIR_RX):
+            if attCids[d]:
+                self.l2capCids[(d, gatt.CID_GATT)] += attCids[d]
+        for (i, count) in cids.items():
+            self.l2capCids[(i >> 16, i & 0xFFFF)] += count
+        return pos
+
+    def _addThroughput(self, bucket, tput):
+        for d in (DIR_TX, DIR_RX):
+            if tput[d]:
+                self.throughput[(d, bucket)] += tput[d]
+
+    def _onAdvertisingReports(self, buf, pos, end):
+        # As events.AdvertisingReport.parseData, without the objects
+        advertisers = self.advertisers
+        nReports = buf[pos]
+        pos += 1
+        for i in range(nReports):
+            # Vol 2, 7.7.65.2: type, address type, address, length, data, RSSI
+            if pos + 10 > end or pos + 10 + buf[pos + 8] > end:
+                self.hciEvents['malformed'] += 1
+                return
+            dataEnd = pos + 9 + buf[pos + 8]
+            address = bytes(buf[pos + 2:pos + 8])
+            info = advertisers.get(address)
+            if info is None:
+                info = advertisers[address] = AdvertiserInfo(address, buf[pos + 1])
+            rssi = buf[dataEnd]
+            info.addReport(rssi - 256 if rssi > 127 else rssi, buf[pos + 9:dataEnd])
+            pos = dataEnd + 1
+
+    # HCI events ------------------------
+
+    def onEventData(self, data):
+        code = data[1]
+        self.hciEvents[code] += 1
+        if code == events.E_LE_META_EVENT:
+            self.leEvents[data[3]] += 1
+        if code in (events.E_CMD_RESPONSE, events.E_CMD_STATUS, events.E_LE_META_EVENT,
+                    events.E_DISCONN_COMPLETE):
+            self._decodeEvent(data)
+
+    def _decodeEvent(self, data):
+        # data includes the packet type byte
+        try:
+            self.onEventReceived(bytes(data[1:]))
+        except (struct.error, IndexError, ValueError):
+            self.hciEvents['malformed'] += 1
+
+    def onCommandResponse(self, n_cmds, opcode, params):
+        sent = self.cmdSent.get(opcode)
+        if sent:
+            self.cmdLatency[opcode].add(self.now - sent.popleft())
+
+    def onCommandStatus(self, status, n_cmds, opcode):
+        # e.g. LE Create Connection: answered by a status, and completed
+        # (if at all) by some other event later
+        self.onCommandResponse(n_cmds, opcode, None)
+
+    def onAdvertisingReport(self, report):
+        info = self.advertisers.get(report.address)
+        if info is None:
+            info = self.advertisers[report.address] = AdvertiserInfo(report.address, report.address_type)
+        info.add(report)
+
+    def onMasterConnected(self, handle, peerAddrType, peerAddr):
+        self.connectionEvents['master'] += 1
+
+    def onSlaveConnected(self, handle, peerAddrType, peerAddr):
+        self.connectionEvents['slave'] += 1
+
+    def onConnectionFailed(self, status, peerAddrType, peerAddr):
+        self.connectionEvents['failed'] += 1
+
+    def onDisconnect(self, status, handle, reason):
+        self.connectionEvents['disconnect'] += 1
+        for d in (DIR_TX, DIR_RX):
+            self.fragments.pop(handle << 1 | d, None)
+            self.attPending.pop(handle << 1 | d, None)
+
+    # ACL / L2CAP / ATT -----------------
+
+    def onAclData(self, direction, ts, data):
+        (hnd_flags, fraglen) = ACL_HEADER.unpack_from(data, 1)
+        handle = hnd_flags & 0xFFF
+        self.throughput[(direction, ts // self.bucketUs)] += fraglen
+        if fraglen + 5 != len(data):
+            return
+        if (hnd_flags & hcipacket.FRAG_FLAGS) != hcipacket.FRAG_NEXT and fraglen >= 4:
+            (pktlen, cid) = ACL_HEADER.unpack_from(data, 5)
+            if pktlen + 4 == fraglen:
+                # Unfragmented: the usual case, so skip reassembly
+                self.onL2CAPPacket(handle, direction, cid, data[9:])
+                return
+        self._reassemble(handle, direction, hnd_flags, data[1:])
+
+    def _reassemble(self, handle, direction, hnd_flags, data):
+        # data is from the ACL header on. As hcipacket.ACLConnection
+        # does it, without its logging of every fragment.
+        key = handle << 1 | direction
+        if (hnd_flags & hcipacket.FRAG_FLAGS) == hcipacket.FRAG_NEXT:
+            frag = self.fragments.get(key)
+            if frag is None:
+                return # Continuation with no start
+            frag[1] += data[4:]
+            if len(frag[1]) >= frag[0]:
+                del self.fragments[key]
+                self.onL2CAPPacket(handle, direction, frag[2], bytes(frag[1][0:frag[0]]))
+            return
+        if len(data) < 8:
+            return
+        (pktlen, cid) = ACL_HEADER.unpack_from(data, 4)
+        if pktlen + 8 <= len(data):
+            self.fragments.pop(key, None)
+            self.onL2CAPPacket(handle, direction, cid, bytes(data[8:8+pktlen]))
+        else:
+            self.fragments[key] = [ pktlen, bytearray(data[8:]), cid ]
+
+    def onL2CAPPacket(self, handle, direction, cid, pdu):
+        self.l2capCids[(direction, cid)] += 1
+        if cid != gatt.CID_GATT or len(pdu) == 0:
+            return
+        opcode = pdu[0]
+        self.attOpcodes[(direction, opcode)] += 1
+        if opcode in ATT_TRANSACTIONS:
+            self.attPending[handle << 1 | direction] = (opcode, self.now)
+        elif opcode in ATT_ANSWERS or opcode == 0x01:
+            req = self.attPending.pop(handle << 1 | (1 - direction), None)
+            if req is not None:
+                self.attLatency[req[0]].add(self.now - req[1])
+                if opcode == 0x01 and len(pdu) >= 5:
+                    self.attErrors[(pdu[1], pdu[4])] += 1
+
+    # Reporting -------------------------
+
+    def summary(self):
+        span = ((self.lastTs - self.firstTs) / 1e6) if self.records else 0
+        return {
+            'records': self.records,
+            'bytes': self.bytes,
+            'seconds': span,
+            'packet_types': { "%s:%02X" % (DIR_NAMES[d], t) : n for ((d,t),n) in self.packetTypes.items() },
+            'hci_commands': { "%04X" % opc : n for (opc,n) in self.hciCommands.items() },
+            'hci_events': { str(code) : n for (code,n) in self.hciEvents.items() },
+            'le_events': { "%02X" % sub : n for (sub,n) in self.leEvents.items() },
+            'att_opcodes': { "%s:%s" % (DIR_NAMES[d], ATT_OPCODE_NAMES.get(opc, "%02X" % opc)) : n
+                                for ((d,opc),n) in self.attOpcodes.items() },
+            'att_errors': { "%s:%02X" % (ATT_OPCODE_NAMES.get(opc, "%02X" % opc), err) : n
+                                for ((opc,err),n) in self.attErrors.items() },
+            'att_latency_us': { ATT_OPCODE_NAMES.get(opc, "%02X" % opc) :
+                                    { 'count': h.count, 'mean': h.mean(),
+                                      'p50': h.percentile(50), 'p99': h.percentile(99) }
+                                for (opc,h) in self.attLatency.items() },
+            'advertisers': len(self.advertisers),
+            'connections': dict(self.connectionEvents),
+        }
+
+    def printReport(self, fp=sys.stdout):
+        s = self.summary()
+        fp.write("%d records, %d bytes, %.1f seconds\n" % (s['records'], s['bytes'], s['seconds']))
+        fp.write("\nHCI commands:\n")
+        for (opc, n) in sorted(self.hciCommands.items()):
+            h = self.cmdLatency.get(opc)
+            lat = (" mean %.0fus" % h.mean()) if h else ""
+            fp.write("  %04X %8d%s\n" % (opc, n, lat))
+        fp.write("\nHCI events:\n")
+        for (code, n) in sorted(self.hciEvents.items(), key=str):
+            fp.write("  %-9s %8d\n" % (code if isinstance(code, str) else "%02X" % code, n))
+        fp.write("\nATT opcodes:\n")
+        for ((d, opc), n) in sorted(self.attOpcodes.items()):
+            fp.write("  %s %-28s %8d\n" % (DIR_NAMES[d], ATT_OPCODE_NAMES.get(opc, "%02X" % opc), n))
+        fp.write("\nATT latency (us), by request:\n")
+        for (opc, h) in sorted(self.attLatency.items()):
+            fp.write("  %-28s n=%-8d mean=%-8.0f p50<=%-8d p99<=%d\n" % (
+                ATT_OPCODE_NAMES.get(opc, "%02X" % opc), h.count, h.mean(), h.percentile(50), h.percentile(99)))
+            for b in sorted(h.buckets):
+                fp.write("      < %8d : %d\n" % (1 << b, h.buckets[b]))
+        if self.attErrors:
+            fp.write("\nATT errors:\n")
+            for ((opc, err), n) in sorted(self.attErrors.items()):
+                fp.write("  %-28s 0x%02X %8d\n" % (ATT_OPCODE_NAMES.get(opc, "%02X" % opc), err, n))
+        fp.write("\nAdvertisers: %d\n" % len(self.advertisers))
+        for info in sorted(self.advertisers.values(), key=lambda i: -i.reports)[:20]:
+            fp.write("  %s %6d reports RSSI %d..%d %s\n" % (
+                ":".join("%02X" % b for b in reversed(info.address)), info.reports,
+                info.rssiMin, info.rssiMax, info.name or ""))
+        fp.write("\nACL throughput (bytes per %gs):\n" % (self.bucketUs / 1e6))
+        if self.throughput:
+            first = min(b for (d,b) in self.throughput)
+            for b in sorted(set(b for (d,b) in self.throughput)):
+                fp.write("  %6d  tx %10d  rx %10d\n" % (b-first,
+                    self.throughput.get((DIR_TX,b), 0), self.throughput.get((DIR_RX,b), 0)))
+
+
+if __name__ == '__main__':
+    # Usage: traceanalyzer.py file.btsnoop ...
+    # With no files, analyses generated captures both ways, with feed()
+    # for each record and with the fast path, checks they agree, and
+    # times both
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            t0 = time.perf_counter()
+            an = TraceAnalyzer().analyzeFile(path)
+            dt = time.perf_counter() - t0
+            an.printReport()
+            size = os.path.getsize(path)
+            print ("\n%s: %d bytes in %.2fs (%.1f MB/s, %.0f records/s)" % (path, size, dt,
+                size / dt / 1e6, an.records / dt))
+        sys.exit(0)
+
+    import random
+    import tempfile
+
+    def makeCapture(path, nRecords, bulk):
+        # A gateway polling 4 links while scanning 200 advertisers, with
+        # now and then a fragmented notification, a command, and a
+        # connection made and dropped; or (bulk) a link streaming
+        # notifications 244 bytes at a time
+        rnd = random.Random(1)
+        out = [ btsnoop.FILE_HEADER.pack(btsnoop.BTSNOOP_MAGIC, btsnoop.BTSNOOP_VERSION, btsnoop.DATALINK_H4) ]
+        now = [ 1700000000 * 1000000 ]
+        def record(data, received, dt=0):
+            now[0] += dt
+            out.append(btsnoop.RECORD_HEADER.pack(len(data), len(data), btsnoop.recordFlags(data, received), 0,
+                                                  now[0] + btsnoop.EPOCH_DELTA_US) + data)
+        def acl(hndFlags, frag):
+            return struct.pack("<BHH", HCI_ACL_DATA_PACKET, hndFlags, len(frag)) + frag
+        def l2cap(handle, pdu, cid=gatt.CID_GATT):
+            return acl(hcipacket.FRAG_FIRST | handle, struct.pack("<HH", len(pdu), cid) + pdu)
+        def event(code, params):
+            return struct.pack("<BBB", HCI_EVENT_PACKET, code, len(params)) + params
+        advertisers = [ bytes([i, 0, 0, 0xDD, 0xDD, 0xDD]) for i in range(200) ]
+        cycle = 0
+        while len(out) <= nRecords:
+            cycle += 1
+            handle = 0x40 + cycle % 4
+            if bulk:
+                record(l2cap(handle, struct.pack("<BH", 0x1B, 0x0010) + bytes(244)), True, 100)
+                if cycle % 4 == 0:
+                    record(event(events.E_NUM_COMPLETED_PACKETS, struct.pack("<BHH", 1, handle, 1)), True)
+                    record(l2cap(handle, b'\x52\x12\x00\x01'), False)
+                continue
+            record(l2cap(handle, b'\x0a\x03\x00'), False, 2000) # Read
+            record(event(events.E_NUM_COMPLETED_PACKETS, struct.pack("<BHH", 1, handle, 1)), True)
+            if cycle % 50 == 0:
+                record(l2cap(handle, b'\x01\x0a\x03\x00\x02'), True, rnd.randrange(100, 900)) # Error
+            else:
+                record(l2cap(handle, b'\x0b' + bytes(20)), True, rnd.randrange(100, 900))
+            record(l2cap(handle, b'\x1b\x05\x00' + bytes(16)), True)
+            name = b'Sensor %d' % (cycle % 7)
+            ad = b'\x02\x01\x06' + bytes([len(name) + 1, gap.GAP_NAME_COMPLETE]) + name
+            record(event(events.E_LE_META_EVENT, struct.pack("<BBBB6sB", events.E_LE_ADVERTISING_REPORT, 1, 0, 0,
+                advertisers[rnd.randrange(200)], len(ad)) + ad + bytes([256 - rnd.randrange(40, 90)])), True)
+            if cycle % 25 == 0:
+                # A 47 byte PDU in 27 byte fragments
+                pdu = struct.pack("<HH", 43, gatt.CID_GATT) + struct.pack("<BH", 0x1B, 0x0007) + bytes(40)
+                record(acl(hcipacket.FRAG_FIRST | handle, pdu[0:27]), True)
+                record(acl(hcipacket.FRAG_NEXT | handle, pdu[27:]), True)
+            if cycle % 40 == 0:
+                # Two pipelined commands, each answered 400us after it
+                # went, then a connection made and dropped
+                for dt in (0, 100):
+                    record(struct.pack("<BHBBB", HCI_COMMAND_PACKET, 0x200C, 2, 1, 0), False, dt)
+                for dt in (300, 100):
+                    record(event(events.E_CMD_RESPONSE, struct.pack("<BHB", 1, 0x200C, 0)), True, dt)
+                record(struct.pack("<BHB", HCI_COMMAND_PACKET, 0x200D, 25) + bytes(25), False)
+                record(event(events.E_CMD_STATUS, struct.pack("<BBH", 0, 1, 0x200D)), True, 200)
+                record(event(events.E_LE_META_EVENT, struct.pack("<BBHBB6sHHHB", events.E_LE_CONN_COMPLETE, 0,
+                    0x50, 0, 0, advertisers[0], 24, 0, 72, 0)), True, 5000)
+                record(l2cap(0x50, b'\x0a\x03\x00'), False)
+                record(event(events.E_DISCONN_COMPLETE, struct.pack("<BHB", 0, 0x50, 0x13)), True, 1000)
+        with open(path, "wb") as fp:
+            fp.write(b''.join(out))
+
+    def analyze(path, fast):
+        an = TraceAnalyzer()
+        t0 = time.process_time()
+        if fast:
+            an.analyzeFile(path)
+        else:
+            with btsnoop.BtSnoopReader(path) as rdr:
+                for (flags, ts, data) in rdr:
+                    an.feed(flags, ts, data)
+        return (an, time.process_time() - t0)
+
+    def census(an):
+        return sorted( (info.address, info.reports, info.rssiMin, info.rssiMax, info.rssiTotal, info.name)
+                       for info in an.advertisers.values() )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "capture.btsnoop")
+        for (label, bulk) in [ ("small packets", False), ("bulk notifications", True) ]:
+            makeCapture(path, 300000, bulk)
+            size = os.path.getsize(path)
+            (slow, slowTime) = analyze(path, False)
+            (fast, fastTime) = analyze(path, True)
+            assert fast.summary() == slow.summary(), "Summaries differ"
+            assert fast.throughput == slow.throughput and census(fast) == census(slow)
+            assert fast.l2capCids == slow.l2capCids
+            if not bulk:
+                assert fast.attErrors and fast.connectionEvents['disconnect'] > 0 and len(fast.advertisers) == 200
+                assert fast.cmdLatency[0x200C].mean() == 400 and fast.cmdLatency[0x200C].count == 2 * fast.hciCommands[0x200D]
+            print ("%-20s %5.1f MB, %d records: fast path %5.1f MB/s (%3.0fk records/s), per record %5.1f MB/s" % (
+                label, size / 1e6, fast.records, size / fastTime / 1e6, fast.records / fastTime / 1000,
+                size / slowTime / 1e6))
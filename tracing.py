@@ -0,0 +1,202 @@
+import json
+import time
+import collections
+
+# Tracing of received PDUs through the stack, to see where the time for
+# a slow response went. Each packet read from the socket gets a trace
+# ID, which follows it (and what's sent in reply) along the path:
+#
+#   socket     waiting to be read, until handed to the stack *
+#   dispatch   Device / Central.onPacketReceived
+#   acl        ACLConnection.onReceivedData
+#   fragments  first fragment to whole PDU, if fragmented *
+#   att        GattServer.onMessageReceived
+#   execute    the ATT command itself, e.g. Read's getValue
+#   send       ACLConnection.send: fragmenting and queueing
+#   queued     in the transmit queue *
+#   transmit   writing to the socket
+#
+# Those marked * overlap other PDUs' spans. Timestamps are monotonic
+# nanoseconds. Components take a Tracer with withTracer(), and without
+# one pay only a test for None at each point. Spans go to any number of
+# sinks: MemorySink keeps the most recent, ChromeTraceSink writes JSON
+# for chrome://tracing or Perfetto.
+
+if hasattr(time, 'monotonic_ns'):
+    monotonicNs = time.monotonic_ns
+else:
+    def monotonicNs():
+        return int(time.monotonic() * 1e9)
+
+# Spans which needn't nest inside the ones around them
+ASYNC_SPANS = frozenset(["socket", "fragments", "queued"])
+
+
+class Tracer:
+    def __init__(self, clock=monotonicNs):
+        self.now = clock
+        self.sinks = []
+        self.nextId = 1
+        self.current = None # Trace ID of the PDU being handled
+
+    def withSink(self, sink):
+        # sink.record(traceId, name, start, end, args)
+        self.sinks.append(sink)
+        return self
+
+    def begin(self):
+        '''Starts a new trace, as a packet is read; returns its ID'''
+        self.current = self.nextId
+        self.nextId += 1
+        return self.current
+
+    def end(self):
+        self.current = None
+
+    def tag(self, pkt):
+        # Marks an hcipacket.HCIPacket as queued now, for the current trace
+        pkt.traceId = self.current
+        pkt.queuedAt = self.now()
+
+    def sent(self, pkt, start):
+        # pkt was written to the socket between start and now
+        if pkt.traceId is not None:
+            self.span("queued", pkt.traceId, pkt.queuedAt, start)
+            self.span("transmit", pkt.traceId, start, self.now())
+
+    def span(self, name, traceId, start, end, args=None):
+        for s in self.sinks:
+            s.record(traceId, name, start, end, args)
+
+
+class MemorySink:
+    # The last capacity spans, as (traceId, name, start, end, args)
+
+    def __init__(self, capacity=10000):
+        self.spans = collections.deque(maxlen=capacity)
+
+    def record(self, traceId, name, start, end, args):
+        self.spans.append( (traceId, name, start, end, args) )
+
+    def trace(self, traceId):
+        '''Spans for one trace, in the order they ended'''
+        return [ s for s in self.spans if s[0] == traceId ]
+
+    def summary(self):
+        '''Maps span name to (count, mean ns, max ns)'''
+        totals = collections.OrderedDict()
+        for (_, name, start, end, _) in self.spans:
+            (n, total, most) = totals.get(name, (0, 0, 0))
+            totals[name] = (n + 1, total + end - start, max(most, end - start))
+        return collections.OrderedDict( (name, (n, total / n, most))
+                                        for (name, (n, total, most)) in totals.items() )
+
+
+class ChromeTraceSink:
+    # Collects Trace Event Format events; close() writes them to path
+
+    def __init__(self, path, pid=1):
+        self.path = path
+        self.pid = pid
+        self.events = []
+
+    def record(self, traceId, name, start, end, args):
+        a = { 'id': traceId }
+        if args:
+            a.update(args)
+        if name in ASYNC_SPANS:
+            # Async begin / end pairs, matched by name and id
+            base = { 'name': name, 'cat': 'ble', 'id': traceId, 'pid': self.pid, 'tid': 1 }
+            self.events.append(dict(base, ph='b', ts=start / 1000.0, args=a))
+            self.events.append(dict(base, ph='e', ts=end / 1000.0))
+        else:
+            self.events.append({ 'name': name, 'cat': 'ble', 'ph': 'X', 'ts': start / 1000.0,
+                                 'dur': (end - start) / 1000.0, 'pid': self.pid, 'tid': 1, 'args': a })
+
+    def close(self):
+        with open(self.path, "w") as fp:
+            json.dump({ 'traceEvents': self.events, 'displayTimeUnit': 'ns' }, fp)
+
+
+if __name__ == '__main__':
+    # A remote central reading from a Device on the virtual controller:
+    # time per read untraced and traced, where the time goes, and a
+    # Chrome trace of the run
+    import io
+    import os
+    import sys
+    import struct
+    import tempfile
+    import device
+    from hcisocket_virtual import VirtualController, VirtualHCISocket, VirtualCentral
+
+    READS = 2000
+
+    def readLoad(tracer):
+        ctlr = VirtualController()
+        dev = device.Device().withSocket( VirtualHCISocket(ctlr) )
+        if tracer is not None:
+            dev.withTracer(tracer)
+        state = { 'left': READS }
+
+        def onAtt(central, pdu):
+            state['left'] -= 1
+            if state['left'] > 0:
+                peer.sendAtt(struct.pack("<BH", 0x0A, 0x0003))
+        saved = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            dev.start()
+            peer = VirtualCentral(ctlr).withAttCallback(onAtt)
+            peer.connect()
+            dev.run()
+            t0 = time.process_time()
+            peer.sendAtt(struct.pack("<BH", 0x0A, 0x0003))
+            dev.run()
+            t = time.process_time() - t0
+        finally:
+            sys.stdout = saved
+        assert state['left'] == 0
+        return t / READS
+
+    bare = min(readLoad(None) for i in range(3))
+    memory = MemorySink(100000)
+    path = os.path.join(tempfile.mkdtemp(), "trace.json")
+    chrome = ChromeTraceSink(path)
+    traced = readLoad(Tracer().withSink(memory).withSink(chrome))
+    chrome.close()
+    print ("Per read: %.1fus untraced, %.1fus traced" % (bare * 1e6, traced * 1e6))
+
+    summary = memory.summary()
+    for name in ["socket", "dispatch", "acl", "att", "execute", "send", "queued", "transmit"]:
+        (n, mean, most) = summary[name]
+        print ("  %-9s %5d spans, mean %7.1fus, max %7.1fus" % (name, n, mean / 1000.0, most / 1000.0))
+    # One read, start to finish, under one ID
+    last = [ s for s in memory.spans if s[1] == "transmit" ][-1][0]
+    names = [ s[1] for s in memory.trace(last) ]
+    assert names == ["socket", "execute", "send", "att", "acl", "dispatch", "queued", "transmit"], names
+    with open(path) as fp:
+        events = json.load(fp)['traceEvents']
+    print ("Chrome trace: %d events, %d bytes" % (len(events), os.path.getsize(path)))
+
+    # A write arriving in two fragments: traced from the first, and the
+    # response keeps its ID
+    memory = MemorySink()
+    ctlr = VirtualController()
+    dev = device.Device().withSocket( VirtualHCISocket(ctlr) ).withTracer(Tracer().withSink(memory))
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        dev.start()
+        peer = VirtualCentral(ctlr)
+        peer.connect()
+        dev.run()
+        peer.sendAtt(struct.pack("<BH", 0x12, 0x0005) + bytes(30))
+        dev.run()
+    finally:
+        sys.stdout = saved
+    (first, name, start, end, _) = [ s for s in memory.spans if s[1] == "fragments" ][-1]
+    names = [ s[1] for s in memory.trace(first) ]
+    assert names[0] == "socket" and "att" in names and names[-1] == "transmit", names
+    print ("Fragmented write: reassembled in %.1fus, reply traced under the first fragment's ID" % (
+        (end - start) / 1000.0))
@@ -0,0 +1,304 @@
+import struct
+import collections
+
+import hcipacket
+from hcipacket import HCI_COMMAND_PACKET, HCI_ACL_DATA_PACKET
+
+# Transmit scheduling for HCI sockets. Packets are sorted into classes:
+# commands and ATT responses go out in strict priority order; the rest
+# share what's left by weighted round robin. Each ACL PDU is kept
+# together, so fragments for one handle are never interleaved.
+
+CLASS_COMMAND = 0
+CLASS_ATT_RESPONSE = 1   # Also confirmations
+CLASS_INDICATION = 2
+CLASS_NOTIFICATION = 3
+CLASS_BULK = 4           # Everything else: ATT requests, other L2CAP
+CLASS_NAMES = ["command", "att_response", "indication", "notification", "bulk"]
+
+STRICT_CLASSES = [CLASS_COMMAND, CLASS_ATT_RESPONSE]
+WEIGHTED_CLASSES = [CLASS_INDICATION, CLASS_NOTIFICATION, CLASS_BULK]
+
+DEFAULT_WEIGHTS = { CLASS_INDICATION: 4, CLASS_NOTIFICATION: 2, CLASS_BULK: 1 }
+
+# Max PDUs queued per class; None for no limit
+DEFAULT_LIMITS = { CLASS_COMMAND: None, CLASS_ATT_RESPONSE: None,
+    CLASS_INDICATION: 64, CLASS_NOTIFICATION: 256, CLASS_BULK: 1024 }
+
+CID_ATT = 0x04 # Same as gatt.CID_GATT
+
+ATT_ERROR_RSP = 0x01
+ATT_NOTIFICATION = 0x1B
+ATT_INDICATION = 0x1D
+ATT_CONFIRMATION = 0x1E
+
+def classifyAttOpcode(opcode):
+    if opcode == ATT_NOTIFICATION:
+        return CLASS_NOTIFICATION
+    if opcode == ATT_INDICATION:
+        return CLASS_INDICATION
+    if opcode == ATT_CONFIRMATION or opcode == ATT_ERROR_RSP:
+        return CLASS_ATT_RESPONSE
+    if opcode < 0x1A and (opcode & 1) == 1:
+        return CLASS_ATT_RESPONSE # Vol 3 / F / 3.4.8: responses are odd
+    return CLASS_BULK
+
+def classifyPacket(packet):
+    if packet.packetType == HCI_COMMAND_PACKET:
+        return CLASS_COMMAND
+    payload = packet.payload
+    if packet.packetType == HCI_ACL_DATA_PACKET and len(payload) >= 9:
+        cid = payload[6] | (payload[7] << 8)
+        if cid == CID_ATT:
+            return classifyAttOpcode(payload[8])
+    return CLASS_BULK
+
+
+# Marks a handle whose current PDU was dropped, so its fragments are too
+DROPPED = object()
+
+
+class PDUEntry:
+    # One command, or the ACL fragments of one L2CAP PDU
+
+    def __init__(self, txClass, packet, handle=None):
+        self.txClass = txClass
+        self.handle = handle # ACL handle, or None for a command
+        self.packets = [ packet ]
+        self.pos = 0
+        self.remaining = 0 # ACL bytes still to come
+        if ( packet.packetType == HCI_ACL_DATA_PACKET and len(packet.payload) >= 8
+               and (packet.payload[1] << 8) & hcipacket.FRAG_FLAGS != hcipacket.FRAG_NEXT ):
+            (fraglen, pktlen) = struct.unpack("<HH", packet.payload[2:6])
+            self.remaining = max(0, pktlen + 4 - fraglen)
+
+    def addFragment(self, packet):
+        self.packets.append(packet)
+        self.remaining = max(0, self.remaining - (len(packet.payload) - 4))
+
+    def isComplete(self):
+        return self.remaining == 0
+
+
+class TransmitScheduler:
+    def __init__(self, weights=None, limits=None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.queues = [ collections.deque() for c in CLASS_NAMES ]
+        self.openEntries = {}   # Maps ACL handle to entry still taking fragments
+        self.current = None     # ACL entry being sent
+        self.deficit = { c: 0 for c in WEIGHTED_CLASSES }
+        self.drrIndex = 0
+        self.packetCount = 0
+        self.drops = [ 0 for c in CLASS_NAMES ]
+        self.sent = [ 0 for c in CLASS_NAMES ]
+        self.aclBuffers = None  # Controller's ACL buffer count, if known
+        self.aclCredits = None  # None means don't flow-control ACL data
+        self.inFlight = collections.Counter() # Maps handle to ACL packets not yet completed
+
+    # Queueing ------------------------------
+
+    def push(self, packet, txClass=None):
+        '''Returns False if the packet was dropped because its class is full'''
+        if packet.packetType == HCI_ACL_DATA_PACKET:
+            hnd_flags = packet.payload[0] | (packet.payload[1] << 8)
+            handle = hnd_flags & 0xFFF
+            if (hnd_flags & hcipacket.FRAG_FLAGS) == hcipacket.FRAG_NEXT:
+                entry = self.openEntries.get(handle)
+                if entry is not None:
+                    if entry is DROPPED:
+                        return False
+                    entry.addFragment(packet)
+                    self.packetCount += 1
+                    if entry.isComplete():
+                        del self.openEntries[handle]
+                    return True
+        else:
+            handle = None
+
+        if txClass is None:
+            txClass = classifyPacket(packet)
+        limit = self.limits[txClass]
+        if (limit is not None) and len(self.queues[txClass]) >= limit:
+            self.drops[txClass] += 1
+            if handle is not None:
+                self.openEntries[handle] = DROPPED
+            return False
+        entry = PDUEntry(txClass, packet, handle)
+        if handle is not None:
+            if entry.isComplete():
+                self.openEntries.pop(handle, None)
+            else:
+                self.openEntries[handle] = entry
+        self.queues[txClass].append(entry)
+        self.packetCount += 1
+        return True
+
+    def __len__(self):
+        return self.packetCount
+
+    def depth(self, txClass):
+        return len(self.queues[txClass])
+
+    # ACL flow control ----------------------
+
+    def setAclBuffers(self, count):
+        # From LE Read Buffer Size; enables flow control of ACL data
+        self.aclBuffers = count
+        self.aclCredits = count
+
+    def onPacketsCompleted(self, count, handle=None):
+        # From Number Of Completed Packets events
+        if handle is not None:
+            left = self.inFlight[handle] - count
+            if left > 0:
+                self.inFlight[handle] = left
+            else:
+                del self.inFlight[handle]
+        if self.aclCredits is not None:
+            self.aclCredits = min(self.aclCredits + count, self.aclBuffers)
+
+    def onDisconnected(self, handle):
+        # The controller has flushed the link's packets, and won't report
+        # them completed (Vol 2 / E / 4.3): their buffers are free again.
+        # Anything still queued for it can't be sent.
+        self.onPacketsCompleted(self.inFlight.get(handle, 0), handle)
+        self.openEntries.pop(handle, None)
+        if self.current is not None and self.current.handle == handle:
+            self.packetCount -= len(self.current.packets) - self.current.pos
+            self.current = None
+        for c in range(CLASS_COMMAND + 1, len(CLASS_NAMES)):
+            q = self.queues[c]
+            if any(e.handle == handle for e in q):
+                kept = [ e for e in q if e.handle != handle ]
+                self.packetCount -= sum(len(e.packets) for e in q if e.handle == handle)
+                q.clear()
+                q.extend(kept)
+
+    def _aclAllowed(self):
+        return (self.aclCredits is None) or self.aclCredits > 0
+
+    # Dequeueing ----------------------------
+
+    def ready(self):
+        '''True if pop() would return a packet now'''
+        if len(self.queues[CLASS_COMMAND]) > 0:
+            return True
+        if self.packetCount == 0 or not self._aclAllowed():
+            return False
+        if self.current is not None:
+            return self.current.pos < len(self.current.packets)
+        return True
+
+    def pop(self):
+        # Commands may go between fragments of an ACL PDU, and don't use
+        # up ACL credits
+        cmdq = self.queues[CLASS_COMMAND]
+        if len(cmdq) > 0:
+            self.packetCount -= 1
+            self.sent[CLASS_COMMAND] += 1
+            return cmdq.popleft().packets[0]
+        if not self._aclAllowed():
+            return None
+        if self.current is None:
+            self.current = self._nextEntry()
+            if self.current is None:
+                return None
+        entry = self.current
+        if entry.pos >= len(entry.packets):
+            return None # Waiting for the rest of this PDU to be queued
+        pkt = entry.packets[entry.pos]
+        entry.pos += 1
+        if entry.pos >= len(entry.packets) and entry.isComplete():
+            self.current = None
+        self.packetCount -= 1
+        self.sent[entry.txClass] += 1
+        if pkt.packetType == HCI_ACL_DATA_PACKET:
+            self.inFlight[entry.handle] += 1
+            if self.aclCredits is not None:
+                self.aclCredits -= 1
+        return pkt
+
+    def _nextEntry(self):
+        for c in STRICT_CLASSES[1:]:
+            if len(self.queues[c]) > 0:
+                return self.queues[c].popleft()
+        # Deficit round robin between the weighted classes, counted in PDUs
+        n = len(WEIGHTED_CLASSES)
+        for i in range(n+1):
+            c = WEIGHTED_CLASSES[self.drrIndex]
+            q = self.queues[c]
+            if len(q) == 0:
+                self.deficit[c] = 0
+            elif self.deficit[c] > 0:
+                self.deficit[c] -= 1
+                return q.popleft()
+            self.drrIndex = (self.drrIndex + 1) % n
+            nc = WEIGHTED_CLASSES[self.drrIndex]
+            self.deficit[nc] += self.weights[nc]
+        return None
+
+    def stats(self):
+        return { CLASS_NAMES[c] : { 'queued': len(self.queues[c]), 'sent': self.sent[c],
+                                    'dropped': self.drops[c] }
+                 for c in range(len(CLASS_NAMES)) }
+
+
+if __name__ == '__main__':
+    # A disconnect queued behind a notification flood goes straight out,
+    # and fragments of one PDU stay together
+    def acl(handle, cid, data, fragLen=27):
+        pdu = struct.pack("<HH", len(data), cid) + data
+        flags = hcipacket.FRAG_FIRST_HOST
+        pkts = []
+        for pos in range(0, len(pdu), fragLen):
+            frag = pdu[pos:pos+fragLen]
+            pkts.append(hcipacket.HCIPacket(HCI_ACL_DATA_PACKET,
+                struct.pack("<HH", flags | handle, len(frag)) + frag))
+            flags = hcipacket.FRAG_NEXT
+        return pkts
+
+    ts = TransmitScheduler()
+    for i in range(300):
+        for p in acl(0x40, CID_ATT, struct.pack("<BH", ATT_NOTIFICATION, 0x0E) + bytes(40)):
+            ts.push(p)
+    ts.push(hcipacket.HCIPacket(HCI_ACL_DATA_PACKET, acl(0x40, CID_ATT, b'\x0b' + bytes(10))[0].payload))
+    ts.push(hcipacket.HCIPacket(HCI_COMMAND_PACKET, b'\x06\x04\x03\x40\x00\x13'))
+    first = ts.pop()
+    second = ts.pop()
+    print ("First out: %s" % first)
+    print ("Second out: %s" % second)
+    assert first.packetType == HCI_COMMAND_PACKET
+    assert second.payload[8] == 0x0b
+    while ts.pop() is not None:
+        pass
+    print (ts.stats())
+
+    # A link going with packets in flight and queued: the buffers come
+    # back, and its queue is emptied
+    ts = TransmitScheduler()
+    ts.setAclBuffers(4)
+    for i in range(3):
+        for p in acl(0x41, CID_ATT, b'\x0b' + bytes(40)) + acl(0x42, CID_ATT, b'\x0b' + bytes(10)):
+            ts.push(p)
+    while ts.pop() is not None:
+        pass
+    ts.onPacketsCompleted(1, 0x41)
+    while ts.pop() is not None:
+        pass
+    assert ts.aclCredits == 0 and ts.inFlight[0x41] == 3 and ts.inFlight[0x42] == 1, (ts.aclCredits, ts.inFlight)
+    ts.onDisconnected(0x41)
+    credits = ts.aclCredits
+    assert credits == 3 and 0x41 not in ts.inFlight
+    out = []
+    while True:
+        p = ts.pop()
+        if p is None:
+            break
+        out.append(p.getAclChannel())
+    assert out == [0x42, 0x42] and len(ts) == 0, (out, len(ts))
+    print ("Disconnect with 3 packets in flight: credits back to %d, other link's 2 PDUs still sent" % credits)